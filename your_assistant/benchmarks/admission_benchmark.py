@@ -0,0 +1,100 @@
+"""Load test the admission control of a backend under overload: without it, every
+request queues up behind the busy backend; with it, the requests beyond the queue
+are rejected at once and the admitted ones keep a stable latency.
+Run this benchmark with command: python -m your_assistant.benchmarks.admission_benchmark
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from your_assistant.core.admission import AdmissionPool, Rejected
+from your_assistant.core.metrics import _percentile
+
+
+class SlowBackend:
+    """A backend that serves a fixed number of requests at a time, each in a fixed
+    time, like an LLM with a rate limit. The requests beyond wait for a slot."""
+
+    def __init__(self, capacity: int, service_time: float):
+        self.service_time = service_time
+        self._slots = threading.Semaphore(capacity)
+
+    def serve(self) -> None:
+        with self._slots:
+            time.sleep(self.service_time)
+
+
+def run_load(
+    backend: SlowBackend,
+    pool: Optional[AdmissionPool],
+    rate: float,
+    duration: float,
+    timeout: float,
+) -> None:
+    """Send the requests at a fixed rate, whether or not the previous ones are
+    served, like the clients of a service do."""
+    latencies: List[float] = []
+    num_rejected = 0
+    lock = threading.Lock()
+
+    def request() -> None:
+        nonlocal num_rejected
+        start = time.perf_counter()
+        try:
+            if pool is None:
+                backend.serve()
+            else:
+                with pool.admit(timeout=timeout):
+                    backend.serve()
+        except Rejected:
+            with lock:
+                num_rejected += 1
+            return
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    num_requests = int(rate * duration)
+    with ThreadPoolExecutor(max_workers=num_requests) as executor:
+        start = time.perf_counter()
+        for idx in range(num_requests):
+            time.sleep(max(0.0, start + idx / rate - time.perf_counter()))
+            executor.submit(request)
+    late = sum(1 for latency in latencies if latency > timeout)
+    p50 = _percentile(latencies, 50) or 0.0
+    p99 = _percentile(latencies, 99) or 0.0
+    print(
+        f"{'admission' if pool else 'no admission':>12}: "
+        + f"{len(latencies):4d} served ({late:4d} past deadline), "
+        + f"{num_rejected:4d} rejected, "
+        + f"p50 {p50 * 1000:7.1f} ms, p99 {p99 * 1000:7.1f} ms"
+    )
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Admission control benchmark")
+    parser.add_argument("--capacity", default=4, type=int)
+    parser.add_argument("--service-time", default=0.05, type=float)
+    parser.add_argument("--duration", default=3.0, type=float)
+    parser.add_argument("--timeout", default=1.0, type=float)
+    parser.add_argument("--queue-size", default=8, type=int)
+    args = parser.parse_args()
+    throughput = args.capacity / args.service_time
+    for load in [0.5, 1.0, 2.0, 4.0]:
+        print(f"Offered load {load:.1f}x ({throughput * load:.0f} requests/s)")
+        for use_admission in [False, True]:
+            backend = SlowBackend(args.capacity, args.service_time)
+            pool = None
+            if use_admission:
+                pool = AdmissionPool(
+                    name="Benchmark",
+                    limit=args.capacity,
+                    queue_size=args.queue_size,
+                    service_time=args.service_time,
+                )
+            run_load(backend, pool, throughput * load, args.duration, args.timeout)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,238 @@
+"""Benchmark per-call client setup against pooled clients and a cached model.
+
+The ChatGPT and PaLM wrappers are called for real, against the fake LLM service.
+RevChatGPT and RevBard only talk to their own endpoints, so their client pool is
+measured with stand-in clients of a stand-in server.
+Run this benchmark with command: python -m your_assistant.benchmarks.llm_client_benchmark
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List
+
+import aiohttp
+import openai
+import requests
+from werkzeug.serving import make_server
+
+import your_assistant.core.llm as llm_lib
+import your_assistant.server.fake_llm_service as fake_llm_service
+from your_assistant.core.llm import CachedValue, ClientPool
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """A local stand-in for an LLM backend, with a fixed latency per endpoint."""
+
+    protocol_version = "HTTP/1.1"
+    latencies = {"/session": 0.03, "/models": 0.02, "/generate": 0.01}
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latencies.get(self.path, 0))
+        body: Dict[str, Any] = {"result": "ok"}
+        if self.path == "/models":
+            body = {"models": [{"name": "models/text-bison-001"}]}
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class StandInClient:
+    """A client that opens an authenticated session when created, like the
+    reverse-engineered chatbots do."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.session = requests.Session()
+        self.session.post(f"{base_url}/session", json={})
+
+    def list_models(self) -> str:
+        response = self.session.post(f"{self.base_url}/models", json={})
+        return response.json()["models"][0]["name"]
+
+    def generate(self, model: str, prompt: str) -> str:
+        response = self.session.post(
+            f"{self.base_url}/generate", json={"model": model, "prompt": prompt}
+        )
+        return response.json()["result"]
+
+
+def run_calls(
+    name: str, call: Callable[[str], str], num_calls: int, concurrency: int
+) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, [f"prompt {idx}" for idx in range(num_calls)]))
+    elapsed = time.perf_counter() - start
+    per_call = elapsed / num_calls * 1000
+    print(
+        f"{name:>26}: {elapsed * 1000:9.1f} ms total, "
+        + f"{per_call:7.2f} ms/call (concurrency {concurrency})"
+    )
+    return per_call
+
+
+def run_async_calls(
+    name: str, call: Callable[[str], Any], num_calls: int, concurrency: int
+) -> float:
+    async def run_all() -> None:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_one(prompt: str) -> None:
+            async with semaphore:
+                await call(prompt)
+
+        await asyncio.gather(*[run_one(f"prompt {idx}") for idx in range(num_calls)])
+        await llm_lib.aclose_clients()
+
+    start = time.perf_counter()
+    asyncio.run(run_all())
+    elapsed = time.perf_counter() - start
+    per_call = elapsed / num_calls * 1000
+    print(
+        f"{name:>26}: {elapsed * 1000:9.1f} ms total, "
+        + f"{per_call:7.2f} ms/call (concurrency {concurrency})"
+    )
+    return per_call
+
+
+def start_fake_llm_service(latency_ms: float) -> Any:
+    """Serve the fake LLM service in a thread, with a constant latency."""
+    parser = argparse.ArgumentParser()
+    fake_llm_service.add_arguments_to_parser(parser)
+    fake_args = parser.parse_args(
+        [
+            "--port",
+            "0",
+            "--latency-distribution",
+            "constant",
+            "--latency-mean-ms",
+            str(latency_ms),
+            "--token-interval-ms",
+            "0",
+            "--response-tokens",
+            "20",
+        ]
+    )
+    server = make_server(
+        "127.0.0.1", 0, fake_llm_service.create_app(fake_args), threaded=True
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_real_wrappers(num_calls: int, concurrencies: List[int]) -> None:
+    """Call the ChatGPT and PaLM wrappers against the fake LLM service."""
+    server = start_fake_llm_service(latency_ms=10)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    os.environ["OPENAI_API_KEY"] = os.environ["PALM_API_KEY"] = "fake"
+    openai.api_key = "fake"
+    llm_lib.set_api_base(f"{base_url}/v1")
+    # The PaLM model is configured, so that it is not resolved with the real API.
+    llm_lib.PALM_API_BASE = f"{base_url}/v1beta2"
+    chatgpt = llm_lib.ChatGPT()
+    palm_llm = llm_lib.PaLM(model="models/text-bison-001")
+
+    async def chatgpt_new_session(prompt: str) -> str:
+        # What each async call did before: open a session of its own.
+        async with aiohttp.ClientSession() as session:
+            openai.aiosession.set(session)
+            response = await openai.ChatCompletion.acreate(
+                model=chatgpt.model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=chatgpt.max_tokens,
+            )
+        return response.choices[0].message.content  # type: ignore
+
+    try:
+        print("Real wrappers against the fake LLM service (10 ms per call):")
+        for concurrency in concurrencies:
+            run_calls("ChatGPT sync", chatgpt, num_calls, concurrency)
+            baseline = run_async_calls(
+                "ChatGPT async, new session",
+                chatgpt_new_session,
+                num_calls,
+                concurrency,
+            )
+            pooled = run_async_calls(
+                "ChatGPT async, shared",
+                lambda prompt: llm_lib.acomplete(chatgpt, prompt),
+                num_calls,
+                concurrency,
+            )
+            print(f"{'saved per call':>26}: {baseline - pooled:7.2f} ms")
+            run_async_calls(
+                "PaLM async, shared",
+                lambda prompt: llm_lib.acomplete(palm_llm, prompt),
+                num_calls,
+                concurrency,
+            )
+    finally:
+        server.shutdown()
+
+
+def run():
+    parser = argparse.ArgumentParser(description="LLM client benchmark")
+    parser.add_argument("--num-calls", default=200, type=int)
+    parser.add_argument("--concurrency", default=4, type=int)
+    args = parser.parse_args()
+    # Leave out the log line of each request.
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    concurrencies = sorted({1, args.concurrency})
+    run_real_wrappers(args.num_calls, concurrencies)
+
+    print("Stand-in reverse-engineered clients (30 ms login, 20 ms models):")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def fresh_client_call(prompt: str) -> str:
+        client = StandInClient(base_url)
+        return client.generate(client.list_models(), prompt)
+
+    pool = ClientPool(lambda: StandInClient(base_url), max_size=args.concurrency)
+
+    def resolve_model() -> str:
+        with pool.acquire() as client:
+            return client.list_models()
+
+    model = CachedValue(resolve_model, ttl_seconds=3600)
+
+    def pooled_client_call(prompt: str) -> str:
+        resolved_model = model.get()
+        with pool.acquire() as client:
+            return client.generate(resolved_model, prompt)
+
+    try:
+        for concurrency in concurrencies:
+            baseline = run_calls(
+                "new client + list models",
+                fresh_client_call,
+                args.num_calls,
+                concurrency,
+            )
+            pooled = run_calls(
+                "pooled client + cached model",
+                pooled_client_call,
+                args.num_calls,
+                concurrency,
+            )
+            print(f"{'saved per call':>26}: {baseline - pooled:7.2f} ms")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    run()
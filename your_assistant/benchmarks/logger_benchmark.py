@@ -0,0 +1,128 @@
+"""Benchmark the per-call overhead of the logger, before and after dropping
+inspect.stack, with and without the queue handler.
+Run this benchmark with command: python -m your_assistant.benchmarks.logger_benchmark
+"""
+import argparse
+import inspect
+import logging
+import os
+import time
+from typing import Any, Callable
+
+from colorama import Fore
+
+import your_assistant.core.utils as utils
+
+
+class LegacyLogger:
+    """The logger before, which inspected the stack on every call and added a
+    handler on every construction."""
+
+    def __init__(self, logger_name: str, stream: Any):
+        self.logger = logging.getLogger(logger_name)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        console_handler = logging.StreamHandler(stream)
+        console_handler.setFormatter(
+            logging.Formatter(
+                "%(asctime)s %(levelname)s %(name)s %(message)s "
+                + "(%(filename)s:%(lineno)d)"
+            )
+        )
+        self.logger.addHandler(console_handler)
+
+    def info(self, message: str) -> None:
+        caller_frame = inspect.stack()[1]
+        caller_name = caller_frame[3]
+        caller_line = caller_frame[2]
+        self.logger.info(
+            Fore.CYAN + f"({caller_name} L{caller_line}): {message}" + Fore.RESET
+        )
+
+
+class SlowStream:
+    """A console that takes a while to write each line, e.g. a busy terminal."""
+
+    def __init__(self, delay: float = 0.0002):
+        self.delay = delay
+
+    def write(self, text: str) -> None:
+        time.sleep(self.delay)
+
+    def flush(self) -> None:
+        pass
+
+
+def new_logger(logger_name: str, stream: Any, use_queue: bool) -> utils.Logger:
+    """A logger writing to the stream, instead of the shared console handler."""
+    logger = utils.Logger(logger_name)
+    logger.logger.handlers = [
+        utils._create_log_handler(stream=stream, use_queue=use_queue)
+    ]
+    logger.logger.propagate = False
+    return logger
+
+
+def measure(name: str, log: Callable[[int], None], num_calls: int) -> None:
+    start = time.perf_counter()
+    for idx in range(num_calls):
+        log(idx)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>40}: {elapsed / num_calls * 1e6:9.1f} us/call")
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Logger benchmark")
+    parser.add_argument("--num-calls", default=2000, type=int)
+    args = parser.parse_args()
+    # The legacy logger is slow, so it is measured on fewer calls.
+    num_legacy_calls = max(args.num_calls // 10, 1)
+    with open(os.devnull, "w") as devnull:
+        legacy = LegacyLogger("LegacyBench", stream=devnull)
+        measure(
+            "inspect.stack (before)",
+            lambda idx: legacy.info(f"Indexing batch {idx}."),
+            num_legacy_calls,
+        )
+        # Every construction of the legacy logger added one more handler.
+        for _ in range(9):
+            legacy = LegacyLogger("LegacyBench", stream=devnull)
+        measure(
+            "inspect.stack, 10 constructions (before)",
+            lambda idx: legacy.info(f"Indexing batch {idx}."),
+            num_legacy_calls,
+        )
+        logger = new_logger("SyncBench", stream=devnull, use_queue=False)
+        measure(
+            "stacklevel (after)",
+            lambda idx: logger.info("Indexing batch %d.", idx),
+            args.num_calls,
+        )
+        async_logger = new_logger("AsyncBench", stream=devnull, use_queue=True)
+        measure(
+            "stacklevel, queue handler (after)",
+            lambda idx: async_logger.info("Indexing batch %d.", idx),
+            args.num_calls,
+        )
+        # Wait for the queued records to be written before closing the stream.
+        for handler in async_logger.logger.handlers:
+            handler.close()
+        for use_queue in [False, True]:
+            slow_logger = new_logger(
+                f"SlowBench{use_queue}", stream=SlowStream(), use_queue=use_queue
+            )
+            measure(
+                f"slow console, {'queue' if use_queue else 'sync'} handler (after)",
+                lambda idx: slow_logger.info("Indexing batch %d.", idx),
+                args.num_calls,
+            )
+        quiet_logger = utils.Logger("QuietBench", verbose=False)
+        measure(
+            "not verbose (after)",
+            lambda idx: quiet_logger.info("Indexing batch %d.", idx),
+            args.num_calls,
+        )
+
+
+if __name__ == "__main__":
+    run()
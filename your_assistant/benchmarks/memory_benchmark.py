@@ -0,0 +1,74 @@
+"""Benchmark the token accounting of the conversation memories.
+Run this benchmark with command: python -m your_assistant.benchmarks.memory_benchmark
+"""
+import argparse
+import time
+from typing import List, Optional, Type
+
+from langchain.llms.base import LLM
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain.schema import BaseMessage, get_buffer_string
+
+from your_assistant.core.memory import IncrementalSummaryBufferMemory
+
+
+class WordCountLLM(LLM):
+    """An instant summarizer whose tokenizer counts the words it is given."""
+
+    num_counted_words: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "WordCountLLM"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        return "The user and the AI talked about many things."
+
+    def get_num_tokens(self, text: str) -> int:
+        num_words = len(text.split())
+        self.num_counted_words += num_words
+        return num_words
+
+    def get_num_tokens_from_messages(self, messages: List[BaseMessage]) -> int:
+        return self.get_num_tokens(get_buffer_string(messages))
+
+
+def run_conversation(
+    memory_type: Type[ConversationSummaryBufferMemory],
+    num_turns: int,
+    max_token_limit: int,
+) -> None:
+    llm = WordCountLLM()
+    memory = memory_type(llm=llm, max_token_limit=max_token_limit)
+    question = "Could you tell me more about the topic number {} please?"
+    answer = "Sure, here is a fairly long answer about the topic number {0}. " * 3
+    start = time.perf_counter()
+    for idx in range(num_turns):
+        memory.save_context({"user": question.format(idx)}, {"AI": answer.format(idx)})
+    elapsed = time.perf_counter() - start
+    print(
+        f"{memory_type.__name__:>34}: {elapsed * 1000:9.1f} ms total, "
+        + f"{elapsed / num_turns * 1e6:8.1f} us/turn, "
+        + f"{llm.num_counted_words:>10} words tokenized"
+    )
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Memory benchmark")
+    parser.add_argument("--num-turns", default=1000, type=int)
+    args = parser.parse_args()
+    for max_token_limit in [300, 2000, 8000]:
+        print(f"{args.num_turns} turns, max token limit {max_token_limit}:")
+        for memory_type in [
+            ConversationSummaryBufferMemory,
+            IncrementalSummaryBufferMemory,
+        ]:
+            run_conversation(
+                memory_type=memory_type,
+                num_turns=args.num_turns,
+                max_token_limit=max_token_limit,
+            )
+
+
+if __name__ == "__main__":
+    run()
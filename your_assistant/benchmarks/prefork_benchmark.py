@@ -0,0 +1,184 @@
+"""Benchmark the memory and the throughput of the pre-fork server, with the index
+preloaded once before the fork or loaded by each worker after it, as the workers
+grow. The memory is the sum over the server processes of their resident memory
+(RSS), which counts the shared pages once per process, and of their proportional
+share of it (PSS), which counts them once in all.
+Run this benchmark with command: python -m your_assistant.benchmarks.prefork_benchmark
+"""
+import argparse
+import logging
+import os
+import signal
+import tempfile
+import threading
+import time
+import urllib.request
+from typing import Dict, List, Optional
+
+import faiss
+import numpy as np
+from flask import Flask
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.embeddings import FakeEmbeddings
+from langchain.vectorstores import FAISS
+
+import your_assistant.core.responder as responder
+from your_assistant.core.indexer import MetadataIndex
+from your_assistant.core.metrics import _percentile
+from your_assistant.server.prefork import PreforkServer
+
+
+def build_index(db_name: str, num_docs: int, dim: int) -> None:
+    """Save an index of random embeddings, like the one of a db of PDF pages."""
+    vectors = np.random.default_rng(0).random((num_docs, dim), dtype=np.float32)
+    index = faiss.IndexFlatL2(dim)
+    index.add(vectors)
+    documents = {
+        str(idx): Document(
+            page_content=f"Page {idx % 300} of book-{idx // 300}. " * 20,
+            metadata={
+                "source": f"book-{idx // 300}.pdf",
+                "title": f"book-{idx // 300}",
+                "page": idx % 300,
+            },
+        )
+        for idx in range(num_docs)
+    }
+    db_index_name = os.path.join(db_name, "index")
+    FAISS(
+        FakeEmbeddings(size=dim).embed_query,
+        index,
+        InMemoryDocstore(documents),
+        {idx: str(idx) for idx in range(num_docs)},
+    ).save_local(db_index_name)
+    metadata_index = MetadataIndex()
+    for idx in range(num_docs):
+        metadata_index.add(idx, documents[str(idx)].metadata)
+    metadata_index.save(db_index_name)
+
+
+def create_server(
+    db_name: str, workers: int, preload: bool, ready_fd: int
+) -> PreforkServer:
+    """Serve the retrieval of DocumentQA. Each worker writes to ready_fd once its
+    index is loaded."""
+    app = Flask("Prefork Benchmark")
+    qa: Optional[responder.DocumentQA] = None
+
+    @app.route("/search")
+    def search():
+        docs = qa.retrieve("Which page?", k=4)  # type: ignore
+        return {"pid": os.getpid(), "docs": len(docs)}
+
+    def post_fork(worker_id: int) -> None:
+        nonlocal qa
+        qa = responder.DocumentQA(
+            db_name=db_name,
+            llm_type="RevBard",
+            use_memory=False,
+            test_mode=True,
+            stage_workers=0,
+        )
+        # Load the index, or adopt the preloaded one, before taking requests.
+        qa._load_index()
+        os.write(ready_fd, b"1")
+
+    return PreforkServer(
+        app,
+        host="127.0.0.1",
+        port=0,
+        workers=workers,
+        preload=(
+            (lambda: responder.preload_index(db_name, FakeEmbeddings(size=1536)))
+            if preload
+            else None
+        ),
+        post_fork=post_fork,
+    )
+
+
+def _memory(pid: int) -> Dict[str, int]:
+    """The RSS and the PSS in KB of the process and of its children."""
+    memory = {"Rss": 0, "Pss": 0}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in memory:
+                memory[key] += int(value.split()[0])
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        for child in f.read().split():
+            for name, size in _memory(int(child)).items():
+                memory[name] += size
+    return memory
+
+
+def run_load(port: int, clients: int, duration: float) -> List[float]:
+    latencies: List[float] = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client() -> None:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/search") as r:
+                r.read()
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def run_server(
+    db_name: str, workers: int, preload: bool, clients: int, duration: float
+) -> None:
+    ready_read, ready_write = os.pipe()
+    server = create_server(db_name, workers, preload, ready_write)
+    port = server.bind()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            server.serve()
+        finally:
+            os._exit(0)
+    for _ in range(workers):
+        os.read(ready_read, 1)
+    memory = _memory(pid)
+    latencies = run_load(port, clients, duration)
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    server.socket.close()  # type: ignore
+    os.close(ready_read)
+    os.close(ready_write)
+    print(
+        f"{workers} workers, {'preload' if preload else 'per-worker load':>15}: "
+        + f"RSS {memory['Rss'] / 1024:7.1f} MB, PSS {memory['Pss'] / 1024:7.1f} MB, "
+        + f"{len(latencies) / duration:7.1f} requests/s, "
+        + f"p50 {(_percentile(latencies, 50) or 0.0) * 1000:6.1f} ms"
+    )
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Pre-fork server benchmark")
+    parser.add_argument("--num-docs", default=20000, type=int)
+    parser.add_argument("--clients", default=16, type=int)
+    parser.add_argument("--duration", default=5.0, type=float)
+    parser.add_argument("--workers", default="1,4,8", type=str)
+    args = parser.parse_args()
+    # Leave out the log line of each request.
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as db_name:
+        build_index(db_name, args.num_docs, dim=1536)
+        print(f"Index of {args.num_docs} docs, {os.cpu_count()} CPUs.")
+        for workers in [int(workers) for workers in args.workers.split(",")]:
+            for preload in [False, True]:
+                run_server(db_name, workers, preload, args.clients, args.duration)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,271 @@
+"""Admit the requests to the backends, shedding the ones that would wait too long.
+"""
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import your_assistant.core.prometheus as prometheus
+
+# The priority classes, from the most to the least urgent. The critical requests,
+# e.g. of the operators, are always admitted.
+PRIORITIES = {"critical": 0, "interactive": 1, "batch": 2}
+
+_ACTIVE = prometheus.REGISTRY.gauge(
+    "admission_active", "The requests being served by the backends.", ["backend"]
+)
+_QUEUED = prometheus.REGISTRY.gauge(
+    "admission_queued", "The requests waiting for a backend.", ["backend"]
+)
+_REJECTED = prometheus.REGISTRY.counter(
+    "admission_rejected_total",
+    "The requests rejected, by reason.",
+    ["backend", "reason"],
+)
+_WAIT_SECONDS = prometheus.REGISTRY.histogram(
+    "admission_wait_seconds",
+    "The wait of the admitted requests for a backend.",
+    ["backend", "priority"],
+)
+
+
+class Rejected(Exception):
+    """The request was not admitted, and can be retried after retry_after seconds.
+
+    The status is 429 when the queue of the backend is full, and 503 when the
+    request could not be served within its deadline.
+    """
+
+    def __init__(self, status: int, reason: str, retry_after: int):
+        super().__init__(f"Request rejected ({reason}), retry after {retry_after}s.")
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.admitted = False
+        self.evicted = False
+
+
+class AdmissionPool:
+    """Serve up to limit requests to a backend at the same time. The others wait in
+    a bounded queue, by priority and then in order of arrival.
+
+    A request is shed at once when the estimated wait would exceed its deadline, so
+    that it does not take a queue slot only to time out. A full queue evicts its
+    least urgent request for a more urgent one.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        queue_size: int,
+        max_wait: float = 30.0,
+        service_time: float = 1.0,
+    ):
+        """
+        Args:
+            name (str): The backend, e.g. QA.
+            limit (int): The number of requests served at the same time.
+            queue_size (int): The number of requests waiting at most.
+            max_wait (float): The seconds a request waits at most.
+            service_time (float): The initial estimate of the seconds to serve a
+                request, refined as the requests are served.
+        """
+        if limit < 1 or queue_size < 0:
+            raise ValueError("The limit must be positive and the queue size not.")
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.service_time = service_time
+        self._active = 0
+        self._queue: List[Tuple[int, int, _Waiter]] = []
+        self._arrivals = itertools.count()
+        self._lock = threading.Lock()
+        self._active_gauge = _ACTIVE.labels(backend=name)
+        self._queued_gauge = _QUEUED.labels(backend=name)
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def acquire(
+        self, priority: str = "interactive", timeout: Optional[float] = None
+    ) -> float:
+        """Wait for the backend to serve the request.
+
+        Args:
+            priority (str): One of PRIORITIES.
+            timeout (Optional[float]): The seconds left to the deadline of the
+                request, which covers its wait and its service.
+
+        Returns:
+            float: The time the request was admitted, to pass to release.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority [{priority}].")
+        rank = PRIORITIES[priority]
+        start = time.perf_counter()
+        max_wait = self.max_wait
+        if timeout is not None:
+            max_wait = min(max_wait, timeout - self.service_time)
+        with self._lock:
+            if rank == 0 or (self._active < self.limit and not self._queue):
+                self._admit()
+                _WAIT_SECONDS.labels(backend=self.name, priority=priority).observe(0)
+                return start
+            ahead = sum(1 for entry in self._queue if entry[0] <= rank)
+            estimate = self._estimate_wait(ahead)
+            if estimate > max_wait:
+                raise self._reject(503, "deadline", estimate)
+            if len(self._queue) >= self.queue_size:
+                least_urgent = max(self._queue)
+                if least_urgent[0] <= rank:
+                    raise self._reject(429, "queue_full", estimate)
+                self._queue.remove(least_urgent)
+                heapq.heapify(self._queue)
+                self._queued_gauge.dec()
+                least_urgent[2].evicted = True
+                least_urgent[2].event.set()
+            waiter = _Waiter()
+            entry = (rank, next(self._arrivals), waiter)
+            heapq.heappush(self._queue, entry)
+            self._queued_gauge.inc()
+        waiter.event.wait(max_wait)
+        with self._lock:
+            if not waiter.admitted:
+                if waiter.evicted:
+                    raise self._reject(503, "evicted", self._estimate_wait(ahead))
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._queued_gauge.dec()
+                raise self._reject(503, "timeout", self._estimate_wait(ahead))
+        admitted = time.perf_counter()
+        _WAIT_SECONDS.labels(backend=self.name, priority=priority).observe(
+            admitted - start
+        )
+        return admitted
+
+    def release(self, admitted: float) -> None:
+        """Hand the slot of a served request to the next request waiting.
+
+        Args:
+            admitted (float): The time returned by acquire.
+        """
+        elapsed = time.perf_counter() - admitted
+        with self._lock:
+            # A moving average follows the backend as it slows down or recovers.
+            self.service_time = 0.8 * self.service_time + 0.2 * elapsed
+            self._active -= 1
+            self._active_gauge.dec()
+            if self._queue and self._active < self.limit:
+                _, _, waiter = heapq.heappop(self._queue)
+                self._queued_gauge.dec()
+                waiter.admitted = True
+                self._admit()
+                waiter.event.set()
+
+    @contextmanager
+    def admit(
+        self, priority: str = "interactive", timeout: Optional[float] = None
+    ) -> Iterator[None]:
+        """Serve the block once the request is admitted. See acquire."""
+        admitted = self.acquire(priority=priority, timeout=timeout)
+        try:
+            yield
+        finally:
+            self.release(admitted)
+
+    def _admit(self) -> None:
+        self._active += 1
+        self._active_gauge.inc()
+
+    def _estimate_wait(self, ahead: int) -> float:
+        """The seconds until the requests ahead, and the request, get a slot."""
+        return self.service_time * (ahead + 1) / self.limit
+
+    def _reject(self, status: int, reason: str, estimate: float) -> Rejected:
+        _REJECTED.labels(backend=self.name, reason=reason).inc()
+        return Rejected(status, reason, retry_after=max(1, math.ceil(estimate)))
+
+
+class AdmissionController:
+    """The admission pools of the backends, created on first use."""
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, int]] = None,
+        default_limit: int = 8,
+        queue_size: int = 16,
+        max_wait: float = 30.0,
+    ):
+        """
+        Args:
+            limits (Optional[Dict[str, int]]): The limit of each backend, e.g.
+                {"QA": 2}.
+            default_limit (int): The limit of the other backends.
+            queue_size (int): The size of the queue of each backend.
+            max_wait (float): The seconds a request waits at most.
+        """
+        self.limits = limits or {}
+        self.default_limit = default_limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self._pools: Dict[str, AdmissionPool] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        """Configure the pools from the ADMISSION_LIMITS env var, e.g.
+        "QA=2,ChatGPT=16", and the ADMISSION_DEFAULT_LIMIT, ADMISSION_QUEUE_SIZE
+        and ADMISSION_MAX_WAIT env vars."""
+        limits = {}
+        for item in os.getenv("ADMISSION_LIMITS", "").split(","):
+            if item.strip():
+                backend, limit = item.split("=")
+                limits[backend.strip()] = int(limit)
+        return cls(
+            limits=limits,
+            default_limit=int(os.getenv("ADMISSION_DEFAULT_LIMIT") or 8),
+            queue_size=int(os.getenv("ADMISSION_QUEUE_SIZE") or 16),
+            max_wait=float(os.getenv("ADMISSION_MAX_WAIT") or 30.0),
+        )
+
+    def pool(self, backend: str) -> AdmissionPool:
+        pool = self._pools.get(backend)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(backend)
+                if pool is None:
+                    pool = self._pools[backend] = AdmissionPool(
+                        name=backend,
+                        limit=self.limits.get(backend, self.default_limit),
+                        queue_size=self.queue_size,
+                        max_wait=self.max_wait,
+                    )
+        return pool
+
+    def status(self) -> Dict[str, Dict[str, float]]:
+        """The requests served and waiting, and the service time, by backend."""
+        return {
+            name: {
+                "active": pool.active,
+                "queued": pool.queued,
+                "limit": pool.limit,
+                "service_time": pool.service_time,
+            }
+            for name, pool in list(self._pools.items())
+        }
@@ -0,0 +1,286 @@
+"""Cache the responses of the LLMs.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+
+import your_assistant.core.utils as utils
+
+
+class ResponseCache:
+    """An on-disk cache of the LLM responses, keyed by exact match.
+
+    The key is a hash of the backend, model, params and prompt. Entries expire after
+    a time-to-live, and the least recently used ones are evicted once the responses
+    exceed the size budget. Calls sampled above max_temperature bypass the cache,
+    as their responses are not meant to repeat.
+    """
+
+    def __init__(
+        self,
+        db_path: str = "llm_cache.db",
+        ttl_seconds: float = 86400,
+        max_size: int = 50000000,
+        max_temperature: float = 0.5,
+    ):
+        """Initialize the cache.
+
+        Args:
+            db_path (str): The path to the sqlite db.
+            ttl_seconds (float): The seconds after which an entry expires.
+            max_size (int): The maximum characters of all the cached responses.
+            max_temperature (float): Bypass the cache above this temperature.
+        """
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.max_temperature = max_temperature
+        self.logger = utils.Logger("ResponseCache")
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY,
+                response TEXT, size INTEGER, created_at REAL, accessed_at REAL);
+            CREATE INDEX IF NOT EXISTS responses_accessed_at
+                ON responses (accessed_at);
+            -- Keep the total size in the db, as several processes may share it.
+            CREATE TABLE IF NOT EXISTS responses_size (
+                id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER);
+            INSERT OR IGNORE INTO responses_size VALUES (0, 0);
+            CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses
+            BEGIN UPDATE responses_size SET total = total + NEW.size; END;
+            CREATE TRIGGER IF NOT EXISTS responses_update
+                AFTER UPDATE OF size ON responses
+            BEGIN UPDATE responses_size SET total = total + NEW.size - OLD.size; END;
+            CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses
+            BEGIN UPDATE responses_size SET total = total - OLD.size; END;
+            """
+        )
+        self._db.commit()
+
+    @staticmethod
+    def make_key(backend: str, params: Dict[str, Any], prompt: str) -> str:
+        """Hash the backend, params and prompt of a call into a cache key.
+
+        Args:
+            backend (str): The type of the LLM.
+            params (Dict[str, Any]): The model and the sampling params.
+            prompt (str): The prompt to the LLM.
+
+        Returns:
+            str: The cache key.
+        """
+        payload = json.dumps(
+            [backend, params, prompt], sort_keys=True, ensure_ascii=False, default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def cacheable(self, params: Dict[str, Any]) -> bool:
+        """Whether the responses of a call with these params can be cached."""
+        return float(params.get("temperature") or 0) <= self.max_temperature
+
+    def get(self, key: str) -> Optional[str]:
+        """Look up a response. Expired entries are removed.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            Optional[str]: The cached response, or None on a miss.
+        """
+        with self._lock:
+            now = time.time()
+            row = self._db.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row and now - row[1] > self.ttl_seconds:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row:
+                self.hits += 1
+                self._db.execute(
+                    "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+                )
+            else:
+                self.misses += 1
+            self._db.commit()
+            return row[0] if row else None
+
+    def put(self, key: str, response: str) -> None:
+        """Store a response and evict the least recently used entries over budget.
+
+        Args:
+            key (str): The cache key.
+            response (str): The response to cache.
+        """
+        size = len(response)
+        if size > self.max_size:
+            return
+        with self._lock:
+            now = time.time()
+            self._db.execute(
+                "INSERT INTO responses VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO "
+                + "UPDATE SET response = excluded.response, size = excluded.size, "
+                + "created_at = excluded.created_at, accessed_at = excluded.accessed_at",
+                (key, response, size, now, now),
+            )
+            self._evict(now=now)
+            self._db.commit()
+
+    def cached(
+        self, backend: str, params: Dict[str, Any], prompt: str, call: Callable[[], str]
+    ) -> str:
+        """Return the cached response of a call, or make the call and cache it.
+
+        Args:
+            backend (str): The type of the LLM.
+            params (Dict[str, Any]): The model and the sampling params.
+            prompt (str): The prompt to the LLM.
+            call (Callable[[], str]): Make the call on a miss.
+
+        Returns:
+            str: The response.
+        """
+        key = self._lookup_key(backend=backend, params=params, prompt=prompt)
+        response = self.get(key) if key else None
+        if response is None:
+            response = call()
+            if key:
+                self.put(key, response)
+        return response
+
+    async def acached(
+        self,
+        backend: str,
+        params: Dict[str, Any],
+        prompt: str,
+        call: Callable[[], Any],
+    ) -> str:
+        """The async version of cached, where call is a coroutine function. The db
+        is local, so it is queried inline."""
+        key = self._lookup_key(backend=backend, params=params, prompt=prompt)
+        response = self.get(key) if key else None
+        if response is None:
+            response = await call()
+            if key:
+                self.put(key, response)
+        return response
+
+    def cached_stream(
+        self,
+        backend: str,
+        params: Dict[str, Any],
+        prompt: str,
+        stream: Callable[[], Iterator[str]],
+    ) -> Iterator[str]:
+        """Stream the response of a call. A cached response is yielded as a single
+        chunk, and a streamed response is cached once it completes.
+
+        Args:
+            backend (str): The type of the LLM.
+            params (Dict[str, Any]): The model and the sampling params.
+            prompt (str): The prompt to the LLM.
+            stream (Callable[[], Iterator[str]]): Stream the call on a miss.
+
+        Returns:
+            Iterator[str]: The text deltas of the response.
+        """
+        key = self._lookup_key(backend=backend, params=params, prompt=prompt)
+        response = self.get(key) if key else None
+        if response is not None:
+            yield response
+            return
+        chunks = []
+        for chunk in stream():
+            chunks.append(chunk)
+            yield chunk
+        if key:
+            self.put(key, "".join(chunks))
+
+    async def acached_stream(
+        self,
+        backend: str,
+        params: Dict[str, Any],
+        prompt: str,
+        stream: Callable[[], AsyncIterator[str]],
+    ) -> AsyncIterator[str]:
+        """The async version of cached_stream."""
+        key = self._lookup_key(backend=backend, params=params, prompt=prompt)
+        response = self.get(key) if key else None
+        if response is not None:
+            yield response
+            return
+        chunks = []
+        async for chunk in stream():
+            chunks.append(chunk)
+            yield chunk
+        if key:
+            self.put(key, "".join(chunks))
+
+    def hit_ratio(self) -> float:
+        """The ratio of the lookups that hit the cache. Bypassed calls are excluded."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        """The counters of the cache."""
+        with self._lock:
+            num_entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "hit_ratio": self.hit_ratio(),
+                "entries": num_entries[0],
+                "size": self._size(),
+            }
+
+    def clear(self) -> None:
+        """Remove all the entries."""
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def close(self) -> None:
+        """Log the hit ratio and close the db."""
+        with self._lock:
+            self.logger.info(
+                f"Hit ratio {self.hit_ratio():.2%} ({self.hits} hits, "
+                + f"{self.misses} misses, {self.bypasses} bypasses)."
+            )
+            self._db.close()
+
+    def _lookup_key(
+        self, backend: str, params: Dict[str, Any], prompt: str
+    ) -> Optional[str]:
+        """The cache key of a call, or None if the call bypasses the cache."""
+        if not self.cacheable(params):
+            with self._lock:
+                self.bypasses += 1
+            return None
+        return self.make_key(backend=backend, params=params, prompt=prompt)
+
+    def _size(self) -> int:
+        return self._db.execute("SELECT total FROM responses_size").fetchone()[0]
+
+    def _evict(self, now: float) -> None:
+        """Remove the expired entries once the responses exceed the size budget,
+        then the least recently used ones."""
+        if self._size() <= self.max_size:
+            return
+        self._db.execute(
+            "DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,)
+        )
+        while self._size() > self.max_size:
+            self._db.execute(
+                "DELETE FROM responses WHERE key = "
+                + "(SELECT key FROM responses ORDER BY accessed_at LIMIT 1)"
+            )
@@ -0,0 +1,214 @@
+"""Concurrency helpers shared by the orchestrators and the responders.
+"""
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Tuple
+
+
+class _Flight:
+    """An in-flight call whose outcome is shared by the identical calls."""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Any = None
+
+
+class SingleFlight:
+    """Coalesce concurrent identical calls into one upstream call.
+
+    The first caller of a key makes the call. The callers arriving with the same
+    key while it is in flight wait for it and get its result, or its exception.
+    Once the call completes the key is forgotten, so later callers call again.
+    """
+
+    def __init__(self) -> None:
+        self.num_calls = 0
+        self.num_saved_calls = 0
+        self._flights: Dict[Any, _Flight] = {}
+        self._async_flights: Dict[Tuple[Any, Any], asyncio.Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Any, call: Callable[[], Any]) -> Any:
+        """Make the call, unless an identical one is in flight.
+
+        Args:
+            key (Any): Identify the identical calls.
+            call (Callable[[], Any]): Make the call.
+
+        Returns:
+            Any: The result of the call.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.num_calls += 1
+                leader = True
+            else:
+                self.num_saved_calls += 1
+                leader = False
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = call()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    async def ado(self, key: Any, call: Callable[[], Any]) -> Any:
+        """The async version of do, where call is a coroutine function. The calls
+        are coalesced per event loop.
+
+        Args:
+            key (Any): Identify the identical calls.
+            call (Callable[[], Any]): Make the call.
+
+        Returns:
+            Any: The result of the call.
+        """
+        loop_key = (asyncio.get_running_loop(), key)
+        with self._lock:
+            future = self._async_flights.get(loop_key)
+            if future is None:
+                future = self._async_flights[loop_key] = asyncio.ensure_future(
+                    self._afly(loop_key, call)
+                )
+                self.num_calls += 1
+            else:
+                self.num_saved_calls += 1
+        # Shield the shared call, so that a cancelled caller does not cancel it for
+        # the others.
+        return await asyncio.shield(future)
+
+    async def _afly(self, loop_key: Tuple[Any, Any], call: Callable[[], Any]) -> Any:
+        try:
+            return await call()
+        finally:
+            with self._lock:
+                del self._async_flights[loop_key]
+
+    def stats(self) -> Dict[str, int]:
+        """The number of upstream calls made and of calls saved by coalescing."""
+        with self._lock:
+            return {"calls": self.num_calls, "saved_calls": self.num_saved_calls}
+
+
+class RateLimiter:
+    """Pace the calls to at most rate per second, with bursts of up to burst calls.
+
+    Each call reserves the next free slot, so the waiting callers are served in
+    their order of arrival.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        Args:
+            rate (float): The calls per second on average.
+            burst (int): The calls allowed at once after an idle period.
+        """
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"Invalid rate [{rate}] or burst [{burst}].")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Reserve a call.
+
+        Returns:
+            float: The seconds to wait before making the call.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            # Go into debt, so that the later callers queue behind this one.
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self) -> None:
+        """Wait for a slot."""
+        time.sleep(self.reserve())
+
+    async def aacquire(self) -> None:
+        """Wait for a slot without blocking the event loop."""
+        await asyncio.sleep(self.reserve())
+
+
+class KeyedLock:
+    """A lock per key, e.g. per conversation session. The lock of a key only exists
+    while it is held or waited for, so that the keys do not accumulate."""
+
+    def __init__(self) -> None:
+        # The lock of each key and the number of its holders and waiters.
+        self._locks: Dict[Any, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key: Any) -> Iterator[None]:
+        """Hold the lock of the key. A None key is not locked.
+
+        Args:
+            key (Any): The key to lock.
+        """
+        if key is None:
+            yield
+            return
+        lock = self._ref(key)
+        try:
+            with lock:
+                yield
+        finally:
+            self._unref(key)
+
+    @asynccontextmanager
+    async def ahold(self, key: Any) -> AsyncIterator[None]:
+        """The async version of hold, sharing the locks with the threads. The lock
+        is polled with a backoff, as waiting for it in worker threads could tie up
+        all of them while the holder needs one."""
+        if key is None:
+            yield
+            return
+        lock = self._ref(key)
+        try:
+            delay = 0.001
+            while not lock.acquire(blocking=False):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.05)
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            self._unref(key)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def _ref(self, key: Any) -> threading.Lock:
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def _unref(self, key: Any) -> None:
+        with self._lock:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
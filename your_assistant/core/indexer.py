@@ -2,14 +2,18 @@
 
 """
 import argparse
+import fcntl
 import json
 import os
 import re
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 
 import nltk
+import numpy as np
 from langchain.docstore.document import Document
 from langchain.document_loaders import UnstructuredFileLoader
 from langchain.document_loaders.base import BaseLoader
@@ -18,10 +22,122 @@ from langchain.embeddings.base import Embeddings
 from langchain.text_splitter import TokenTextSplitter
 from langchain.vectorstores import FAISS, VectorStore
 
+import your_assistant.core.llm as llm_lib
 import your_assistant.core.loader as loader_lib
+import your_assistant.core.metrics as metrics_lib
+import your_assistant.core.tracing as tracing
 import your_assistant.core.utils as utils
 
 
+class MetadataIndex:
+    """The ids of the indexed chunks per metadata value, to filter retrieval.
+
+    The ids are the positions of the chunks in the FAISS index. They are kept as
+    sorted numpy arrays so that a filter can be turned into a FAISS id selector
+    without scanning the docstore.
+    """
+
+    # The metadata fields that can be filtered on.
+    FIELDS = ["source", "title", "authors", "page"]
+    FILE_NAME = "metadata_index.json"
+
+    def __init__(self) -> None:
+        self.ids: Dict[str, Dict[str, List[int]]] = {field: {} for field in self.FIELDS}
+        self._arrays: Dict[Tuple[str, str], np.ndarray] = {}
+
+    @classmethod
+    def load(cls, db_path: str) -> Optional["MetadataIndex"]:
+        """Load the metadata index stored in the db folder, if any.
+
+        Args:
+            db_path (str): The path to the vector database.
+        """
+        path = os.path.join(db_path, cls.FILE_NAME)
+        if not os.path.exists(path):
+            return None
+        metadata_index = cls()
+        with open(path, "r") as f:
+            metadata_index.ids.update(json.load(f))
+        return metadata_index
+
+    @classmethod
+    def from_faiss(cls, db: FAISS) -> "MetadataIndex":
+        """Build the metadata index of a db indexed before the metadata index existed.
+
+        Args:
+            db (FAISS): The vector database.
+        """
+        metadata_index = cls()
+        for idx, docstore_id in db.index_to_docstore_id.items():
+            doc = db.docstore.search(docstore_id)
+            if isinstance(doc, Document):
+                metadata_index.add(idx, doc.metadata)
+        return metadata_index
+
+    def save(self, db_path: str) -> None:
+        with open(os.path.join(db_path, self.FILE_NAME), "w") as f:
+            json.dump(self.ids, f)
+
+    def add(self, idx: int, metadata: Dict[str, Any]) -> None:
+        """Record the metadata of the chunk at the given position of the index."""
+        for field in self.FIELDS:
+            values = metadata.get(field)
+            if values is None:
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                self.ids[field].setdefault(str(value), []).append(idx)
+        self._arrays.clear()
+
+    def select(self, retrieval_filter: Dict[str, Any]) -> Optional[np.ndarray]:
+        """Find the ids of the chunks that match the filter.
+
+        Args:
+            retrieval_filter (Dict[str, Any]): The filter, with the optional keys
+                source, title and authors (a value or a list of values, any of which
+                matches), and page_range (the first and the last page, inclusive).
+                All the given keys must match.
+
+        Returns:
+            Optional[np.ndarray]: The sorted ids, or None if the filter is empty.
+        """
+        selected: Optional[np.ndarray] = None
+        for field in ["source", "title", "authors"]:
+            values = retrieval_filter.get(field)
+            if not values:
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            ids = self._union(field, [str(value) for value in values])
+            selected = ids if selected is None else np.intersect1d(selected, ids)
+        page_range = retrieval_filter.get("page_range")
+        if page_range:
+            first_page, last_page = int(page_range[0]), int(page_range[1])
+            pages = [
+                page
+                for page in self.ids["page"]
+                if first_page <= int(page) <= last_page
+            ]
+            ids = self._union("page", pages)
+            selected = ids if selected is None else np.intersect1d(selected, ids)
+        return selected
+
+    def _union(self, field: str, values: List[str]) -> np.ndarray:
+        arrays = [self._array(field, value) for value in values]
+        if not arrays:
+            return np.array([], dtype=np.int64)
+        return np.unique(np.concatenate(arrays))
+
+    def _array(self, field: str, value: str) -> np.ndarray:
+        key = (field, value)
+        if key not in self._arrays:
+            self._arrays[key] = np.array(
+                sorted(self.ids[field].get(value, [])), dtype=np.int64
+            )
+        return self._arrays[key]
+
+
 class KnowledgeIndexer:
     def __init__(self, args: argparse.Namespace):
         """Initialize the knowledge indexer.
@@ -39,6 +155,11 @@ class KnowledgeIndexer:
         if not args.db_path:
             raise ValueError("db_path is not specified.")
         self.db_path = args.db_path
+        # The files are embedded concurrently, but merged into the db one at a time,
+        # and by one of the processes sharing the db at a time.
+        self._db_lock = threading.Lock()
+        # The version of the db on disk that is loaded, see _db_version.
+        self._loaded_version: Optional[Tuple[int, int]] = None
         self._init_index_db(args=args, embeddings_tool=self.embeddings_tool)
         self._init_index_recorder(args=args)
 
@@ -59,6 +180,8 @@ class KnowledgeIndexer:
         if not args.embeddings_tool_name:
             raise ValueError("embeddings_tool_name is not specified.")
         if args.embeddings_tool_name == "openai":
+            if getattr(args, "api_base", None):
+                llm_lib.set_api_base(args.api_base)
             return OpenAIEmbeddings()  # type: ignore
         raise ValueError(f"Unsupported embeddings tool: {args.embeddings_tool_name}.")
 
@@ -76,12 +199,33 @@ class KnowledgeIndexer:
             raise ValueError("db_path is not specified.")
         self.db_index_path = os.path.join(args.db_path, "index")
         self.embeddings_db_engine = FAISS
+        self._load_index_db(embeddings_tool=embeddings_tool)
+
+    def _load_index_db(self, embeddings_tool: Embeddings) -> None:
+        """Load the db from disk, if it exists, or start an empty one."""
         self.embeddings_db: Optional[VectorStore] = None
+        self.metadata_index = MetadataIndex()
+        self._loaded_version = self._db_version()
         if os.path.exists(self.db_index_path):
             self.logger.info(f"DB [{self.db_index_path}] exists, load it.")
             self.embeddings_db = self.embeddings_db_engine.load_local(
                 self.db_index_path, embeddings_tool
             )
+            # Dbs indexed before the metadata index existed are backfilled.
+            self.metadata_index = MetadataIndex.load(
+                self.db_index_path
+            ) or MetadataIndex.from_faiss(
+                self.embeddings_db  # type: ignore
+            )
+
+    def _db_version(self) -> Optional[Tuple[int, int]]:
+        """The version of the db on disk. The faiss index is replaced last on each
+        save, so its inode and its modification time change with the db."""
+        try:
+            stat = os.stat(os.path.join(self.db_index_path, "index.faiss"))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
 
     def _init_index_recorder(self, args: argparse.Namespace) -> None:
         """Initialize the index recorder. The index recorder stores the information
@@ -100,7 +244,9 @@ class KnowledgeIndexer:
             if not os.path.exists(os.path.dirname(self.index_record_path)):
                 os.makedirs(os.path.dirname(self.index_record_path))
             self.index_record_path.touch()
-        # Load the index record.
+        self._load_index_record()
+
+    def _load_index_record(self) -> None:
         self.index_record: Dict[str, Any] = {}
         with self.index_record_path.open("r+") as f:
             try:
@@ -115,6 +261,8 @@ class KnowledgeIndexer:
         chunk_size: int = 500,
         chunk_overlap: int = 50,
         batch_size: int = 50,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        public_only: bool = False,
     ) -> str:
         """Index a given file into the vector DB according to the name.
 
@@ -123,28 +271,45 @@ class KnowledgeIndexer:
             chunk_size (int, optional): The chunk size to split the text. Defaults to 500.
             chunk_overlap (int, optional): The chunk overlap to split the text. Defaults to 50.
             batch_size (int, optional): The batch size to index the embeddings. Defaults to 50.
+            on_progress (Optional[Callable[[int, int], None]]): Called with the
+                chunks embedded and the chunks of the file after each batch.
+            public_only (bool, optional): Whether a url may only be downloaded from
+                the public hosts. Defaults to False.
 
         Returns:
             str: The status of the indexing.
         """
         self.logger.info(f"Indexing {path}...")
-        loader, source, downloaded_path = self._init_loader(path=path)
-        documents = self._extract_data(
-            loader=loader, chunk_size=chunk_size, chunk_overlap=chunk_overlap
-        )
-        is_indexed = self._index_embeddings(
-            documents=documents, source=source, batch_size=batch_size
-        )
+        with tracing.span("indexer.index", path=path) as span:
+            with tracing.span("indexer.load"):
+                loader, source, downloaded_path = self._init_loader(
+                    path=path, public_only=public_only
+                )
+                documents = self._extract_data(
+                    loader=loader, chunk_size=chunk_size, chunk_overlap=chunk_overlap
+                )
+            span.set_attribute("documents", len(documents))
+            with tracing.span("indexer.embed"):
+                is_indexed = self._index_embeddings(
+                    documents=documents,
+                    source=source,
+                    batch_size=batch_size,
+                    on_progress=on_progress,
+                )
         # Remove the downloaded file.
         if os.path.exists(downloaded_path):
             os.remove(downloaded_path)
         return f"Index {source} finished." if is_indexed else ""
 
-    def _init_loader(self, path: str) -> Tuple[BaseLoader, str, str]:
+    def _init_loader(
+        self, path: str, public_only: bool = False
+    ) -> Tuple[BaseLoader, str, str]:
         """Initialize the loader based on the file path and type.
 
         Args:
             path (str): The path to the file.
+            public_only (bool): Whether a url may only be downloaded from the public
+                hosts.
 
         Returns:
             Tuple[BaseLoader, str, str]: The loader, the source, and the downloaded file path.
@@ -154,26 +319,29 @@ class KnowledgeIndexer:
             # If the path is a url, download the file.
             result = urlparse(path)
             downloaded_path = ""
+            source = path
             if all([result.scheme, result.netloc]):
                 self.logger.info("Download online file.")
-                source, downloaded_path = utils.file_downloader(url=path)
-            if os.path.exists(path):
+                source, downloaded_path = utils.file_downloader(
+                    url=path, public_only=public_only
+                )
+            local_path = downloaded_path or path
+            if os.path.exists(local_path):
                 self.logger.info("Load local loader.")
-                extension = os.path.splitext(path)[1]
+                extension = os.path.splitext(local_path)[1]
                 if extension not in self.supported_file_types:
                     raise ValueError(
-                        f"File extension not supported: {os.path.basename(path)}. "
+                        f"File extension not supported: {os.path.basename(local_path)}. "
                         + f"Only support {list(sorted(self.supported_file_types))}."
                     )
                 if extension == ".mobi":
-                    loader = loader_lib.MobiLoader(path=path)
+                    loader = loader_lib.MobiLoader(path=local_path)
                 elif extension == ".epub":
-                    loader = loader_lib.EpubLoader(path=path)
+                    loader = loader_lib.EpubLoader(path=local_path)
                 elif extension == ".pdf":
-                    loader = loader_lib.PdfLoader(path=path)
+                    loader = loader_lib.PdfLoader(path=local_path)
                 elif extension in self.supported_file_types:
-                    loader = UnstructuredFileLoader(path)
-                source = path
+                    loader = UnstructuredFileLoader(local_path)
             else:
                 raise ValueError(f"File not found: {os.path.basename(path)}")
         except ValueError as e:
@@ -200,15 +368,19 @@ class KnowledgeIndexer:
         return documents
 
     def _index_embeddings(
-        self, documents: List[Document], source: str, batch_size: int = 100
+        self,
+        documents: List[Document],
+        source: str,
+        batch_size: int = 100,
+        on_progress: Optional[Callable[[int, int], None]] = None,
     ) -> bool:
         """Index a file.
 
         Args:
             documents (Any): The documents to index.
             source (str): The source of the documents.
+            on_progress (Optional[Callable[[int, int], None]]): See index.
         """
-        self.index_record["indexed_doc"] = set(self.index_record["indexed_doc"])
         if source in self.index_record["indexed_doc"]:
             self.logger.info(f"File {source} already indexed. Skip.")
             return False
@@ -216,28 +388,89 @@ class KnowledgeIndexer:
         for doc in documents:
             doc.metadata["source"] = source
             doc.page_content = re.sub(r"[^\w\s]|['\"]", "", doc.page_content)
-        # Index the new documents in batches.
+        # Embed the new documents in batches, without holding the db.
+        batch_dbs = []
+        num_embedded = 0
         for idx, document_batch in enumerate(utils.chunk_list(documents, batch_size)):
             if self.verbose:
                 self.logger.info(
-                    f"Indexing {len(document_batch)} documents (batch {idx})."
+                    "Indexing %d documents (batch %d).", len(document_batch), idx
+                )
+            batch_dbs.append(
+                self.embeddings_db_engine.from_documents(
+                    document_batch, metrics_lib.MeteredEmbeddings(self.embeddings_tool)
                 )
-            new_db = self.embeddings_db_engine.from_documents(
-                document_batch, self.embeddings_tool
             )
+            num_embedded += len(document_batch)
+            if on_progress:
+                on_progress(num_embedded, len(documents))
+        with self._hold_db():
+            # Another process may have saved the db meanwhile: merge into its
+            # version, or the save would drop the files it indexed.
+            if self._db_version() != self._loaded_version:
+                self._load_index_db(embeddings_tool=self.embeddings_tool)
+                self._load_index_record()
+            # Another job may have indexed the same file meanwhile.
+            if source in self.index_record["indexed_doc"]:
+                self.logger.info(f"File {source} already indexed. Skip.")
+                return False
+            self._merge(documents=documents, source=source, batch_dbs=batch_dbs)
+        return True
+
+    @contextmanager
+    def _hold_db(self) -> Iterator[None]:
+        """Hold the db, against the other threads of this process and the other
+        processes sharing it, e.g. the workers of a PreforkServer."""
+        with self._db_lock:
+            os.makedirs(self.db_path, exist_ok=True)
+            with open(os.path.join(self.db_path, "index.lock"), "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+
+    def _merge(
+        self, documents: List[Document], source: str, batch_dbs: List[VectorStore]
+    ) -> None:
+        """Append the embedded documents to the db, and save it and the record."""
+        # New chunks are appended to the index, so their ids follow the existing ones.
+        first_id = (
+            len(self.embeddings_db.index_to_docstore_id)  # type: ignore
+            if self.embeddings_db
+            else 0
+        )
+        for idx, doc in enumerate(documents):
+            self.metadata_index.add(first_id + idx, doc.metadata)
+        for new_db in batch_dbs:
             if self.embeddings_db:
                 self.embeddings_db.merge_from(new_db)  # type: ignore
             else:
                 self.embeddings_db = new_db
         self.logger.info(f"Indexing done. {len(documents)} documents indexed.")
-        self.embeddings_db.save_local(self.db_index_path)  # type: ignore
-        # Record the newly indexed documents. Delete the old index first.
+        self._save_db()
+        self._loaded_version = self._db_version()
+        # Record the newly indexed documents, replacing the record at once so that
+        # the other processes never read it half written.
         self.index_record["indexed_doc"].add(source)
-        self.index_record["indexed_doc"] = list(self.index_record["indexed_doc"])
         index_size = len(self.index_record["indexed_doc"])
-        self.index_record_path.unlink()
-        with self.index_record_path.open("w") as f:
-            json.dump(self.index_record, f, indent=2)
-            self.logger.info(f"Updated index record with [{index_size}] records.")
+        temp_path = f"{self.db_record_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            record = dict(self.index_record)
+            record["indexed_doc"] = list(record["indexed_doc"])
+            json.dump(record, f, indent=2)
+        os.replace(temp_path, self.db_record_path)
+        self.logger.info(f"Updated index record with [{index_size}] records.")
         self.logger.info(f"DB saved to {self.db_path}.")
-        return True
+
+    def _save_db(self) -> None:
+        """Save the db through a staging folder, replacing the faiss index last. The
+        responders reload the db when the faiss index changes, and a responder that
+        loads it meanwhile reads a docstore at least as new as the index."""
+        staging_path = self.db_index_path + ".staging"
+        self.embeddings_db.save_local(staging_path)  # type: ignore
+        self.metadata_index.save(staging_path)
+        os.makedirs(self.db_index_path, exist_ok=True)
+        for file_name in ["index.pkl", MetadataIndex.FILE_NAME, "index.faiss"]:
+            os.replace(
+                os.path.join(staging_path, file_name),
+                os.path.join(self.db_index_path, file_name),
+            )
+        os.rmdir(staging_path)
@@ -0,0 +1,441 @@
+"""Run the indexing jobs in the background, and report their progress.
+"""
+import fcntl
+import ipaddress
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from urllib.parse import urlparse
+
+import your_assistant.core.utils as utils
+
+# The statuses of a job. The queued and running jobs resume after a restart.
+JOB_STATUSES = ["queued", "running", "done", "failed"]
+
+# The schemes of the urls that may be indexed.
+URL_SCHEMES = ["http", "https"]
+
+# The seconds between the attempts to claim the unfinished jobs of a live process.
+RESUME_RETRY_SECONDS = 5.0
+
+
+class IndexJob:
+    """The files of an indexing job and its progress. The job is changed by the
+    thread that runs it and reported by the others, so its fields are changed and
+    read under its lock."""
+
+    # The fields persisted across restarts.
+    FIELDS = [
+        "job_id",
+        "paths",
+        "chunk_size",
+        "chunk_overlap",
+        "status",
+        "files",
+        "files_done",
+        "chunks_done",
+        "results",
+        "errors",
+        "error",
+        "created_at",
+        "started_at",
+        "finished_at",
+        "claimed_by",
+    ]
+
+    def __init__(
+        self,
+        job_id: str,
+        paths: List[str],
+        chunk_size: int = 500,
+        chunk_overlap: int = 50,
+    ):
+        self.job_id = job_id
+        self.paths = paths
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.status = "queued"
+        # The files to index, once the directories of the paths are listed.
+        self.files: List[str] = []
+        self.files_done = 0
+        self.chunks_done = 0
+        # The chunks embedded from the file being indexed.
+        self.file_chunks_done = 0
+        self.file_chunks = 0
+        self.results: List[str] = []
+        # The errors of the files that could not be indexed, by file.
+        self.errors: Dict[str, str] = {}
+        self.error = ""
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # The pid of the process that runs the job.
+        self.claimed_by: Optional[int] = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> "IndexJob":
+        job = cls(job_id=state["job_id"], paths=state["paths"])
+        for field in cls.FIELDS:
+            if field in state:
+                setattr(job, field, state[field])
+        return job
+
+    def to_dict(self) -> Dict[str, Any]:
+        """A snapshot of the persisted fields, which the job no longer changes."""
+        with self._lock:
+            return {field: _copy_value(getattr(self, field)) for field in self.FIELDS}
+
+    def update(self, **changes: Any) -> None:
+        """Change the fields at once, so that the job is never reported half
+        changed."""
+        with self._lock:
+            for field, value in changes.items():
+                setattr(self, field, value)
+
+    def finish_file(self, file_path: str, result: str, error: str) -> None:
+        """Count the file being indexed as done, with its result or its error."""
+        with self._lock:
+            if result:
+                self.results.append(result)
+            if error:
+                self.errors[file_path] = error
+            self.chunks_done += self.file_chunks_done
+            self.file_chunks_done, self.file_chunks = 0, 0
+            self.files_done += 1
+
+    def progress(self) -> Dict[str, Any]:
+        """The state of the job, with its throughput in chunks per second and the
+        estimated seconds left, from the files done so far."""
+        with self._lock:
+            state = self.to_dict()
+            file_chunks_done, file_chunks = self.file_chunks_done, self.file_chunks
+        state["files_total"] = len(state["files"])
+        state["current_file_chunks"] = [file_chunks_done, file_chunks]
+        elapsed = 0.0
+        if state["started_at"] is not None:
+            elapsed = (state["finished_at"] or time.time()) - state["started_at"]
+        state["elapsed"] = elapsed
+        state["chunks_per_second"] = state["chunks_done"] / elapsed if elapsed else 0.0
+        state["eta"] = None
+        if state["status"] in ["done", "failed"]:
+            state["eta"] = 0.0
+        elif state["files"] and (state["files_done"] or file_chunks_done):
+            # The file being indexed counts for the share of its chunks embedded.
+            files_done: float = state["files_done"]
+            if file_chunks:
+                files_done += file_chunks_done / file_chunks
+            state["eta"] = elapsed / files_done * (state["files_total"] - files_done)
+        return state
+
+
+def _copy_value(value: Any) -> Any:
+    """Copy the lists and the dicts of a job, which it keeps changing."""
+    if isinstance(value, (list, dict)):
+        return type(value)(value)
+    return value
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class IndexJobManager:
+    """Run the indexing jobs in a pool of workers, and persist their state so that
+    the unfinished jobs resume after a restart.
+
+    The jobs of the pool share one indexer, which embeds their files concurrently
+    and merges them into the db one at a time. The managers of several processes,
+    e.g. the workers of a PreforkServer, may share one state file: each one merges
+    its jobs into it, and reports the jobs of the others from it.
+
+    The paths come from the clients, so the local ones must lie under the root
+    directory, symlinks resolved, and the urls must be http(s) urls of public hosts.
+    """
+
+    def __init__(
+        self,
+        indexer_factory: Callable[[], Any],
+        state_path: str,
+        workers: int = 2,
+        on_complete: Optional[Callable[[IndexJob], None]] = None,
+        resume: bool = True,
+        root: Optional[str] = None,
+    ):
+        """
+        Args:
+            indexer_factory (Callable[[], Any]): Create the indexer, e.g. a
+                KnowledgeIndexer, on the first job.
+            state_path (str): The json file of the state of the jobs.
+            workers (int): The number of jobs run at the same time.
+            on_complete (Optional[Callable[[IndexJob], None]]): Called once a job
+                is done, e.g. to reload the index of the responders.
+            resume (bool): Whether to resume the unfinished jobs of the state file
+                that no live process runs. Only one of the processes sharing the
+                state file should, but a job is only ever claimed by one.
+            root (Optional[str]): The directory of the local files that may be
+                indexed, relative paths included. Without it, only urls may be.
+        """
+        self.indexer_factory = indexer_factory
+        self.state_path = state_path
+        self.on_complete = on_complete
+        self.root = os.path.realpath(root) if root else None
+        self.logger = utils.Logger("IndexJobManager")
+        self._indexer: Any = None
+        self._indexer_lock = threading.Lock()
+        self._jobs: Dict[str, IndexJob] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="index-job"
+        )
+        self._closed = False
+        self._resume_timer: Optional[threading.Timer] = None
+        if resume:
+            self._resume()
+
+    def submit(
+        self, paths: List[str], chunk_size: int = 500, chunk_overlap: int = 50
+    ) -> IndexJob:
+        """Queue a job to index the files, directories or urls.
+
+        Args:
+            paths (List[str]): The paths or urls to index.
+            chunk_size (int): The chunk size to split the text.
+            chunk_overlap (int): The chunk overlap to split the text.
+
+        Returns:
+            IndexJob: The queued job.
+
+        Raises:
+            ValueError: If a path is outside the root, or a url is not an http(s)
+                url of a public host.
+        """
+        if not paths or not all(isinstance(path, str) and path for path in paths):
+            raise ValueError("The paths to index must be a non-empty list of paths.")
+        if chunk_size <= chunk_overlap:
+            raise ValueError(
+                f"Chunk size [{chunk_size}] must be larger than chunk overlap "
+                + f"[{chunk_overlap}]."
+            )
+        job = IndexJob(
+            job_id=uuid.uuid4().hex,
+            paths=[self._check_path(path) for path in paths],
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+        )
+        job.claimed_by = os.getpid()
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._save()
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[IndexJob]:
+        """Get the job, from the state file if another process runs it."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            with self._state_lock():
+                state = self._read_states().get(job_id)
+            if state is not None:
+                job = IndexJob.from_dict(state)
+        return job
+
+    def jobs(self) -> List[IndexJob]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def close(self) -> None:
+        """Stop taking jobs. The queued and running jobs resume on the next start."""
+        with self._lock:
+            self._closed = True
+            if self._resume_timer is not None:
+                self._resume_timer.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            self._save()
+
+    def _indexer_instance(self) -> Any:
+        with self._indexer_lock:
+            if self._indexer is None:
+                self._indexer = self.indexer_factory()
+            return self._indexer
+
+    def _run(self, job: IndexJob) -> None:
+        try:
+            indexer = self._indexer_instance()
+            if job.status == "queued":
+                self._update(
+                    job,
+                    files=self._list_files(job.paths),
+                    started_at=time.time(),
+                    status="running",
+                )
+            # A resumed job starts from the first file not done. Only this thread
+            # changes the files and the files done, so it reads them as they are.
+            for file_path in job.files[job.files_done :]:
+                job.update(file_chunks_done=0, file_chunks=0)
+                result, error = "", ""
+                try:
+                    result = indexer.index(
+                        path=file_path,
+                        chunk_size=job.chunk_size,
+                        chunk_overlap=job.chunk_overlap,
+                        on_progress=lambda done, total: job.update(
+                            file_chunks_done=done, file_chunks=total
+                        ),
+                        # The host is checked again as it is connected to.
+                        public_only=True,
+                    )
+                except Exception as e:
+                    self.logger.error(f"Failed to index {file_path}: {e}")
+                    error = str(e)
+                job.finish_file(file_path, result=result, error=error)
+                self._update(job)
+        except Exception as e:
+            self.logger.error(f"Index job {job.job_id} failed: {e}")
+            self._update(job, error=str(e), finished_at=time.time(), status="failed")
+            return
+        self._update(job, finished_at=time.time(), status="done")
+        self.logger.info(
+            f"Index job {job.job_id} done: {job.files_done} files, "
+            + f"{job.chunks_done} chunks, {len(job.errors)} errors."
+        )
+        if self.on_complete:
+            self.on_complete(job)
+
+    def _check_path(self, path: str) -> str:
+        """Check that the path may be indexed.
+
+        Returns:
+            str: The url, or the real path of the local file or directory.
+        """
+        url = urlparse(path)
+        if url.scheme or url.netloc:
+            if url.scheme not in URL_SCHEMES or not url.hostname:
+                raise ValueError(f"Only the {URL_SCHEMES} urls can be indexed: {path}")
+            try:
+                addresses = socket.getaddrinfo(url.hostname, None)
+            except (OSError, UnicodeError):
+                raise ValueError(f"Cannot resolve the host of {path}")
+            # The private hosts, e.g. the cloud metadata service, are off limits.
+            # This rejects them early; the download checks each connection.
+            if not all(
+                ipaddress.ip_address(address[4][0].split("%")[0]).is_global
+                for address in addresses
+            ):
+                raise ValueError(
+                    f"Only the urls of public hosts can be indexed: {path}"
+                )
+            return path
+        if self.root is None:
+            raise ValueError(f"Only urls can be indexed, not local paths: {path}")
+        real_path = os.path.realpath(os.path.join(self.root, path))
+        if not self._under_root(real_path):
+            raise ValueError(f"The path is outside of the index root: {path}")
+        return real_path
+
+    def _under_root(self, real_path: str) -> bool:
+        if self.root is None:
+            return False
+        return os.path.commonpath([self.root, real_path]) == self.root
+
+    def _list_files(self, paths: List[str]) -> List[str]:
+        """List the files of the directories, like the KnowledgeIndex orchestrator,
+        except the links out of the root. The urls and the missing files are left
+        to the indexer to download or to report."""
+        files: List[str] = []
+        for path in paths:
+            if os.path.isdir(path):
+                for file_name in sorted(os.listdir(path)):
+                    file_path = os.path.join(path, file_name)
+                    if file_name.startswith("."):
+                        continue
+                    if not self._under_root(os.path.realpath(file_path)):
+                        self.logger.warning(f"Skip {file_path}, outside of the root.")
+                        continue
+                    files.append(file_path)
+            else:
+                files.append(path)
+        return files
+
+    def _update(self, job: IndexJob, **changes: Any) -> None:
+        """Change the fields of the job, and save its state."""
+        job.update(**changes)
+        with self._lock:
+            self._save()
+
+    @contextmanager
+    def _state_lock(self) -> Iterator[None]:
+        """Keep the other processes from changing the state file meanwhile."""
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{self.state_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _save(self) -> None:
+        """Merge the state of the jobs into the state file."""
+        with self._state_lock():
+            self._write_states(self._read_states())
+
+    def _write_states(self, states: Dict[str, Dict[str, Any]]) -> None:
+        """Merge the state of the jobs into the states, and write them, under the
+        state lock. The merged state is written to a temporary file, which then
+        replaces the state file, so that a crash never leaves a partial state."""
+        states.update({job.job_id: job.to_dict() for job in self._jobs.values()})
+        temp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(list(states.values()), f, indent=2)
+        os.replace(temp_path, self.state_path)
+
+    def _read_states(self) -> Dict[str, Dict[str, Any]]:
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path, "r") as f:
+            return {state["job_id"]: state for state in json.load(f)}
+
+    def _resume(self) -> None:
+        """Claim and run the unfinished jobs that no live process runs, e.g. the
+        jobs of the previous run. The jobs of a live process, e.g. of a replaced
+        worker still finishing its requests, are claimed once it exits."""
+        claimed = []
+        with self._lock:
+            if self._closed:
+                return
+            # The jobs are claimed under the state lock, so only one process may.
+            with self._state_lock():
+                states = self._read_states()
+                waiting = False
+                for state in states.values():
+                    if state["status"] not in ["queued", "running"]:
+                        continue
+                    if state.get("claimed_by") and _is_alive(state["claimed_by"]):
+                        waiting = waiting or state["job_id"] not in self._jobs
+                        continue
+                    job = IndexJob.from_dict(state)
+                    job.claimed_by = os.getpid()
+                    self._jobs[job.job_id] = job
+                    claimed.append(job)
+                if claimed:
+                    self._write_states(states)
+            if waiting:
+                self._resume_timer = threading.Timer(RESUME_RETRY_SECONDS, self._resume)
+                self._resume_timer.daemon = True
+                self._resume_timer.start()
+        for job in claimed:
+            self.logger.info(f"Resume index job {job.job_id}.")
+            self._executor.submit(self._run, job)
@@ -1,13 +1,423 @@
 """Core logic of custom LLMs.
 """
+import asyncio
+import functools
 import os
-from typing import List, Optional
-
+import re
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+import aiohttp
 import google.generativeai as palm
 import openai
+from Bard import AsyncChatbot as BardAsyncChat
 from Bard import Chatbot as BardChat
+from langchain.chat_models import ChatOpenAI
+from langchain.llms import Anthropic
 from langchain.llms.base import LLM
-from revChatGPT.V1 import Chatbot
+from langchain.schema import BaseLanguageModel, HumanMessage
+from revChatGPT.V1 import AsyncChatbot, Chatbot
+
+import your_assistant.core.tracing as tracing
+import your_assistant.core.utils as utils
+
+
+@tracing.traced()
+def stream_completion(llm: BaseLanguageModel, prompt: str) -> Iterator[str]:
+    """Stream the completion of a prompt as text deltas, as the backend produces them.
+
+    Backends without native streaming yield the full completion as a single chunk.
+
+    Args:
+        llm (BaseLanguageModel): The LLM to call.
+        prompt (str): The prompt to the LLM.
+
+    Returns:
+        Iterator[str]: The text deltas of the completion.
+    """
+    if isinstance(llm, (ChatGPT, RevChatGPT, RevBard, PaLM)):
+        yield from llm.stream(prompt)
+    elif isinstance(llm, ChatOpenAI):
+        params = {**llm._default_params, "stream": True}
+        for chunk in llm.completion_with_retry(
+            messages=[{"role": "user", "content": prompt}], **params
+        ):
+            yield chunk["choices"][0]["delta"].get("content", "")
+    elif isinstance(llm, Anthropic):
+        # Anthropic streams the cumulative completion on every event.
+        yield from utils.iter_text_deltas(
+            data["completion"] for data in llm.stream(prompt)
+        )
+    else:
+        yield str(llm(prompt))  # type: ignore
+
+
+@tracing.traced()
+async def acomplete(llm: BaseLanguageModel, prompt: str) -> str:
+    """Complete a prompt without blocking the event loop.
+
+    Args:
+        llm (BaseLanguageModel): The LLM to call.
+        prompt (str): The prompt to the LLM.
+
+    Returns:
+        str: The completion.
+    """
+    if isinstance(llm, ChatOpenAI):
+        result = await llm.agenerate([[HumanMessage(content=prompt)]])
+    else:
+        result = await llm.agenerate([prompt])  # type: ignore
+    return result.generations[0][0].text
+
+
+@tracing.traced()
+async def astream_completion(llm: BaseLanguageModel, prompt: str) -> AsyncIterator[str]:
+    """Stream the completion of a prompt as text deltas without blocking the event
+    loop. Backends without native async streaming yield the full completion as a
+    single chunk.
+
+    Args:
+        llm (BaseLanguageModel): The LLM to call.
+        prompt (str): The prompt to the LLM.
+
+    Returns:
+        AsyncIterator[str]: The text deltas of the completion.
+    """
+    if isinstance(llm, (ChatGPT, RevChatGPT, RevBard, PaLM)):
+        async for chunk in llm.astream(prompt):
+            yield chunk
+    elif isinstance(llm, ChatOpenAI):
+        openai.aiosession.set(_aiohttp_session())
+        params = {**llm._default_params, "stream": True}
+        async for chunk in await openai.ChatCompletion.acreate(
+            messages=[{"role": "user", "content": prompt}], **params
+        ):
+            yield chunk["choices"][0]["delta"].get("content", "")  # type: ignore
+    else:
+        yield await acomplete(llm, prompt)
+
+
+def llm_params(llm: BaseLanguageModel) -> Dict[str, Any]:
+    """The model and the sampling params that determine the completions of an LLM,
+    e.g. to key a response cache. Transport settings are left out.
+
+    Args:
+        llm (BaseLanguageModel): The LLM.
+
+    Returns:
+        Dict[str, Any]: The params.
+    """
+    if isinstance(llm, ChatOpenAI):
+        params = {"model": llm.model_name, **llm._default_params}
+    else:
+        params = llm.dict()
+    return {key: value for key, value in params.items() if key not in _TRANSPORT_PARAMS}
+
+
+_TRANSPORT_PARAMS = {"verbose", "request_timeout", "max_retries", "stream", "streaming"}
+
+
+def warmup(llm: BaseLanguageModel) -> None:
+    """Prepare the llm for its first call, e.g. log in its client or resolve its
+    model. The llms without anything to prepare are left as they are."""
+    if hasattr(llm, "warmup"):
+        llm.warmup()
+
+
+def set_api_base(api_base: str) -> None:
+    """Point the OpenAI clients of the process, including the embeddings, at
+    another server, e.g. the fake LLM service.
+
+    Args:
+        api_base (str): The base URL of the API, e.g. http://localhost:8008/v1.
+    """
+    openai.api_base = api_base
+
+
+def _stream_test_response(response: str) -> Iterator[str]:
+    """Stream a canned test response word by word."""
+    yield from re.findall(r"\S+\s*", response)
+
+
+async def _astream_test_response(response: str) -> AsyncIterator[str]:
+    """Stream a canned test response word by word, asynchronously."""
+    for chunk in _stream_test_response(response):
+        yield chunk
+
+
+class ClientPool:
+    """A thread-safe pool of reusable client sessions.
+
+    Clients are created lazily up to max_size. When all of them are in use,
+    acquire blocks until one is released.
+    """
+
+    def __init__(self, factory: Callable[[], Any], max_size: int = 4):
+        """
+        Args:
+            factory (Callable[[], Any]): Creates a new client.
+            max_size (int): The max number of clients to keep.
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self._idle: List[Any] = []
+        self._num_created = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def acquire(self) -> Iterator[Any]:
+        """Borrow a client from the pool. A client that raised while borrowed is
+        discarded, as its session may be in a broken state.
+
+        Returns:
+            Iterator[Any]: The client, returned to the pool on exit.
+        """
+        with self._condition:
+            while not self._idle and self._num_created >= self.max_size:
+                self._condition.wait()
+            if self._idle:
+                client = self._idle.pop()
+            else:
+                self._num_created += 1
+                client = None
+        if client is None:
+            try:
+                client = self.factory()
+            except BaseException:
+                self._discard()
+                raise
+        try:
+            yield client
+        except BaseException:
+            self._discard()
+            raise
+        with self._condition:
+            self._idle.append(client)
+            self._condition.notify()
+
+    def _discard(self) -> None:
+        with self._condition:
+            self._num_created -= 1
+            self._condition.notify()
+
+    def reset(self) -> None:
+        """Drop all the idle clients, e.g. after forking a process."""
+        with self._condition:
+            self._num_created -= len(self._idle)
+            self._idle = []
+            self._condition.notify_all()
+
+    @property
+    def num_created(self) -> int:
+        """The number of clients alive, idle or borrowed."""
+        return self._num_created
+
+
+class AsyncClientPool:
+    """An asyncio pool of reusable client sessions, bound to one event loop.
+
+    Clients are created lazily up to max_size. When all of them are in use,
+    acquire waits until one is released.
+    """
+
+    def __init__(self, factory: Callable[[], Any], max_size: int = 16):
+        """
+        Args:
+            factory (Callable[[], Any]): A coroutine function that creates a client.
+            max_size (int): The max number of clients to keep.
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self._idle: List[Any] = []
+        self._num_created = 0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Any]:
+        """Borrow a client from the pool. A client that raised while borrowed is
+        discarded, as its session may be in a broken state.
+
+        Returns:
+            AsyncIterator[Any]: The client, returned to the pool on exit.
+        """
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: bool(self._idle) or self._num_created < self.max_size
+            )
+            if self._idle:
+                client = self._idle.pop()
+            else:
+                self._num_created += 1
+                client = None
+        if client is None:
+            try:
+                client = await self.factory()
+            except BaseException:
+                await self._discard()
+                raise
+        try:
+            yield client
+        except BaseException:
+            await self._discard()
+            raise
+        async with self._condition:
+            self._idle.append(client)
+            self._condition.notify()
+
+    async def _discard(self) -> None:
+        async with self._condition:
+            self._num_created -= 1
+            self._condition.notify()
+
+    @property
+    def num_created(self) -> int:
+        """The number of clients alive, idle or borrowed."""
+        return self._num_created
+
+
+class CachedValue:
+    """A thread-safe value that is loaded once and reloaded when older than ttl."""
+
+    def __init__(self, loader: Callable[[], Any], ttl_seconds: float = 3600):
+        """
+        Args:
+            loader (Callable[[], Any]): Loads the value.
+            ttl_seconds (float): Reload the value after this many seconds.
+        """
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self._value: Optional[Any] = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> Any:
+        """Get the value, loading it if missing or expired.
+
+        Returns:
+            Any: The value.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._value is None or now - self._loaded_at >= self.ttl_seconds:
+                self._value = self.loader()
+                self._loaded_at = now
+            return self._value
+
+    def invalidate(self) -> None:
+        """Force the next get to reload the value."""
+        with self._lock:
+            self._value = None
+
+
+_client_pools: Dict[tuple, ClientPool] = {}
+_palm_models: Dict[str, CachedValue] = {}
+# The key PaLM was last configured with, as the configuration is global.
+_palm_api_key: Optional[str] = None
+_registry_lock = threading.Lock()
+# The async clients are bound to the event loop that created them.
+_async_client_pools: "weakref.WeakKeyDictionary[Any, Dict[tuple, AsyncClientPool]]" = (
+    weakref.WeakKeyDictionary()
+)
+_aiohttp_sessions: "weakref.WeakKeyDictionary[Any, aiohttp.ClientSession]" = (
+    weakref.WeakKeyDictionary()
+)
+PALM_API_BASE = "https://generativelanguage.googleapis.com/v1beta2"
+
+
+def _client_pool(backend: str, token: str, factory: Callable[[], Any]) -> ClientPool:
+    """Get the shared client pool of a backend and credential."""
+    with _registry_lock:
+        pool = _client_pools.get((backend, token))
+        if pool is None:
+            pool = _client_pools[(backend, token)] = ClientPool(factory)
+        return pool
+
+
+def _async_client_pool(
+    backend: str, token: str, factory: Callable[[], Any]
+) -> AsyncClientPool:
+    """Get the client pool of a backend and credential on the running event loop."""
+    pools = _async_client_pools.setdefault(asyncio.get_running_loop(), {})
+    pool = pools.get((backend, token))
+    if pool is None:
+        pool = pools[(backend, token)] = AsyncClientPool(factory)
+    return pool
+
+
+def _aiohttp_session() -> aiohttp.ClientSession:
+    """Get the HTTP session shared by the async calls on the running event loop."""
+    loop = asyncio.get_running_loop()
+    session = _aiohttp_sessions.get(loop)
+    if session is None or session.closed:
+        session = _aiohttp_sessions[loop] = aiohttp.ClientSession()
+    return session
+
+
+async def aclose_clients() -> None:
+    """Close the async clients of the running event loop, e.g. before it stops."""
+    loop = asyncio.get_running_loop()
+    _async_client_pools.pop(loop, None)
+    session = _aiohttp_sessions.pop(loop, None)
+    if session is not None:
+        await session.close()
+
+
+def reset_clients() -> None:
+    """Drop all the pooled clients and cached models, e.g. after forking a process."""
+    global _palm_api_key
+    with _registry_lock:
+        for pool in _client_pools.values():
+            pool.reset()
+        _client_pools.clear()
+        _palm_models.clear()
+        _palm_api_key = None
+
+
+def _reset_clients_after_fork() -> None:
+    """Drop the clients inherited through a fork, e.g. by the workers of the
+    pre-fork server: they share their connections with the parent, and a lock may
+    be held by a parent thread that does not exist in the child. Each process then
+    creates its own clients."""
+    global _registry_lock, _palm_api_key
+    _registry_lock = threading.Lock()
+    _client_pools.clear()
+    _palm_models.clear()
+    _palm_api_key = None
+    _async_client_pools.clear()
+    _aiohttp_sessions.clear()
+
+
+os.register_at_fork(after_in_child=_reset_clients_after_fork)
+
+
+def _reset_bard_conversation(bard: BardChat) -> None:
+    """Start a new conversation on a pooled Bard client so calls stay independent."""
+    for attr in ["conversation_id", "response_id", "choice_id"]:
+        if hasattr(bard, attr):
+            setattr(bard, attr, "")
+
+
+def _configure_palm(api_key: str) -> None:
+    """Configure PaLM with the key, unless it already is."""
+    global _palm_api_key
+    with _registry_lock:
+        if _palm_api_key != api_key:
+            palm.configure(api_key=api_key)
+            _palm_api_key = api_key
+
+
+def _resolve_palm_model(api_key: str) -> str:
+    """Pick the first model that the key can generate text with."""
+    _configure_palm(api_key)
+    models = [
+        m
+        for m in palm.list_models()
+        if "generateText" in m.supported_generation_methods
+    ]
+    return models[0].name
 
 
 class ChatGPT(LLM):
@@ -20,6 +430,16 @@ class ChatGPT(LLM):
     def _llm_type(self) -> str:
         return "ChatGPT"
 
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "test_mode": self.test_mode,
+        }
+
+    @tracing.traced()
     def _call(
         self,
         prompt: str,
@@ -52,6 +472,96 @@ class ChatGPT(LLM):
         )
         return response.choices[0].message.content  # type: ignore
 
+    @tracing.traced()
+    def stream(self, prompt: str, stop: Optional[List[str]] = None) -> Iterator[str]:
+        """Stream the LLM response token by token. In test mode, stream a test response.
+
+        Args:
+            prompt (str): The prompt to the LLM.
+            stop (Optional[List[str]]): The stop tokens. Will be ignored.
+
+        Returns:
+            Iterator[str]: The text deltas of the response.
+        """
+        if self.test_mode:
+            yield from _stream_test_response("This is a test chatgpt response.")
+            return
+
+        # Check token availability.
+        access_token = os.getenv("OPENAI_API_KEY")
+        if not access_token:
+            yield "Please set OPENAI_API_KEY before chatting with ChatGPT."
+            return
+
+        for chunk in openai.ChatCompletion.create(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            stream=True,
+        ):
+            yield chunk.choices[0].delta.get("content", "")  # type: ignore
+
+    @tracing.traced()
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        """Call the LLM without blocking the event loop. In test mode, return a
+        test response.
+
+        Args:
+            prompt (str): The prompt to the LLM.
+            stop (Optional[List[str]]): The stop tokens. Will be ignored.
+
+        Returns:
+            str: The response from the LLM.
+        """
+        return "".join([chunk async for chunk in self._astream(prompt, stream=False)])
+
+    @tracing.traced()
+    async def astream(
+        self, prompt: str, stop: Optional[List[str]] = None
+    ) -> AsyncIterator[str]:
+        """Stream the LLM response token by token without blocking the event loop.
+        In test mode, stream a test response.
+
+        Args:
+            prompt (str): The prompt to the LLM.
+            stop (Optional[List[str]]): The stop tokens. Will be ignored.
+
+        Returns:
+            AsyncIterator[str]: The text deltas of the response.
+        """
+        async for chunk in self._astream(prompt, stream=True):
+            yield chunk
+
+    async def _astream(self, prompt: str, stream: bool) -> AsyncIterator[str]:
+        if self.test_mode:
+            async for chunk in _astream_test_response(
+                "This is a test chatgpt response."
+            ):
+                yield chunk
+            return
+
+        # Check token availability.
+        access_token = os.getenv("OPENAI_API_KEY")
+        if not access_token:
+            yield "Please set OPENAI_API_KEY before chatting with ChatGPT."
+            return
+
+        # Reuse the connections of the event loop instead of a session per call.
+        openai.aiosession.set(_aiohttp_session())
+        response = await openai.ChatCompletion.acreate(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            stream=stream,
+        )
+        if not stream:
+            yield response.choices[0].message.content  # type: ignore
+            return
+        async for chunk in response:  # type: ignore
+            yield chunk.choices[0].delta.get("content", "")  # type: ignore
+
 
 class RevChatGPT(LLM):
     test_mode: bool = False
@@ -60,6 +570,11 @@ class RevChatGPT(LLM):
     def _llm_type(self) -> str:
         return "RevChatGPT"
 
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"test_mode": self.test_mode}
+
+    @tracing.traced()
     def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
         """Call the LLM. In test mode, return a test response.
 
@@ -70,24 +585,107 @@ class RevChatGPT(LLM):
         Returns:
             str: The response from the LLM.
         """
-        response = ""
+        return "".join(self.stream(prompt, stop=stop))
+
+    @tracing.traced()
+    def stream(self, prompt: str, stop: Optional[List[str]] = None) -> Iterator[str]:
+        """Stream the LLM response. In test mode, stream a test response.
+
+        Args:
+            prompt (str): The prompt to the LLM.
+            stop (Optional[List[str]]): The stop tokens. Will be ignored.
+
+        Returns:
+            Iterator[str]: The text deltas of the response.
+        """
         if self.test_mode:
-            response = "This is a test revchatgpt response."
-            return response
+            yield from _stream_test_response("This is a test revchatgpt response.")
+            return
 
         # Check token availability.
         access_token = os.getenv("CHATGPT_ACCESS_TOKEN")
         if not access_token:
-            return "Please set CHATGPT_ACCESS_TOKEN before chatting with ChatGPT."
-
-        chatgpt = Chatbot(
-            config={
-                "access_token": access_token,
-            }
+            yield "Please set CHATGPT_ACCESS_TOKEN before chatting with ChatGPT."
+            return
+
+        with self._pool(access_token).acquire() as chatgpt:
+            # Every prompt starts a new conversation, as with a fresh client.
+            chatgpt.reset_chat()
+            # The chatbot yields the whole message so far on every update.
+            yield from utils.iter_text_deltas(
+                data["message"] for data in chatgpt.ask(prompt)
+            )
+
+    def warmup(self) -> None:
+        """Log in a pooled client ahead of the first call."""
+        access_token = os.getenv("CHATGPT_ACCESS_TOKEN")
+        if self.test_mode or not access_token:
+            return
+        with self._pool(access_token).acquire():
+            pass
+
+    def _pool(self, access_token: str) -> ClientPool:
+        return _client_pool(
+            "RevChatGPT",
+            access_token,
+            lambda: Chatbot(config={"access_token": access_token}),
         )
-        for data in chatgpt.ask(prompt):
-            response = data["message"]
-        return response
+
+    @tracing.traced()
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        """Call the LLM without blocking the event loop. In test mode, return a
+        test response.
+
+        Args:
+            prompt (str): The prompt to the LLM.
+            stop (Optional[List[str]]): The stop tokens. Will be ignored.
+
+        Returns:
+            str: The response from the LLM.
+        """
+        return "".join([chunk async for chunk in self.astream(prompt, stop=stop)])
+
+    @tracing.traced()
+    async def astream(
+        self, prompt: str, stop: Optional[List[str]] = None
+    ) -> AsyncIterator[str]:
+        """Stream the LLM response without blocking the event loop. In test mode,
+        stream a test response.
+
+        Args:
+            prompt (str): The prompt to the LLM.
+            stop (Optional[List[str]]): The stop tokens. Will be ignored.
+
+        Returns:
+            AsyncIterator[str]: The text deltas of the response.
+        """
+        if self.test_mode:
+            async for chunk in _astream_test_response(
+                "This is a test revchatgpt response."
+            ):
+                yield chunk
+            return
+
+        # Check token availability.
+        access_token = os.getenv("CHATGPT_ACCESS_TOKEN")
+        if not access_token:
+            yield "Please set CHATGPT_ACCESS_TOKEN before chatting with ChatGPT."
+            return
+
+        async def create_client() -> AsyncChatbot:
+            return AsyncChatbot(config={"access_token": access_token})
+
+        pool = _async_client_pool("RevChatGPT", access_token, create_client)
+        async with pool.acquire() as chatgpt:
+            chatgpt.reset_chat()
+            # The chatbot yields the whole message so far on every update.
+            # As iter_text_deltas, a rewritten message is emitted whole.
+            message = ""
+            async for data in chatgpt.ask(prompt):
+                delta = utils.text_delta(message, data["message"])
+                message = data["message"]
+                if delta:
+                    yield delta
 
 
 class RevBard(LLM):
@@ -97,6 +695,11 @@ class RevBard(LLM):
     def _llm_type(self) -> str:
         return "RevBard"
 
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"test_mode": self.test_mode}
+
+    @tracing.traced()
     def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
         """Call the LLM. In test mode, return a test response.
 
@@ -117,21 +720,131 @@ class RevBard(LLM):
         if not access_token:
             return "Please set BARD_SESSION_TOKEN before chatting with Bard."
 
-        bard = BardChat(session_id=os.getenv("BARD_SESSION_TOKEN"))
-        response = bard.ask(message=prompt)
+        with self._pool(access_token).acquire() as bard:
+            _reset_bard_conversation(bard)
+            response = bard.ask(message=prompt)
         return response["content"]  # type: ignore
 
+    def warmup(self) -> None:
+        """Log in a pooled client ahead of the first call."""
+        access_token = os.getenv("BARD_SESSION_TOKEN")
+        if self.test_mode or not access_token:
+            return
+        with self._pool(access_token).acquire():
+            pass
+
+    def _pool(self, access_token: str) -> ClientPool:
+        return _client_pool(
+            "RevBard", access_token, lambda: BardChat(session_id=access_token)
+        )
+
+    @tracing.traced()
+    def stream(self, prompt: str, stop: Optional[List[str]] = None) -> Iterator[str]:
+        """Stream the LLM response. Bard does not stream, so the whole response
+        is yielded as a single chunk.
+
+        Args:
+            prompt (str): The prompt to the LLM.
+            stop (Optional[List[str]]): The stop tokens. Will be ignored.
+
+        Returns:
+            Iterator[str]: The text deltas of the response.
+        """
+        yield self._call(prompt, stop=stop)
+
+    @tracing.traced()
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        """Call the LLM without blocking the event loop. In test mode, return a
+        test response.
+
+        Args:
+            prompt (str): The prompt to the LLM.
+            stop (Optional[List[str]]): The stop tokens. Will be ignored.
+
+        Returns:
+            str: The response from the LLM.
+        """
+        if self.test_mode:
+            return "This is a test revbard response."
+
+        # Check token availability.
+        access_token = os.getenv("BARD_SESSION_TOKEN")
+        if not access_token:
+            return "Please set BARD_SESSION_TOKEN before chatting with Bard."
+
+        async def create_client() -> BardAsyncChat:
+            return await BardAsyncChat.create(session_id=access_token)
+
+        pool = _async_client_pool("RevBard", access_token, create_client)
+        async with pool.acquire() as bard:
+            _reset_bard_conversation(bard)
+            response = await bard.ask(message=prompt)
+        return response["content"]
+
+    @tracing.traced()
+    async def astream(
+        self, prompt: str, stop: Optional[List[str]] = None
+    ) -> AsyncIterator[str]:
+        """Stream the LLM response without blocking the event loop. Bard does not
+        stream, so the whole response is yielded as a single chunk.
+
+        Args:
+            prompt (str): The prompt to the LLM.
+            stop (Optional[List[str]]): The stop tokens. Will be ignored.
+
+        Returns:
+            AsyncIterator[str]: The text deltas of the response.
+        """
+        yield await self._acall(prompt, stop=stop)
+
 
 class PaLM(LLM):
     test_mode: bool = False
-    model: str = "chat-bison-001"
+    # The model to generate with. Empty to use the first model that the key can
+    # generate text with.
+    model: str = ""
     max_tokens: int = 800
     temperature: float = 0
+    model_refresh_interval: float = 3600
 
     @property
     def _llm_type(self) -> str:
         return "PaLM"
 
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "test_mode": self.test_mode,
+        }
+
+    def warmup(self) -> None:
+        """Resolve the model ahead of the first call."""
+        api_key = os.getenv("PALM_API_KEY")
+        if self.test_mode or not api_key:
+            return
+        _configure_palm(api_key)
+        self._resolve_model(api_key)
+
+    def _resolve_model(self, api_key: str) -> str:
+        """The configured model, or else the one resolved for the key."""
+        return self.model or self._cached_model(api_key).get()
+
+    def _cached_model(self, api_key: str) -> CachedValue:
+        """Get the model resolved for the key. PaLM is configured and the model
+        resolved once per key and refresh interval, not on every call."""
+        with _registry_lock:
+            cached_model = _palm_models.get(api_key)
+            if cached_model is None:
+                cached_model = _palm_models[api_key] = CachedValue(
+                    functools.partial(_resolve_palm_model, api_key),
+                    ttl_seconds=self.model_refresh_interval,
+                )
+            return cached_model
+
+    @tracing.traced()
     def _call(
         self,
         prompt: str,
@@ -156,16 +869,9 @@ class PaLM(LLM):
         if not api_key:
             return "Please set PALM_API_KEY before chatting with PaLM."
 
-        palm.configure(api_key=api_key)
-        models = [
-            m
-            for m in palm.list_models()
-            if "generateText" in m.supported_generation_methods
-        ]
-        self.model = models[0].name
-
+        _configure_palm(api_key)
         response = palm.generate_text(
-            model=self.model,
+            model=self._resolve_model(api_key),
             prompt=prompt,
             temperature=self.temperature,
             max_output_tokens=self.max_tokens,
@@ -173,3 +879,74 @@ class PaLM(LLM):
         if not response or not "result" in response:
             return "No response from PaLM"
         return str(response.result)  # type: ignore
+
+    @tracing.traced()
+    def stream(self, prompt: str, stop: Optional[List[str]] = None) -> Iterator[str]:
+        """Stream the LLM response. PaLM does not stream, so the whole response
+        is yielded as a single chunk.
+
+        Args:
+            prompt (str): The prompt to the LLM.
+            stop (Optional[List[str]]): The stop tokens. Will be ignored.
+
+        Returns:
+            Iterator[str]: The text deltas of the response.
+        """
+        yield self._call(prompt, stop=stop)
+
+    @tracing.traced()
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        """Call the LLM through the REST API without blocking the event loop.
+        In test mode, return a test response.
+
+        Args:
+            prompt (str): The prompt to the LLM.
+            stop (Optional[List[str]]): The stop tokens. Will be ignored.
+
+        Returns:
+            str: The response from the LLM.
+        """
+        if self.test_mode:
+            return "This is a test PaLM response."
+
+        # Check token availability.
+        api_key = os.getenv("PALM_API_KEY")
+        if not api_key:
+            return "Please set PALM_API_KEY before chatting with PaLM."
+
+        # The model is resolved once per refresh interval, so a thread is fine.
+        model = await asyncio.get_running_loop().run_in_executor(
+            None, self._resolve_model, api_key
+        )
+
+        async with _aiohttp_session().post(
+            f"{PALM_API_BASE}/{model}:generateText",
+            params={"key": api_key},
+            json={
+                "prompt": {"text": prompt},
+                "temperature": self.temperature,
+                "maxOutputTokens": self.max_tokens,
+            },
+        ) as response:
+            response.raise_for_status()
+            result = await response.json()
+        candidates = result.get("candidates")
+        if not candidates:
+            return "No response from PaLM"
+        return str(candidates[0]["output"])
+
+    @tracing.traced()
+    async def astream(
+        self, prompt: str, stop: Optional[List[str]] = None
+    ) -> AsyncIterator[str]:
+        """Stream the LLM response without blocking the event loop. PaLM does not
+        stream, so the whole response is yielded as a single chunk.
+
+        Args:
+            prompt (str): The prompt to the LLM.
+            stop (Optional[List[str]]): The stop tokens. Will be ignored.
+
+        Returns:
+            AsyncIterator[str]: The text deltas of the response.
+        """
+        yield await self._acall(prompt, stop=stop)
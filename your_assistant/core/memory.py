@@ -0,0 +1,577 @@
+"""Core logic of the conversation memories.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+import langchain.schema as schema
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain.schema import BaseMessage, get_buffer_string
+from pydantic import Field
+
+import your_assistant.core.tracing as tracing
+import your_assistant.core.utils as utils
+
+# The session used when the caller does not identify the conversation.
+DEFAULT_SESSION_ID = "default"
+
+# The threads that summarize the memories of all the sessions in the background.
+SUMMARY_WORKERS = 4
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _summary_executor() -> ThreadPoolExecutor:
+    """The summary threads shared by the memories, started on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=SUMMARY_WORKERS, thread_name_prefix="AsyncSummaryMemory"
+            )
+        return _executor
+
+
+def _reset_executor_after_fork() -> None:
+    """Drop the summary threads inherited through a fork, which do not exist in the
+    child. Each process then starts its own."""
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_executor_after_fork)
+
+
+class IncrementalSummaryBufferMemory(ConversationSummaryBufferMemory):
+    """A summary buffer memory that counts the tokens of each message only once.
+
+    ConversationSummaryBufferMemory re-counts the tokens of the whole buffer on every
+    save, and again for every message it prunes. This memory keeps the token count of
+    each message, computed when the message is inserted, and a running total. So
+    deciding what to prune costs O(1) amortized per message.
+    """
+
+    message_token_counts: Deque[int] = Field(default_factory=deque)
+    buffer_token_count: int = 0
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        """Save context from this conversation to buffer, and prune it if needed."""
+        self.append_context(inputs, outputs)
+        pruned = self.messages_to_prune()
+        if pruned:
+            self.moving_summary_buffer = self.predict_new_summary(
+                pruned, self.moving_summary_buffer
+            )
+            self.remove_pruned(len(pruned))
+
+    def append_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        """Append the turn to the buffer without pruning it."""
+        num_messages = len(self.chat_memory.messages)
+        # Bypass the pruning of ConversationSummaryBufferMemory.save_context.
+        super(ConversationSummaryBufferMemory, self).save_context(inputs, outputs)
+        self._count_tokens(self.chat_memory.messages[num_messages:])
+
+    def set_messages(self, messages: List[BaseMessage]) -> None:
+        """Replace the messages in the buffer, e.g. to restore a saved memory."""
+        self.chat_memory.messages = list(messages)
+        self.message_token_counts.clear()
+        self.buffer_token_count = 0
+        self._count_tokens(self.chat_memory.messages)
+
+    def messages_to_prune(self) -> List[BaseMessage]:
+        """Find the oldest messages to fold into the summary to fit the token limit."""
+        num_pruned, token_count = 0, self.buffer_token_count
+        while token_count > self.max_token_limit:
+            token_count -= self.message_token_counts[num_pruned]
+            num_pruned += 1
+        return self.chat_memory.messages[:num_pruned]
+
+    def remove_pruned(self, num_pruned: int) -> None:
+        """Remove the oldest messages once they are folded into the summary."""
+        del self.chat_memory.messages[:num_pruned]
+        for _ in range(num_pruned):
+            self.buffer_token_count -= self.message_token_counts.popleft()
+
+    def clear(self) -> None:
+        super().clear()
+        self.message_token_counts.clear()
+        self.buffer_token_count = 0
+
+    def _count_tokens(self, messages: List[BaseMessage]) -> None:
+        for message in messages:
+            token_count = self.llm.get_num_tokens(
+                get_buffer_string(
+                    [message], human_prefix=self.human_prefix, ai_prefix=self.ai_prefix
+                )
+            )
+            self.message_token_counts.append(token_count)
+            self.buffer_token_count += token_count
+
+
+class AsyncSummaryMemory:
+    """Keep the summarization of a conversation memory off the critical path.
+
+    A saved turn is appended to the buffer right away, so the next request sees it
+    without delay. Pruning the buffer into the summary needs another llm call, and
+    is done in the background once every few turns, by the summary threads shared
+    by all the memories. A request only waits for the summarization when too many
+    turns are pending it.
+    """
+
+    def __init__(
+        self,
+        memory: IncrementalSummaryBufferMemory,
+        coalesce_turns: int = 3,
+        max_pending_turns: int = 8,
+        executor: Optional[Executor] = None,
+    ):
+        """Initialize the memory.
+
+        Args:
+            memory (IncrementalSummaryBufferMemory): The memory to update.
+            coalesce_turns (int): The number of turns to save before summarizing.
+            max_pending_turns (int): The number of unsummarized turns after which
+                loading the memory waits for the summarization.
+            executor (Optional[Executor]): Run the summarizations. Defaults to the
+                summary threads shared by the memories.
+        """
+        if coalesce_turns < 1 or max_pending_turns < coalesce_turns:
+            raise ValueError(
+                f"Invalid coalesce turns [{coalesce_turns}] "
+                + f"and max pending turns [{max_pending_turns}]."
+            )
+        self.memory = memory
+        self.coalesce_turns = coalesce_turns
+        self.max_pending_turns = max_pending_turns
+        self.executor = executor
+        self.logger = utils.Logger("AsyncSummaryMemory")
+        self._pending_turns = 0
+        self._size = 0
+        # Called with the change of the size, e.g. by a store of many memories.
+        self._on_resize: Optional[Callable[[int], None]] = None
+        self._generation = 0
+        # Whether a summarization is scheduled or running. There is at most one.
+        self._summarizing = False
+        self._flush_requested = False
+        # The failed summarizations, which leave their turns pending.
+        self._failures = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+    @property
+    def pending_turns(self) -> int:
+        """The number of saved turns that have not been summarized yet."""
+        return self._pending_turns
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the history, waiting for the summarization only if it is overdue.
+        If the summarization fails, the history keeps the turns unsummarized."""
+        with self._condition:
+            if self._pending_turns >= self.max_pending_turns:
+                self._flush_requested = True
+                self._schedule()
+                failures = self._failures
+                self._condition.wait_for(
+                    lambda: self._pending_turns < self.max_pending_turns
+                    or self._closed
+                    or (self._failures > failures and not self._summarizing)
+                )
+            return self.memory.load_memory_variables(inputs)
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        """Append the turn to the buffer and schedule its summarization."""
+        with self._condition:
+            num_messages = len(self.memory.chat_memory.messages)
+            self.memory.append_context(inputs, outputs)
+            self._resize(
+                self._size
+                + self._messages_size(self.memory.chat_memory.messages[num_messages:])
+            )
+            self._pending_turns += 1
+            self._schedule()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Summarize all the pending turns and wait until it is done.
+
+        Args:
+            timeout (Optional[float]): The maximum seconds to wait.
+
+        Returns:
+            bool: Whether all the pending turns are summarized.
+        """
+        with self._condition:
+            self._flush_requested = True
+            self._schedule()
+            failures = self._failures
+            self._condition.wait_for(
+                lambda: not self._summarizing
+                and (
+                    self._pending_turns == 0
+                    or self._closed
+                    or self._failures > failures
+                ),
+                timeout=timeout,
+            )
+            return self._pending_turns == 0 and not self._summarizing
+
+    def clear(self) -> None:
+        with self._condition:
+            self.memory.clear()
+            self._pending_turns = 0
+            self._resize(0)
+            self._generation += 1
+
+    def close(self, wait: bool = True) -> None:
+        """Stop summarizing. Pending turns stay unsummarized in the buffer.
+
+        Args:
+            wait (bool): Whether to wait for an ongoing summarization to finish.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            if wait:
+                self._condition.wait_for(lambda: not self._summarizing)
+
+    def snapshot(self) -> Tuple[str, List[BaseMessage]]:
+        """Return the current summary and the messages in the buffer."""
+        with self._condition:
+            return (
+                self.memory.moving_summary_buffer,
+                list(self.memory.chat_memory.messages),
+            )
+
+    def restore(self, summary: str, messages: List[BaseMessage]) -> None:
+        """Restore the memory from a snapshot. Restored turns count as pending."""
+        with self._condition:
+            # A summarization in progress was of the replaced messages.
+            self._generation += 1
+            self.memory.moving_summary_buffer = summary
+            self.memory.set_messages(messages)
+            self._pending_turns = len(messages) // 2
+            self._resize(len(summary) + self._messages_size(messages))
+            self._schedule()
+
+    def size(self) -> int:
+        """The approximate size of the memory in characters."""
+        return self._size
+
+    def watch_size(self, on_resize: Optional[Callable[[int], None]]) -> int:
+        """Call back with each change of the size, or stop with None.
+
+        Args:
+            on_resize (Optional[Callable[[int], None]]): Called with the change of
+                the size, with the lock of the memory held.
+
+        Returns:
+            int: The size when the callback is set.
+        """
+        with self._condition:
+            self._on_resize = on_resize
+            return self._size
+
+    def _resize(self, size: int) -> None:
+        """Set the size. Call it with the lock held."""
+        delta, self._size = size - self._size, size
+        if delta and self._on_resize:
+            self._on_resize(delta)
+
+    def _schedule(self) -> None:
+        """Schedule a summarization if one is due. Call it with the lock held."""
+        if self._closed or self._summarizing:
+            return
+        if self._pending_turns >= self.coalesce_turns or (
+            self._flush_requested and self._pending_turns > 0
+        ):
+            self._summarizing = True
+            (self.executor or _summary_executor()).submit(tracing.bind(self._summarize))
+
+    def _summarize(self) -> None:
+        with self._condition:
+            if self._closed:
+                self._summarizing = False
+                self._condition.notify_all()
+                return
+            self._flush_requested = False
+            pending_turns, generation = self._pending_turns, self._generation
+            pruned = self.memory.messages_to_prune()
+            summary = self.memory.moving_summary_buffer
+        failed = False
+        try:
+            if pruned:
+                # The llm call runs without the lock so that requests can go on.
+                with tracing.span(
+                    "memory.summarize",
+                    turns=pending_turns,
+                    pruned_messages=len(pruned),
+                ):
+                    summary = self.memory.predict_new_summary(pruned, summary)
+        except Exception as e:
+            # The turns stay pending, to be summarized with the next ones.
+            self.logger.error(f"Failed to summarize the memory: {e}")
+            failed = True
+        with self._condition:
+            self._summarizing = False
+            if failed:
+                self._failures += 1
+            else:
+                if generation == self._generation:
+                    # Only one summarization runs at a time, so the pruned
+                    # messages are still the first ones.
+                    self.memory.remove_pruned(len(pruned))
+                    self._resize(
+                        self._size
+                        + len(summary)
+                        - len(self.memory.moving_summary_buffer)
+                        - self._messages_size(pruned)
+                    )
+                    self.memory.moving_summary_buffer = summary
+                    self._pending_turns -= pending_turns
+                # The turns saved meanwhile may be due already.
+                self._schedule()
+            self._condition.notify_all()
+
+    @staticmethod
+    def _messages_size(messages: List[BaseMessage]) -> int:
+        return sum(len(message.content) for message in messages)
+
+
+class SessionMemoryStore:
+    """Keep one conversation memory per session.
+
+    The resident memories are bounded by the number of sessions, an idle time-to-live
+    and a global budget in characters. Sessions evicted from RAM are spilled to a
+    local sqlite database, from which they are loaded back when the session returns,
+    and deleted once they are cold for longer than a time-to-live. The sessions
+    pinned by the requests in flight are not evicted, so the bounds may be exceeded
+    while they are.
+
+    Several processes may share the database, e.g. the workers of the http service,
+    with shared set. Each session is then written to it once its request is done,
+    and loaded again when another process wrote it since.
+    """
+
+    def __init__(
+        self,
+        memory_factory: Callable[[], AsyncSummaryMemory],
+        namespace: str,
+        db_path: str = "",
+        max_sessions: int = 100,
+        ttl_seconds: float = 3600,
+        max_total_size: int = 1000000,
+        spilled_ttl_seconds: float = 2592000,
+        shared: bool = False,
+    ):
+        """Initialize the store.
+
+        Args:
+            memory_factory (Callable[[], AsyncSummaryMemory]): Create an empty memory.
+            namespace (str): Separate the sessions of different owners in the db.
+            db_path (str): The path to the sqlite db. Spilled sessions are dropped
+                if empty.
+            max_sessions (int): The maximum number of sessions kept in RAM.
+            ttl_seconds (float): The idle seconds after which a session is spilled.
+            max_total_size (int): The maximum characters of all the sessions in RAM.
+            spilled_ttl_seconds (float): The seconds after which a session spilled
+                to the db and not used since is deleted.
+            shared (bool): Whether other processes use the sessions in the db.
+        """
+        if max_sessions < 1:
+            raise ValueError(f"Invalid max sessions [{max_sessions}].")
+        self.memory_factory = memory_factory
+        self.namespace = namespace
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_total_size = max_total_size
+        self.spilled_ttl_seconds = spilled_ttl_seconds
+        self.shared = shared and bool(db_path)
+        self.logger = utils.Logger("SessionMemoryStore")
+        # Session id -> (memory, last access time), in least recently used order.
+        self._sessions: OrderedDict[
+            str, Tuple[AsyncSummaryMemory, float]
+        ] = OrderedDict()
+        # The size of all the sessions in RAM, kept up to date by their memories.
+        self._total_size = 0
+        self._size_lock = threading.Lock()
+        # Session id -> the updated_at of its row when it was last loaded or written.
+        self._versions: Dict[str, float] = {}
+        # Session id -> number of requests in flight using its memory.
+        self._pins: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (namespace TEXT, session_id TEXT, "
+                + "summary TEXT, messages TEXT, updated_at REAL, "
+                + "PRIMARY KEY (namespace, session_id))"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_updated_at "
+                + "ON sessions (namespace, updated_at)"
+            )
+            self._delete_expired()
+            self._db.commit()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, session_id: str) -> AsyncSummaryMemory:
+        """Get the memory of the session, loading it from the db if it is cold.
+
+        Args:
+            session_id (str): The id of the session.
+
+        Returns:
+            AsyncSummaryMemory: The memory of the session.
+        """
+        with self._lock:
+            now = time.time()
+            if session_id in self._sessions:
+                memory, _ = self._sessions.pop(session_id)
+                if self.shared:
+                    self._load(session_id=session_id, memory=memory, if_changed=True)
+            else:
+                memory = self.memory_factory()
+                self._add_size(memory.watch_size(self._add_size))
+                self._load(session_id=session_id, memory=memory)
+            self._sessions[session_id] = (memory, now)
+            self._evict(now=now, keep=session_id)
+            return memory
+
+    @contextmanager
+    def pin(self, session_id: str) -> Iterator[None]:
+        """Keep the memory of the session in RAM while a request uses it, from
+        loading its history to saving its turn. Otherwise another session could
+        evict it meanwhile, and the turn would be saved to a spilled memory. With
+        shared set, the session is written to the db once it is unpinned.
+
+        Args:
+            session_id (str): The id of the session.
+        """
+        with self._lock:
+            self._pins[session_id] = self._pins.get(session_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins[session_id] -= 1
+                if self._pins[session_id] == 0:
+                    del self._pins[session_id]
+                    if self.shared and session_id in self._sessions:
+                        self._write(session_id, self._sessions[session_id][0])
+
+    def total_size(self) -> int:
+        """The approximate size in characters of all the sessions in RAM."""
+        return self._total_size
+
+    def close(self) -> None:
+        """Spill all the sessions to the db and stop their workers."""
+        with self._lock:
+            for session_id in list(self._sessions):
+                self._spill(session_id)
+            if self._db:
+                self._db.close()
+                self._db = None
+
+    def _evict(self, now: float, keep: str) -> None:
+        """Spill the least recently used sessions until the store is within bounds,
+        but for the pinned ones."""
+        for session_id, (_, last_access) in list(self._sessions.items()):
+            if session_id == keep:
+                break
+            if (
+                len(self._sessions) <= self.max_sessions
+                and self.total_size() <= self.max_total_size
+                and now - last_access <= self.ttl_seconds
+            ):
+                break
+            if session_id not in self._pins:
+                self._spill(session_id)
+
+    def _add_size(self, delta: int) -> None:
+        # The memories call it with their own lock held, so it takes no other.
+        with self._size_lock:
+            self._total_size += delta
+
+    def _spill(self, session_id: str) -> None:
+        memory, _ = self._sessions.pop(session_id)
+        self._add_size(-memory.watch_size(None))
+        # Do not wait for an ongoing summarization; the snapshot keeps its input.
+        memory.close(wait=False)
+        if not self._db:
+            return
+        self._write(session_id, memory)
+        self._versions.pop(session_id, None)
+        self._delete_expired()
+        self._db.commit()
+        self.logger.info(f"Spilled session {session_id} to the db.")
+
+    def _write(self, session_id: str, memory: AsyncSummaryMemory) -> None:
+        if not self._db:
+            return
+        summary, messages = memory.snapshot()
+        updated_at = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)",
+            (
+                self.namespace,
+                session_id,
+                summary,
+                json.dumps(schema.messages_to_dict(messages)),
+                updated_at,
+            ),
+        )
+        self._db.commit()
+        self._versions[session_id] = updated_at
+
+    def _delete_expired(self) -> None:
+        """Delete the sessions spilled for longer than their time-to-live, e.g. the
+        ones of the clients that never came back."""
+        if not self._db:
+            return
+        self._db.execute(
+            "DELETE FROM sessions WHERE namespace = ? AND updated_at < ?",
+            (self.namespace, time.time() - self.spilled_ttl_seconds),
+        )
+
+    def _load(
+        self, session_id: str, memory: AsyncSummaryMemory, if_changed: bool = False
+    ) -> None:
+        """Restore the memory from the db.
+
+        Args:
+            session_id (str): The id of the session.
+            memory (AsyncSummaryMemory): The memory to restore.
+            if_changed (bool): Only if another process wrote the session since this
+                one loaded or wrote it.
+        """
+        if not self._db:
+            return
+        if if_changed:
+            row = self._db.execute(
+                "SELECT updated_at FROM sessions WHERE namespace = ? "
+                + "AND session_id = ?",
+                (self.namespace, session_id),
+            ).fetchone()
+            if row is None or row[0] == self._versions.get(session_id):
+                return
+        row = self._db.execute(
+            "SELECT summary, messages, updated_at FROM sessions WHERE namespace = ? "
+            + "AND session_id = ?",
+            (self.namespace, session_id),
+        ).fetchone()
+        if row:
+            memory.restore(
+                summary=row[0], messages=schema.messages_from_dict(json.loads(row[1]))
+            )
+            self._versions[session_id] = row[2]
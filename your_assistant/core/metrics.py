@@ -0,0 +1,289 @@
+"""Account the tokens and the latency of the LLM and embedding calls.
+"""
+import asyncio
+import json
+import math
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from langchain.embeddings.base import Embeddings
+
+import your_assistant.core.prometheus as prometheus
+from your_assistant.core.cache import ResponseCache
+
+# The cache outcomes of a call. Only the calls that reached the backend are
+# charged tokens: "miss", "bypass" (not cacheable) and "off" (no cache).
+CACHE_STATUSES = ["hit", "miss", "bypass", "off", "coalesced"]
+UPSTREAM_CACHE_STATUSES = ["miss", "bypass", "off"]
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text: str) -> int:
+    """Estimate the tokens of the text as its words and punctuation marks. The
+    tokenizers of the backends differ, and some need a download, so the counts are
+    an approximation that is comparable across backends."""
+    return len(_TOKEN_PATTERN.findall(text))
+
+
+def _percentile(values: List[float], percentile: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    rank = math.ceil(percentile / 100 * len(values)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class CallMetrics:
+    """The measurements of a call, filled in by the caller while the call runs."""
+
+    def __init__(self, kind: str, backend: str, prompt: Any):
+        self.kind = kind
+        self.backend = backend
+        self.prompt = prompt
+        self.response: Any = ""
+        self.cache = "off"
+        self.error = False
+        self.latency = 0.0
+        self.time_to_first_token: Optional[float] = None
+        self._start = time.perf_counter()
+
+    def start_lookup(self, cache: Optional[ResponseCache], params: Any) -> None:
+        """Set the cache status of the call before looking it up in the cache. It
+        is a hit unless the call then reaches the backend."""
+        if cache is None:
+            self.cache = "off"
+        elif not cache.cacheable(params):
+            self.cache = "bypass"
+        else:
+            self.cache = "hit"
+
+    def reach_backend(self) -> None:
+        """Mark that the call missed the cache and reached the backend."""
+        if self.cache == "hit":
+            self.cache = "miss"
+
+    def first_token(self) -> None:
+        """Mark the arrival of the first chunk of a streamed response."""
+        if self.time_to_first_token is None:
+            self.time_to_first_token = time.perf_counter() - self._start
+
+    @property
+    def upstream(self) -> bool:
+        """Whether the call reached the backend."""
+        return self.cache in UPSTREAM_CACHE_STATUSES
+
+    def prompt_tokens(self) -> int:
+        if not self.upstream:
+            return 0
+        if isinstance(self.prompt, str):
+            return count_tokens(self.prompt)
+        return sum(count_tokens(text) for text in self.prompt)
+
+    def completion_tokens(self) -> int:
+        if not self.upstream or not isinstance(self.response, str):
+            return 0
+        return count_tokens(self.response)
+
+
+class _CallStats:
+    """The aggregates of the calls of a kind to a backend."""
+
+    def __init__(self, window: int):
+        self.num_calls = 0
+        self.num_errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_latency = 0.0
+        self.cache = {status: 0 for status in CACHE_STATUSES}
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.times_to_first_token: Deque[float] = deque(maxlen=window)
+
+    def record(self, call: CallMetrics) -> None:
+        self.num_calls += 1
+        self.num_errors += int(call.error)
+        self.prompt_tokens += call.prompt_tokens()
+        self.completion_tokens += call.completion_tokens()
+        self.total_latency += call.latency
+        self.cache[call.cache] += 1
+        self.latencies.append(call.latency)
+        if call.time_to_first_token is not None:
+            self.times_to_first_token.append(call.time_to_first_token)
+
+    def snapshot(self) -> Dict[str, Any]:
+        latencies = list(self.latencies)
+        times_to_first_token = list(self.times_to_first_token)
+        return {
+            "calls": self.num_calls,
+            "errors": self.num_errors,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency": {
+                "mean": self.total_latency / self.num_calls,
+                "p50": _percentile(latencies, 50),
+                "p95": _percentile(latencies, 95),
+                "p99": _percentile(latencies, 99),
+            },
+            "time_to_first_token": {
+                "p50": _percentile(times_to_first_token, 50),
+                "p95": _percentile(times_to_first_token, 95),
+            },
+            "cache": dict(self.cache),
+        }
+
+
+class MetricsRegistry:
+    """Aggregate the calls per kind (llm or embedding) and backend, in process.
+
+    The percentiles are over a window of the most recent calls, while the counters
+    cover all the calls since the registry was created or reset. With a Prometheus
+    registry, the calls also feed its counters and latency histograms, which are
+    never reset.
+    """
+
+    def __init__(
+        self,
+        window: int = 1000,
+        prometheus_registry: Optional[prometheus.PrometheusRegistry] = None,
+    ):
+        """
+        Args:
+            window (int): The number of recent calls kept for the percentiles.
+            prometheus_registry (Optional[prometheus.PrometheusRegistry]): The
+                registry to export the calls to.
+        """
+        self.window = window
+        self.prometheus_registry = prometheus_registry
+        self._stats: Dict[str, Dict[str, _CallStats]] = {}
+        self._lock = threading.Lock()
+        if prometheus_registry is not None:
+            labels = ["kind", "backend"]
+            self._calls = prometheus_registry.counter(
+                "calls_total", "The calls by cache status.", labels + ["cache"]
+            )
+            self._errors = prometheus_registry.counter(
+                "call_errors_total", "The failed calls.", labels
+            )
+            self._prompt_tokens = prometheus_registry.counter(
+                "prompt_tokens_total", "The estimated tokens sent upstream.", labels
+            )
+            self._completion_tokens = prometheus_registry.counter(
+                "completion_tokens_total",
+                "The estimated tokens received from upstream.",
+                labels,
+            )
+            self._latency = prometheus_registry.histogram(
+                "call_duration_seconds", "The latency of the calls.", labels
+            )
+            self._time_to_first_token = prometheus_registry.histogram(
+                "time_to_first_token_seconds",
+                "The latency of the first chunk of the streamed calls.",
+                labels,
+            )
+            self._cache_hit_ratio = prometheus_registry.gauge(
+                "cache_hit_ratio",
+                "The cache hits over the cache lookups since the last reset.",
+                labels,
+            )
+
+    @contextmanager
+    def track(self, kind: str, backend: str, prompt: Any) -> Iterator[CallMetrics]:
+        """Measure a call made in the block, and record it when the block exits.
+        The block sets the response, the cache status and the first token.
+
+        Args:
+            kind (str): The kind of the call, e.g. llm or embedding.
+            backend (str): The backend that serves the call.
+            prompt (Any): The prompt, or the texts to embed.
+        """
+        call = CallMetrics(kind=kind, backend=backend, prompt=prompt)
+        try:
+            yield call
+        except (GeneratorExit, asyncio.CancelledError):
+            # The caller stopped reading the stream, or a hedged call lost its race.
+            raise
+        except BaseException:
+            call.error = True
+            raise
+        finally:
+            call.latency = time.perf_counter() - call._start
+            self.record(call)
+
+    def record(self, call: CallMetrics) -> None:
+        with self._lock:
+            backends = self._stats.setdefault(call.kind, {})
+            new_backend = call.backend not in backends
+            if new_backend:
+                backends[call.backend] = _CallStats(window=self.window)
+            backends[call.backend].record(call)
+        if self.prometheus_registry is not None:
+            self._export(call, new_backend)
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """The aggregates of the calls, by kind and backend."""
+        with self._lock:
+            return {
+                kind: {backend: stats.snapshot() for backend, stats in backends.items()}
+                for kind, backends in self._stats.items()
+            }
+
+    def dump(self) -> str:
+        """The aggregates of the calls as indented json."""
+        return json.dumps(self.snapshot(), indent=2)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats = {}
+
+    def cache_hit_ratio(self, kind: str, backend: str) -> float:
+        """The cache hits over the hits and misses of the calls, or 0 without any."""
+        with self._lock:
+            stats = self._stats.get(kind, {}).get(backend)
+            if stats is None:
+                return 0.0
+            lookups = stats.cache["hit"] + stats.cache["miss"]
+            return stats.cache["hit"] / lookups if lookups else 0.0
+
+    def _export(self, call: CallMetrics, new_backend: bool) -> None:
+        labels = {"kind": call.kind, "backend": call.backend}
+        self._calls.labels(cache=call.cache, **labels).inc()
+        if call.error:
+            self._errors.labels(**labels).inc()
+        self._prompt_tokens.labels(**labels).inc(call.prompt_tokens())
+        self._completion_tokens.labels(**labels).inc(call.completion_tokens())
+        self._latency.labels(**labels).observe(call.latency)
+        if call.time_to_first_token is not None:
+            self._time_to_first_token.labels(**labels).observe(call.time_to_first_token)
+        if new_backend:
+            self._cache_hit_ratio.labels(**labels).set_function(
+                lambda: self.cache_hit_ratio(call.kind, call.backend)
+            )
+
+
+# The registry shared by the orchestrators, the responders and the services.
+REGISTRY = MetricsRegistry(prometheus_registry=prometheus.REGISTRY)
+
+
+class MeteredEmbeddings(Embeddings):
+    """Record the embedding calls of the wrapped embeddings tool."""
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        registry: MetricsRegistry = REGISTRY,
+    ):
+        self.embeddings = embeddings
+        self.backend = type(embeddings).__name__
+        self.registry = registry
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self.registry.track("embedding", self.backend, texts):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with self.registry.track("embedding", self.backend, text):
+            return self.embeddings.embed_query(text)
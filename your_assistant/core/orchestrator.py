@@ -1,21 +1,209 @@
 """The orchestrator that uses the agents to orchestrate the conversation.
 """
 import argparse
+import asyncio
 import os
 import textwrap
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Optional
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
 
 from langchain.chat_models import ChatOpenAI
 from langchain.llms import Anthropic
 from langchain.llms.base import LLM
-from langchain.memory import ConversationSummaryBufferMemory
 from langchain.schema import HumanMessage
 
+import your_assistant.core.concurrency as concurrency_lib
+import your_assistant.core.llm as llm_lib
+import your_assistant.core.memory as memory_lib
+import your_assistant.core.metrics as metrics_lib
+import your_assistant.core.tracing as tracing
+from your_assistant.core.cache import ResponseCache
 from your_assistant.core.indexer import KnowledgeIndexer
-from your_assistant.core.llm import PaLM, RevBard, RevChatGPT
 from your_assistant.core.responder import DocumentQA
-from your_assistant.core.utils import Logger, load_env
+from your_assistant.core.routing import CircuitOpenError, LatencyRouter
+from your_assistant.core.utils import Logger, init_parser, load_env
+
+
+def _add_memory_arguments_to_parser(parser: argparse.ArgumentParser) -> None:
+    """Add the arguments of the conversation memory to the parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser that accepts the arguments.
+    """
+    parser.add_argument(
+        "--use-memory",
+        default=True,
+        action="store_true",
+        help="Whether to use the memory.",
+    )
+    parser.add_argument(
+        "--memory-token-size",
+        default=300,
+        type=int,
+        help="The maximum number of tokens used to keep the memory.",
+    )
+    parser.add_argument(
+        "--memory-coalesce-turns",
+        default=3,
+        type=int,
+        help="The number of turns to summarize together in the background.",
+    )
+    parser.add_argument(
+        "--session-id",
+        default=memory_lib.DEFAULT_SESSION_ID,
+        type=str,
+        help="The id of the conversation whose memory is used.",
+    )
+    parser.add_argument(
+        "--memory-db-path",
+        default="memory.db",
+        type=str,
+        help="The sqlite db to spill the cold sessions to. Empty to not persist them.",
+    )
+    parser.add_argument(
+        "--max-memory-sessions",
+        default=100,
+        type=int,
+        help="The maximum number of sessions whose memory is kept in RAM.",
+    )
+    parser.add_argument(
+        "--memory-session-ttl",
+        default=3600,
+        type=float,
+        help="The idle seconds after which the memory of a session is spilled.",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        default=1000000,
+        type=int,
+        help="The maximum characters of the memories of all the sessions in RAM.",
+    )
+    parser.add_argument(
+        "--memory-spilled-ttl",
+        default=2592000,
+        type=float,
+        help="The seconds after which a session spilled to the db and not used "
+        + "since is deleted.",
+    )
+    parser.add_argument(
+        "--memory-shared",
+        action="store_true",
+        help="Whether other processes use the sessions in the memory db, e.g. the "
+        + "workers of the http service. Each turn is then written through to it.",
+    )
+
+
+def _add_cache_arguments_to_parser(parser: argparse.ArgumentParser) -> None:
+    """Add the arguments of the LLM response cache to the parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser that accepts the arguments.
+    """
+    parser.add_argument(
+        "--use-cache",
+        default=False,
+        action="store_true",
+        help="Whether to reuse the responses to identical prompts and params.",
+    )
+    parser.add_argument(
+        "--cache-db-path",
+        default="llm_cache.db",
+        type=str,
+        help="The sqlite db to store the cached responses.",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        default=86400,
+        type=float,
+        help="The seconds after which a cached response expires.",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        default=50000000,
+        type=int,
+        help="The maximum characters of all the cached responses.",
+    )
+    parser.add_argument(
+        "--cache-max-temperature",
+        default=0.5,
+        type=float,
+        help="Bypass the cache for the calls sampled above this temperature.",
+    )
+
+
+def _create_response_cache(args: argparse.Namespace) -> Optional[ResponseCache]:
+    """Create the response cache if it is enabled in the arguments."""
+    if not args.use_cache:
+        return None
+    return ResponseCache(
+        db_path=args.cache_db_path,
+        ttl_seconds=args.cache_ttl,
+        max_size=args.cache_max_size,
+        max_temperature=args.cache_max_temperature,
+    )
+
+
+# How the prompts of a batch use the conversation memory: not at all, one new
+# conversation per prompt, or one after another in the conversation of the args.
+BATCH_MEMORY_MODES = ["none", "isolated", "shared"]
+
+
+class BatchResult:
+    """The outcome of a prompt of a batch, either its response or its error."""
+
+    def __init__(
+        self,
+        prompt: str,
+        response: Optional[str] = None,
+        error: Optional[Exception] = None,
+    ):
+        self.prompt = prompt
+        self.response = response
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        outcome = f"response={self.response!r}" if self.ok else f"error={self.error!r}"
+        return f"BatchResult(prompt={self.prompt!r}, {outcome})"
+
+
+class RequestContext(argparse.Namespace):
+    """The arguments of a single request to an orchestrator.
+
+    The context is immutable, so that a request cannot change the arguments seen
+    by the requests processed concurrently. Derive a new context with replace.
+    """
+
+    def __init__(self, **kwargs: Any):
+        self.__dict__.update(kwargs)
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace, **changes: Any) -> "RequestContext":
+        """Create the context of a request from the arguments of the orchestrator.
+
+        Args:
+            args (argparse.Namespace): The arguments of the orchestrator.
+            changes (Any): The arguments of the request, e.g. the prompt.
+        """
+        kwargs = {key: value for key, value in vars(args).items() if key != "func"}
+        return cls(**{**kwargs, **changes})
+
+    def replace(self, **changes: Any) -> "RequestContext":
+        """A copy of the context with some arguments changed."""
+        return RequestContext(**{**vars(self), **changes})
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"The request context is immutable, cannot set {name}.")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"The request context is immutable, cannot del {name}.")
 
 
 class Orchestrator(ABC):
@@ -26,11 +214,27 @@ class Orchestrator(ABC):
         self.args = args
         self.verbose = args.verbose
         self.logger = Logger(type(self).__name__)
+        if args.api_base:
+            llm_lib.set_api_base(args.api_base)
 
     @classmethod
     def add_arguments_to_parser(cls, parser: argparse.ArgumentParser) -> None:
         # Add verbase (default: False) to parser.
         parser.add_argument("-v", "--verbose", default=False, action="store_true")
+        parser.add_argument(
+            "--api-base",
+            default=None,
+            type=str,
+            help="The base URL of the OpenAI and Anthropic compatible APIs, e.g. "
+            + "http://localhost:8008/v1 for the fake LLM service.",
+        )
+        parser.add_argument(
+            "--trace-file",
+            default=None,
+            type=str,
+            help="Trace the requests to this file, as Chrome trace events if it ends "
+            + "with .json and as json lines otherwise. Default: no tracing.",
+        )
         cls._add_arguments_to_parser(parser)
 
     @classmethod
@@ -51,6 +255,194 @@ class Orchestrator(ABC):
     def process(self, args: argparse.Namespace) -> str:
         raise NotImplementedError("process must be implemented.")
 
+    def stream(self, args: argparse.Namespace) -> Iterator[str]:
+        """Process the prompt and stream the response as it is produced.
+        Orchestrators without streaming support yield the whole response at once.
+
+        Args:
+            args (argparse.Namespace): The arguments to the orchestrator.
+        """
+        yield self.process(args=args)
+
+    async def aprocess(self, args: argparse.Namespace) -> str:
+        """Process the prompt without blocking the event loop. Orchestrators
+        without native async support process it in a worker thread.
+
+        Args:
+            args (argparse.Namespace): The arguments to the orchestrator.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, tracing.bind(self.process), args)
+
+    async def astream(self, args: argparse.Namespace) -> AsyncIterator[str]:
+        """Process the prompt and stream the response without blocking the event
+        loop. Orchestrators without native async support pull the chunks of
+        stream in a worker thread.
+
+        Args:
+            args (argparse.Namespace): The arguments to the orchestrator.
+        """
+        loop = asyncio.get_running_loop()
+        chunks: "asyncio.Queue[Any]" = asyncio.Queue()
+        end = object()
+        stopped = threading.Event()
+
+        def put(item: Any) -> None:
+            try:
+                loop.call_soon_threadsafe(chunks.put_nowait, item)
+            except RuntimeError:
+                # The event loop is closed, nobody reads the chunks anymore.
+                stopped.set()
+
+        def pump() -> None:
+            # Pull the whole stream in one thread, so that the thread locks held
+            # across its chunks, e.g. the session lock, and the spans stay in the
+            # thread and the context that entered them.
+            stream = self.stream(args=args)
+            try:
+                for chunk in stream:
+                    if stopped.is_set():
+                        break
+                    put(chunk)
+                put(end)
+            except BaseException as e:
+                put(e)
+            finally:
+                # Release what the stream holds once it stops, even early.
+                getattr(stream, "close", lambda: None)()
+
+        loop.run_in_executor(None, tracing.bind(pump))
+        try:
+            while True:
+                item = await chunks.get()
+                if item is end:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # A consumer that stops early stops the stream at its next chunk.
+            stopped.set()
+
+    def process_batch(
+        self,
+        prompts: List[str],
+        args: argparse.Namespace,
+        concurrency: int = 4,
+        rate_limit: Optional[float] = None,
+        memory_mode: str = "none",
+    ) -> List[BatchResult]:
+        """Process many prompts concurrently.
+
+        Args:
+            prompts (List[str]): The prompts to process.
+            args (argparse.Namespace): The arguments shared by the prompts. Each
+                prompt gets a copy, so args is not modified.
+            concurrency (int): The maximum number of prompts in flight.
+            rate_limit (Optional[float]): The maximum prompts started per second,
+                to stay under the rate limit of the provider. None to not limit.
+            memory_mode (str): One of BATCH_MEMORY_MODES. The shared mode processes
+                the prompts one at a time, so that the turns are in order.
+
+        Returns:
+            List[BatchResult]: The results in the order of the prompts. A failed
+                prompt does not fail the others.
+        """
+        batch_args = self._batch_args(prompts=prompts, args=args, mode=memory_mode)
+        limiter = concurrency_lib.RateLimiter(rate=rate_limit) if rate_limit else None
+
+        def run(prompt: str, prompt_args: argparse.Namespace) -> BatchResult:
+            if limiter:
+                limiter.acquire()
+            try:
+                return BatchResult(prompt=prompt, response=self.process(prompt_args))
+            except Exception as e:
+                return BatchResult(prompt=prompt, error=e)
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(
+            max_workers=1 if memory_mode == "shared" else concurrency,
+            thread_name_prefix="batch",
+        ) as executor:
+            futures = [
+                executor.submit(tracing.bind(run), prompt, prompt_args)
+                for prompt, prompt_args in zip(prompts, batch_args)
+            ]
+            results = [future.result() for future in futures]
+        self._log_batch(results=results, seconds=time.monotonic() - start)
+        return results
+
+    async def aprocess_batch(
+        self,
+        prompts: List[str],
+        args: argparse.Namespace,
+        concurrency: int = 4,
+        rate_limit: Optional[float] = None,
+        memory_mode: str = "none",
+    ) -> List[BatchResult]:
+        """The async version of process_batch."""
+        batch_args = self._batch_args(prompts=prompts, args=args, mode=memory_mode)
+        limiter = concurrency_lib.RateLimiter(rate=rate_limit) if rate_limit else None
+        semaphore = asyncio.Semaphore(1 if memory_mode == "shared" else concurrency)
+
+        async def run(prompt: str, prompt_args: argparse.Namespace) -> BatchResult:
+            async with semaphore:
+                if limiter:
+                    await limiter.aacquire()
+                try:
+                    response = await self.aprocess(prompt_args)
+                    return BatchResult(prompt=prompt, response=response)
+                except Exception as e:
+                    return BatchResult(prompt=prompt, error=e)
+
+        start = time.monotonic()
+        results = await asyncio.gather(
+            *[run(prompt, arg) for prompt, arg in zip(prompts, batch_args)]
+        )
+        self._log_batch(results=results, seconds=time.monotonic() - start)
+        return results
+
+    @staticmethod
+    def _batch_args(
+        prompts: List[str], args: argparse.Namespace, mode: str
+    ) -> List[argparse.Namespace]:
+        """Copy the args for each prompt of a batch, set up for the memory mode."""
+        if mode not in BATCH_MEMORY_MODES:
+            raise ValueError(f"Invalid memory mode [{mode}].")
+        batch_args: List[argparse.Namespace] = []
+        for idx, prompt in enumerate(prompts):
+            changes: Dict[str, Any] = {"prompt": prompt}
+            if mode == "none":
+                changes["use_memory"] = False
+            elif mode == "isolated":
+                session_id = getattr(args, "session_id", memory_lib.DEFAULT_SESSION_ID)
+                changes["session_id"] = f"{session_id}/batch-{idx}"
+            batch_args.append(RequestContext.from_args(args, **changes))
+        return batch_args
+
+    def _log_batch(self, results: List[BatchResult], seconds: float) -> None:
+        num_failed = sum(not result.ok for result in results)
+        self.logger.info(
+            f"Processed {len(results)} prompts in {seconds:.2f}s, {num_failed} failed."
+        )
+
+    def _span(self, name: str, args: argparse.Namespace) -> Any:
+        """A tracing span of the request in args, e.g. orchestrator.process."""
+        return tracing.span(
+            f"orchestrator.{name}",
+            orchestrator=type(self).__name__,
+            session_id=getattr(args, "session_id", None),
+        )
+
+    def warmup(self) -> None:
+        """Prepare the orchestrator for its first request, e.g. log in the clients
+        and load the indexes."""
+        pass
+
+    def close(self) -> None:
+        """Release the resources held by the orchestrator, e.g. persist the memory."""
+        pass
+
 
 class LLMOrchestrator(Orchestrator):
     """The abstract orchestrator that uses the LLM."""
@@ -63,58 +455,309 @@ class LLMOrchestrator(Orchestrator):
         if not self.llm:
             raise ValueError("The llm must be initialized.")
         if args.use_memory:
-            self.memory: ConversationSummaryBufferMemory = (
-                ConversationSummaryBufferMemory(
-                    llm=self.llm, max_token_limit=args.memory_token_size
+            self.memory_store: memory_lib.SessionMemoryStore = (
+                memory_lib.SessionMemoryStore(
+                    memory_factory=lambda: memory_lib.AsyncSummaryMemory(
+                        memory=memory_lib.IncrementalSummaryBufferMemory(
+                            llm=self.llm, max_token_limit=args.memory_token_size
+                        ),
+                        coalesce_turns=args.memory_coalesce_turns,
+                    ),
+                    namespace=type(self).__name__,
+                    db_path=args.memory_db_path,
+                    max_sessions=args.max_memory_sessions,
+                    ttl_seconds=args.memory_session_ttl,
+                    max_total_size=args.memory_budget,
+                    spilled_ttl_seconds=args.memory_spilled_ttl,
+                    shared=args.memory_shared,
                 )
             )
 
+        self.response_cache: Optional[ResponseCache] = _create_response_cache(args)
+        # The requests of a session are processed one at a time, so that each one
+        # sees the turns of the previous ones.
+        self.session_locks: concurrency_lib.KeyedLock = concurrency_lib.KeyedLock()
+        # Identical prompts in flight share one llm call.
+        self.single_flight: concurrency_lib.SingleFlight = (
+            concurrency_lib.SingleFlight()
+        )
+
     def _init_llm(self, args: argparse.Namespace) -> None:
         raise NotImplementedError("_init_llm must be implemented.")
 
+    def warmup(self) -> None:
+        llm_lib.warmup(self.llm)  # type: ignore
+
+    def close(self) -> None:
+        if hasattr(self, "memory_store"):
+            self.memory_store.close()
+        if self.response_cache:
+            self.response_cache.close()
+        self.logger.info(f"Coalesced llm calls: {self.single_flight.stats()}")
+
     @classmethod
     def _add_arguments_to_parser(cls, parser: argparse.ArgumentParser) -> None:
-        parser.add_argument(
-            "--use-memory",
-            default=True,
-            action="store_true",
-            help="Whether to use the memory.",
-        )
-        parser.add_argument(
-            "--memory-token-size",
-            default=300,
-            type=int,
-            help="The maximum number of tokens used to keep the memory.",
-        )
+        _add_memory_arguments_to_parser(parser)
+        _add_cache_arguments_to_parser(parser)
 
     def process(self, args: argparse.Namespace) -> str:
-        # Set memory.
-        original_prompt = args.prompt
-        if args.use_memory and hasattr(self, "memory"):
-            history: Dict[str, Any] = self.memory.load_memory_variables({})
+        with self._span("process", args), self._hold_session(args):
+            request = self._with_history(args=args)
+            with self._track(request) as call:
+                # A call that waits for an identical one in flight keeps this status.
+                call.cache = "coalesced"
+                call.response = self.single_flight.do(
+                    self._flight_key(args=args, request=request),
+                    lambda: self._cached_process(args=request, call=call),
+                )
+            self._save_memory(prompt=args.prompt, response=call.response, args=args)
+        return call.response
+
+    @tracing.isolate_spans
+    def stream(self, args: argparse.Namespace) -> Iterator[str]:
+        with self._span("stream", args), self._hold_session(args):
+            request = self._with_history(args=args)
+            with self._track(request) as call:
+                llm_call = self._llm_call(request)
+                call.start_lookup(self.response_cache, llm_call["params"])
+
+                def upstream() -> Iterator[str]:
+                    call.reach_backend()
+                    return self._stream(args=request)
+
+                if self.response_cache:
+                    stream = self.response_cache.cached_stream(
+                        **llm_call, stream=upstream
+                    )
+                else:
+                    stream = upstream()
+                chunks = []
+                for chunk in stream:
+                    call.first_token()
+                    chunks.append(chunk)
+                    yield chunk
+                call.response = "".join(chunks)
+            # Save the memory only once the whole response is known.
+            self._save_memory(prompt=args.prompt, response=call.response, args=args)
+
+    async def aprocess(self, args: argparse.Namespace) -> str:
+        with self._span("aprocess", args):
+            async with self._ahold_session(args):
+                # The history may hit the memory db, so load it off the event loop.
+                loop = asyncio.get_running_loop()
+                request = await loop.run_in_executor(
+                    None, tracing.bind(self._with_history), args
+                )
+                with self._track(request) as call:
+                    call.cache = "coalesced"
+                    call.response = await self.single_flight.ado(
+                        self._flight_key(args=args, request=request),
+                        lambda: self._acached_process(args=request, call=call),
+                    )
+                self._save_memory(prompt=args.prompt, response=call.response, args=args)
+        return call.response
+
+    @tracing.isolate_spans
+    async def astream(self, args: argparse.Namespace) -> AsyncIterator[str]:
+        with self._span("astream", args):
+            async with self._ahold_session(args):
+                loop = asyncio.get_running_loop()
+                request = await loop.run_in_executor(
+                    None, tracing.bind(self._with_history), args
+                )
+                with self._track(request) as call:
+                    llm_call = self._llm_call(request)
+                    call.start_lookup(self.response_cache, llm_call["params"])
+
+                    def upstream() -> AsyncIterator[str]:
+                        call.reach_backend()
+                        return self._astream(args=request)
+
+                    if self.response_cache:
+                        stream = self.response_cache.acached_stream(
+                            **llm_call, stream=upstream
+                        )
+                    else:
+                        stream = upstream()
+                    chunks = []
+                    async for chunk in stream:
+                        call.first_token()
+                        chunks.append(chunk)
+                        yield chunk
+                    call.response = "".join(chunks)
+                self._save_memory(prompt=args.prompt, response=call.response, args=args)
+
+    def _cached_process(
+        self, args: argparse.Namespace, call: metrics_lib.CallMetrics
+    ) -> str:
+        llm_call = self._llm_call(args)
+        call.start_lookup(self.response_cache, llm_call["params"])
+
+        def upstream() -> str:
+            call.reach_backend()
+            return self._process(args=args)
+
+        if self.response_cache:
+            return self.response_cache.cached(**llm_call, call=upstream)
+        return upstream()
+
+    async def _acached_process(
+        self, args: argparse.Namespace, call: metrics_lib.CallMetrics
+    ) -> str:
+        llm_call = self._llm_call(args)
+        call.start_lookup(self.response_cache, llm_call["params"])
+
+        async def upstream() -> str:
+            call.reach_backend()
+            return await self._aprocess(args=args)
+
+        if self.response_cache:
+            return await self.response_cache.acached(**llm_call, call=upstream)
+        return await upstream()
+
+    @contextmanager
+    def _track(self, args: argparse.Namespace) -> Iterator[metrics_lib.CallMetrics]:
+        """Record the tokens and the latency of the llm call of the prompt, and
+        trace it."""
+        backend = type(self).__name__
+        with tracing.span("llm.call", backend=backend) as span:
+            with metrics_lib.REGISTRY.track(
+                kind="llm", backend=backend, prompt=args.prompt
+            ) as call:
+                try:
+                    yield call
+                finally:
+                    span.set_attribute("cache", call.cache)
+
+    def _llm_call(self, args: argparse.Namespace) -> Dict[str, Any]:
+        """Identify the llm call of the prompt in args, to cache and coalesce it.
+        The prompt includes the history, so only identical conversations match."""
+        return {
+            "backend": type(self).__name__,
+            "params": llm_lib.llm_params(self.llm),  # type: ignore
+            "prompt": args.prompt,
+        }
+
+    def _flight_key(self, args: argparse.Namespace, request: RequestContext) -> str:
+        """Identify the llm call in flight of the request, to coalesce it.
+        Without history, e.g. in a new conversation or without memory, the call is
+        keyed on the bare prompt, so that the same prompt from any session shares
+        one call."""
+        llm_call = self._llm_call(request)
+        if not request.history:
+            llm_call["prompt"] = args.prompt
+        return ResponseCache.make_key(**llm_call)
+
+    def _session_key(self, args: argparse.Namespace) -> Optional[str]:
+        """The session whose requests are serialized, or None without memory."""
+        if args.use_memory and hasattr(self, "memory_store"):
+            return args.session_id
+        return None
+
+    @contextmanager
+    def _hold_session(self, args: argparse.Namespace) -> Iterator[None]:
+        """Process the request alone in its session, with the memory of the session
+        pinned in RAM until its turn is saved."""
+        key = self._session_key(args)
+        with self.session_locks.hold(key), self._pin_memory(key):
+            yield
+
+    @asynccontextmanager
+    async def _ahold_session(self, args: argparse.Namespace) -> AsyncIterator[None]:
+        """The async version of _hold_session."""
+        key = self._session_key(args)
+        async with self.session_locks.ahold(key):
+            with self._pin_memory(key):
+                yield
+
+    def _pin_memory(self, key: Optional[str]) -> Any:
+        return self.memory_store.pin(key) if key is not None else nullcontext()
+
+    def _with_history(self, args: argparse.Namespace) -> RequestContext:
+        """Augment the prompt in args with the conversation history.
+
+        Args:
+            args (argparse.Namespace): The arguments to the orchestrator.
+
+        Returns:
+            RequestContext: A copy of args with the augmented prompt, and the
+                history in it. The args are left unchanged.
+        """
+        prompt, history = args.prompt, ""
+        if args.use_memory and hasattr(self, "memory_store"):
+            with tracing.span("memory.load"):
+                memory = self.memory_store.get(args.session_id)
+                variables: Dict[str, Any] = memory.load_memory_variables({})
             if self.verbose:
-                self.logger.info(f"History: {history}\n\n")
-            args.prompt = textwrap.dedent(
+                self.logger.info(f"History: {variables}\n\n")
+            history = variables["history"]
+            prompt = textwrap.dedent(
                 f"""
                 Current conversation:
-                {history["history"]}
+                {history}
                 "User": {args.prompt}
             """
             )
         if self.verbose:
-            self.logger.info(f"Prompt: {args.prompt}\n\n")
-        response = self._process(args=args)
-        if args.use_memory and hasattr(self, "memory"):
+            self.logger.info(f"Prompt: {prompt}\n\n")
+        if isinstance(args, RequestContext):
+            return args.replace(prompt=prompt, history=history)
+        return RequestContext.from_args(args, prompt=prompt, history=history)
+
+    def _save_memory(
+        self, prompt: str, response: str, args: argparse.Namespace
+    ) -> None:
+        if args.use_memory and hasattr(self, "memory_store"):
             # Only save the user original prompt without history augmentation.
-            self.memory.save_context(
-                inputs={"user": original_prompt}, outputs={"AI": response}
-            )
-        return response
+            with tracing.span("memory.save"):
+                memory = self.memory_store.get(args.session_id)
+                memory.save_context(inputs={"user": prompt}, outputs={"AI": response})
 
     @abstractmethod
     def _process(self, args: argparse.Namespace) -> str:
         raise NotImplementedError("_process must be implemented.")
 
+    def _stream(self, args: argparse.Namespace) -> Iterator[str]:
+        """Stream the response of the llm to the prompt.
+
+        Args:
+            args (argparse.Namespace): The arguments to the orchestrator.
+        """
+        if len(args.prompt) == 0:
+            return
+        if not self.llm:
+            raise ValueError("The llm must be initialized.")
+        yield from llm_lib.stream_completion(self.llm, args.prompt)
+
+    async def _aprocess(self, args: argparse.Namespace) -> str:
+        """Process the prompt without blocking the event loop.
+
+        Args:
+            args (argparse.Namespace): The arguments to the orchestrator.
+        """
+        if len(args.prompt) == 0:
+            return ""
+        if not self.llm:
+            raise ValueError("The llm must be initialized.")
+        response = await llm_lib.acomplete(self.llm, args.prompt)
+        if self.verbose:
+            self.logger.info(f"Response: {response}\n")
+        return response
+
+    async def _astream(self, args: argparse.Namespace) -> AsyncIterator[str]:
+        """Stream the response of the llm to the prompt without blocking the event
+        loop.
+
+        Args:
+            args (argparse.Namespace): The arguments to the orchestrator.
+        """
+        if len(args.prompt) == 0:
+            return
+        if not self.llm:
+            raise ValueError("The llm must be initialized.")
+        async for chunk in llm_lib.astream_completion(self.llm, args.prompt):
+            yield chunk
+
 
 class ChatGPTOrchestrator(LLMOrchestrator):
     """The orchestrator that uses the ChatGPT."""
@@ -167,11 +810,48 @@ class ChatGPTOrchestrator(LLMOrchestrator):
         response = self.llm(messsage)  # type: ignore
         if self.verbose:
             self.logger.info(f"Response: {response}\n")
-        content = str(response.content)  # type: ignore
+        return self._strip_ai_prefix(str(response.content))  # type: ignore
+
+    async def _aprocess(self, args: argparse.Namespace) -> str:
+        return self._strip_ai_prefix(await super()._aprocess(args=args))
+
+    @staticmethod
+    def _strip_ai_prefix(content: str) -> str:
         if not content.startswith("AI:"):
             return content
         return content[3:]
 
+    def _stream(self, args: argparse.Namespace) -> Iterator[str]:
+        """Stream the response, stripping the leading "AI:" like _process does.
+
+        Args:
+            args (argparse.Namespace): The arguments to the orchestrator.
+        """
+        head = ""
+        chunks = super()._stream(args=args)
+        # Hold back the first characters until the prefix can be decided.
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= len("AI:"):
+                break
+        head = self._strip_ai_prefix(head)
+        if head:
+            yield head
+        yield from chunks
+
+    async def _astream(self, args: argparse.Namespace) -> AsyncIterator[str]:
+        head = ""
+        chunks = super()._astream(args=args)
+        async for chunk in chunks:
+            head += chunk
+            if len(head) >= len("AI:"):
+                break
+        head = self._strip_ai_prefix(head)
+        if head:
+            yield head
+        async for chunk in chunks:
+            yield chunk
+
 
 class PaLMOrchestrator(LLMOrchestrator):
     """The orchestrator that uses the PaLM."""
@@ -184,7 +864,7 @@ class PaLMOrchestrator(LLMOrchestrator):
         self.model = args.model
         self.temperature = args.temperature
         self.max_tokens = args.max_token
-        self.llm = PaLM()
+        self.llm = llm_lib.PaLM()
 
     @classmethod
     def _add_arguments_to_parser(cls, parser: argparse.ArgumentParser) -> None:
@@ -236,6 +916,9 @@ class AnthropicOrchestrator(LLMOrchestrator):
             max_tokens_to_sample=self.max_tokens,
             temperature=self.temperature,
         )
+        if args.api_base:
+            # The Anthropic client appends the version to its URL.
+            self.llm.client.api_url = args.api_base.removesuffix("/v1")
 
     @classmethod
     def _add_arguments_to_parser(cls, parser: argparse.ArgumentParser) -> None:
@@ -277,7 +960,7 @@ class RevChatGPTOrchestrator(LLMOrchestrator):
         super().__init__(args=args)
 
     def _init_llm(self, args: argparse.Namespace) -> None:
-        self.llm = RevChatGPT()
+        self.llm = llm_lib.RevChatGPT()
 
     @classmethod
     def _add_arguments_to_parser(cls, parser: argparse.ArgumentParser) -> None:
@@ -305,7 +988,7 @@ class RevBardOrchestrator(LLMOrchestrator):
         super().__init__(args=args)
 
     def _init_llm(self, args: argparse.Namespace) -> None:
-        self.llm = RevBard()
+        self.llm = llm_lib.RevBard()
 
     @classmethod
     def _add_arguments_to_parser(cls, parser: argparse.ArgumentParser) -> None:
@@ -325,6 +1008,237 @@ class RevBardOrchestrator(LLMOrchestrator):
         return response
 
 
+# The orchestrators that the router can send the requests to.
+ROUTABLE_ORCHESTRATORS: Dict[str, Any] = {
+    "ChatGPT": ChatGPTOrchestrator,
+    "Claude": AnthropicOrchestrator,
+    "PaLM": PaLMOrchestrator,
+    "RevChatGPT": RevChatGPTOrchestrator,
+    "RevBard": RevBardOrchestrator,
+}
+
+
+class RouterOrchestrator(LLMOrchestrator):
+    """The orchestrator that sends each prompt to the fastest healthy backend.
+
+    The router keeps the conversation memory and the response cache itself, so
+    that a conversation survives switching backends. A backend that fails is
+    retried on the next one, and with --hedge a slow call is raced against the
+    next backend after a percentile of the latencies of its backend.
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        """Initialize the orchestrator."""
+        self.backends: Dict[str, LLMOrchestrator] = {}
+        super().__init__(args=args)
+        self.hedge = args.hedge
+        self.router = LatencyRouter(
+            backends=list(self.backends),
+            alpha=args.ewma_alpha,
+            failure_threshold=args.failure_threshold,
+            reset_seconds=args.circuit_reset_seconds,
+            hedge_percentile=args.hedge_percentile,
+            default_hedge_delay=args.default_hedge_delay,
+        )
+        self._executor = ThreadPoolExecutor(thread_name_prefix="router")
+
+    def _init_llm(self, args: argparse.Namespace) -> None:
+        for name in args.backends:
+            if name not in ROUTABLE_ORCHESTRATORS:
+                raise ValueError(f"Backend {name} cannot be routed to.")
+            orchestrator_type = ROUTABLE_ORCHESTRATORS[name]
+            backend_args = init_parser(name, orchestrator_type).parse_args([name])
+            backend_args.verbose = args.verbose
+            backend_args.api_base = args.api_base
+            # The router owns the memory and the cache of the conversation.
+            backend_args.use_memory = False
+            backend_args.use_cache = False
+            self.backends[name] = orchestrator_type(args=backend_args)
+        # Summarize the memory with the most preferred backend.
+        self.llm = self.backends[args.backends[0]].llm
+
+    @classmethod
+    def _add_arguments_to_parser(cls, parser: argparse.ArgumentParser) -> None:
+        super()._add_arguments_to_parser(parser=parser)
+        parser.add_argument(
+            "--backends",
+            nargs="+",
+            default=["ChatGPT", "Claude", "PaLM"],
+            choices=list(ROUTABLE_ORCHESTRATORS),
+            help="The backends to route to, in the order of preference.",
+        )
+        parser.add_argument(
+            "--hedge",
+            default=False,
+            action="store_true",
+            help="Race a slow call against the next backend.",
+        )
+        parser.add_argument(
+            "--hedge-percentile",
+            default=95,
+            type=float,
+            help="Hedge a call once it is slower than this latency percentile.",
+        )
+        parser.add_argument(
+            "--default-hedge-delay",
+            default=1.0,
+            type=float,
+            help="The seconds before hedging a call to a backend without history.",
+        )
+        parser.add_argument(
+            "--ewma-alpha",
+            default=0.2,
+            type=float,
+            help="The weight of the latest call in the latency and error averages.",
+        )
+        parser.add_argument(
+            "--failure-threshold",
+            default=5,
+            type=int,
+            help="The consecutive failures after which a backend is skipped.",
+        )
+        parser.add_argument(
+            "--circuit-reset-seconds",
+            default=30,
+            type=float,
+            help="The seconds after which a skipped backend is probed again.",
+        )
+
+    def warmup(self) -> None:
+        for backend in self.backends.values():
+            backend.warmup()
+
+    def close(self) -> None:
+        super().close()
+        self._executor.shutdown(wait=False)
+        for backend in self.backends.values():
+            backend.close()
+        self.logger.info(f"Backends: {self.router.snapshot()}")
+
+    def _process(self, args: argparse.Namespace) -> str:
+        """Process the prompt on the fastest healthy backend, failing over to the
+        next ones, and hedging the slow calls if enabled.
+
+        Args:
+            args (argparse.Namespace): The arguments to the orchestrator.
+        """
+        if len(args.prompt) == 0:
+            return ""
+        candidates = self.router.candidates()
+        last_error: Optional[BaseException] = None
+        while candidates:
+            backend = candidates.pop(0)
+            futures = {
+                self._executor.submit(tracing.bind(self._call), backend, args): backend
+            }
+            if self.hedge and candidates:
+                done, _ = wait(futures, timeout=self.router.hedge_delay(backend))
+                if not done:
+                    hedge_backend = candidates.pop(0)
+                    futures[
+                        self._executor.submit(
+                            tracing.bind(self._call), hedge_backend, args
+                        )
+                    ] = hedge_backend
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    last_error = future.exception()
+        raise RuntimeError("All the backends failed.") from last_error
+
+    async def _aprocess(self, args: argparse.Namespace) -> str:
+        if len(args.prompt) == 0:
+            return ""
+        candidates = self.router.candidates()
+        last_error: Optional[BaseException] = None
+        while candidates:
+            backend = candidates.pop(0)
+            tasks = {asyncio.ensure_future(self._acall(backend, args))}
+            if self.hedge and candidates:
+                done, _ = await asyncio.wait(
+                    tasks, timeout=self.router.hedge_delay(backend)
+                )
+                if not done:
+                    hedge_backend = candidates.pop(0)
+                    tasks.add(asyncio.ensure_future(self._acall(hedge_backend, args)))
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        # Keep whichever finished first and drop the other.
+                        for other in pending:
+                            other.cancel()
+                        return task.result()
+                    last_error = task.exception()
+        raise RuntimeError("All the backends failed.") from last_error
+
+    def _stream(self, args: argparse.Namespace) -> Iterator[str]:
+        """Stream from the fastest healthy backend. A backend that fails before its
+        first chunk is failed over; streams are not hedged.
+
+        Args:
+            args (argparse.Namespace): The arguments to the orchestrator.
+        """
+        if len(args.prompt) == 0:
+            return
+        last_error: Optional[BaseException] = None
+        for backend in self.router.candidates():
+            try:
+                self.router.acquire(backend)
+            except CircuitOpenError as e:
+                # Another call opened the circuit; that is no new failure to record.
+                last_error = e
+                continue
+            started = False
+            start = time.monotonic()
+            try:
+                for chunk in self.backends[backend].stream(args=args):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                self.router.record(backend, time.monotonic() - start, error=True)
+                if started:
+                    raise
+                last_error = e
+                continue
+            self.router.record(backend, time.monotonic() - start, error=False)
+            return
+        raise RuntimeError("All the backends failed.") from last_error
+
+    def _call(self, backend: str, args: argparse.Namespace) -> str:
+        self.router.acquire(backend)
+        start = time.monotonic()
+        try:
+            response = self.backends[backend].process(args=args)
+        except Exception:
+            self.router.record(backend, time.monotonic() - start, error=True)
+            raise
+        self.router.record(backend, time.monotonic() - start, error=False)
+        if self.verbose:
+            self.logger.info(f"Routed to {backend}.")
+        return response
+
+    async def _acall(self, backend: str, args: argparse.Namespace) -> str:
+        self.router.acquire(backend)
+        start = time.monotonic()
+        try:
+            response = await self.backends[backend].aprocess(args=args)
+        except asyncio.CancelledError:
+            # The hedged call lost the race; that is not a failure of the backend.
+            raise
+        except Exception:
+            self.router.record(backend, time.monotonic() - start, error=True)
+            raise
+        self.router.record(backend, time.monotonic() - start, error=False)
+        return response
+
+
 class KnowledgeIndexOrchestrator(Orchestrator):
     def __init__(self, args: argparse.Namespace):
         """Initialize the orchestrator."""
@@ -380,6 +1294,10 @@ class KnowledgeIndexOrchestrator(Orchestrator):
         Args:
             args (argparse.Namespace): The arguments to the orchestrator.
         """
+        with self._span("process", args):
+            return self._process(args=args)
+
+    def _process(self, args: argparse.Namespace) -> str:
         path, chunk_size, chunk_overlap = args.path, args.chunk_size, args.chunk_overlap
         if not os.path.exists(path):
             raise FileNotFoundError(f"Path {path} does not exist.")
@@ -420,8 +1338,29 @@ class QAOrchestrator(Orchestrator):
             max_token_size=args.max_token_size,
             use_memory=args.use_memory,
             memory_token_size=args.memory_token_size,
+            memory_coalesce_turns=args.memory_coalesce_turns,
+            memory_db_path=args.memory_db_path,
+            max_memory_sessions=args.max_memory_sessions,
+            memory_session_ttl=args.memory_session_ttl,
+            memory_budget=args.memory_budget,
+            memory_spilled_ttl=args.memory_spilled_ttl,
+            memory_shared=args.memory_shared,
+            response_cache=_create_response_cache(args),
+            stage_workers=args.stage_workers,
         )
 
+    def warmup(self) -> None:
+        self.qa.warmup()
+
+    def reload_index(self) -> None:
+        """Swap in the index changed on disk, e.g. by an indexing job."""
+        self.qa.reload_index()
+
+    def close(self) -> None:
+        self.qa.close()
+        if self.qa.response_cache:
+            self.qa.response_cache.close()
+
     def _init_llm(self, args: argparse.Namespace) -> None:
         if args.llm_type == "ChatGPT":
             self.llm = ChatOpenAI(  # type: ignore
@@ -462,22 +1401,53 @@ class QAOrchestrator(Orchestrator):
             help="The maximum number of tokens to use for the context. Default: 800.",
         )
         parser.add_argument(
-            "--use-memory",
-            default=True,
-            action="store_true",
-            help="Whether to use the memory.",
+            "--stage-workers",
+            default=16,
+            type=int,
+            help="The threads running the independent stages of building the prompt, "
+            + "e.g. the retrieval and the history. 0 runs them one after the other.",
+        )
+        _add_memory_arguments_to_parser(parser)
+        _add_cache_arguments_to_parser(parser)
+        parser.add_argument(
+            "--filter-source",
+            nargs="+",
+            type=str,
+            help="Only retrieve the documents from any of these sources.",
+        )
+        parser.add_argument(
+            "--filter-title",
+            nargs="+",
+            type=str,
+            help="Only retrieve the documents with any of these titles.",
         )
         parser.add_argument(
-            "--memory-token-size",
-            default=300,
+            "--filter-authors",
+            nargs="+",
+            type=str,
+            help="Only retrieve the documents by any of these authors.",
+        )
+        parser.add_argument(
+            "--filter-page-range",
+            nargs=2,
             type=int,
-            help="The maximum number of tokens used to keep the memory.",
+            metavar=("FIRST", "LAST"),
+            help="Only retrieve the documents within these pages, inclusive.",
         )
 
     @classmethod
     def create_from_args(cls, args: argparse.Namespace) -> "Orchestrator":
         return cls(args=args)
 
+    @staticmethod
+    def _retrieval_filter(args: argparse.Namespace) -> Dict[str, Any]:
+        """Build the retrieval filter from the filter arguments."""
+        return {
+            key: getattr(args, f"filter_{key}")
+            for key in ["source", "title", "authors", "page_range"]
+            if getattr(args, f"filter_{key}", None)
+        }
+
     def process(self, args: argparse.Namespace) -> str:
         """Process the prompt.
 
@@ -488,5 +1458,54 @@ class QAOrchestrator(Orchestrator):
             return ""
         if args.verbose:
             self.logger.info(f"Prompt: {args.prompt}")
-        response = self.qa.answer(question=args.prompt)
+        with self._span("process", args):
+            response = self.qa.answer(
+                question=args.prompt,
+                session_id=args.session_id,
+                retrieval_filter=self._retrieval_filter(args),
+            )
         return response
+
+    @tracing.isolate_spans
+    def stream(self, args: argparse.Namespace) -> Iterator[str]:
+        """Process the prompt and stream the answer.
+
+        Args:
+            args (argparse.Namespace): The arguments to the orchestrator.
+        """
+        if len(args.prompt) == 0:
+            return
+        if args.verbose:
+            self.logger.info(f"Prompt: {args.prompt}")
+        with self._span("stream", args):
+            yield from self.qa.stream_answer(
+                question=args.prompt,
+                session_id=args.session_id,
+                retrieval_filter=self._retrieval_filter(args),
+            )
+
+    async def aprocess(self, args: argparse.Namespace) -> str:
+        if len(args.prompt) == 0:
+            return ""
+        if args.verbose:
+            self.logger.info(f"Prompt: {args.prompt}")
+        with self._span("aprocess", args):
+            return await self.qa.aanswer(
+                question=args.prompt,
+                session_id=args.session_id,
+                retrieval_filter=self._retrieval_filter(args),
+            )
+
+    @tracing.isolate_spans
+    async def astream(self, args: argparse.Namespace) -> AsyncIterator[str]:
+        if len(args.prompt) == 0:
+            return
+        if args.verbose:
+            self.logger.info(f"Prompt: {args.prompt}")
+        with self._span("astream", args):
+            async for chunk in self.qa.astream_answer(
+                question=args.prompt,
+                session_id=args.session_id,
+                retrieval_filter=self._retrieval_filter(args),
+            ):
+                yield chunk
@@ -0,0 +1,316 @@
+"""Expose the metrics of the process in the Prometheus text format.
+"""
+import bisect
+import math
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# The content type of the text exposition format.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# The upper bounds of the latency buckets, in seconds.
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# A sample: the suffix of the metric name, the labels and the value.
+Sample = Tuple[str, Dict[str, str], float]
+
+
+class _Shard:
+    """The values of a thread, referenced only by the thread, so that they can be
+    retired once the thread ends."""
+
+    def __init__(self, values: List[float]):
+        self.values = values
+
+
+class _ShardedValues:
+    """Values updated without a lock: each thread adds to its own shard, and the
+    reads sum the shards. The shards of the ended threads are folded into one, so
+    that the short-lived request threads do not accumulate."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._local = threading.local()
+        self._shards: Dict[int, List[float]] = {}
+        self._retired = [0.0] * size
+        self._lock = threading.Lock()
+
+    def shard(self) -> List[float]:
+        """The values of the calling thread, to update in place."""
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = _Shard([0.0] * self.size)
+            with self._lock:
+                self._shards[id(shard.values)] = shard.values
+            # The thread local storage is released when the thread ends.
+            weakref.finalize(shard, self._retire, shard.values)
+            self._local.shard = shard
+        return shard.values
+
+    def sum(self) -> List[float]:
+        with self._lock:
+            shards = [self._retired] + list(self._shards.values())
+            return [sum(values) for values in zip(*shards)]
+
+    def _retire(self, values: List[float]) -> None:
+        with self._lock:
+            del self._shards[id(values)]
+            self._retired = [a + b for a, b in zip(self._retired, values)]
+
+
+class _CounterChild:
+    def __init__(self) -> None:
+        self._values = _ShardedValues(1)
+
+    def inc(self, amount: float = 1) -> None:
+        if amount < 0:
+            raise ValueError("Counters can only increase.")
+        self._values.shard()[0] += amount
+
+    def samples(self) -> List[Sample]:
+        return [("", {}, self._values.sum()[0])]
+
+
+class _GaugeChild:
+    def __init__(self) -> None:
+        self._values = _ShardedValues(1)
+        self._function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1) -> None:
+        self._values.shard()[0] += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self._values.shard()[0] -= amount
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Compute the value on each scrape instead, e.g. a ratio."""
+        self._function = function
+
+    def samples(self) -> List[Sample]:
+        if self._function is not None:
+            return [("", {}, self._function())]
+        return [("", {}, self._values.sum()[0])]
+
+
+class _HistogramChild:
+    def __init__(self, buckets: List[float]):
+        self.buckets = list(buckets)
+        # The count of each bucket and of +Inf, then the sum and the count.
+        self._values = _ShardedValues(len(self.buckets) + 3)
+
+    def observe(self, value: float) -> None:
+        shard = self._values.shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-2] += value
+        shard[-1] += 1
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self) -> List[Sample]:
+        values = self._values.sum()
+        samples: List[Sample] = []
+        cumulative = 0.0
+        for bound, count in zip(self.buckets + [math.inf], values):
+            cumulative += count
+            samples.append(("_bucket", {"le": _format_value(bound)}, cumulative))
+        samples.append(("_sum", {}, values[-2]))
+        samples.append(("_count", {}, values[-1]))
+        return samples
+
+
+class _Metric:
+    """A metric family, with a child per combination of label values."""
+
+    kind = ""
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Optional[List[str]] = None
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames or ())
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels: Any) -> Any:
+        """The child of the label values, created on first use."""
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"Metric [{self.name}] takes the labels {list(self.labelnames)}."
+            )
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._children[key] = self._create_child()
+        return child
+
+    def expose(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {_escape_help(self.documentation)}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            labels = dict(zip(self.labelnames, key))
+            for suffix, sample_labels, value in child.samples():
+                lines.append(
+                    f"{self.name}{suffix}{_format_labels({**labels, **sample_labels})} "
+                    + _format_value(value)
+                )
+        return lines
+
+    def _create_child(self) -> Any:
+        raise NotImplementedError("_create_child must be implemented.")
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1) -> None:
+        """Increase the counter without labels."""
+        self.labels().inc(amount)
+
+    def _create_child(self) -> _CounterChild:
+        return _CounterChild()
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.labels().dec(amount)
+
+    def _create_child(self) -> _GaugeChild:
+        return _GaugeChild()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Optional[List[str]] = None,
+        buckets: Optional[List[float]] = None,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _create_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+
+class PrometheusRegistry:
+    """The metric families of the process, exposed on scrape.
+
+    The updates only touch the shard of the calling thread, so the hot paths do
+    not contend on a lock; a scrape sums the shards.
+    """
+
+    def __init__(self, namespace: str = "your_assistant"):
+        """
+        Args:
+            namespace (str): The prefix of the metric names.
+        """
+        self.namespace = namespace
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def counter(
+        self, name: str, documentation: str, labelnames: Optional[List[str]] = None
+    ) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(
+        self, name: str, documentation: str, labelnames: Optional[List[str]] = None
+    ) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Optional[List[str]] = None,
+        buckets: Optional[List[float]] = None,
+    ) -> Histogram:
+        return self._register(
+            Histogram, name, documentation, labelnames, buckets=buckets
+        )
+
+    def expose(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+    def _register(
+        self,
+        metric_type: Any,
+        name: str,
+        documentation: str,
+        labelnames: Optional[List[str]],
+        **kwargs: Any,
+    ) -> Any:
+        """Create the metric, or return it if it is already registered the same
+        way, e.g. by another instance of the same class."""
+        full_name = f"{self.namespace}_{name}" if self.namespace else name
+        with self._lock:
+            metric = self._metrics.get(full_name)
+            if metric is None:
+                metric = metric_type(full_name, documentation, labelnames, **kwargs)
+                self._metrics[full_name] = metric
+            elif type(metric) is not metric_type or metric.labelnames != tuple(
+                labelnames or ()
+            ):
+                raise ValueError(f"Metric [{full_name}] is registered differently.")
+            return metric
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = [
+        '{}="{}"'.format(
+            name,
+            value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'),
+        )
+        for name, value in labels.items()
+    ]
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+# The registry shared by the services, the orchestrators and the responders.
+REGISTRY = PrometheusRegistry()
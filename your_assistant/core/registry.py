@@ -0,0 +1,121 @@
+"""Create the orchestrators on first use.
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import your_assistant.core.utils as utils
+
+
+class OrchestratorRegistry:
+    """Create each orchestrator on its first use, once, even when several threads
+    ask for it at the same time.
+
+    The orchestrators in the warmup list are created and warmed up in the
+    background instead, and the registry is ready once all of them are warm.
+    """
+
+    def __init__(
+        self,
+        orchestrator_types: Dict[str, Any],
+        create: Callable[[str, Any], Any],
+    ):
+        """
+        Args:
+            orchestrator_types (Dict[str, Any]): The orchestrator types by name.
+            create (Callable[[str, Any], Any]): Create the orchestrator of a name
+                and type.
+        """
+        self.orchestrator_types = orchestrator_types
+        self.create = create
+        self.logger = utils.Logger("OrchestratorRegistry")
+        self.warmup_names: List[str] = []
+        self.warmup_errors: Dict[str, str] = {}
+        self._orchestrators: Dict[str, Any] = {}
+        # One lock per orchestrator, so that a slow one does not block the others.
+        self._locks = {name: threading.Lock() for name in orchestrator_types}
+        self._warm = threading.Event()
+        self._warm.set()
+
+    def get(self, name: str) -> Any:
+        """Get the orchestrator, creating it on first use.
+
+        Args:
+            name (str): The name of the orchestrator.
+
+        Returns:
+            Any: The orchestrator.
+        """
+        if name not in self.orchestrator_types:
+            raise KeyError(f"Unknown orchestrator [{name}].")
+        orchestrator = self._orchestrators.get(name)
+        if orchestrator is not None:
+            return orchestrator
+        with self._locks[name]:
+            if name not in self._orchestrators:
+                start = time.perf_counter()
+                self._orchestrators[name] = self.create(
+                    name, self.orchestrator_types[name]
+                )
+                self.logger.info(
+                    f"Created {name} in {time.perf_counter() - start:.2f}s."
+                )
+            return self._orchestrators[name]
+
+    def get_created(self, name: str) -> Optional[Any]:
+        """Get the orchestrator if it is already created, without creating it."""
+        return self._orchestrators.get(name)
+
+    def warmup(self, names: List[str]) -> threading.Thread:
+        """Create and warm up the orchestrators in a background thread.
+
+        Args:
+            names (List[str]): The names of the orchestrators to warm up.
+
+        Returns:
+            threading.Thread: The thread warming up the orchestrators.
+        """
+        unknown = [name for name in names if name not in self.orchestrator_types]
+        if unknown:
+            raise ValueError(f"Unknown orchestrators to warm up {unknown}.")
+        self.warmup_names = list(names)
+        self._warm.clear()
+        thread = threading.Thread(
+            target=self._warmup, args=(self.warmup_names,), name="warmup", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def ready(self) -> bool:
+        """Whether all the orchestrators to warm up are warm."""
+        return self._warm.is_set() and not self.warmup_errors
+
+    def status(self) -> Dict[str, Any]:
+        """The readiness, the orchestrators created so far and the warmup errors."""
+        return {
+            "ready": self.ready(),
+            "created": list(self._orchestrators),
+            "warmup": self.warmup_names,
+            "warmup_errors": dict(self.warmup_errors),
+        }
+
+    def close(self) -> None:
+        """Close the orchestrators created so far."""
+        for orchestrator in list(self._orchestrators.values()):
+            orchestrator.close()
+
+    def _warmup(self, names: List[str]) -> None:
+        try:
+            for name in names:
+                start = time.perf_counter()
+                try:
+                    self.get(name).warmup()
+                except Exception as e:
+                    self.warmup_errors[name] = str(e)
+                    self.logger.error(f"Failed to warm up {name}: {e}")
+                    continue
+                self.logger.info(
+                    f"Warmed up {name} in {time.perf_counter() - start:.2f}s."
+                )
+        finally:
+            self._warm.set()
@@ -1,21 +1,74 @@
 """Core logic of the responders.
 """
 
+import asyncio
+import functools
 import os
 import textwrap
-from typing import Any, Dict, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
 
+import faiss
+import numpy as np
 from colorama import Fore
 from langchain import PromptTemplate
 from langchain.chat_models import ChatOpenAI
 from langchain.docstore.document import Document
 from langchain.embeddings import FakeEmbeddings, OpenAIEmbeddings
-from langchain.memory import ConversationSummaryBufferMemory
 from langchain.vectorstores import FAISS
-from langchain.vectorstores.base import VectorStoreRetriever
+from langchain.vectorstores.utils import maximal_marginal_relevance
 
 import your_assistant.core.llm as llm_lib
+import your_assistant.core.memory as memory_lib
+import your_assistant.core.metrics as metrics_lib
+import your_assistant.core.prometheus as prometheus
+import your_assistant.core.tracing as tracing
 import your_assistant.core.utils as utils
+from your_assistant.core.cache import ResponseCache
+from your_assistant.core.concurrency import KeyedLock, SingleFlight
+from your_assistant.core.indexer import MetadataIndex
+from your_assistant.core.stages import StageGraph
+
+_INDEX_LOAD_SECONDS = prometheus.REGISTRY.histogram(
+    "index_load_duration_seconds",
+    "The time to load an index from disk, on first use or after it changed.",
+    ["index"],
+)
+
+# The indexes loaded once in a parent process, e.g. by the pre-fork server before
+# it forks its workers, with the mtime of their faiss index, by path. The workers
+# then share their memory copy-on-write instead of loading their own copies.
+_PRELOADED_INDEXES: Dict[str, Tuple[float, Tuple[FAISS, MetadataIndex]]] = {}
+
+
+def preload_index(db_name: str, embeddings_tool: Any) -> bool:
+    """Load the index of a db for the DocumentQA instances created later in this
+    process and its forks. An index already preloaded is only loaded again if it
+    changed on disk.
+
+    Args:
+        db_name (str): The db, as passed to DocumentQA.
+        embeddings_tool (Any): The embeddings tool of the loaded index.
+
+    Returns:
+        bool: Whether the db has an index to preload.
+    """
+    db_index_name = os.path.join(db_name, "index")
+    index_path = os.path.join(db_index_name, "index.faiss")
+    if not os.path.exists(index_path):
+        return False
+    mtime = os.path.getmtime(index_path)
+    preloaded = _PRELOADED_INDEXES.get(db_index_name)
+    if preloaded is None or preloaded[0] != mtime:
+        with _INDEX_LOAD_SECONDS.labels(index=db_index_name).time():
+            db = FAISS.load_local(db_index_name, embeddings_tool)
+            metadata_index = MetadataIndex.load(
+                db_index_name
+            ) or MetadataIndex.from_faiss(db)
+        _PRELOADED_INDEXES[db_index_name] = (mtime, (db, metadata_index))
+    return True
 
 
 class DocumentQA:
@@ -27,11 +80,34 @@ class DocumentQA:
         llm_type: str = "ChatGPT",
         use_memory: bool = True,
         memory_token_size: int = 300,
+        memory_coalesce_turns: int = 3,
+        memory_db_path: str = "",
+        max_memory_sessions: int = 100,
+        memory_session_ttl: float = 3600,
+        memory_budget: int = 1000000,
+        memory_spilled_ttl: float = 2592000,
+        memory_shared: bool = False,
         test_mode: bool = False,
         verbose: bool = False,
         max_token_size: int = 1000,
+        response_cache: Optional[ResponseCache] = None,
+        stage_workers: int = 16,
     ):
         self.logger = utils.Logger("DocumentQA")
+        self.response_cache = response_cache
+        # Identical questions in flight share one embedding call and one llm call.
+        self.embedding_flight = SingleFlight()
+        self.llm_flight = SingleFlight()
+        # The questions of a session are answered one at a time, so that each one
+        # sees the turns of the previous ones.
+        self.session_locks = KeyedLock()
+        # The independent stages of building a prompt, e.g. the retrieval and the
+        # history, run in this pool. Without workers they run one after the other.
+        self.stage_executor: Optional[ThreadPoolExecutor] = None
+        if stage_workers > 0:
+            self.stage_executor = ThreadPoolExecutor(
+                max_workers=stage_workers, thread_name_prefix="qa-stage"
+            )
         self.db_index_name = os.path.join(db_name, "index")
         self.llm: Any = None
         # Init the LLM.
@@ -48,17 +124,35 @@ class DocumentQA:
             self.llm = llm_lib.RevChatGPT()
         self.use_memory = use_memory
         if self.use_memory:
-            self.memory: ConversationSummaryBufferMemory = (
-                ConversationSummaryBufferMemory(
-                    llm=self.llm, max_token_limit=memory_token_size
+            self.memory_store: memory_lib.SessionMemoryStore = (
+                memory_lib.SessionMemoryStore(
+                    memory_factory=lambda: memory_lib.AsyncSummaryMemory(
+                        memory=memory_lib.IncrementalSummaryBufferMemory(
+                            llm=self.llm, max_token_limit=memory_token_size
+                        ),
+                        coalesce_turns=memory_coalesce_turns,
+                    ),
+                    namespace="DocumentQA",
+                    db_path=memory_db_path,
+                    max_sessions=max_memory_sessions,
+                    ttl_seconds=memory_session_ttl,
+                    max_total_size=memory_budget,
+                    spilled_ttl_seconds=memory_spilled_ttl,
+                    shared=memory_shared,
                 )
             )
         if test_mode:
-            self.embeddings_tool = FakeEmbeddings()  # type: ignore
+            embeddings_tool = FakeEmbeddings(size=1536)  # type: ignore
         else:
-            self.embeddings_tool = OpenAIEmbeddings()  # type: ignore
+            embeddings_tool = OpenAIEmbeddings()  # type: ignore
+        self.embeddings_tool = metrics_lib.MeteredEmbeddings(embeddings_tool)
         self.verbose = verbose
         self.max_token_size = max_token_size
+        # The loaded index and its metadata index, swapped for new ones only when
+        # the index on disk changes.
+        self._index: Optional[Tuple[FAISS, MetadataIndex]] = None
+        self._index_mtime = 0.0
+        self._index_lock = threading.Lock()
         prompt_template = """
             Please provide an informative ANSWER to the following question based on the retrieved document snippets.
             DO NOT use your own context knowledge. The answer should be in the same language as the question.
@@ -72,14 +166,307 @@ class DocumentQA:
             template=prompt_template,
         )
 
-    def answer(self, question: str, k: int = 5) -> str:
+    def answer(
+        self,
+        question: str,
+        k: int = 5,
+        session_id: str = memory_lib.DEFAULT_SESSION_ID,
+        retrieval_filter: Optional[Dict[str, Any]] = None,
+    ) -> str:
         """Answer a given question.
         Args:
             question (str): The question to answer.
+            session_id (str): The id of the conversation whose memory is used.
+            retrieval_filter (Optional[Dict[str, Any]]): Only retrieve the documents
+                matching the filter. See MetadataIndex.select for the keys.
+        """
+        with self._span("answer", session_id), self._hold_session(session_id):
+            prompt, truncated_prompt = self._build_prompt(
+                question=question,
+                k=k,
+                session_id=session_id,
+                retrieval_filter=retrieval_filter,
+            )
+            with self._track(truncated_prompt) as call:
+                call.cache = "coalesced"
+                call.response = self.llm_flight.do(
+                    ResponseCache.make_key(**self._llm_call(truncated_prompt)),
+                    lambda: self._cached_complete(truncated_prompt, call=call),
+                )
+            self._save_memory(
+                prompt=prompt, answer=call.response, session_id=session_id
+            )
+        answer = f"{call.response}."
+        return answer
+
+    @tracing.isolate_spans
+    def stream_answer(
+        self,
+        question: str,
+        k: int = 5,
+        session_id: str = memory_lib.DEFAULT_SESSION_ID,
+        retrieval_filter: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[str]:
+        """Answer a given question and stream the answer as it is generated.
+        Args:
+            question (str): The question to answer.
+            session_id (str): The id of the conversation whose memory is used.
+            retrieval_filter (Optional[Dict[str, Any]]): Only retrieve the documents
+                matching the filter. See MetadataIndex.select for the keys.
+        """
+        with self._span("stream_answer", session_id), self._hold_session(session_id):
+            prompt, truncated_prompt = self._build_prompt(
+                question=question,
+                k=k,
+                session_id=session_id,
+                retrieval_filter=retrieval_filter,
+            )
+            with self._track(truncated_prompt) as call:
+                llm_call = self._llm_call(truncated_prompt)
+                call.start_lookup(self.response_cache, llm_call["params"])
+
+                def upstream() -> Iterator[str]:
+                    call.reach_backend()
+                    return llm_lib.stream_completion(self.llm, truncated_prompt)
+
+                if self.response_cache:
+                    stream = self.response_cache.cached_stream(
+                        **llm_call, stream=upstream
+                    )
+                else:
+                    stream = upstream()
+                chunks = []
+                for chunk in stream:
+                    call.first_token()
+                    chunks.append(chunk)
+                    yield chunk
+                call.response = "".join(chunks)
+            self._save_memory(
+                prompt=prompt, answer=call.response, session_id=session_id
+            )
+        yield "."
+
+    async def aanswer(
+        self,
+        question: str,
+        k: int = 5,
+        session_id: str = memory_lib.DEFAULT_SESSION_ID,
+        retrieval_filter: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        """Answer a given question without blocking the event loop. The retrieval
+        runs in a worker thread and the llm is awaited.
+        Args:
+            question (str): The question to answer.
+            session_id (str): The id of the conversation whose memory is used.
+            retrieval_filter (Optional[Dict[str, Any]]): Only retrieve the documents
+                matching the filter. See MetadataIndex.select for the keys.
+        """
+        with self._span("aanswer", session_id):
+            async with self._ahold_session(session_id):
+                prompt, truncated_prompt = await self._abuild_prompt(
+                    question=question,
+                    k=k,
+                    session_id=session_id,
+                    retrieval_filter=retrieval_filter,
+                )
+                with self._track(truncated_prompt) as call:
+                    call.cache = "coalesced"
+                    call.response = await self.llm_flight.ado(
+                        ResponseCache.make_key(**self._llm_call(truncated_prompt)),
+                        lambda: self._acached_complete(truncated_prompt, call=call),
+                    )
+                self._save_memory(
+                    prompt=prompt, answer=call.response, session_id=session_id
+                )
+            return f"{call.response}."
+
+    @tracing.isolate_spans
+    async def astream_answer(
+        self,
+        question: str,
+        k: int = 5,
+        session_id: str = memory_lib.DEFAULT_SESSION_ID,
+        retrieval_filter: Optional[Dict[str, Any]] = None,
+    ) -> AsyncIterator[str]:
+        """Answer a given question and stream the answer without blocking the
+        event loop.
+        Args:
+            question (str): The question to answer.
+            session_id (str): The id of the conversation whose memory is used.
+            retrieval_filter (Optional[Dict[str, Any]]): Only retrieve the documents
+                matching the filter. See MetadataIndex.select for the keys.
         """
-        loaded_db = FAISS.load_local(self.db_index_name, self.embeddings_tool)
-        retriever = VectorStoreRetriever(vectorstore=loaded_db, search_type="mmr", k=k)  # type: ignore
-        docs = retriever.get_relevant_documents(question)
+        with self._span("astream_answer", session_id):
+            async with self._ahold_session(session_id):
+                prompt, truncated_prompt = await self._abuild_prompt(
+                    question=question,
+                    k=k,
+                    session_id=session_id,
+                    retrieval_filter=retrieval_filter,
+                )
+                with self._track(truncated_prompt) as call:
+                    llm_call = self._llm_call(truncated_prompt)
+                    call.start_lookup(self.response_cache, llm_call["params"])
+
+                    def upstream() -> AsyncIterator[str]:
+                        call.reach_backend()
+                        return llm_lib.astream_completion(self.llm, truncated_prompt)
+
+                    if self.response_cache:
+                        stream = self.response_cache.acached_stream(
+                            **llm_call, stream=upstream
+                        )
+                    else:
+                        stream = upstream()
+                    chunks = []
+                    async for chunk in stream:
+                        call.first_token()
+                        chunks.append(chunk)
+                        yield chunk
+                    call.response = "".join(chunks)
+                self._save_memory(
+                    prompt=prompt, answer=call.response, session_id=session_id
+                )
+            yield "."
+
+    def retrieve(
+        self,
+        question: str,
+        k: int = 5,
+        retrieval_filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+    ) -> List[Document]:
+        """Retrieve the documents relevant to the question with MMR.
+        The filter is applied inside the FAISS search, so k is not wasted on
+        documents that would be filtered out afterwards.
+
+        Args:
+            question (str): The question to answer.
+            k (int): The number of documents to retrieve.
+            retrieval_filter (Optional[Dict[str, Any]]): Only retrieve the documents
+                matching the filter. See MetadataIndex.select for the keys.
+            fetch_k (int): The number of documents to fetch to pass to MMR.
+        """
+        return self._search(
+            index=self._load_index(),
+            embedding=self._embed_query(question),
+            k=k,
+            retrieval_filter=retrieval_filter,
+            fetch_k=fetch_k,
+        )
+
+    def _search(
+        self,
+        index: Tuple[FAISS, MetadataIndex],
+        embedding: List[float],
+        k: int,
+        retrieval_filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+    ) -> List[Document]:
+        """Search the loaded index with the embedded question. See retrieve."""
+        db, metadata_index = index
+        ids = metadata_index.select(retrieval_filter) if retrieval_filter else None
+        if ids is None:
+            return db.max_marginal_relevance_search_by_vector(
+                embedding, k=k, fetch_k=fetch_k
+            )
+        if len(ids) == 0:
+            return []
+        query = np.array([embedding], dtype=np.float32)
+        _, indices = db.index.search(
+            query,
+            min(fetch_k, len(ids)),
+            params=faiss.SearchParameters(sel=faiss.IDSelectorBatch(ids)),  # type: ignore
+        )
+        # -1 happens when not enough docs are returned.
+        candidates = [int(idx) for idx in indices[0] if idx != -1]
+        mmr_selected = maximal_marginal_relevance(
+            query,
+            [db.index.reconstruct(idx) for idx in candidates],
+            k=min(k, len(candidates)),
+        )
+        docs = []
+        for selected in mmr_selected:
+            doc = db.docstore.search(db.index_to_docstore_id[candidates[selected]])
+            if isinstance(doc, Document):
+                docs.append(doc)
+        return docs
+
+    def _load_index(self) -> Tuple[FAISS, MetadataIndex]:
+        """Load the index and its metadata index, unless they are already loaded and
+        did not change on disk since. While a changed index loads, the other
+        questions are answered with the loaded one, which is then swapped for it.
+        """
+        index = self._index
+        mtime = os.path.getmtime(os.path.join(self.db_index_name, "index.faiss"))
+        if index is not None and mtime == self._index_mtime:
+            return index
+        if index is not None and not self._index_lock.acquire(blocking=False):
+            # Another question is loading the changed index.
+            return index
+        if index is None:
+            self._index_lock.acquire()
+        try:
+            preloaded = _PRELOADED_INDEXES.get(self.db_index_name)
+            if preloaded is not None and preloaded[0] == mtime:
+                self._index, self._index_mtime = preloaded[1], mtime
+            elif self._index is None or mtime != self._index_mtime:
+                with _INDEX_LOAD_SECONDS.labels(index=self.db_index_name).time():
+                    db = FAISS.load_local(self.db_index_name, self.embeddings_tool)
+                    # Dbs indexed before the metadata index existed are backfilled.
+                    metadata_index = MetadataIndex.load(
+                        self.db_index_name
+                    ) or MetadataIndex.from_faiss(db)
+                self._index, self._index_mtime = (db, metadata_index), mtime
+            return self._index
+        finally:
+            self._index_lock.release()
+
+    def reload_index(self) -> None:
+        """Load the index if it changed on disk, e.g. once an indexing job is done,
+        so that the next question does not wait for it."""
+        if os.path.exists(os.path.join(self.db_index_name, "index.faiss")):
+            self._load_index()
+
+    @tracing.traced("qa.build_prompt")
+    def _build_prompt(
+        self,
+        question: str,
+        k: int,
+        session_id: str,
+        retrieval_filter: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[str, str]:
+        """Retrieve the documents and build the prompt for the question.
+        Args:
+            question (str): The question to answer.
+            k (int): The number of documents to retrieve.
+            session_id (str): The id of the conversation whose memory is used.
+            retrieval_filter (Optional[Dict[str, Any]]): The filter of the documents.
+
+        Returns:
+            Tuple[str, str]: The prompt without history and the final prompt to the llm.
+        """
+        # Loading the index and embedding the question are independent, and so are
+        # the retrieval and loading the history.
+        graph = (
+            StageGraph()
+            .add("index", self._load_index)
+            .add("embedding", lambda: self._embed_query(question))
+            .add(
+                "docs",
+                lambda index, embedding: self._search(
+                    index=index,
+                    embedding=embedding,
+                    k=k,
+                    retrieval_filter=retrieval_filter,
+                ),
+                deps=["index", "embedding"],
+            )
+            .add("history", lambda: self._load_history(session_id))
+        )
+        results, timings = graph.run(self.stage_executor)
+        self._record_stages(timings)
+        docs = results["docs"]
         if self.verbose:
             self.logger.info(f"Retrieved {len(docs)} documents.")
         if self.verbose:
@@ -90,13 +477,10 @@ class DocumentQA:
             question=question, doc_snippets=doc_snippets
         )
         if self.use_memory:
-            history: Dict[str, Any] = self.memory.load_memory_variables({})
-            if self.verbose:
-                self.logger.info(f"History: {history}\n\n")
             prompt_with_hist = textwrap.dedent(
                 f"""
                 Past conversations for references:
-                {history["history"]}
+                {results["history"]}
 
                 The current round of the conversation:
                 {prompt}
@@ -111,12 +495,143 @@ class DocumentQA:
             self.logger.info(
                 Fore.GREEN + f"Prompt: {truncated_prompt}\n\n" + Fore.RESET
             )
-        answer = str(self.llm(prompt=truncated_prompt))
+        return prompt, truncated_prompt
+
+    async def _abuild_prompt(self, **kwargs: Any) -> Tuple[str, str]:
+        """Build the prompt in a worker thread, as the retrieval embeds the
+        question and searches the index synchronously."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, tracing.bind(functools.partial(self._build_prompt, **kwargs))
+        )
+
+    def _load_history(self, session_id: str) -> str:
+        if not self.use_memory:
+            return ""
+        memory = self.memory_store.get(session_id)
+        history: Dict[str, Any] = memory.load_memory_variables({})
+        if self.verbose:
+            self.logger.info(f"History: {history}\n\n")
+        return history["history"]
+
+    def _record_stages(self, timings: Dict[str, float]) -> None:
+        """Record the seconds taken by each stage of building the prompt."""
+        for name, seconds in timings.items():
+            stage = metrics_lib.CallMetrics(
+                kind="stage", backend=f"DocumentQA.{name}", prompt=""
+            )
+            stage.latency = seconds
+            metrics_lib.REGISTRY.record(stage)
+        if self.verbose:
+            self.logger.info(
+                "Stages: "
+                + ", ".join(
+                    f"{name} {seconds * 1000:.1f}ms"
+                    for name, seconds in timings.items()
+                )
+            )
+
+    def _embed_query(self, question: str) -> List[float]:
+        return self.embedding_flight.do(
+            question, lambda: self.embeddings_tool.embed_query(question)
+        )
+
+    def _cached_complete(self, prompt: str, call: metrics_lib.CallMetrics) -> str:
+        llm_call = self._llm_call(prompt)
+        call.start_lookup(self.response_cache, llm_call["params"])
+
+        def upstream() -> str:
+            call.reach_backend()
+            return str(self.llm(prompt=prompt))
+
+        if self.response_cache:
+            return self.response_cache.cached(**llm_call, call=upstream)
+        return upstream()
+
+    async def _acached_complete(
+        self, prompt: str, call: metrics_lib.CallMetrics
+    ) -> str:
+        llm_call = self._llm_call(prompt)
+        call.start_lookup(self.response_cache, llm_call["params"])
+
+        async def upstream() -> str:
+            call.reach_backend()
+            return await llm_lib.acomplete(self.llm, prompt)
+
+        if self.response_cache:
+            return await self.response_cache.acached(**llm_call, call=upstream)
+        return await upstream()
+
+    @contextmanager
+    def _track(self, prompt: str) -> Iterator[metrics_lib.CallMetrics]:
+        """Record the tokens and the latency of the llm call of the prompt, and
+        trace it."""
+        with tracing.span("llm.call", backend="DocumentQA") as span:
+            with metrics_lib.REGISTRY.track(
+                kind="llm", backend="DocumentQA", prompt=prompt
+            ) as call:
+                try:
+                    yield call
+                finally:
+                    span.set_attribute("cache", call.cache)
+
+    def _span(self, name: str, session_id: str) -> Any:
+        """A tracing span of the question, e.g. qa.answer."""
+        return tracing.span(f"qa.{name}", session_id=session_id)
+
+    def _llm_call(self, prompt: str) -> Dict[str, Any]:
+        """Identify the llm call of the prompt, to cache and coalesce it."""
+        return {
+            "backend": "DocumentQA",
+            "params": llm_lib.llm_params(self.llm),
+            "prompt": prompt,
+        }
+
+    def _session_key(self, session_id: str) -> Optional[str]:
+        """The session whose questions are serialized, or None without memory."""
+        return session_id if self.use_memory else None
+
+    @contextmanager
+    def _hold_session(self, session_id: str) -> Iterator[None]:
+        """Answer the question alone in its session, with the memory of the session
+        pinned in RAM until its turn is saved."""
+        key = self._session_key(session_id)
+        with self.session_locks.hold(key), self._pin_memory(key):
+            yield
+
+    @asynccontextmanager
+    async def _ahold_session(self, session_id: str) -> AsyncIterator[None]:
+        """The async version of _hold_session."""
+        key = self._session_key(session_id)
+        async with self.session_locks.ahold(key):
+            with self._pin_memory(key):
+                yield
+
+    def _pin_memory(self, key: Optional[str]) -> Any:
+        return self.memory_store.pin(key) if key is not None else nullcontext()
+
+    def _save_memory(self, prompt: str, answer: str, session_id: str) -> None:
         if self.use_memory:
             # Only save the user original prompt without history augmentation.
-            self.memory.save_context(inputs={"user": prompt}, outputs={"AI": answer})
-        answer = f"{answer}."
-        return answer
+            with tracing.span("memory.save"):
+                memory = self.memory_store.get(session_id)
+                memory.save_context(inputs={"user": prompt}, outputs={"AI": answer})
+
+    def warmup(self) -> None:
+        """Prepare the llm and load the index ahead of the first question."""
+        llm_lib.warmup(self.llm)
+        self._load_index()
+
+    def close(self) -> None:
+        """Spill the conversation memories to the db."""
+        if self.use_memory:
+            self.memory_store.close()
+        if self.stage_executor:
+            self.stage_executor.shutdown(wait=False)
+        self.logger.info(
+            f"Coalesced embedding calls: {self.embedding_flight.stats()}, "
+            + f"llm calls: {self.llm_flight.stats()}"
+        )
 
     def _concate_docs(self, docs: List[Document]) -> str:
         """Concatenate a list of documents into a single string.
@@ -0,0 +1,197 @@
+"""Route the requests between the LLM backends by their latency and health.
+"""
+import math
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+
+class CircuitOpenError(RuntimeError):
+    """The backend is skipped, as its circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Stop calling a backend after consecutive failures.
+
+    After failure_threshold consecutive failures the circuit opens and the backend
+    is skipped. Once reset_seconds passed, a single probe call is let through
+    (half-open): its success closes the circuit and its failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30):
+        """
+        Args:
+            failure_threshold (int): The consecutive failures that open the circuit.
+            reset_seconds (float): The seconds to wait before probing the backend.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.num_failures = 0
+        # When the circuit opened, or when the last probe was let through.
+        self._changed_at = 0.0
+
+    def available(self, now: float) -> bool:
+        """Whether a call would be let through, without letting it through."""
+        if self.state == self.CLOSED:
+            return True
+        return now - self._changed_at >= self.reset_seconds
+
+    def allow(self, now: float) -> bool:
+        """Let a call through if possible. When open, the call is the probe.
+        A probe that never reports back is replaced after reset_seconds."""
+        if not self.available(now):
+            return False
+        if self.state != self.CLOSED:
+            self.state = self.HALF_OPEN
+            self._changed_at = now
+        return True
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.num_failures = 0
+
+    def record_failure(self, now: float) -> None:
+        self.num_failures += 1
+        if self.state == self.HALF_OPEN or self.num_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self._changed_at = now
+
+
+class BackendStats:
+    """The exponentially weighted moving averages of the latency and the error rate
+    of a backend, plus a window of recent latencies for percentiles."""
+
+    def __init__(self, alpha: float = 0.2, window: int = 200):
+        """
+        Args:
+            alpha (float): The weight of the latest observation in the averages.
+            window (int): The number of recent latencies kept for percentiles.
+        """
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.num_calls = 0
+        self.latencies: Deque[float] = deque(maxlen=window)
+
+    def record(self, latency: float, error: bool) -> None:
+        self.num_calls += 1
+        self.error_rate += self.alpha * (float(error) - self.error_rate)
+        # A failure is often fast, so it would make the backend look fast.
+        if error:
+            return
+        self.latencies.append(latency)
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.alpha * (latency - self.latency)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """The latency at the percentile of the recent successful calls."""
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        rank = math.ceil(percentile / 100 * len(latencies)) - 1
+        return latencies[min(max(rank, 0), len(latencies) - 1)]
+
+
+class LatencyRouter:
+    """Rank the backends by their expected latency, penalized by their error rate,
+    and skip the ones whose circuit is open."""
+
+    def __init__(
+        self,
+        backends: List[str],
+        alpha: float = 0.2,
+        error_penalty: float = 10,
+        failure_threshold: int = 5,
+        reset_seconds: float = 30,
+        hedge_percentile: float = 95,
+        default_hedge_delay: float = 1.0,
+    ):
+        """
+        Args:
+            backends (List[str]): The names of the backends, by preference.
+            alpha (float): The weight of the latest observation in the averages.
+            error_penalty (float): Multiply the latency by 1 + error_penalty * rate.
+            failure_threshold (int): The consecutive failures that open a circuit.
+            reset_seconds (float): The seconds to wait before probing a backend.
+            hedge_percentile (float): Hedge a call once it is slower than this
+                percentile of the latencies of its backend.
+            default_hedge_delay (float): The hedge delay of a backend without history.
+        """
+        if not backends:
+            raise ValueError("At least one backend is required.")
+        self.backends = backends
+        self.error_penalty = error_penalty
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.stats = {backend: BackendStats(alpha=alpha) for backend in backends}
+        self.breakers = {
+            backend: CircuitBreaker(
+                failure_threshold=failure_threshold, reset_seconds=reset_seconds
+            )
+            for backend in backends
+        }
+        self._lock = threading.Lock()
+
+    def candidates(self) -> List[str]:
+        """The available backends, fastest first. Backends without history come
+        first, in the order of preference, so that they get measured."""
+        with self._lock:
+            now = time.monotonic()
+            available = [
+                backend
+                for backend in self.backends
+                if self.breakers[backend].available(now)
+            ]
+            return sorted(available, key=self._score)
+
+    def acquire(self, backend: str) -> None:
+        """Claim a call to the backend.
+
+        Raises:
+            CircuitOpenError: If the circuit of the backend is open.
+        """
+        with self._lock:
+            if not self.breakers[backend].allow(time.monotonic()):
+                raise CircuitOpenError(f"The circuit of {backend} is open.")
+
+    def record(self, backend: str, latency: float, error: bool) -> None:
+        """Record the outcome of a call to the backend."""
+        with self._lock:
+            self.stats[backend].record(latency=latency, error=error)
+            if error:
+                self.breakers[backend].record_failure(time.monotonic())
+            else:
+                self.breakers[backend].record_success()
+
+    def hedge_delay(self, backend: str) -> float:
+        """The seconds to wait for a call before hedging it on another backend."""
+        with self._lock:
+            delay = self.stats[backend].percentile(self.hedge_percentile)
+        return self.default_hedge_delay if delay is None else delay
+
+    def snapshot(self) -> Dict[str, Dict[str, object]]:
+        """The stats and the circuit state of every backend."""
+        with self._lock:
+            return {
+                backend: {
+                    "latency": self.stats[backend].latency,
+                    "error_rate": self.stats[backend].error_rate,
+                    "calls": self.stats[backend].num_calls,
+                    "circuit": self.breakers[backend].state,
+                }
+                for backend in self.backends
+            }
+
+    def _score(self, backend: str) -> float:
+        stats = self.stats[backend]
+        if stats.latency is None:
+            return 0.0 if stats.num_calls == 0 else math.inf
+        return stats.latency * (1 + self.error_penalty * stats.error_rate)
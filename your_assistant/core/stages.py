@@ -0,0 +1,102 @@
+"""Run the stages of a pipeline concurrently, following their dependencies.
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import your_assistant.core.tracing as tracing
+
+
+class StageGraph:
+    """Run the stages of a pipeline as a dependency graph.
+
+    A stage starts as soon as the stages it depends on are done, and is given
+    their results as keyword arguments. The independent stages thus run
+    concurrently, and the latency of the pipeline is that of its critical path.
+    The stages can only depend on the stages added before them, so the graph has
+    no cycle. Each stage is traced as a stage.<name> span under the caller's span.
+    """
+
+    def __init__(self) -> None:
+        self._stages: Dict[str, Tuple[Callable[..., Any], List[str]]] = {}
+
+    def add(
+        self, name: str, fn: Callable[..., Any], deps: Iterable[str] = ()
+    ) -> "StageGraph":
+        """Add a stage.
+
+        Args:
+            name (str): The name of the stage, and of its result.
+            fn (Callable[..., Any]): The stage, called with the results of its
+                dependencies as keyword arguments.
+            deps (Iterable[str]): The names of the stages it depends on.
+
+        Returns:
+            StageGraph: The graph, to chain the additions.
+        """
+        deps = list(deps)
+        if name in self._stages:
+            raise ValueError(f"Duplicate stage [{name}].")
+        unknown = [dep for dep in deps if dep not in self._stages]
+        if unknown:
+            raise ValueError(f"Stage [{name}] depends on unknown stages {unknown}.")
+        self._stages[name] = (fn, deps)
+        return self
+
+    def run(
+        self, executor: Optional[Executor] = None
+    ) -> Tuple[Dict[str, Any], Dict[str, float]]:
+        """Run the stages. The first failing stage raises its exception, and the
+        stages that did not start yet are cancelled.
+
+        Args:
+            executor (Optional[Executor]): The executor of the stages. Without
+                one, the stages run one after the other in the caller thread.
+
+        Returns:
+            Tuple[Dict[str, Any], Dict[str, float]]: The result and the seconds
+                taken by each stage.
+        """
+        results: Dict[str, Any] = {}
+        timings: Dict[str, float] = {}
+        if executor is None:
+            for name, (fn, deps) in self._stages.items():
+                results[name], timings[name] = self._timed(
+                    name, fn, {dep: results[dep] for dep in deps}
+                )
+            return results, timings
+        pending = dict(self._stages)
+        running: Dict[Future, str] = {}
+        try:
+            while pending or running:
+                ready = [
+                    name
+                    for name, (_, deps) in pending.items()
+                    if all(dep in results for dep in deps)
+                ]
+                for name in ready:
+                    fn, deps = pending.pop(name)
+                    future = executor.submit(
+                        tracing.bind(self._timed),
+                        name,
+                        fn,
+                        {dep: results[dep] for dep in deps},
+                    )
+                    running[future] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name], timings[name] = future.result()
+        finally:
+            for future in running:
+                future.cancel()
+        return results, timings
+
+    @staticmethod
+    def _timed(
+        name: str, fn: Callable[..., Any], kwargs: Dict[str, Any]
+    ) -> Tuple[Any, float]:
+        start = time.perf_counter()
+        with tracing.span(f"stage.{name}"):
+            result = fn(**kwargs)
+        return result, time.perf_counter() - start
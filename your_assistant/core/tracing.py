@@ -0,0 +1,408 @@
+"""Trace the requests as nested spans, e.g. to find the slow step of a request.
+"""
+import asyncio
+import atexit
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import os
+import threading
+import time
+from collections.abc import AsyncIterator, Iterator
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Optional, TextIO
+
+# The formats of the trace files. Chrome traces open in chrome://tracing or Perfetto.
+TRACE_FORMATS = ["jsonl", "chrome"]
+
+_CURRENT_SPAN: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+_span_ids = itertools.count(1)
+
+
+class Span:
+    """A timed step of a request, with attributes. The span open when another one
+    starts is its parent, so that the spans of a request form a tree."""
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span_id = next(_span_ids)
+        self.parent: Optional[Span] = None
+        self.trace_id = self.span_id
+        self.start_time = 0.0
+        self.duration = 0.0
+        self.thread_id = 0
+        self._start = 0.0
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def start(self) -> "Span":
+        """Start the span and make it the parent of the spans started under it."""
+        self.parent = _CURRENT_SPAN.get()
+        if self.parent is not None:
+            self.trace_id = self.parent.trace_id
+        self.thread_id = threading.get_native_id()
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        _CURRENT_SPAN.set(self)
+        return self
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        """End the span and export it.
+
+        Args:
+            error (Optional[BaseException]): The error that ended the span.
+        """
+        self.duration = time.perf_counter() - self._start
+        # The caller stopping a stream, or a hedged call losing its race, is not an
+        # error.
+        if error is not None and not isinstance(
+            error, (GeneratorExit, asyncio.CancelledError)
+        ):
+            self.attributes["error"] = repr(error)
+        if _CURRENT_SPAN.get() is self:
+            _CURRENT_SPAN.set(self.parent)
+        self.tracer.export(self)
+
+    def __enter__(self) -> "Span":
+        return self.start()
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        self.end(error=exc)
+
+
+class _NoopSpan:
+    """The span of a disabled tracer, which records nothing."""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def start(self) -> "_NoopSpan":
+        return self
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class JsonlExporter:
+    """Write each span as a json line, once it ends."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file: TextIO = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(
+            {
+                "name": span.name,
+                "trace_id": span.trace_id,
+                "span_id": span.span_id,
+                "parent_id": span.parent.span_id if span.parent else None,
+                "start": span.start_time,
+                "duration": span.duration,
+                "thread_id": span.thread_id,
+                "attributes": span.attributes,
+            },
+            default=str,
+        )
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class ChromeTraceExporter:
+    """Write the spans as complete events of the Chrome trace format. The array is
+    closed on close, but the viewers also accept a trace cut short."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file: TextIO = open(path, "w", encoding="utf-8")
+        self._file.write("[")
+        self._num_events = 0
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        event = json.dumps(
+            {
+                "name": span.name,
+                "cat": span.name.split(".")[0],
+                "ph": "X",
+                "ts": int(span.start_time * 1e6),
+                "dur": int(span.duration * 1e6),
+                "pid": os.getpid(),
+                "tid": span.thread_id,
+                "args": {
+                    **span.attributes,
+                    "trace_id": span.trace_id,
+                    "span_id": span.span_id,
+                    "parent_id": span.parent.span_id if span.parent else None,
+                },
+            },
+            default=str,
+        )
+        with self._lock:
+            self._file.write(("," if self._num_events else "") + "\n" + event)
+            self._file.flush()
+            self._num_events += 1
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.write("\n]\n")
+            self._file.close()
+
+
+class Tracer:
+    """Create the spans and export them. Without an exporter the tracer is disabled,
+    and its spans cost a function call."""
+
+    def __init__(self, exporter: Any = None):
+        """
+        Args:
+            exporter (Any): Export the ended spans, e.g. a JsonlExporter.
+        """
+        self.exporter = exporter
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def span(self, name: str, **attributes: Any) -> Any:
+        """A span to use as a context manager, or to start and end explicitly.
+
+        Args:
+            name (str): The name of the span, e.g. qa.answer.
+            attributes (Any): The attributes of the span.
+        """
+        if self.exporter is None:
+            return _NOOP_SPAN
+        return Span(tracer=self, name=name, attributes=attributes)
+
+    def export(self, span: Span) -> None:
+        exporter = self.exporter
+        if exporter is not None:
+            exporter.export(span)
+
+    def close(self) -> None:
+        """Flush and close the exporter, disabling the tracer."""
+        exporter, self.exporter = self.exporter, None
+        if exporter is not None:
+            exporter.close()
+
+
+# The tracer shared by the services, the orchestrators and the responders.
+TRACER = Tracer()
+
+
+def configure(path: Optional[str], trace_format: Optional[str] = None) -> Tracer:
+    """Export the spans of the shared tracer to a file, or disable it.
+
+    Args:
+        path (Optional[str]): The trace file. None or empty disables the tracer.
+        trace_format (Optional[str]): One of TRACE_FORMATS. Defaults to chrome for
+            .json files and to jsonl otherwise.
+
+    Returns:
+        Tracer: The shared tracer.
+    """
+    TRACER.close()
+    if not path:
+        return TRACER
+    if trace_format is None:
+        trace_format = "chrome" if path.endswith(".json") else "jsonl"
+    if trace_format not in TRACE_FORMATS:
+        raise ValueError(f"Unknown trace format [{trace_format}].")
+    if trace_format == "chrome":
+        TRACER.exporter = ChromeTraceExporter(path)
+    else:
+        TRACER.exporter = JsonlExporter(path)
+    return TRACER
+
+
+def configure_from_env(per_process: bool = False) -> Tracer:
+    """Configure the shared tracer from the TRACE_FILE and TRACE_FORMAT env vars.
+
+    Args:
+        per_process (bool): Trace to a file of this process, e.g. trace.1234.json
+            for trace.json, as the pre-forked workers cannot share one file.
+    """
+    path = os.getenv("TRACE_FILE") or None
+    if path and per_process:
+        root, extension = os.path.splitext(path)
+        path = f"{root}.{os.getpid()}{extension}"
+    return configure(path, os.getenv("TRACE_FORMAT") or None)
+
+
+def span(name: str, **attributes: Any) -> Any:
+    """A span of the shared tracer. See Tracer.span."""
+    if TRACER.exporter is None:
+        return _NOOP_SPAN
+    return Span(tracer=TRACER, name=name, attributes=attributes)
+
+
+def current_span() -> Optional[Span]:
+    """The innermost open span of the caller."""
+    return _CURRENT_SPAN.get()
+
+
+def bind(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """Bind the function to the current span, to run it in a worker thread that
+    would otherwise start its spans as new traces. Each call of the result needs a
+    fresh bind."""
+    if TRACER.exporter is None:
+        return fn
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+def steps(iterator: Iterator[Any]) -> Iterator[Any]:
+    """Iterate the generator in a context of its own, so that the spans it opens
+    are current while it runs, and not in the consumer between its items."""
+    context = contextvars.copy_context()
+    try:
+        while True:
+            try:
+                item = context.run(next, iterator)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        context.run(getattr(iterator, "close", lambda: None))
+
+
+async def asteps(iterator: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    """The async version of steps. A coroutine cannot run in another context, so
+    the current span is set and reset around each step instead."""
+    current = _CURRENT_SPAN.get()
+    try:
+        while True:
+            token = _CURRENT_SPAN.set(current)
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                current = _CURRENT_SPAN.get()
+                _CURRENT_SPAN.reset(token)
+            yield item
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            token = _CURRENT_SPAN.set(current)
+            try:
+                await aclose()
+            finally:
+                _CURRENT_SPAN.reset(token)
+
+
+def isolate_spans(fn: Any) -> Any:
+    """Iterate each stream of the (async) generator function with steps or asteps,
+    e.g. a stream that opens a span around the items it yields. Disabled, the
+    streams are iterated as they are."""
+    if inspect.isasyncgenfunction(fn):
+
+        @functools.wraps(fn)
+        async def isolated_asyncgen(*args: Any, **kwargs: Any) -> Any:
+            stream = fn(*args, **kwargs)
+            if TRACER.exporter is not None:
+                stream = asteps(stream)
+            async for item in stream:
+                yield item
+
+        return isolated_asyncgen
+
+    @functools.wraps(fn)
+    def isolated_gen(*args: Any, **kwargs: Any) -> Any:
+        if TRACER.exporter is None:
+            yield from fn(*args, **kwargs)
+        else:
+            yield from steps(fn(*args, **kwargs))
+
+    return isolated_gen
+
+
+def traced(name: Optional[str] = None) -> Callable[[Any], Any]:
+    """Trace each call of the decorated function, coroutine function or
+    (async) generator function. Disabled, the calls are not traced.
+
+    Args:
+        name (Optional[str]): The name of the spans. Defaults to the module and the
+            qualified name of the function, e.g. llm.PaLM._call.
+    """
+
+    def decorator(fn: Any) -> Any:
+        span_name = name or f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__qualname__}"
+
+        # Each wrapper is of the same kind as fn, so that the callers inspecting fn,
+        # e.g. with inspect.iscoroutinefunction, see what it is.
+        if inspect.isasyncgenfunction(fn):
+
+            async def spanned_asyncgen(*args: Any, **kwargs: Any) -> Any:
+                with span(span_name):
+                    async for item in fn(*args, **kwargs):
+                        yield item
+
+            @functools.wraps(fn)
+            async def traced_asyncgen(*args: Any, **kwargs: Any) -> Any:
+                if TRACER.exporter is None:
+                    stream = fn(*args, **kwargs)
+                else:
+                    stream = asteps(spanned_asyncgen(*args, **kwargs))
+                async for item in stream:
+                    yield item
+
+            return traced_asyncgen
+        if inspect.isgeneratorfunction(fn):
+
+            def spanned_gen(*args: Any, **kwargs: Any) -> Any:
+                with span(span_name):
+                    yield from fn(*args, **kwargs)
+
+            @functools.wraps(fn)
+            def traced_gen(*args: Any, **kwargs: Any) -> Any:
+                if TRACER.exporter is None:
+                    yield from fn(*args, **kwargs)
+                else:
+                    yield from steps(spanned_gen(*args, **kwargs))
+
+            return traced_gen
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def traced_coroutine(*args: Any, **kwargs: Any) -> Any:
+                with span(span_name) if TRACER.exporter else nullcontext():
+                    return await fn(*args, **kwargs)
+
+            return traced_coroutine
+
+        @functools.wraps(fn)
+        def traced_call(*args: Any, **kwargs: Any) -> Any:
+            if TRACER.exporter is None:
+                return fn(*args, **kwargs)
+            with span(span_name):
+                return fn(*args, **kwargs)
+
+        return traced_call
+
+    return decorator
+
+
+atexit.register(TRACER.close)
@@ -0,0 +1,617 @@
+"""Synthesize speech with a pool of resident text-to-speech models, and cache it.
+"""
+import functools
+import hashlib
+import io
+import json
+import os
+import queue
+import re
+import struct
+import threading
+import time
+import wave
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import your_assistant.core.prometheus as prometheus
+import your_assistant.core.utils as utils
+
+_TTS_LOAD_SECONDS = prometheus.REGISTRY.histogram(
+    "tts_load_seconds", "The time to load a text-to-speech model.", ["model"]
+)
+_TTS_SYNTHESIS_SECONDS = prometheus.REGISTRY.histogram(
+    "tts_synthesis_seconds", "The time to synthesize the speech of a text.", ["model"]
+)
+
+# The end of a sentence: its punctuation, then spaces, or a line break.
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\s*\n\s*")
+
+
+def split_sentences(text: str, max_chars: int = 500) -> List[str]:
+    """Split the text into sentences, to synthesize one after the other. The
+    sentences longer than max_chars are split between words.
+
+    Args:
+        text (str): The text to split.
+        max_chars (int): The maximum length of a piece, but for longer words.
+
+    Returns:
+        List[str]: The non-empty sentences, in order.
+    """
+    sentences: List[str] = []
+    for sentence in _SENTENCE_END.split(text):
+        piece = ""
+        for word in sentence.split():
+            if piece and len(piece) + 1 + len(word) > max_chars:
+                sentences.append(piece)
+                piece = ""
+            piece = f"{piece} {word}" if piece else word
+        if piece:
+            sentences.append(piece)
+    return sentences
+
+
+def wav_header(sample_rate: int) -> bytes:
+    """The header of a streamed 16-bit mono WAV file. Its length is not known when
+    it is sent, so the sizes are the largest ones, which the players read as "up
+    to the end of the stream"."""
+    unknown_size = 0xFFFFFFFF
+    return (
+        struct.pack("<4sI4s", b"RIFF", unknown_size, b"WAVE")
+        + struct.pack(
+            "<4sIHHIIHH", b"fmt ", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16
+        )
+        + struct.pack("<4sI", b"data", unknown_size)
+    )
+
+
+def wav_frames(wav: bytes) -> bytes:
+    """The bare PCM frames of a WAV file, wherever its header ends."""
+    with wave.open(io.BytesIO(wav), "rb") as wav_file:
+        return wav_file.readframes(wav_file.getnframes())
+
+
+@functools.lru_cache(maxsize=8)
+def _file_digest(path: str, size: int, mtime_ns: int) -> str:
+    # The file is hashed again only once its size or its mtime change.
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SileroTTS:
+    """The Silero text-to-speech model, run on the CPU."""
+
+    VERSION = "v3_en"
+    SAMPLE_RATES = [8000, 24000, 48000]
+
+    def __init__(self, model_path: str = "model.pt", version: str = VERSION):
+        """Load the model, downloading it first if needed.
+
+        Args:
+            model_path (str): The local file of the model package.
+            version (str): The version of the model package.
+        """
+        # Torch is only needed by the service that synthesizes speech.
+        import torch
+
+        if not os.path.isfile(model_path):
+            torch.hub.download_url_to_file(
+                f"https://models.silero.ai/models/tts/en/{version}.pt", model_path
+            )
+        self.version = self.file_version(model_path, version)
+        self.model = torch.package.PackageImporter(model_path).load_pickle(
+            "tts_models", "model"
+        )
+        # TODO(fuj): GPU doesn't seem to help? Dig more into this later.
+        self.model.to(torch.device("cpu"))
+
+    @staticmethod
+    def file_version(model_path: str = "model.pt", version: str = VERSION) -> str:
+        """The version of the model package, and the hash of its file, so that a
+        swapped file is told apart from the previous one.
+
+        Args:
+            model_path (str): The local file of the model package.
+            version (str): The version of the model package.
+
+        Returns:
+            str: The version, or an empty one if the file is not downloaded yet.
+        """
+        if not os.path.isfile(model_path):
+            return ""
+        stat = os.stat(model_path)
+        digest = _file_digest(
+            os.path.realpath(model_path), stat.st_size, stat.st_mtime_ns
+        )
+        return f"{version}-{digest[:16]}"
+
+    def init_thread(self, num_threads: int) -> None:
+        """Set the intra-op threads of the calling thread."""
+        import torch
+
+        torch.set_num_threads(num_threads)
+
+    def synthesize(self, text: str, voice_id: str, sample_rate: int) -> np.ndarray:
+        """Synthesize the text into samples in [-1, 1]."""
+        audio = self.model.apply_tts(
+            text=text, speaker=voice_id, sample_rate=sample_rate
+        )
+        return audio.numpy()
+
+
+class Speech:
+    """The samples of a synthesized text, and the time spent on them."""
+
+    def __init__(
+        self,
+        audio: np.ndarray,
+        sample_rate: int,
+        wait_seconds: float,
+        synthesis_seconds: float,
+    ):
+        self.audio = audio
+        self.sample_rate = sample_rate
+        # The time waited for a free model, then the time synthesizing.
+        self.wait_seconds = wait_seconds
+        self.synthesis_seconds = synthesis_seconds
+
+    @classmethod
+    def concatenate(cls, speeches: List["Speech"]) -> "Speech":
+        """The speech of consecutive sentences, as one."""
+        return cls(
+            audio=np.concatenate([speech.audio for speech in speeches]),
+            sample_rate=speeches[0].sample_rate,
+            wait_seconds=sum(speech.wait_seconds for speech in speeches),
+            synthesis_seconds=sum(speech.synthesis_seconds for speech in speeches),
+        )
+
+    def to_pcm(self) -> bytes:
+        """The 16-bit little-endian mono PCM of the samples."""
+        samples = np.clip(np.asarray(self.audio, dtype=np.float32), -1.0, 1.0)
+        return (samples * 32767).astype("<i2").tobytes()
+
+    def to_wav(self) -> bytes:
+        """The WAV file of the samples, built in memory."""
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(self.sample_rate)
+            wav_file.writeframes(self.to_pcm())
+        return buffer.getvalue()
+
+
+class TTSModelPool:
+    """Keep a few text-to-speech models loaded, each used by one thread at a time.
+
+    The models are loaded once, on the first synthesis or the warmup, instead of on
+    every request. Each of the pool threads synthesizes with its own budget of
+    intra-op threads, so that the syntheses in parallel do not oversubscribe the
+    CPUs. A request may ask for fewer of them, but not for more.
+    """
+
+    def __init__(
+        self,
+        model_factory: Callable[[], Any],
+        size: int = 1,
+        num_threads: int = 4,
+        name: str = "Silero",
+        version: str = "",
+    ):
+        """
+        Args:
+            model_factory (Callable[[], Any]): Load a model, e.g. a SileroTTS.
+            size (int): The number of models, and of syntheses in parallel.
+            num_threads (int): The intra-op threads of each synthesis.
+            name (str): The name of the model, in the metrics.
+            version (str): The version of the model, known before it loads, e.g.
+                to look up its speech in a cache. The one of the loaded model
+                replaces it.
+        """
+        if size < 1 or num_threads < 1:
+            raise ValueError(
+                f"The pool needs at least one model [{size}] and one thread "
+                + f"[{num_threads}]."
+            )
+        self.model_factory = model_factory
+        self.size = size
+        self.num_threads = num_threads
+        self.name = name
+        self.logger = utils.Logger("TTSModelPool")
+        # The seconds spent loading the models, 0 until they are loaded.
+        self.load_seconds = 0.0
+        self.version = version
+        self._models: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+        self._loaded = False
+        self._load_lock = threading.Lock()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="tts")
+
+    @classmethod
+    def from_env(cls, workers: int = 1) -> "TTSModelPool":
+        """Create the pool within the TTS_POOL_SIZE and TTS_THREADS env vars. By
+        default the CPUs are shared by the workers of the service, and then by the
+        models of each one.
+
+        Args:
+            workers (int): The number of processes of the service.
+        """
+        size = int(os.getenv("TTS_POOL_SIZE") or 1)
+        threads = int(
+            os.getenv("TTS_THREADS") or max(1, (os.cpu_count() or 1) // workers)
+        )
+        return cls(
+            model_factory=SileroTTS,
+            size=size,
+            num_threads=max(1, threads // size),
+            version=SileroTTS.file_version(),
+        )
+
+    def load(self) -> float:
+        """Load the models, unless they are loaded.
+
+        Returns:
+            float: The seconds spent loading them.
+        """
+        if self._loaded:
+            return self.load_seconds
+        with self._load_lock:
+            if not self._loaded:
+                start = time.perf_counter()
+                models: List[Any] = []
+                for _ in range(self.size):
+                    with _TTS_LOAD_SECONDS.labels(model=self.name).time():
+                        models.append(self.model_factory())
+                for model in models:
+                    self._models.put(model)
+                # The file of the model may have changed since the pool was created.
+                self.version = getattr(models[0], "version", "") or self.version
+                self.load_seconds = time.perf_counter() - start
+                self._loaded = True
+                self.logger.info(
+                    f"Loaded {self.size} {self.name} models in "
+                    + f"{self.load_seconds:.2f}s."
+                )
+            return self.load_seconds
+
+    def warmup(self) -> threading.Thread:
+        """Load the models in a background thread."""
+        thread = threading.Thread(target=self.load, name="tts-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def synthesize(
+        self,
+        text: str,
+        voice_id: str = "en_0",
+        sample_rate: int = 48000,
+        num_threads: Optional[int] = None,
+    ) -> Speech:
+        """Synthesize the text with the first free model.
+
+        Args:
+            text (str): The text to speak.
+            voice_id (str): The speaker of the model.
+            sample_rate (int): The sample rate of the audio.
+            num_threads (Optional[int]): The intra-op threads of the synthesis,
+                at most the ones of the pool, by default.
+
+        Returns:
+            Speech: The samples and the time spent on them.
+        """
+        self.load()
+        submitted = time.perf_counter()
+        return self._executor.submit(
+            self._synthesize,
+            text,
+            voice_id,
+            sample_rate,
+            self._threads(num_threads),
+            submitted,
+        ).result()
+
+    def stream(
+        self,
+        text: str,
+        voice_id: str = "en_0",
+        sample_rate: int = 48000,
+        lookahead: int = 2,
+        num_threads: Optional[int] = None,
+    ) -> Iterator[Speech]:
+        """Synthesize the text sentence by sentence, and yield the speech of each
+        one as soon as it is ready. The next sentences are synthesized while the
+        previous ones are yielded, so that the first one is heard after its own
+        synthesis rather than the one of the whole text.
+
+        Args:
+            text (str): The text to speak.
+            voice_id (str): The speaker of the model.
+            sample_rate (int): The sample rate of the audio.
+            lookahead (int): The sentences synthesized ahead of the one yielded.
+            num_threads (Optional[int]): The intra-op threads of each synthesis,
+                at most the ones of the pool, by default.
+
+        Yields:
+            Speech: The speech of each sentence, in order.
+        """
+        self.load()
+        threads = self._threads(num_threads)
+        sentences = iter(split_sentences(text))
+        futures: Deque[Future] = deque()
+
+        def submit_next() -> None:
+            sentence = next(sentences, None)
+            if sentence is not None:
+                futures.append(
+                    self._executor.submit(
+                        self._synthesize,
+                        sentence,
+                        voice_id,
+                        sample_rate,
+                        threads,
+                        time.perf_counter(),
+                    )
+                )
+
+        try:
+            for _ in range(max(1, lookahead)):
+                submit_next()
+            while futures:
+                speech = futures.popleft().result()
+                submit_next()
+                yield speech
+        finally:
+            # The client went away: the sentences not started are dropped.
+            for future in futures:
+                future.cancel()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def _threads(self, num_threads: Optional[int]) -> int:
+        if num_threads is None:
+            return self.num_threads
+        if num_threads < 1:
+            raise ValueError(f"A synthesis needs at least one thread [{num_threads}].")
+        return min(num_threads, self.num_threads)
+
+    def _synthesize(
+        self,
+        text: str,
+        voice_id: str,
+        sample_rate: int,
+        num_threads: int,
+        submitted: float,
+    ) -> Speech:
+        # There are as many models as pool threads, so one is always free.
+        model = self._models.get()
+        try:
+            # The threads are set again only when a request asks for others.
+            if getattr(self._local, "num_threads", None) != num_threads:
+                model.init_thread(num_threads)
+                self._local.num_threads = num_threads
+            start = time.perf_counter()
+            with _TTS_SYNTHESIS_SECONDS.labels(model=self.name).time():
+                audio = model.synthesize(text, voice_id, sample_rate)
+            return Speech(
+                audio=audio,
+                sample_rate=sample_rate,
+                wait_seconds=start - submitted,
+                synthesis_seconds=time.perf_counter() - start,
+            )
+        finally:
+            self._models.put(model)
+
+
+class SpeechCache:
+    """An on-disk cache of the synthesized speech, addressed by its content.
+
+    The key is a hash of the text, the voice, the sample rate and the model
+    version, and the audio is stored as a file named after it, so that it can be
+    sent as is, ranges included. The least recently used files are evicted once
+    the files exceed the size budget. The hottest entries are also kept in
+    memory, within a smaller budget.
+
+    Several processes may share the directory: the files are written atomically,
+    and a process that finds its view of the directory over budget scans it again
+    before evicting.
+    """
+
+    def __init__(
+        self,
+        directory: str = "tts_cache",
+        max_size: int = 500000000,
+        memory_size: int = 32000000,
+        suffix: str = ".wav",
+    ):
+        """Initialize the cache.
+
+        Args:
+            directory (str): The directory of the audio files.
+            max_size (int): The maximum bytes of all the audio files.
+            memory_size (int): The maximum bytes of the audio kept in memory.
+            suffix (str): The suffix of the audio files.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.memory_size = memory_size
+        self.suffix = suffix
+        self.logger = utils.Logger("SpeechCache")
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # The sizes of the files, and of the audio in memory, from the least
+        # recently used.
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        self._files_size = 0
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_used = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def make_key(text: str, voice_id: str, sample_rate: int, model_version: str) -> str:
+        """Hash what the speech of a text depends on into a cache key.
+
+        Args:
+            text (str): The text spoken.
+            voice_id (str): The speaker.
+            sample_rate (int): The sample rate of the audio.
+            model_version (str): The model, and its version.
+
+        Returns:
+            str: The cache key.
+        """
+        payload = json.dumps(
+            [text, voice_id, sample_rate, model_version], ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        """The path of the audio file of the key, whether it exists or not."""
+        return os.path.join(self.directory, key[:2], f"{key}{self.suffix}")
+
+    def get(self, key: str) -> Tuple[Optional[bytes], Optional[str]]:
+        """Look up the speech of a key, in memory first, then on disk.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            Tuple[Optional[bytes], Optional[str]]: The audio if it is in memory,
+                else the path of its file if it is on disk, else None for both.
+        """
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                if key in self._files:
+                    self._files.move_to_end(key)
+                self.memory_hits += 1
+                return audio, None
+        path = self.path(key)
+        try:
+            # The access time is the modification time, as atime is often off.
+            os.utime(path)
+            size = os.path.getsize(path)
+        except OSError:
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return None, None
+        with self._lock:
+            self._remember(key, size)
+            self.disk_hits += 1
+        if size <= self.memory_size // 8:
+            # The entry is hot again: the next hits are served from memory.
+            with open(path, "rb") as f:
+                audio = f.read()
+            with self._lock:
+                self._keep_in_memory(key, audio)
+        return None, path
+
+    def put(self, key: str, audio: bytes) -> str:
+        """Store the speech of a key and evict the least recently used files over
+        budget.
+
+        Args:
+            key (str): The cache key.
+            audio (bytes): The encoded audio, e.g. a WAV file.
+
+        Returns:
+            str: The path of the audio file.
+        """
+        path = self.path(key)
+        if len(audio) > self.max_size:
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so that the readers never see a partial file.
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(audio)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._remember(key, len(audio))
+            self._keep_in_memory(key, audio)
+            if self._files_size > self.max_size:
+                self._evict()
+        return path
+
+    def stats(self) -> Dict[str, Any]:
+        """The counters of the cache."""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": hits / lookups if lookups else 0.0,
+                "entries": len(self._files),
+                "size": self._files_size,
+                "memory_entries": len(self._memory),
+                "memory_size": self._memory_used,
+            }
+
+    def _scan(self) -> None:
+        """Rebuild the view of the files on disk, from the least recently used."""
+        files = []
+        for root, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                if not file_name.endswith(self.suffix):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, file_name))
+                except OSError:
+                    continue
+                files.append(
+                    (stat.st_mtime, file_name[: -len(self.suffix)], stat.st_size)
+                )
+        files.sort()
+        self._files = OrderedDict((key, size) for _, key, size in files)
+        self._files_size = sum(self._files.values())
+
+    def _remember(self, key: str, size: int) -> None:
+        self._files_size += size - self._files.get(key, 0)
+        self._files[key] = size
+        self._files.move_to_end(key)
+
+    def _forget(self, key: str) -> None:
+        self._files_size -= self._files.pop(key, 0)
+        audio = self._memory.pop(key, None)
+        if audio is not None:
+            self._memory_used -= len(audio)
+
+    def _keep_in_memory(self, key: str, audio: bytes) -> None:
+        # The large entries would push out many small ones.
+        if len(audio) > self.memory_size // 8:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_used -= len(previous)
+        self._memory[key] = audio
+        self._memory_used += len(audio)
+        while self._memory_used > self.memory_size:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted)
+
+    def _evict(self) -> None:
+        """Remove the least recently used files down to 90% of the size budget,
+        so that the scans of the directory are not repeated on every put."""
+        # The other processes may have added or removed files.
+        self._scan()
+        while self._files and self._files_size > self.max_size * 0.9:
+            key = next(iter(self._files))
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            self._forget(key)
@@ -1,14 +1,20 @@
 """Utilities.
 """
 import argparse
-import inspect
+import http.client
+import ipaddress
 import itertools
 import logging
+import logging.handlers
 import os
+import queue
+import socket
 import ssl
+import threading
 import urllib.parse
+import urllib.request
 import xml.etree.ElementTree as ET
-from typing import Any, Dict, Iterator, List, Tuple, Type
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Type
 from urllib.request import Request, urlopen
 
 from colorama import Fore
@@ -24,62 +30,211 @@ def load_env(env_file_path: str = "") -> None:
         load_dotenv()
 
 
-# Create a logger class that accept level setting.
-# The logger should be able to log to stdout and display the datetime, caller, and line of code.
+# The colors of the log lines by level.
+_LEVEL_COLORS = {
+    logging.ERROR: Fore.RED,
+    logging.WARNING: Fore.YELLOW,
+    logging.INFO: Fore.CYAN,
+}
+
+
+class _ColorFormatter(logging.Formatter):
+    """Show the caller and color the message by level. The caller comes from the
+    record, which logging fills from the frame given by stacklevel."""
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        color = _LEVEL_COLORS.get(record.levelno, "")
+        record.colored_message = (
+            f"{color}({record.funcName} L{record.lineno}): {record.message}"
+            + (Fore.RESET if color else "")
+        )
+        return super().formatMessage(record)
+
+
+_LOG_FORMAT = (
+    "%(asctime)s %(levelname)s %(name)s %(colored_message)s (%(filename)s:%(lineno)d)"
+)
+_log_handler: Optional[logging.Handler] = None
+_log_lock = threading.Lock()
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queue the records for a listener thread that writes them, and stop the
+    listener on close, which logging does at exit, so that no record is lost."""
+
+    def __init__(self, handler: logging.Handler):
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        super().__init__(log_queue)
+        self.listener = logging.handlers.QueueListener(log_queue, handler)
+        self.listener.start()
+        self._listening = True
+
+    def close(self) -> None:
+        if self._listening:
+            self._listening = False
+            self.listener.stop()
+        super().close()
+
+    def restart(self) -> None:
+        """Start a new listener thread on a new queue, e.g. in a forked child, which
+        inherits neither the thread of its parent nor the records it has yet to
+        write."""
+        if self._listening:
+            self.queue = queue.SimpleQueue()
+            self.listener.queue = self.queue
+            self.listener._thread = None  # type: ignore
+            self.listener.start()
+
+
+def _create_log_handler(stream: Any = None, use_queue: bool = False) -> logging.Handler:
+    """Create a console handler, writing through a queue if use_queue. The handler
+    is shared by loggers of different levels, so it lets every record through and
+    the level of each logger decides."""
+    console_handler = logging.StreamHandler(stream)
+    console_handler.setLevel(logging.NOTSET)
+    console_handler.setFormatter(_ColorFormatter(_LOG_FORMAT))
+    if use_queue:
+        queue_handler = _QueueHandler(console_handler)
+        queue_handler.setLevel(logging.NOTSET)
+        return queue_handler
+    return console_handler
+
+
+def _shared_log_handler() -> logging.Handler:
+    """The handler shared by all the loggers, created once. With the LOG_ASYNC env
+    var set, the records are queued and written by a background thread, so that
+    the callers do not wait for the console."""
+    global _log_handler
+    with _log_lock:
+        if _log_handler is None:
+            _log_handler = _create_log_handler(
+                use_queue=os.getenv("LOG_ASYNC", "").lower() in ["1", "true"]
+            )
+        return _log_handler
+
+
+def _restart_log_listener() -> None:
+    global _log_lock
+    _log_lock = threading.Lock()
+    if isinstance(_log_handler, _QueueHandler):
+        _log_handler.restart()
+
+
+os.register_at_fork(after_in_child=_restart_log_listener)
+
+
 class Logger:
+    """Log to stdout with the datetime, the caller and its line of code.
+
+    The messages are formatted lazily, as in logging: pass the arguments after a
+    %-style message, e.g. logger.info("Indexed %d documents.", num_documents).
+    The loggers share one handler, and the level of each logger filters its records.
+    """
+
     def __init__(
         self, logger_name: str, verbose: bool = True, level: Any = logging.INFO
     ):
         self.logger = logging.getLogger(logger_name)
         self.verbose = verbose
         self.logger.setLevel(level=level)
-        self.formatter = logging.Formatter(
-            "%(asctime)s %(levelname)s %(name)s %(message)s (%(filename)s:%(lineno)d)"
-        )
-
-        self.console_handler = logging.StreamHandler()
-        self.console_handler.setLevel(level=level)
-        self.console_handler.setFormatter(self.formatter)
-
-        self.logger.addHandler(self.console_handler)
-
-    def info(self, message: str) -> None:
-        if not self.verbose:
-            return
-        caller_frame = inspect.stack()[1]
-        caller_name = caller_frame[3]
-        caller_line = caller_frame[2]
-        self.logger.info(
-            Fore.CYAN + f"({caller_name} L{caller_line}): {message}" + Fore.RESET
-        )
-
-    def error(self, message: str) -> None:
-        if not self.verbose:
-            return
-        caller_frame = inspect.stack()[1]
-        caller_name = caller_frame[3]
-        caller_line = caller_frame[2]
-        self.logger.error(
-            Fore.RED + f"({caller_name} L{caller_line}): {message}" + Fore.RESET
-        )
-
-    def warning(self, message: str) -> None:
-        if not self.verbose:
-            return
-        caller_frame = inspect.stack()[1]
-        caller_name = caller_frame[3]
-        caller_line = caller_frame[2]
-        self.logger.warning(
-            Fore.YELLOW + f"({caller_name} L{caller_line}): {message}" + Fore.RESET
+        handler = _shared_log_handler()
+        with _log_lock:
+            if handler not in self.logger.handlers:
+                self.logger.addHandler(handler)
+
+    def info(self, message: str, *args: Any) -> None:
+        if self.verbose:
+            # The caller of this method is the caller of the record.
+            self.logger.info(message, *args, stacklevel=2)
+
+    def error(self, message: str, *args: Any) -> None:
+        if self.verbose:
+            self.logger.error(message, *args, stacklevel=2)
+
+    def warning(self, message: str, *args: Any) -> None:
+        if self.verbose:
+            self.logger.warning(message, *args, stacklevel=2)
+
+
+def _create_public_connection(
+    address: Tuple[str, int], timeout: Any = None, source_address: Any = None
+) -> socket.socket:
+    """Connect to the host only if all its addresses are public. The addresses are
+    checked as they are connected to, so that the host cannot resolve to another
+    one after the check, e.g. by rebinding its DNS."""
+    host, port = address
+    infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    for *_, sockaddr in infos:
+        if not ipaddress.ip_address(str(sockaddr[0]).split("%")[0]).is_global:
+            raise ValueError(f"Only public hosts can be downloaded from: {host}")
+    error: Optional[OSError] = None
+    for family, type_, proto, _, sockaddr in infos:
+        sock = socket.socket(family, type_, proto)
+        try:
+            if isinstance(timeout, (int, float)):
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            error = e
+            sock.close()
+    raise error or OSError(f"Cannot connect to {host}")
+
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _create_public_connection  # type: ignore
+
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _create_public_connection  # type: ignore
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req: Request) -> Any:
+        return self.do_open(_PublicHTTPConnection, req)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req: Request) -> Any:
+        return self.do_open(
+            _PublicHTTPSConnection, req, context=self._context  # type: ignore
         )
 
 
-def file_downloader(url: str, retry_with_no_verify: bool = True) -> Tuple[str, str]:
+def _public_opener(
+    context: Optional[ssl.SSLContext] = None,
+) -> urllib.request.OpenerDirector:
+    """An opener of the http(s) urls of the public hosts, redirects included, and
+    of no other url. It connects directly, not through the proxies."""
+    opener = urllib.request.OpenerDirector()
+    for handler in [
+        _PublicHTTPHandler(),
+        _PublicHTTPSHandler(context=context),
+        urllib.request.HTTPRedirectHandler(),
+        urllib.request.HTTPDefaultErrorHandler(),
+        urllib.request.HTTPErrorProcessor(),
+        urllib.request.UnknownHandler(),
+    ]:
+        opener.add_handler(handler)
+    return opener
+
+
+def file_downloader(
+    url: str, retry_with_no_verify: bool = True, public_only: bool = False
+) -> Tuple[str, str]:
     """Download a file from a given url.
 
     Args:
         url (str): The url to download the file from.
         retry_with_no_verify (bool, optional): Whether to retry the download with
+        public_only (bool, optional): Whether to only connect to the public hosts,
+            e.g. for the urls of the clients. The redirects are checked too.
 
     Returns:
         Tuple[str, str]: The url and the path to the downloaded file.
@@ -90,8 +245,14 @@ def file_downloader(url: str, retry_with_no_verify: bool = True) -> Tuple[str, s
     logger = Logger("file_downloader")
     filepath = os.path.basename(urllib.parse.urlparse(url).path)
     req = Request(url, headers=headers)
+
+    def open_url(req: Request, context: Optional[ssl.SSLContext] = None) -> Any:
+        if public_only:
+            return _public_opener(context).open(req)
+        return urlopen(req, context=context)
+
     try:
-        response = urlopen(req)
+        response = open_url(req)
     except urllib.error.URLError:
         if not retry_with_no_verify:
             raise
@@ -99,7 +260,7 @@ def file_downloader(url: str, retry_with_no_verify: bool = True) -> Tuple[str, s
         context = ssl.create_default_context()
         context.check_hostname = False
         context.verify_mode = ssl.CERT_NONE
-        response = urlopen(req, context=context)
+        response = open_url(req, context=context)
 
     with open(filepath, "wb") as outfile:
         outfile.write(response.read())
@@ -121,6 +282,40 @@ def chunk_list(lst: List[Any], chunk_size: int) -> Iterator[Any]:
     return iter(lambda: tuple(itertools.islice(it, chunk_size)), ())
 
 
+def iter_text_deltas(cumulative_texts: Iterable[str]) -> Iterator[str]:
+    """Convert a stream of cumulative texts into a stream of newly added text.
+
+    Args:
+        cumulative_texts (Iterable[str]): Each item is the whole text so far.
+
+    Returns:
+        Iterator[str]: The text appended by each item.
+    """
+    previous = ""
+    for text in cumulative_texts:
+        delta = text_delta(previous, text)
+        previous = text
+        if delta:
+            yield delta
+
+
+def text_delta(previous: str, text: str) -> str:
+    """The text appended to the previous cumulative text, or the whole text if the
+    backend rewrote it.
+
+    Args:
+        previous (str): The previous cumulative text.
+        text (str): The cumulative text.
+
+    Returns:
+        str: The text to emit.
+    """
+    if text.startswith(previous):
+        return text[len(previous) :]
+    # The backend rewrote the text; emit it as is.
+    return text
+
+
 def xml_to_markdown(xml_string: str) -> str:
     """This function is used to convert document annotations in XML format to Markdown.
 
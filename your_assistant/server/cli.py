@@ -2,6 +2,8 @@
 """
 from colorama import Fore, Style
 
+import your_assistant.core.metrics as metrics_lib
+import your_assistant.core.tracing as tracing
 import your_assistant.core.utils as utils
 from your_assistant.core.orchestrator import *
 
@@ -11,6 +13,7 @@ ORCHESTRATORS = {
     "RevChatGPT": RevChatGPTOrchestrator,
     "RevBard": RevBardOrchestrator,
     "QA": QAOrchestrator,
+    "Router": RouterOrchestrator,
     "KnowledgeIndex": KnowledgeIndexOrchestrator,
 }
 
@@ -19,6 +22,7 @@ ORCHESTRATORS = {
 def run():
     parser = utils.init_parsers(ORCHESTRATORS)
     args = parser.parse_args()
+    tracing.configure(args.trace_file)
     orchestrator_cls = ORCHESTRATORS[args.orchestrator]
     orchestrator = orchestrator_cls.create_from_args(args)
     params = vars(args)
@@ -33,19 +37,26 @@ def run():
         "RevChatGPT",
         "RevBard",
         "QA",
+        "Router",
     ]:
         # Init prompt as user_input if is RevChatGPTOrchestrator, RevBardOrchestrator, QAOrchestrator.
         while True:
             try:
                 user_input = input(
                     Fore.GREEN
-                    + "\nEnter your conversation (exit with ctrl + C): "
+                    + "\nEnter your conversation (/metrics to show the metrics, exit with "
+                    + "ctrl + C): "
                     + Style.RESET_ALL
                 )
+                if user_input == "/metrics":
+                    print(metrics_lib.REGISTRY.dump())
+                    continue
                 args.prompt = user_input
                 response = orchestrator.process(args)
                 print(Fore.BLUE + response + Style.RESET_ALL)
             except KeyboardInterrupt:
+                orchestrator.close()
+                print(f"\nMetrics: {metrics_lib.REGISTRY.dump()}")
                 exit(0)
     else:
         raise ValueError("The orchestrator is not supported.")
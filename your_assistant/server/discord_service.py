@@ -2,7 +2,9 @@
 """Create the discord service.
 """
 import argparse
+import atexit
 import os
+import time
 import traceback
 from typing import Type
 
@@ -10,6 +12,7 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 
+import your_assistant.core.tracing as tracing
 from your_assistant.core.orchestrator import *
 from your_assistant.core.utils import Logger, init_parser, load_env
 
@@ -23,11 +26,15 @@ AVAILABLE_ORCHESTRATORS = {
 
 orchestrators = {}
 
+# Minimum seconds between two edits of a streaming message, to stay within rate limits.
+STREAM_EDIT_INTERVAL = 1.0
+
 
 class DiscordBot(commands.Bot):
     def __init__(self) -> None:
         """Initialize the bot."""
         load_env()
+        tracing.configure_from_env()
         intents = discord.Intents.default()
         intents.message_content = True
         super().__init__(command_prefix="/", intents=intents)
@@ -65,6 +72,13 @@ class DiscordBot(commands.Bot):
 bot = DiscordBot()
 
 
+@atexit.register
+def close_orchestrators() -> None:
+    # Persist the conversation memories so that the sessions survive restarts.
+    for orchestrator in orchestrators.values():
+        orchestrator.close()
+
+
 @bot.tree.command(name="chat")
 @app_commands.describe(prompt="prompt")
 async def chat(interaction: discord.Interaction, prompt: str) -> None:
@@ -123,21 +137,34 @@ async def speak_to_bot(
 ) -> None:
     """Speak to the bot."""
     try:
-        await interaction.channel.typing()
-        await interaction.response.defer()
-        user, channel = (
-            interaction.user.name,
-            interaction.channel,
-        )
-        bot.logger.info(
-            f"Received message from {user} in channel [{channel}]: {args.prompt}"
-        )
-        await interaction.followup.send(f"To {orchestrator_name}: {args.prompt}...")
-        response = orchestrator.process(args=args)
-        user_mention = interaction.user.mention
-        response = f"{user_mention} {response}"
-        bot.logger.info(f"Sending response: {response}")
-        await interaction.followup.send(response)
+        with tracing.span("discord.command", orchestrator=orchestrator_name):
+            await interaction.channel.typing()
+            await interaction.response.defer()
+            user, channel = (
+                interaction.user.name,
+                interaction.channel,
+            )
+            bot.logger.info(
+                f"Received message from {user} in channel [{channel}]: {args.prompt}"
+            )
+            # Keep a separate conversation per user and channel.
+            args = RequestContext.from_args(
+                orchestrator.args,
+                **vars(args),
+                session_id=f"{interaction.user.id}:{interaction.channel_id}",
+            )
+            await interaction.followup.send(f"To {orchestrator_name}: {args.prompt}...")
+            user_mention = interaction.user.mention
+            message = await interaction.followup.send(f"{user_mention} ...", wait=True)
+            response, last_edit_time = "", time.monotonic()
+            async for token in orchestrator.astream(args=args):
+                response += token
+                if time.monotonic() - last_edit_time >= STREAM_EDIT_INTERVAL:
+                    await message.edit(content=f"{user_mention} {response}")
+                    last_edit_time = time.monotonic()
+            response = f"{user_mention} {response}"
+            bot.logger.info(f"Sending response: {response}")
+            await message.edit(content=response)
     except Exception as e:
         error_message = f"Failed to send message: {e}.\n{traceback.format_exc()}"
         bot.logger.error(error_message)
@@ -0,0 +1,443 @@
+"""A local stand-in for the OpenAI, Anthropic and PaLM text APIs, for load and
+latency tests.
+Run the service with command: python -m your_assistant.server.fake_llm_service
+Then point the orchestrators or the indexer at it, e.g. --api-base http://localhost:8008/v1
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+from flask import Flask, Response, request, stream_with_context
+
+import your_assistant.core.utils as utils
+
+LATENCY_DISTRIBUTIONS = ["constant", "uniform", "normal", "lognormal"]
+
+
+class LatencyModel:
+    """Sample latencies in seconds from a distribution."""
+
+    def __init__(
+        self,
+        distribution: str = "constant",
+        mean: float = 0.0,
+        stddev: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        """
+        Args:
+            distribution (str): One of LATENCY_DISTRIBUTIONS. uniform spans
+                mean +/- stddev, and lognormal has the given mean and stddev.
+            mean (float): The mean latency in seconds.
+            stddev (float): The standard deviation of the latency in seconds.
+            seed (Optional[int]): The seed of the random generator.
+        """
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unsupported latency distribution: {distribution}.")
+        self.distribution = distribution
+        self.mean = mean
+        self.stddev = stddev
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self) -> float:
+        if self.mean <= 0:
+            return 0.0
+        with self._lock:
+            if self.distribution == "uniform":
+                latency = self._random.uniform(
+                    self.mean - self.stddev, self.mean + self.stddev
+                )
+            elif self.distribution == "normal":
+                latency = self._random.gauss(self.mean, self.stddev)
+            elif self.distribution == "lognormal":
+                # Convert the mean and stddev of the latency to the underlying normal.
+                sigma2 = np.log(1 + (self.stddev / self.mean) ** 2)
+                mu = np.log(self.mean) - sigma2 / 2
+                latency = self._random.lognormvariate(mu, np.sqrt(sigma2))
+            else:
+                latency = self.mean
+        return max(latency, 0.0)
+
+
+class TokenBucket:
+    """Allow rate requests per second on average, with bursts up to burst."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take a token.
+
+        Returns:
+            float: 0 if a token was taken, else the seconds until one is available.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+
+def fake_completion(prompt: str, num_tokens: int) -> List[str]:
+    """A deterministic completion that echoes the prompt, as a list of tokens."""
+    words = f"This is a fake response to: {prompt}".split() or ["..."]
+    return [
+        ("" if idx == 0 else " ") + words[idx % len(words)] for idx in range(num_tokens)
+    ]
+
+
+def fake_embedding(text: Any, size: int) -> List[float]:
+    """A deterministic unit vector of the text, or of the token ids."""
+    digest = hashlib.sha256(json.dumps(text).encode("utf-8")).digest()
+    generator = np.random.default_rng(int.from_bytes(digest[:8], "little"))
+    vector = generator.standard_normal(size)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def create_app(args: argparse.Namespace) -> Flask:
+    """Create the fake service.
+
+    Args:
+        args (argparse.Namespace): The arguments added by add_arguments_to_parser.
+
+    Returns:
+        Flask: The app.
+    """
+    app = Flask("Fake LLM")
+    logger = utils.Logger("FakeLLMService")
+    first_token_latency = LatencyModel(
+        distribution=args.latency_distribution,
+        mean=args.latency_mean_ms / 1000,
+        stddev=args.latency_stddev_ms / 1000,
+        seed=args.seed,
+    )
+    token_interval = args.token_interval_ms / 1000
+    errors = random.Random(args.seed)
+    errors_lock = threading.Lock()
+    bucket = (
+        TokenBucket(rate=args.rate_limit, burst=args.rate_limit_burst)
+        if args.rate_limit > 0
+        else None
+    )
+
+    def error_response(status: int, message: str, error_type: str) -> Response:
+        return Response(
+            json.dumps({"error": {"message": message, "type": error_type}}),
+            status=status,
+            mimetype="application/json",
+        )
+
+    @app.before_request
+    def inject_failures() -> Optional[Response]:
+        if request.method != "POST":
+            return None
+        if bucket:
+            retry_after = bucket.acquire()
+            if retry_after > 0:
+                response = error_response(
+                    429, "Rate limit reached.", "rate_limit_error"
+                )
+                response.headers["Retry-After"] = str(max(1, round(retry_after)))
+                return response
+        with errors_lock:
+            failed = errors.random() < args.error_rate
+        if failed:
+            time.sleep(first_token_latency.sample())
+            return error_response(500, "Injected failure.", "server_error")
+        return None
+
+    def num_tokens(max_tokens: Optional[int]) -> int:
+        return min(args.response_tokens, max_tokens or args.response_tokens)
+
+    def complete(tokens: List[str]) -> None:
+        """Wait as long as generating the tokens would take."""
+        time.sleep(first_token_latency.sample() + token_interval * len(tokens))
+
+    def stream_events(chunks: Iterator[Dict[str, Any]]) -> Response:
+        def generate() -> Iterator[str]:
+            for chunk in chunks:
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return Response(stream_with_context(generate()), mimetype="text/event-stream")
+
+    def paced(tokens: List[str]) -> Iterator[str]:
+        """Yield the tokens at the pace of a generation."""
+        time.sleep(first_token_latency.sample())
+        for idx, token in enumerate(tokens):
+            if idx > 0:
+                time.sleep(token_interval)
+            yield token
+
+    def usage(prompt: str, tokens: List[str]) -> Dict[str, int]:
+        prompt_tokens = len(prompt.split())
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+        }
+
+    @app.route("/v1/chat/completions", methods=["POST"])
+    def chat_completions():
+        body = request.json or {}
+        prompt = "\n".join(
+            str(message.get("content", "")) for message in body.get("messages", [])
+        )
+        tokens = fake_completion(prompt, num_tokens(body.get("max_tokens")))
+        model = body.get("model", "gpt-3.5-turbo")
+        header = {
+            "id": f"chatcmpl-fake-{time.time_ns()}",
+            "created": int(time.time()),
+            "model": model,
+        }
+        if body.get("stream"):
+
+            def chunks() -> Iterator[Dict[str, Any]]:
+                for idx, token in enumerate(paced(tokens)):
+                    delta = {"content": token}
+                    if idx == 0:
+                        delta["role"] = "assistant"
+                    yield {
+                        **header,
+                        "object": "chat.completion.chunk",
+                        "choices": [
+                            {"index": 0, "delta": delta, "finish_reason": None}
+                        ],
+                    }
+                yield {
+                    **header,
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                }
+
+            return stream_events(chunks())
+        complete(tokens)
+        return {
+            **header,
+            "object": "chat.completion",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": usage(prompt, tokens),
+        }
+
+    @app.route("/v1/completions", methods=["POST"])
+    def completions():
+        body = request.json or {}
+        prompt = body.get("prompt", "")
+        prompt = prompt if isinstance(prompt, str) else "\n".join(prompt)
+        tokens = fake_completion(prompt, num_tokens(body.get("max_tokens")))
+        header = {
+            "id": f"cmpl-fake-{time.time_ns()}",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": body.get("model", "text-davinci-003"),
+        }
+        if body.get("stream"):
+            return stream_events(
+                {
+                    **header,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "text": token,
+                            "logprobs": None,
+                            "finish_reason": None,
+                        }
+                    ],
+                }
+                for token in paced(tokens)
+            )
+        complete(tokens)
+        return {
+            **header,
+            "choices": [
+                {
+                    "index": 0,
+                    "text": "".join(tokens),
+                    "logprobs": None,
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": usage(prompt, tokens),
+        }
+
+    @app.route("/v1/embeddings", methods=["POST"])
+    @app.route("/v1/engines/<engine>/embeddings", methods=["POST"])
+    def embeddings(engine: str = ""):
+        body = request.json or {}
+        inputs = body.get("input", [])
+        # The input is a text, a list of texts, or a list of lists of token ids.
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        time.sleep(first_token_latency.sample())
+        return {
+            "object": "list",
+            "data": [
+                {
+                    "object": "embedding",
+                    "index": idx,
+                    "embedding": fake_embedding(text, args.embedding_size),
+                }
+                for idx, text in enumerate(inputs)
+            ],
+            "model": body.get("model", engine or "text-embedding-ada-002"),
+            "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+        }
+
+    @app.route("/v1/complete", methods=["POST"])
+    def anthropic_complete():
+        body = request.json or {}
+        prompt = body.get("prompt", "")
+        tokens = fake_completion(prompt, num_tokens(body.get("max_tokens_to_sample")))
+        model = body.get("model", "claude-v1")
+        if body.get("stream"):
+
+            def chunks() -> Iterator[Dict[str, Any]]:
+                # Anthropic streams the cumulative completion on every event.
+                completion = ""
+                for token in paced(tokens):
+                    completion += token
+                    yield {
+                        "completion": completion,
+                        "stop_reason": None,
+                        "model": model,
+                    }
+                yield {
+                    "completion": completion,
+                    "stop_reason": "stop_sequence",
+                    "model": model,
+                }
+
+            return stream_events(chunks())
+        complete(tokens)
+        return {
+            "completion": "".join(tokens),
+            "stop_reason": "stop_sequence",
+            "model": model,
+        }
+
+    @app.route("/v1beta2/models/<model>:generateText", methods=["POST"])
+    def palm_generate_text(model: str):
+        body = request.json or {}
+        prompt = (body.get("prompt") or {}).get("text", "")
+        tokens = fake_completion(prompt, num_tokens(body.get("maxOutputTokens")))
+        complete(tokens)
+        return {"candidates": [{"output": "".join(tokens)}]}
+
+    @app.route("/v1/models", methods=["GET"])
+    def models():
+        return {
+            "object": "list",
+            "data": [
+                {"id": model, "object": "model", "owned_by": "fake"}
+                for model in ["gpt-3.5-turbo", "gpt-4", "text-embedding-ada-002"]
+            ],
+        }
+
+    @app.route("/health", methods=["GET"])
+    def health():
+        return {"response": "health success"}
+
+    logger.info(f"Fake LLM service configured with {vars(args)}.")
+    return app
+
+
+def add_arguments_to_parser(parser: argparse.ArgumentParser) -> None:
+    """Add the arguments of the fake service to the parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser that accepts the arguments.
+    """
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=8008, type=int)
+    parser.add_argument(
+        "--latency-distribution",
+        default="lognormal",
+        choices=LATENCY_DISTRIBUTIONS,
+        help="The distribution of the latency before the first token.",
+    )
+    parser.add_argument(
+        "--latency-mean-ms",
+        default=300,
+        type=float,
+        help="The mean latency before the first token.",
+    )
+    parser.add_argument(
+        "--latency-stddev-ms",
+        default=150,
+        type=float,
+        help="The standard deviation of the latency before the first token.",
+    )
+    parser.add_argument(
+        "--token-interval-ms",
+        default=20,
+        type=float,
+        help="The latency between two generated tokens.",
+    )
+    parser.add_argument(
+        "--response-tokens",
+        default=50,
+        type=int,
+        help="The number of tokens generated, unless max tokens is lower.",
+    )
+    parser.add_argument(
+        "--embedding-size",
+        default=1536,
+        type=int,
+        help="The dimension of the embeddings.",
+    )
+    parser.add_argument(
+        "--error-rate",
+        default=0.0,
+        type=float,
+        help="The ratio of the requests failed with a 500.",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        default=0,
+        type=float,
+        help="The requests per second allowed before answering 429. 0 for no limit.",
+    )
+    parser.add_argument(
+        "--rate-limit-burst",
+        default=10,
+        type=int,
+        help="The requests allowed in a burst by the rate limit.",
+    )
+    parser.add_argument(
+        "--seed",
+        default=None,
+        type=int,
+        help="The seed of the latency and the error injection.",
+    )
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Fake LLM service")
+    add_arguments_to_parser(parser)
+    args = parser.parse_args()
+    create_app(args).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    run()
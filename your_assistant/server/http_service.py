@@ -1,25 +1,54 @@
 """Http service for your assistant.
 """
+import argparse
+import atexit
+import hashlib
+import hmac
+import io
+import json
+import math
 import os
+import re
+import secrets
 import time
-from argparse import Namespace
-from typing import Type
+from typing import Any, Dict, Optional, Type
 
 import openai
-import torch
 from flask import Flask, Response
 from flask import g as app_ctx
-from flask import request, send_file
+from flask import request, send_file, stream_with_context
 from flask_cors import CORS, cross_origin
-
+from langchain.embeddings import OpenAIEmbeddings
+
+import your_assistant.core.admission as admission_lib
+import your_assistant.core.metrics as metrics_lib
+import your_assistant.core.prometheus as prometheus
+import your_assistant.core.responder as responder
+import your_assistant.core.tracing as tracing
+import your_assistant.core.tts as tts_lib
 import your_assistant.core.utils as utils
+from your_assistant.core.admission import AdmissionController, Rejected
+from your_assistant.core.indexer import KnowledgeIndexer
+from your_assistant.core.jobs import IndexJob, IndexJobManager
 from your_assistant.core.orchestrator import *
+from your_assistant.core.registry import OrchestratorRegistry
 from your_assistant.core.utils import load_env
+from your_assistant.server.prefork import PreforkServer
 
 app = Flask("Your Assistant")
-cors = CORS(app)
-
-orchestrators = {}
+cors = CORS(app, expose_headers=["X-Session-Id"])
+
+registry = None
+admission = None
+index_jobs = None
+tts_pool = None
+tts_cache = None
+# The key that signs the session ids. Set the SESSION_SECRET env var to keep the
+# conversations across restarts.
+_session_secret = secrets.token_bytes(32)
+# The token of the trusted clients, e.g. the operators, set by the ADMIN_TOKEN env
+# var. Without it, no client is trusted.
+_admin_token: Optional[str] = None
 
 ORCHESTRATORS = {
     "ChatGPT": ChatGPTOrchestrator,
@@ -27,26 +56,249 @@ ORCHESTRATORS = {
     "RevChatGPT": RevChatGPTOrchestrator,
     "RevBard": RevBardOrchestrator,
     "QA": QAOrchestrator,
+    "Router": RouterOrchestrator,
+}
+
+
+# Map the endpoint names to the orchestrators that can stream their responses.
+STREAMING_ENDPOINTS = {
+    "chatgpt": "ChatGPT",
+    "claude": "Claude",
+    "revchatgpt": "RevChatGPT",
+    "bard": "RevBard",
+    "qa": "QA",
+    "router": "Router",
 }
 
 
-def init_service():
-    global orchestrators
+# Map the routes to the backends whose admission pool they wait for. The other
+# routes, e.g. /health and /metrics, are always served.
+ROUTE_BACKENDS = {
+    "/api/v1/chatgpt": "ChatGPT",
+    "/api/v1/claude": "Claude",
+    "/api/v1/revchatgpt": "RevChatGPT",
+    "/api/v1/bard": "RevBard",
+    "/api/v1/router": "Router",
+    "/api/v1/qa": "QA",
+    "/api/v1/audio/transcribe": "Audio",
+    "/api/v1/audio/text-to-speech": "Audio",
+}
+
+# The long requests, which wait behind the short ones of the same backend.
+BATCH_BACKENDS = ["QA"]
+
+
+def init_service(worker_id: int = 0):
+    """Create the orchestrators on first use, except the ones listed in the
+    WARMUP_ORCHESTRATORS env var, e.g. "ChatGPT,QA", which are created and warmed
+    up in the background. /ready reports whether they are warm. The requests are
+    traced to the TRACE_FILE env var, if set, suffixed with the pid of each worker
+    with HTTP_WORKERS > 1, and admitted to the backends within the ADMISSION_* env
+    vars limits. The indexing jobs left unfinished by the
+    previous run resume, in the first worker only. The text-to-speech models load
+    on first use, or in the background with the TTS_WARMUP env var set.
+
+    Args:
+        worker_id (int): The id of the worker process, with HTTP_WORKERS > 1.
+    """
+    global registry, admission, index_jobs, tts_pool, tts_cache
+    global _session_secret, _admin_token
     load_env()
-    for name, orchestrator_type in ORCHESTRATORS.items():
-        orchestrators[name] = _init_orchestrator(name, orchestrator_type)
+    if os.getenv("SESSION_SECRET"):
+        _session_secret = os.environ["SESSION_SECRET"].encode()
+    _admin_token = os.getenv("ADMIN_TOKEN") or None
+    # The pre-forked workers each trace to a file of their own.
+    tracing.configure_from_env(per_process=int(os.getenv("HTTP_WORKERS") or 1) > 1)
+    admission = AdmissionController.from_env()
+    registry = OrchestratorRegistry(ORCHESTRATORS, _init_orchestrator)
+    db_path = os.getenv("INDEX_DB_PATH") or "faiss.db"
+    index_jobs = IndexJobManager(
+        indexer_factory=lambda: KnowledgeIndexer(
+            args=argparse.Namespace(
+                verbose=False, db_path=db_path, embeddings_tool_name="openai"
+            )
+        ),
+        state_path=os.path.join(db_path, "index_jobs.json"),
+        workers=int(os.getenv("INDEX_WORKERS") or 2),
+        on_complete=_on_index_job_complete,
+        resume=worker_id == 0,
+        root=os.getenv("INDEX_ROOT") or None,
+    )
+    tts_pool = tts_lib.TTSModelPool.from_env(
+        workers=int(os.getenv("HTTP_WORKERS") or 1)
+    )
+    if os.getenv("TTS_WARMUP", "").lower() in ["1", "true"]:
+        tts_pool.warmup()
+    if os.getenv("TTS_CACHE_DIR"):
+        tts_cache = tts_lib.SpeechCache(
+            directory=os.environ["TTS_CACHE_DIR"],
+            max_size=int(os.getenv("TTS_CACHE_MAX_SIZE") or 500000000),
+            memory_size=int(os.getenv("TTS_CACHE_MEMORY_SIZE") or 32000000),
+        )
+    warmup = os.getenv("WARMUP_ORCHESTRATORS", "")
+    registry.warmup([name.strip() for name in warmup.split(",") if name.strip()])
+    atexit.register(_close_service)
+
+
+def _preload_service():
+    """Load the QA index once, before the workers fork, so that they share its
+    memory instead of each loading a copy. Nothing here may start a thread, which
+    the workers would not inherit."""
+    load_env()
+    responder.preload_index(
+        os.getenv("INDEX_DB_PATH") or "faiss.db",
+        metrics_lib.MeteredEmbeddings(OpenAIEmbeddings()),
+    )
+
+
+def _close_service():
+    # Persist the conversation memories so that the sessions survive restarts.
+    registry.close()
+    index_jobs.close()
+    tts_pool.close()
+
+
+def _on_index_job_complete(job: IndexJob) -> None:
+    """Swap the index of QA for the new one, unless QA is not created yet."""
+    orchestrator = registry.get_created("QA")
+    if orchestrator is not None:
+        orchestrator.reload_index()
+
+
+def _retrieval_filter_args() -> Dict[str, Any]:
+    """The args of the retrieval filter of the request, e.g. {"authors": ["..."]},
+    to pass to QA."""
+    retrieval_filter = request.json.get("filter") or {}
+    return {
+        f"filter_{key}": retrieval_filter.get(key)
+        for key in ["source", "title", "authors", "page_range"]
+    }
 
 
-def _copy_args(source_args: argparse.Namespace, dest_args: argparse.Namespace):
-    for key, value in vars(source_args).items():
-        if key == "func":
-            continue
-        setattr(dest_args, key, value)
+def _session_id() -> str:
+    """Identify the conversation of the request with the X-Session-Id header, or the
+    session_id field, as issued by the service. A request without one, or with one
+    that the service did not issue, starts a new conversation. Its id is returned in
+    the X-Session-Id header of the response, to send with the next requests."""
+    session_id = str(
+        request.headers.get("X-Session-Id")
+        or (request.get_json(silent=True) or {}).get("session_id")
+        or ""
+    )
+    token, _, signature = session_id.rpartition(".")
+    if not token or not hmac.compare_digest(signature, _sign_session(token)):
+        token = secrets.token_urlsafe(16)
+        session_id = f"{token}.{_sign_session(token)}"
+    app_ctx.session_id = session_id
+    return session_id
+
+
+def _sign_session(token: str) -> str:
+    """Sign the session ids, so that a client cannot make up the id of another
+    client's conversation."""
+    return hmac.new(_session_secret, token.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+_HTTP_REQUESTS = prometheus.REGISTRY.counter(
+    "http_requests_total", "The requests served.", ["route", "method", "status"]
+)
+_HTTP_REQUEST_SECONDS = prometheus.REGISTRY.histogram(
+    "http_request_duration_seconds",
+    "The time to serve the requests, streamed responses included.",
+    ["route", "method"],
+)
+_HTTP_IN_FLIGHT = prometheus.REGISTRY.gauge(
+    "http_requests_in_flight", "The requests being served.", ["route"]
+)
+_TTS_FIRST_AUDIO_SECONDS = prometheus.REGISTRY.histogram(
+    "tts_first_audio_seconds",
+    "The time from a streamed text-to-speech request to its first audio.",
+)
+
+
+def _route() -> str:
+    """The route of the request, e.g. /api/v1/<endpoint>/stream, so that the paths
+    do not blow up the number of label values."""
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def _admission_backend() -> Optional[str]:
+    """The backend whose admission pool the request waits for, if any."""
+    if request.url_rule is None:
+        return None
+    if request.url_rule.rule == "/api/v1/<endpoint>/stream":
+        return STREAMING_ENDPOINTS.get(request.view_args["endpoint"])
+    return ROUTE_BACKENDS.get(request.url_rule.rule)
+
+
+def _authenticated() -> bool:
+    """Whether the request carries the ADMIN_TOKEN, as "Authorization: Bearer ..."."""
+    if not _admin_token:
+        return False
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(
+        token.strip().encode(), _admin_token.encode()
+    )
+
+
+def _admit_request() -> Optional[Response]:
+    """Wait for the backend of the request to serve it, or reject it with a 429 or
+    503 response and a Retry-After header. The X-Priority header lowers the
+    request to "batch". Only the requests with the ADMIN_TOKEN may raise it, to
+    "interactive" or to "critical", which is never queued. The X-Request-Timeout
+    header sets its deadline, in seconds, and a malformed one is rejected with a
+    400 response."""
+    backend = _admission_backend()
+    if admission is None or backend is None:
+        return None
+    default_priority = "batch" if backend in BATCH_BACKENDS else "interactive"
+    priority = request.headers.get("X-Priority") or default_priority
+    ranks = admission_lib.PRIORITIES
+    if priority not in ranks or (
+        ranks[priority] < ranks[default_priority] and not _authenticated()
+    ):
+        priority = default_priority
+    timeout: Optional[float] = None
+    if request.headers.get("X-Request-Timeout"):
+        try:
+            timeout = float(request.headers["X-Request-Timeout"])
+        except ValueError:
+            timeout = math.nan
+        if not 0 < timeout < math.inf:
+            return Response(
+                json.dumps({"error": "X-Request-Timeout must be positive seconds."}),
+                status=400,
+                mimetype="application/json",
+            )
+    pool = admission.pool(backend)
+    try:
+        app_ctx.admitted = pool.acquire(priority=priority, timeout=timeout)
+    except Rejected as e:
+        return Response(
+            json.dumps({"error": str(e)}),
+            status=e.status,
+            mimetype="application/json",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    app_ctx.admission_pool = pool
+    return None
 
 
 def _init_orchestrator(orchestrator_name: str, orchestrator_type: Type) -> Orchestrator:
     parser = utils.init_parser(orchestrator_name, orchestrator_type)
-    args_to_pass = [orchestrator_name, "--use-memory"]
+    # Keep the memories with the index, not in the working directory.
+    db_path = os.getenv("INDEX_DB_PATH") or "faiss.db"
+    os.makedirs(db_path, exist_ok=True)
+    args_to_pass = [
+        orchestrator_name,
+        "--use-memory",
+        "--memory-db-path",
+        os.path.join(db_path, "memory.db"),
+    ]
+    # The requests of a session may reach any worker, so the workers share the
+    # sessions through the db.
+    if int(os.getenv("HTTP_WORKERS") or 1) > 1:
+        args_to_pass.append("--memory-shared")
     args = parser.parse_args(args_to_pass)
     return orchestrator_type(args=args)
 
@@ -58,6 +310,14 @@ def before_request_callback():
     app.logger.debug("Body: %s", request.get_data())
     # Store the start time for the request
     app_ctx.start_time = time.perf_counter()
+    # The span of the request is the parent of the spans of its handler, and ends
+    # once a streamed response is fully sent.
+    app_ctx.span = tracing.span(
+        "http.request", method=request.method, path=request.path
+    ).start()
+    app_ctx.route = _route()
+    _HTTP_IN_FLIGHT.labels(route=app_ctx.route).inc()
+    return _admit_request()
 
 
 @app.after_request
@@ -74,17 +334,42 @@ def after_request_callback(response):
         dict(request.args),
     )
     response.headers["X-Execution-Time-Ms"] = str(time_in_ms)
+    if "session_id" in app_ctx:
+        response.headers["X-Session-Id"] = app_ctx.session_id
+    app_ctx.span.set_attribute("status", response.status_code)
+    app_ctx.status = response.status_code
     return response
 
 
+@app.teardown_request
+def teardown_request_callback(error):
+    # The admission slot is held until a streamed response is fully sent.
+    pool = app_ctx.pop("admission_pool", None)
+    if pool is not None:
+        pool.release(app_ctx.admitted)
+    span = app_ctx.pop("span", None)
+    if span is not None:
+        span.end(error=error)
+    route = app_ctx.pop("route", None)
+    if route is not None:
+        _HTTP_IN_FLIGHT.labels(route=route).dec()
+        _HTTP_REQUEST_SECONDS.labels(route=route, method=request.method).observe(
+            time.perf_counter() - app_ctx.start_time
+        )
+        _HTTP_REQUESTS.labels(
+            route=route, method=request.method, status=app_ctx.get("status", 500)
+        ).inc()
+
+
 @app.route("/api/v1/chatgpt", methods=["POST"])
 def handle_chatgpt_request():
     if request.method == "POST":
         prompt = request.json["prompt"]
-        runtime_args = Namespace()
-        runtime_args.prompt = prompt
-        _copy_args(orchestrators["ChatGPT"].args, runtime_args)
-        response = orchestrators["ChatGPT"].process(args=runtime_args)
+        orchestrator = registry.get("ChatGPT")
+        runtime_args = RequestContext.from_args(
+            orchestrator.args, prompt=prompt, session_id=_session_id()
+        )
+        response = orchestrator.process(args=runtime_args)
         return {"response": response}
 
 
@@ -92,10 +377,11 @@ def handle_chatgpt_request():
 def handle_claude_request():
     if request.method == "POST":
         prompt = request.json["prompt"]
-        runtime_args = Namespace()
-        runtime_args.prompt = prompt
-        _copy_args(orchestrators["Claude"].args, runtime_args)
-        response = orchestrators["Claude"].process(args=runtime_args)
+        orchestrator = registry.get("Claude")
+        runtime_args = RequestContext.from_args(
+            orchestrator.args, prompt=prompt, session_id=_session_id()
+        )
+        response = orchestrator.process(args=runtime_args)
         return {"response": response}
 
 
@@ -103,10 +389,11 @@ def handle_claude_request():
 def handle_rev_chatgpt_request():
     if request.method == "POST":
         prompt = request.json["prompt"]
-        runtime_args = Namespace()
-        runtime_args.prompt = prompt
-        _copy_args(orchestrators["RevChatGPT"].args, runtime_args)
-        response = orchestrators["RevChatGPT"].process(args=runtime_args)
+        orchestrator = registry.get("RevChatGPT")
+        runtime_args = RequestContext.from_args(
+            orchestrator.args, prompt=prompt, session_id=_session_id()
+        )
+        response = orchestrator.process(args=runtime_args)
         return {"response": response}
 
 
@@ -115,13 +402,57 @@ def handle_rev_chatgpt_request():
 def handle_bard_request():
     if request.method == "POST":
         prompt = request.json["prompt"]
-        runtime_args = Namespace()
-        runtime_args.prompt = prompt
-        _copy_args(orchestrators["RevBard"].args, runtime_args)
-        response = orchestrators["RevBard"].process(args=runtime_args)
+        orchestrator = registry.get("RevBard")
+        runtime_args = RequestContext.from_args(
+            orchestrator.args, prompt=prompt, session_id=_session_id()
+        )
+        response = orchestrator.process(args=runtime_args)
+        return {"response": response}
+
+
+@app.route("/api/v1/router", methods=["POST"])
+def handle_router_request():
+    if request.method == "POST":
+        prompt = request.json["prompt"]
+        orchestrator = registry.get("Router")
+        runtime_args = RequestContext.from_args(
+            orchestrator.args, prompt=prompt, session_id=_session_id()
+        )
+        response = orchestrator.process(args=runtime_args)
         return {"response": response}
 
 
+@app.route("/api/v1/<endpoint>/stream", methods=["POST"])
+def handle_stream_request(endpoint: str):
+    """Stream the response token by token as Server-Sent Events."""
+    if endpoint not in STREAMING_ENDPOINTS:
+        return {"error": f"Streaming is not supported for {endpoint}."}, 404
+    orchestrator = registry.get(STREAMING_ENDPOINTS[endpoint])
+    prompt = request.json["prompt"]
+    runtime_args = RequestContext.from_args(
+        orchestrator.args,
+        prompt=prompt,
+        session_id=_session_id(),
+        **_retrieval_filter_args(),
+    )
+
+    def generate():
+        try:
+            for token in orchestrator.stream(args=runtime_args):
+                yield f"data: {json.dumps({'token': token})}\n\n"
+        except Exception as e:
+            app.logger.exception("Streaming from %s failed.", endpoint)
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+            return
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/api/v1/audio/transcribe", methods=["POST"])
 def handle_audio_transcribe_request():
     # request.form is empty (not None) when there is no form data
@@ -143,80 +474,281 @@ def handle_audio_transcribe_request():
         return {"transcript": transcript}
 
 
-@app.route("/api/v1/audio/text-to-speech", methods=["POST"])
-def handle_text_to_speech():
-    if request.method == "POST":
-        model = request.json["model"]
-        audio_filename = ""
-        if model == "Silero":
-            # TODO(fuj): 4 seems to be the optimal # for M1 and server cpu
-            num_threads = (
-                request.json["num_threads"] if "num_threads" in request.json else 4
-            )
-            # TODO(fuj): GPU doesn't seem to help? Dig more into this later.
-            device = torch.device("cpu")
-            torch.set_num_threads(num_threads)
-            local_file = "model.pt"
-
-            if not os.path.isfile(local_file):
-                torch.hub.download_url_to_file(
-                    "https://models.silero.ai/models/tts/en/v3_en.pt", local_file
-                )
+def _speech_cache_key(text: str, voice_id: str, sample_rate: int) -> Optional[str]:
+    """The key of the speech in the cache, or None without a cache."""
+    if tts_cache is None:
+        return None
+    if not tts_pool.version:
+        # The version of the model is only known once it is loaded.
+        tts_pool.load()
+    return tts_lib.SpeechCache.make_key(
+        text=text,
+        voice_id=voice_id,
+        sample_rate=sample_rate,
+        model_version=f"{tts_pool.name}/{tts_pool.version}",
+    )
 
-            model = torch.package.PackageImporter(local_file).load_pickle(
-                "tts_models", "model"
-            )
-            model.to(device)
 
-            text = request.json["body"]
-            sample_rate = (
-                request.json["sample_rate"] if "sample_rate" in request.json else 48000
-            )
-            speaker = request.json["voice_id"] if "voice_id" in request.json else "en_0"
+def _send_speech(
+    audio: Optional[bytes],
+    path: Optional[str],
+    key: Optional[str],
+    audio_format: str,
+    headers: Dict[str, str],
+) -> Response:
+    """Send the WAV file from its path if it has one, so that the server can send
+    it without copying it, else from memory. Both answer the range and the
+    conditional GET requests."""
+    if audio_format == "pcm":
+        if audio is None:
+            with open(path, "rb") as f:  # type: ignore
+                audio = f.read()
+        response = Response(tts_lib.wav_frames(audio), mimetype="audio/pcm")
+    else:
+        response = send_file(
+            path if path is not None else io.BytesIO(audio),  # type: ignore
+            mimetype="audio/wav",
+            as_attachment=True,
+            download_name="speech.wav",
+            etag=key or False,
+            conditional=True,
+        )
+    if key is not None:
+        response.headers["Content-Location"] = f"/api/v1/audio/speech/{key}"
+    response.headers.update(headers)
+    return response
 
-            audio_paths = model.save_wav(
-                text=text, speaker=speaker, sample_rate=sample_rate
-            )
-            audio_filename = "test.wav"
 
+@app.route("/api/v1/audio/speech/<key>", methods=["GET"])
+def handle_cached_speech_request(key: str):
+    """The WAV file of a synthesized speech in the cache, by its key. The ranges and
+    the conditional requests are answered, e.g. for a player to seek."""
+    if tts_cache is None or not re.fullmatch(r"[0-9a-f]{64}", key):
+        return {"error": f"Unknown speech [{key}]."}, 404
+    audio, path = tts_cache.get(key)
+    if audio is None and path is None:
+        return {"error": f"Unknown speech [{key}]."}, 404
+    return _send_speech(audio, path, key, "wav", {"X-TTS-Cache": "hit"})
+
+
+@app.route("/api/v1/audio/text-to-speech", methods=["POST"])
+def handle_text_to_speech():
+    """Synthesize "body" with a resident model of the pool, and return the WAV file.
+    The X-TTS-* headers report the seconds this request waited for the models to
+    load, only the first one does, then for a free model, and synthesized. The
+    "num_threads" of the request may lower the intra-op threads of its syntheses,
+    which never exceed the ones of the pool, i.e. the TTS_THREADS env var.
+
+    With "is_streaming", the text is synthesized sentence by sentence, and the
+    audio of each one is sent as soon as it is ready: a WAV file of unknown length
+    by default, or the bare 16-bit little-endian PCM with "format": "pcm".
+
+    With the TTS_CACHE_DIR env var set, the speech of a text is synthesized once
+    per voice, sample rate and model version, and then sent from the cache, as
+    reported by the X-TTS-Cache header. The Content-Location header is then the
+    url of the WAV file in the cache, which answers the range requests."""
+    if request.method == "POST":
+        model = request.json["model"]
+        if model != "Silero":
+            return {"error": f"Unknown text-to-speech model [{model}]."}, 400
+        text = request.json["body"]
+        voice_id = request.json.get("voice_id", "en_0")
+        try:
+            sample_rate = int(request.json.get("sample_rate", 48000))
+        except (TypeError, ValueError):
+            sample_rate = 0
+        if sample_rate not in tts_lib.SileroTTS.SAMPLE_RATES:
+            return {
+                "error": f"Unsupported sample rate [{request.json['sample_rate']}], "
+                + f"only {tts_lib.SileroTTS.SAMPLE_RATES}."
+            }, 400
+        num_threads = request.json.get("num_threads")
+        if num_threads is not None and (
+            not isinstance(num_threads, int)
+            or isinstance(num_threads, bool)
+            or num_threads < 1
+        ):
+            return {"error": f"Invalid number of threads [{num_threads}]."}, 400
         # Decide if we should stream it or not. Default no
         is_streaming = (
             request.json["is_streaming"] if "is_streaming" in request.json else False
         )
+        audio_format = request.json.get("format", "wav") if is_streaming else "wav"
+        if audio_format not in ["wav", "pcm"]:
+            return {"error": f"Unknown audio format [{audio_format}]."}, 400
+        audio_headers = {
+            "X-Audio-Sample-Rate": str(sample_rate),
+            "X-Audio-Encoding": "s16le",
+        }
+
+        key = _speech_cache_key(text, voice_id, sample_rate)
+        if key is not None:
+            audio, path = tts_cache.get(key)
+            if audio is not None or path is not None:
+                return _send_speech(
+                    audio,
+                    path,
+                    key,
+                    audio_format,
+                    {
+                        **audio_headers,
+                        "X-TTS-Cache": "memory" if audio is not None else "disk",
+                    },
+                )
+        start = time.perf_counter()
+        tts_pool.load()
+        load_seconds = time.perf_counter() - start
+
         if not is_streaming:
-            return send_file(audio_filename, as_attachment=True)
-        else:
-            chunk_size = (
-                request.json["chunk_size"] if "chunk_size" in request.json else 64000
+            speech = tts_pool.synthesize(
+                text=text,
+                voice_id=voice_id,
+                sample_rate=sample_rate,
+                num_threads=num_threads,
             )
+            audio = speech.to_wav()
+            path = tts_cache.put(key, audio) if key is not None else None
+            return _send_speech(
+                audio,
+                path,
+                key,
+                audio_format,
+                {
+                    **audio_headers,
+                    "X-TTS-Cache": "miss",
+                    "X-TTS-Load-Seconds": f"{load_seconds:.3f}",
+                    "X-TTS-Wait-Seconds": f"{speech.wait_seconds:.3f}",
+                    "X-TTS-Synthesis-Seconds": f"{speech.synthesis_seconds:.3f}",
+                },
+            )
+        else:
 
             def generate():
-                with open(audio_filename, "rb") as fwav:
-                    data = fwav.read(chunk_size)
-                    while data:
-                        yield data
-                        data = fwav.read(chunk_size)
-
-            return Response(generate(), mimetype="audio/wav", direct_passthrough=True)
+                if audio_format == "wav":
+                    yield tts_lib.wav_header(sample_rate)
+                speeches = []
+                for speech in tts_pool.stream(
+                    text=text,
+                    voice_id=voice_id,
+                    sample_rate=sample_rate,
+                    num_threads=num_threads,
+                ):
+                    if not speeches:
+                        _TTS_FIRST_AUDIO_SECONDS.observe(
+                            time.perf_counter() - app_ctx.start_time
+                        )
+                    speeches.append(speech)
+                    yield speech.to_pcm()
+                # The speech is cached once it is fully synthesized.
+                if key is not None and speeches:
+                    tts_cache.put(key, tts_lib.Speech.concatenate(speeches).to_wav())
+
+            return Response(
+                stream_with_context(generate()),
+                mimetype="audio/wav" if audio_format == "wav" else "audio/pcm",
+                headers={
+                    **audio_headers,
+                    "X-TTS-Cache": "miss",
+                    "X-TTS-Load-Seconds": f"{load_seconds:.3f}",
+                    "Cache-Control": "no-cache",
+                    "X-Accel-Buffering": "no",
+                },
+                direct_passthrough=True,
+            )
 
 
 @app.route("/api/v1/qa", methods=["POST"])
 def handle_qa_request():
     if request.method == "POST":
         prompt = request.json["prompt"]
-        runtime_args = Namespace()
-        runtime_args.prompt = prompt
-        _copy_args(orchestrators["QA"].args, runtime_args)
-        response = orchestrators["QA"].process(args=runtime_args)
+        orchestrator = registry.get("QA")
+        runtime_args = RequestContext.from_args(
+            orchestrator.args,
+            prompt=prompt,
+            session_id=_session_id(),
+            **_retrieval_filter_args(),
+        )
+        response = orchestrator.process(args=runtime_args)
         return {"response": response}
 
 
+@app.route("/api/v1/index", methods=["POST"])
+def handle_index_request():
+    """Queue a job to index the files, directories or urls of "paths", and return
+    its id at once. GET /api/v1/index/<job_id> reports its progress. The files must
+    lie under the INDEX_ROOT env var directory, and the urls must be http(s) urls
+    of public hosts."""
+    paths = request.json.get("paths") or request.json.get("path")
+    if isinstance(paths, str):
+        paths = [paths]
+    try:
+        job = index_jobs.submit(
+            paths=paths,
+            chunk_size=int(request.json.get("chunk_size", 500)),
+            chunk_overlap=int(request.json.get("chunk_overlap", 50)),
+        )
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    return (
+        {"job_id": job.job_id, "status": job.status},
+        202,
+        {"Location": f"/api/v1/index/{job.job_id}"},
+    )
+
+
+@app.route("/api/v1/index/<job_id>", methods=["GET"])
+def handle_index_job_request(job_id: str):
+    """The progress of an indexing job: the files and chunks done, the throughput
+    and the estimated seconds left."""
+    job = index_jobs.get(job_id)
+    if job is None:
+        return {"error": f"Unknown index job [{job_id}]."}, 404
+    return job.progress()
+
+
+@app.route("/api/v1/metrics", methods=["GET"])
+def handle_metrics_request():
+    """The token and latency aggregates of the llm and embedding calls."""
+    return metrics_lib.REGISTRY.snapshot()
+
+
+@app.route("/metrics", methods=["GET"])
+def handle_prometheus_request():
+    """The metrics of the service for Prometheus to scrape: the latency of the
+    routes and of the llm calls, the requests in flight, the tokens, the cache hit
+    ratios and the index load times."""
+    return Response(prometheus.REGISTRY.expose(), content_type=prometheus.CONTENT_TYPE)
+
+
 @app.route("/health", methods=["GET"])
 def handle_health_request():
     if request.method == "GET":
         return {"response": "health success"}
 
 
+@app.route("/ready", methods=["GET"])
+def handle_ready_request():
+    """Whether the orchestrators to warm up are warm. /health only reports that
+    the service is alive."""
+    status = registry.status()
+    status["admission"] = admission.status()
+    return status, 200 if status["ready"] else 503
+
+
 if __name__ == "__main__":
-    init_service()
-    app.run(host="0.0.0.0", port=32167, debug=True)
+    # With HTTP_WORKERS > 1, the requests are served by pre-forked processes,
+    # each with its own orchestrators, admission pools and metrics.
+    workers = int(os.getenv("HTTP_WORKERS") or 1)
+    if workers > 1:
+        PreforkServer(
+            app,
+            host="0.0.0.0",
+            port=32167,
+            workers=workers,
+            preload=_preload_service,
+            post_fork=init_service,
+            on_exit=_close_service,
+        ).serve()
+    else:
+        init_service()
+        app.run(host="0.0.0.0", port=32167, debug=True)
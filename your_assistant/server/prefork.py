@@ -0,0 +1,225 @@
+"""Serve a WSGI app from pre-forked worker processes.
+"""
+import gc
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from werkzeug.serving import make_server
+
+import your_assistant.core.utils as utils
+
+
+class PreforkServer:
+    """Load the shared state once, then fork the workers that serve the app on one
+    listening socket.
+
+    The state loaded before the fork, e.g. the FAISS index, is shared by the
+    workers copy-on-write. Whatever does not survive a fork, e.g. the threads and
+    the client connections, is created by each worker after it. The parent
+    restarts the workers that die, reloads them all on SIGHUP, and stops them on
+    SIGTERM or SIGINT, letting their requests in flight finish.
+    """
+
+    def __init__(
+        self,
+        app: Any,
+        host: str,
+        port: int,
+        workers: int,
+        preload: Optional[Callable[[], Any]] = None,
+        post_fork: Optional[Callable[[int], None]] = None,
+        on_exit: Optional[Callable[[], None]] = None,
+        graceful_timeout: float = 30.0,
+    ):
+        """
+        Args:
+            app (Any): The WSGI app, e.g. a Flask app.
+            host (str): The host to listen on.
+            port (int): The port to listen on. 0 picks a free port.
+            workers (int): The number of worker processes.
+            preload (Optional[Callable[[], Any]]): Load the shared state, in the
+                parent, before the workers fork, and again on each reload.
+            post_fork (Optional[Callable[[int], None]]): Initialize a worker, with
+                its id, from 0 to workers - 1.
+            on_exit (Optional[Callable[[], None]]): Release the resources of a
+                worker once it stops serving.
+            graceful_timeout (float): The seconds a stopping worker has to finish
+                its requests before it is killed.
+        """
+        if workers < 1:
+            raise ValueError("The server needs at least one worker.")
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.preload = preload
+        self.post_fork = post_fork
+        self.on_exit = on_exit
+        self.graceful_timeout = graceful_timeout
+        self.logger = utils.Logger("PreforkServer")
+        self.socket: Optional[socket.socket] = None
+        # The worker ids by pid, and the pids of the workers being stopped.
+        self._workers: Dict[int, int] = {}
+        self._stopping: Dict[int, float] = {}
+        self._stop = False
+        self._reload = False
+
+    def bind(self) -> int:
+        """Open the listening socket, before forking the workers.
+
+        Returns:
+            int: The port listened on.
+        """
+        if self.socket is None:
+            self.socket = socket.create_server((self.host, self.port), backlog=1024)
+            self.port = self.socket.getsockname()[1]
+        return self.port
+
+    def serve(self) -> None:
+        """Serve until SIGTERM or SIGINT. Blocks the parent process."""
+        self.bind()
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        self._preload()
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+        self.logger.info(
+            f"Serving on {self.host}:{self.port} with {self.workers} workers."
+        )
+        while not self._stop:
+            if self._reload:
+                self._reload = False
+                self._reload_workers()
+            self._reap(respawn=True)
+            self._kill_overdue()
+            time.sleep(0.1)
+        self._stop_workers(list(self._workers))
+        while self._workers:
+            self._reap(respawn=False)
+            self._kill_overdue()
+            time.sleep(0.05)
+        self.socket.close()  # type: ignore
+
+    def worker_pids(self) -> Dict[int, int]:
+        """The worker ids by pid."""
+        return dict(self._workers)
+
+    def _preload(self) -> None:
+        start = time.perf_counter()
+        if self.preload:
+            self.preload()
+        # The objects loaded so far are left out of the garbage collections, which
+        # would otherwise write to their pages and unshare them.
+        gc.freeze()
+        self.logger.info(f"Preloaded in {time.perf_counter() - start:.2f}s.")
+
+    def _spawn(self, worker_id: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self._run_worker(worker_id)
+                code = 0
+            except BaseException as e:
+                self.logger.error(f"Worker {worker_id} failed: {e!r}")
+            finally:
+                # Write the queued logs, since the exit skips the handlers at exit,
+                # and never return into the code of the parent.
+                logging.shutdown()
+                os._exit(code)
+        self._workers[pid] = worker_id
+
+    def _run_worker(self, worker_id: int) -> None:
+        parent_pid = os.getppid()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        if self.post_fork:
+            self.post_fork(worker_id)
+        server = make_server(
+            self.host,
+            self.port,
+            self.app,
+            threaded=True,
+            fd=self.socket.fileno(),  # type: ignore
+        )
+        # All the workers wake up on a new connection, and all but one find nothing
+        # to accept: a blocking accept would hang them until the next one, past
+        # their shutdown.
+        server.socket.setblocking(False)
+        # The requests in flight are waited for when the server closes.
+        server.daemon_threads = False  # type: ignore
+        signal.signal(
+            signal.SIGTERM,
+            # The server is shut down from another thread, since shutdown waits for
+            # the serving loop of this one.
+            lambda signum, frame: threading.Thread(target=server.shutdown).start(),
+        )
+
+        def watch_parent() -> None:
+            # A worker left behind by a killed parent would serve on forever.
+            while os.getppid() == parent_pid:
+                time.sleep(1.0)
+            self.logger.warning(f"Worker {worker_id} lost its parent, stopping.")
+            server.shutdown()
+
+        threading.Thread(target=watch_parent, daemon=True).start()
+        server.serve_forever()
+        server.server_close()
+        if self.on_exit:
+            self.on_exit()
+
+    def _reload_workers(self) -> None:
+        """Load the shared state again, then replace the workers with new ones,
+        which serve on the same socket while the old ones finish their requests."""
+        self.logger.info("Reloading the workers.")
+        old_pids = list(self._workers)
+        self._preload()
+        for pid in old_pids:
+            self._spawn(self._workers[pid])
+        self._stop_workers(old_pids)
+
+    def _stop_workers(self, pids: Any) -> None:
+        for pid in pids:
+            if pid in self._workers and pid not in self._stopping:
+                self._stopping[pid] = time.monotonic() + self.graceful_timeout
+                self._signal(pid, signal.SIGTERM)
+
+    def _reap(self, respawn: bool) -> None:
+        while self._workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            worker_id = self._workers.pop(pid, None)
+            stopped = self._stopping.pop(pid, None) is not None
+            if worker_id is not None and respawn and not stopped:
+                self.logger.warning(
+                    f"Worker {worker_id} (pid {pid}) exited with status {status}, "
+                    + "restarting it."
+                )
+                self._spawn(worker_id)
+
+    def _kill_overdue(self) -> None:
+        now = time.monotonic()
+        for pid, deadline in list(self._stopping.items()):
+            if now > deadline:
+                self.logger.warning(f"Worker pid {pid} did not stop in time, kill it.")
+                self._signal(pid, signal.SIGKILL)
+
+    def _signal(self, pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _handle_stop(self, signum: int, frame: Any) -> None:
+        self._stop = True
+
+    def _handle_reload(self, signum: int, frame: Any) -> None:
+        self._reload = True
@@ -0,0 +1,155 @@
+"""Test the admission control of the requests.
+Run this test with command: pytest your_assistant/tests/core/test_admission.py
+"""
+import threading
+import time
+
+import pytest
+
+import your_assistant.core.admission as admission
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        assert time.perf_counter() < deadline, "The condition was never met."
+        time.sleep(0.001)
+
+
+class Request(threading.Thread):
+    """A request waiting for the pool in the background."""
+
+    def __init__(self, pool, priority="interactive", timeout=None, order=None):
+        super().__init__(daemon=True)
+        self.pool = pool
+        self.priority = priority
+        self.timeout = timeout
+        self.order = order
+        self.admitted = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.admitted = self.pool.acquire(self.priority, timeout=self.timeout)
+        except admission.Rejected as e:
+            self.error = e
+            return
+        if self.order is not None:
+            self.order.append(self.priority)
+        self.pool.release(self.admitted)
+
+
+class TestAdmissionPool:
+    def test_admit_and_release(self):
+        pool = admission.AdmissionPool(
+            "Backend", limit=2, queue_size=2, service_time=0.01
+        )
+        first = pool.acquire()
+        with pool.admit():
+            assert pool.active == 2
+            request = Request(pool)
+            request.start()
+            wait_for(lambda: pool.queued == 1)
+            pool.release(first)
+            request.join()
+        assert request.error is None
+        assert (pool.active, pool.queued) == (0, 0)
+
+    def test_queue_full(self):
+        pool = admission.AdmissionPool(
+            "Backend", limit=1, queue_size=1, service_time=0.01
+        )
+        admitted = pool.acquire()
+        request = Request(pool)
+        request.start()
+        wait_for(lambda: pool.queued == 1)
+        with pytest.raises(admission.Rejected) as e:
+            pool.acquire()
+        assert (e.value.status, e.value.reason) == (429, "queue_full")
+        assert e.value.retry_after >= 1
+        pool.release(admitted)
+        request.join()
+        assert request.error is None
+
+    def test_deadline(self):
+        pool = admission.AdmissionPool(
+            "Backend", limit=1, queue_size=10, service_time=2.0
+        )
+        admitted = pool.acquire()
+        # The request would wait about 2s for the slot, and then take 2s.
+        with pytest.raises(admission.Rejected) as e:
+            pool.acquire(timeout=3.0)
+        assert (e.value.status, e.value.reason, e.value.retry_after) == (
+            503,
+            "deadline",
+            2,
+        )
+        assert pool.queued == 0
+        pool.release(admitted)
+
+    def test_timeout(self):
+        pool = admission.AdmissionPool(
+            "Backend", limit=1, queue_size=1, max_wait=0.05, service_time=0.01
+        )
+        admitted = pool.acquire()
+        with pytest.raises(admission.Rejected) as e:
+            pool.acquire()
+        assert (e.value.status, e.value.reason) == (503, "timeout")
+        assert pool.queued == 0
+        pool.release(admitted)
+        assert pool.active == 0
+
+    def test_priorities(self):
+        pool = admission.AdmissionPool(
+            "Backend", limit=1, queue_size=3, service_time=0.01
+        )
+        admitted = pool.acquire()
+        order = []
+        requests = []
+        for priority in ["batch", "batch", "interactive"]:
+            requests.append(Request(pool, priority, order=order))
+            requests[-1].start()
+            wait_for(lambda: pool.queued == len(requests))
+        # The critical requests do not wait.
+        pool.release(pool.acquire("critical"))
+        pool.release(admitted)
+        for request in requests:
+            request.join()
+        assert order == ["interactive", "batch", "batch"]
+
+    def test_eviction(self):
+        pool = admission.AdmissionPool(
+            "Backend", limit=1, queue_size=1, service_time=0.01
+        )
+        admitted = pool.acquire()
+        batch = Request(pool, "batch")
+        batch.start()
+        wait_for(lambda: pool.queued == 1)
+        interactive = Request(pool, "interactive")
+        interactive.start()
+        batch.join()
+        assert (batch.error.status, batch.error.reason) == (503, "evicted")
+        pool.release(admitted)
+        interactive.join()
+        assert interactive.error is None
+        assert (pool.active, pool.queued) == (0, 0)
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            admission.AdmissionPool("Backend", limit=0, queue_size=1)
+        with pytest.raises(ValueError):
+            admission.AdmissionPool("Backend", limit=1, queue_size=1).acquire("urgent")
+
+
+class TestAdmissionController:
+    def test_from_env(self, monkeypatch):
+        monkeypatch.setenv("ADMISSION_LIMITS", "QA=2, ChatGPT=16")
+        monkeypatch.setenv("ADMISSION_QUEUE_SIZE", "4")
+        monkeypatch.delenv("ADMISSION_DEFAULT_LIMIT", raising=False)
+        controller = admission.AdmissionController.from_env()
+        assert controller.pool("QA").limit == 2
+        assert controller.pool("ChatGPT").limit == 16
+        assert controller.pool("Claude").limit == 8
+        assert controller.pool("QA") is controller.pool("QA")
+        assert controller.pool("QA").queue_size == 4
+        assert controller.status()["QA"]["active"] == 0
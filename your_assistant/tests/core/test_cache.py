@@ -0,0 +1,150 @@
+"""Test the LLM response cache.
+Run this test with command: pytest your_assistant/tests/core/test_cache.py
+"""
+import asyncio
+import os
+import time
+
+import pytest
+
+from your_assistant.core.cache import ResponseCache
+
+
+@pytest.fixture()
+def cache_factory(tmp_path):
+    caches = []
+
+    def create(**kwargs):
+        cache = ResponseCache(db_path=os.path.join(tmp_path, "cache.db"), **kwargs)
+        caches.append(cache)
+        return cache
+
+    yield create
+    for cache in caches:
+        cache._db.close()
+
+
+class TestResponseCache:
+    @pytest.mark.parametrize(
+        "params, other_params, prompt, other_prompt, expected_same",
+        [
+            (
+                {"model": "a", "temperature": 0},
+                {"temperature": 0, "model": "a"},
+                "p",
+                "p",
+                True,
+            ),
+            ({"model": "a"}, {"model": "b"}, "p", "p", False),
+            (
+                {"model": "a", "max_tokens": 10},
+                {"model": "a", "max_tokens": 20},
+                "p",
+                "p",
+                False,
+            ),
+            ({"model": "a"}, {"model": "a"}, "p", "q", False),
+        ],
+    )
+    def test_make_key(self, params, other_params, prompt, other_prompt, expected_same):
+        key = ResponseCache.make_key(backend="ChatGPT", params=params, prompt=prompt)
+        other_key = ResponseCache.make_key(
+            backend="ChatGPT", params=other_params, prompt=other_prompt
+        )
+        assert (key == other_key) == expected_same
+
+    @pytest.mark.parametrize(
+        "temperature, max_temperature, expected_num_calls, expected_hit_ratio, "
+        + "expected_bypasses",
+        [
+            (0, 0.5, 1, 2 / 3, 0),
+            (0.5, 0.5, 1, 2 / 3, 0),
+            (0.9, 0.5, 3, 0.0, 3),
+        ],
+    )
+    def test_cached(
+        self,
+        cache_factory,
+        temperature,
+        max_temperature,
+        expected_num_calls,
+        expected_hit_ratio,
+        expected_bypasses,
+    ):
+        cache = cache_factory(max_temperature=max_temperature)
+        num_calls = []
+        params = {"model": "a", "temperature": temperature}
+        for _ in range(3):
+            response = cache.cached(
+                backend="ChatGPT",
+                params=params,
+                prompt="Hello",
+                call=lambda: num_calls.append(1) or "Hi",
+            )
+            assert response == "Hi"
+        assert len(num_calls) == expected_num_calls
+        assert cache.hit_ratio() == pytest.approx(expected_hit_ratio)
+        assert cache.stats()["bypasses"] == expected_bypasses
+
+    def test_ttl(self, cache_factory):
+        cache = cache_factory(ttl_seconds=0.05)
+        cache.put("key", "response")
+        assert cache.get("key") == "response"
+        time.sleep(0.1)
+        assert cache.get("key") is None
+        assert cache.stats()["entries"] == 0
+
+    def test_size_eviction(self, cache_factory):
+        cache = cache_factory(max_size=30)
+        for idx in range(3):
+            cache.put(f"key-{idx}", "0123456789")
+        # Touch the oldest entry so that the second one is the least recently used.
+        assert cache.get("key-0") is not None
+        cache.put("key-3", "0123456789")
+        assert cache.get("key-1") is None
+        assert [cache.get(f"key-{idx}") is not None for idx in [0, 2, 3]] == [True] * 3
+        assert cache.stats()["size"] == 30
+
+    def test_persistence(self, cache_factory):
+        cache_factory().put("key", "response")
+        other_cache = cache_factory()
+        assert other_cache.get("key") == "response"
+        other_cache.put("key", "longer response")
+        assert other_cache.stats()["size"] == len("longer response")
+
+    def test_cached_stream(self, cache_factory):
+        cache = cache_factory()
+        call = {"backend": "ChatGPT", "params": {"model": "a"}, "prompt": "Hello"}
+        chunks = list(cache.cached_stream(**call, stream=lambda: iter(["H", "i"])))
+        assert chunks == ["H", "i"]
+        assert list(cache.cached_stream(**call, stream=lambda: iter([]))) == ["Hi"]
+
+    def test_async_cached(self, cache_factory):
+        cache = cache_factory()
+        call = {"backend": "ChatGPT", "params": {"model": "a"}, "prompt": "Hello"}
+
+        async def respond():
+            return "Hi"
+
+        async def stream():
+            yield "H"
+            yield "i"
+
+        async def run():
+            first = await cache.acached(**call, call=respond)
+            chunks = [
+                chunk
+                async for chunk in cache.acached_stream(
+                    **{**call, "prompt": "Hey"}, stream=stream
+                )
+            ]
+            cached_chunks = [
+                chunk
+                async for chunk in cache.acached_stream(
+                    **{**call, "prompt": "Hey"}, stream=stream
+                )
+            ]
+            return first, chunks, cached_chunks
+
+        assert asyncio.run(run()) == ("Hi", ["H", "i"], ["Hi"])
+        assert cache.stats()["hits"] == 1
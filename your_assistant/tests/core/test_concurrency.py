@@ -0,0 +1,185 @@
+"""Test the concurrency helpers.
+Run this test with command: pytest your_assistant/tests/core/test_concurrency.py
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+import your_assistant.core.concurrency as concurrency_lib
+
+
+class TestSingleFlight:
+    @pytest.mark.parametrize(
+        "keys, expected_calls, expected_saved_calls",
+        [
+            (["a"] * 8, 1, 7),
+            (["a", "b"] * 4, 2, 6),
+            ([str(idx) for idx in range(8)], 8, 0),
+        ],
+    )
+    def test_do(self, keys, expected_calls, expected_saved_calls):
+        single_flight = concurrency_lib.SingleFlight()
+        barrier = threading.Barrier(len(keys))
+        num_upstream_calls = []
+        results = [None] * len(keys)
+
+        def upstream(key):
+            num_upstream_calls.append(key)
+            time.sleep(0.2)
+            return f"result of {key}"
+
+        def call(idx, key):
+            barrier.wait()
+            results[idx] = single_flight.do(key, lambda: upstream(key))
+
+        threads = [
+            threading.Thread(target=call, args=(idx, key))
+            for idx, key in enumerate(keys)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [f"result of {key}" for key in keys]
+        assert len(num_upstream_calls) == expected_calls
+        assert single_flight.stats() == {
+            "calls": expected_calls,
+            "saved_calls": expected_saved_calls,
+        }
+
+    def test_do_propagates_errors(self):
+        single_flight = concurrency_lib.SingleFlight()
+        barrier = threading.Barrier(4)
+        errors = []
+
+        def upstream():
+            time.sleep(0.2)
+            raise ValueError("upstream failed")
+
+        def call():
+            barrier.wait()
+            try:
+                single_flight.do("a", upstream)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert [str(e) for e in errors] == ["upstream failed"] * 4
+        # The failed call is forgotten, so the next call retries.
+        assert single_flight.do("a", lambda: "recovered") == "recovered"
+
+    def test_ado(self):
+        single_flight = concurrency_lib.SingleFlight()
+        num_upstream_calls = []
+
+        async def upstream(key):
+            num_upstream_calls.append(key)
+            await asyncio.sleep(0.05)
+            if key == "bad":
+                raise ValueError("upstream failed")
+            return f"result of {key}"
+
+        async def call(key):
+            try:
+                return await single_flight.ado(key, lambda: upstream(key))
+            except ValueError as e:
+                return str(e)
+
+        async def run():
+            return await asyncio.gather(*[call(key) for key in ["a", "bad"] * 10])
+
+        results = asyncio.run(run())
+        assert results == ["result of a", "upstream failed"] * 10
+        assert sorted(num_upstream_calls) == ["a", "bad"]
+        assert single_flight.stats() == {"calls": 2, "saved_calls": 18}
+
+
+class TestRateLimiter:
+    @pytest.mark.parametrize(
+        "rate, burst, expected_delays",
+        [
+            (10, 1, [0.0, 0.1, 0.2, 0.3]),
+            (10, 2, [0.0, 0.0, 0.1, 0.2]),
+            (100, 4, [0.0, 0.0, 0.0, 0.0]),
+        ],
+    )
+    def test_reserve(self, rate, burst, expected_delays):
+        limiter = concurrency_lib.RateLimiter(rate=rate, burst=burst)
+        delays = [limiter.reserve() for _ in expected_delays]
+        assert delays == pytest.approx(expected_delays, abs=0.01)
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            concurrency_lib.RateLimiter(rate=0)
+
+
+class TestKeyedLock:
+    @pytest.mark.parametrize(
+        "keys, expected_max_in_flight",
+        [
+            (["a"] * 6, 1),
+            (["a", "b"] * 3, 2),
+            ([None] * 6, 6),
+        ],
+    )
+    def test_hold(self, keys, expected_max_in_flight):
+        keyed_lock = concurrency_lib.KeyedLock()
+        in_flight = {"now": 0, "max": 0}
+        lock = threading.Lock()
+
+        def run(key):
+            with keyed_lock.hold(key):
+                with lock:
+                    in_flight["now"] += 1
+                    in_flight["max"] = max(in_flight["max"], in_flight["now"])
+                time.sleep(0.05)
+                with lock:
+                    in_flight["now"] -= 1
+
+        threads = [threading.Thread(target=run, args=(key,)) for key in keys]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert in_flight["max"] == expected_max_in_flight
+        # The locks are dropped once nobody holds or waits for them.
+        assert len(keyed_lock) == 0
+
+    def test_ahold(self):
+        keyed_lock = concurrency_lib.KeyedLock()
+        order = []
+
+        async def run(key, idx):
+            async with keyed_lock.ahold(key):
+                order.append(f"start {idx}")
+                await asyncio.sleep(0.02)
+                order.append(f"end {idx}")
+
+        async def main():
+            waiter = asyncio.ensure_future(run("a", 2))
+            await asyncio.gather(run("a", 0), run("a", 1))
+            await waiter
+            # A cancelled waiter does not keep the lock.
+            task = asyncio.ensure_future(run("a", 3))
+            async with keyed_lock.ahold("a"):
+                await asyncio.sleep(0.01)
+                task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            async with keyed_lock.ahold("a"):
+                pass
+
+        asyncio.run(main())
+        # The holders of a key do not overlap.
+        assert all(
+            order[idx].startswith("start") and order[idx + 1].startswith("end")
+            for idx in range(0, len(order), 2)
+        )
+        assert len(order) == 6
+        assert len(keyed_lock) == 0
@@ -6,7 +6,8 @@ import os
 from unittest.mock import MagicMock
 
 import pytest
-from langchain.embeddings import OpenAIEmbeddings
+from langchain.docstore.document import Document
+from langchain.embeddings import FakeEmbeddings, OpenAIEmbeddings
 from langchain.vectorstores import FAISS
 
 import your_assistant.core.indexer as indexer
@@ -160,3 +161,29 @@ class TestIndexer:
             assert len(data) == 1
             assert data[0].page_content.strip() == expected.strip()
             assert source == path
+
+    def test_indexers_share_the_db(self, monkeypatch, tmp_path):
+        """Test that the indexers of different processes merge into one db."""
+        monkeypatch.setenv("OPENAI_API_KEY", "fake")
+        args = argparse.Namespace(
+            verbose=False, db_path=str(tmp_path), embeddings_tool_name="openai"
+        )
+        # Like the workers of a PreforkServer, both load the db before either saves.
+        indexers = [indexer.KnowledgeIndexer(args=args) for _ in range(2)]
+        for idx, knowledge_indexer in enumerate(indexers * 2):
+            knowledge_indexer.embeddings_tool = FakeEmbeddings(size=16)
+            source = f"doc-{idx}.txt"
+            assert knowledge_indexer._index_embeddings(
+                documents=[Document(page_content=f"Page of {source}", metadata={})],
+                source=source,
+            )
+        reloaded = indexer.KnowledgeIndexer(args=args)
+        assert reloaded.index_record["indexed_doc"] == {
+            f"doc-{idx}.txt" for idx in range(4)
+        }
+        assert len(reloaded.embeddings_db.index_to_docstore_id) == 4
+        # A file indexed by the other process is not indexed twice.
+        assert not indexers[0]._index_embeddings(
+            documents=[Document(page_content="Page of doc-1.txt", metadata={})],
+            source="doc-1.txt",
+        )
@@ -0,0 +1,267 @@
+"""Test the indexing jobs.
+Run this test with command: pytest your_assistant/tests/core/test_jobs.py
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import your_assistant.core.jobs as jobs_lib
+from your_assistant.core.jobs import IndexJob, IndexJobManager
+
+
+class FakeIndexer:
+    """An indexer that embeds 4 chunks per file, in 2 batches, and fails on the
+    files named bad.txt."""
+
+    def __init__(self, delay=0.0, gate=None):
+        self.delay = delay
+        self.gate = gate
+        self.indexed = []
+
+    def index(
+        self, path, chunk_size, chunk_overlap, on_progress=None, public_only=False
+    ):
+        if self.gate is not None:
+            self.gate.wait()
+        if os.path.basename(path) == "bad.txt":
+            raise ValueError(f"File not found: {path}")
+        for done in [2, 4]:
+            time.sleep(self.delay)
+            on_progress(done, 4)
+        self.indexed.append(path)
+        return f"Index {path} finished."
+
+
+def wait_for(job, statuses=("done", "failed"), timeout=5.0):
+    """Wait for the job, or for the job returned by the callable, to reach one of
+    the statuses."""
+    get_job = job if callable(job) else lambda: job
+    deadline = time.perf_counter() + timeout
+    while get_job().status not in statuses:
+        assert time.perf_counter() < deadline, f"The job is still {get_job().status}."
+        time.sleep(0.005)
+
+
+@pytest.fixture()
+def data_dir(tmp_path):
+    data_dir = os.path.join(tmp_path, "data")
+    os.makedirs(data_dir)
+    for file_name in ["a.txt", "b.txt", ".hidden"]:
+        with open(os.path.join(data_dir, file_name), "w") as f:
+            f.write(file_name)
+    return data_dir
+
+
+class TestIndexJobManager:
+    def test_run_job(self, tmp_path, data_dir):
+        indexer = FakeIndexer(delay=0.01)
+        completed = []
+        manager = IndexJobManager(
+            indexer_factory=lambda: indexer,
+            state_path=os.path.join(tmp_path, "jobs.json"),
+            on_complete=completed.append,
+            root=str(tmp_path),
+        )
+        start = time.perf_counter()
+        job = manager.submit(
+            [data_dir, "data/bad.txt"], chunk_size=100, chunk_overlap=10
+        )
+        assert time.perf_counter() - start < 0.05
+        assert manager.get(job.job_id) is job
+        wait_for(job)
+        progress = job.progress()
+        assert progress["status"] == "done"
+        assert progress["files"] == [
+            os.path.join(data_dir, "a.txt"),
+            os.path.join(data_dir, "b.txt"),
+            os.path.join(data_dir, "bad.txt"),
+        ]
+        assert (progress["files_done"], progress["files_total"]) == (3, 3)
+        assert progress["chunks_done"] == 8
+        assert progress["chunks_per_second"] > 0
+        assert progress["eta"] == 0
+        assert list(progress["errors"]) == [os.path.join(data_dir, "bad.txt")]
+        assert len(progress["results"]) == 2
+        assert completed == [job]
+        manager.close()
+        with open(os.path.join(tmp_path, "jobs.json")) as f:
+            assert json.load(f)[0]["status"] == "done"
+
+    def test_progress(self, tmp_path, data_dir):
+        gate = threading.Event()
+        manager = IndexJobManager(
+            indexer_factory=lambda: FakeIndexer(delay=0.05, gate=gate),
+            state_path=os.path.join(tmp_path, "jobs.json"),
+            root=str(tmp_path),
+        )
+        job = manager.submit([data_dir])
+        wait_for(job, statuses=("running",))
+        assert job.progress()["eta"] is None
+        gate.set()
+        while job.files_done == 0:
+            time.sleep(0.005)
+        progress = job.progress()
+        assert progress["status"] == "running"
+        assert progress["eta"] > 0
+        wait_for(job)
+        manager.close()
+
+    def test_resume_after_restart(self, tmp_path, data_dir):
+        # The process stopped once the first file of the job was indexed.
+        job = IndexJob(job_id="job", paths=[data_dir])
+        job.status = "running"
+        job.files = [os.path.join(data_dir, name) for name in ["a.txt", "b.txt"]]
+        job.files_done, job.chunks_done = 1, 4
+        job.started_at = time.time()
+        state_path = os.path.join(tmp_path, "jobs.json")
+        with open(state_path, "w") as f:
+            json.dump([job.to_dict()], f)
+        indexer = FakeIndexer()
+        manager = IndexJobManager(
+            indexer_factory=lambda: indexer, state_path=state_path, root=str(tmp_path)
+        )
+        resumed = manager.get("job")
+        wait_for(resumed)
+        assert indexer.indexed == [os.path.join(data_dir, "b.txt")]
+        assert (resumed.files_done, resumed.chunks_done) == (2, 8)
+        manager.close()
+
+    def test_claimed_once(self, tmp_path, data_dir, monkeypatch):
+        monkeypatch.setattr(jobs_lib, "RESUME_RETRY_SECONDS", 0.05)
+        # The job is run by a worker that is being replaced, and still alive.
+        old_worker = subprocess.Popen([sys.executable, "-c", "input()"], stdin=-1)
+        job = IndexJob(job_id="job", paths=[data_dir])
+        job.status, job.claimed_by = "running", old_worker.pid
+        job.files = [os.path.join(data_dir, name) for name in ["a.txt", "b.txt"]]
+        state_path = os.path.join(tmp_path, "jobs.json")
+        with open(state_path, "w") as f:
+            json.dump([job.to_dict()], f)
+        indexer = FakeIndexer()
+        # Like the new worker 0 and the one it replaces, both managers resume.
+        managers = [
+            IndexJobManager(
+                indexer_factory=lambda: indexer,
+                state_path=state_path,
+                root=str(tmp_path),
+            )
+            for _ in range(2)
+        ]
+        time.sleep(0.2)
+        assert indexer.indexed == []
+        old_worker.communicate(b"\n")
+        wait_for(lambda: managers[0].get("job"))
+        # Only one of the managers claimed the job.
+        assert len(indexer.indexed) == 2
+        assert sum(manager.jobs() != [] for manager in managers) == 1
+        with open(state_path) as f:
+            assert json.load(f)[0]["claimed_by"] == os.getpid()
+        for manager in managers:
+            manager.close()
+
+    def test_shared_state(self, tmp_path, data_dir):
+        # Like the workers of a PreforkServer, only the first manager resumes.
+        state_path = os.path.join(tmp_path, "jobs.json")
+        first = IndexJobManager(
+            indexer_factory=FakeIndexer, state_path=state_path, root=str(tmp_path)
+        )
+        second = IndexJobManager(
+            indexer_factory=FakeIndexer,
+            state_path=state_path,
+            resume=False,
+            root=str(tmp_path),
+        )
+        first_job = first.submit([data_dir])
+        second_job = second.submit([data_dir])
+        # Each manager reports the jobs of the other from the state file, once the
+        # other saved them.
+        wait_for(lambda: first.get(second_job.job_id))
+        wait_for(lambda: second.get(first_job.job_id))
+        assert first.get(second_job.job_id).files_done == 2
+        assert first.get("void") is None
+        first.close()
+        second.close()
+        with open(state_path) as f:
+            assert {state["job_id"] for state in json.load(f)} == {
+                first_job.job_id,
+                second_job.job_id,
+            }
+
+    @pytest.mark.parametrize(
+        "paths, chunk_size, chunk_overlap",
+        [([], 500, 50), ([""], 500, 50), (["a.txt"], 50, 50)],
+    )
+    def test_invalid_job(self, tmp_path, paths, chunk_size, chunk_overlap):
+        manager = IndexJobManager(
+            indexer_factory=FakeIndexer,
+            state_path=os.path.join(tmp_path, "jobs.json"),
+            root=str(tmp_path),
+        )
+        with pytest.raises(ValueError):
+            manager.submit(paths, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        assert manager.jobs() == []
+        manager.close()
+
+    def test_confined_paths(self, tmp_path, data_dir):
+        outside_dir = os.path.join(tmp_path, "outside")
+        os.makedirs(outside_dir)
+        os.symlink(outside_dir, os.path.join(data_dir, "link"))
+        os.symlink("/etc/passwd", os.path.join(data_dir, "passwd.txt"))
+        indexer = FakeIndexer()
+        manager = IndexJobManager(
+            indexer_factory=lambda: indexer,
+            state_path=os.path.join(tmp_path, "jobs.json"),
+            root=data_dir,
+        )
+        for path in [
+            "../outside/a.txt",
+            outside_dir,
+            "link",
+            "/etc/passwd",
+            "file:///etc/passwd",
+            "ftp://example.com/a.pdf",
+            "http://127.0.0.1:8080/a.pdf",
+            "http://localhost/a.pdf",
+            "http://169.254.169.254/latest/meta-data",
+            "http://[::1]/a.pdf",
+        ]:
+            with pytest.raises(ValueError):
+                manager.submit([path])
+        # The links out of the root in the directories are skipped.
+        job = manager.submit(["."])
+        wait_for(job)
+        assert job.files == [
+            os.path.join(data_dir, "a.txt"),
+            os.path.join(data_dir, "b.txt"),
+        ]
+        manager.close()
+        # Without a root, no local path can be indexed.
+        manager = IndexJobManager(
+            indexer_factory=FakeIndexer,
+            state_path=os.path.join(tmp_path, "jobs.json"),
+            resume=False,
+        )
+        with pytest.raises(ValueError):
+            manager.submit([data_dir])
+        manager.close()
+
+    def test_progress_while_running(self, tmp_path, data_dir):
+        manager = IndexJobManager(
+            indexer_factory=FakeIndexer,
+            state_path=os.path.join(tmp_path, "jobs.json"),
+            root=str(tmp_path),
+        )
+        jobs = [manager.submit([data_dir]) for _ in range(20)]
+        # The jobs are reported while they change, and always whole.
+        while any(job.status not in ("done", "failed") for job in jobs):
+            for job in jobs:
+                progress = job.progress()
+                assert len(progress["results"]) + len(progress["errors"]) == (
+                    progress["files_done"]
+                )
+                json.dumps(progress)
+        manager.close()
@@ -1,7 +1,10 @@
 """Test the LLMs.
 Run this test with command: pytest your_assistant/tests/core/test_llm.py
 """
+import asyncio
 import os
+import threading
+import time
 
 import pytest
 from langchain import PromptTemplate
@@ -97,3 +100,199 @@ class TestLLMs:
         load_env(env_file_path=os.path.join(root_path, config_file))
         llm = llm_lib.PaLM(test_mode=test_mode)
         assert llm("This is a test PaLM prompt.") == expected
+
+    @pytest.mark.parametrize(
+        "llm_type, expected",
+        [
+            (llm_lib.ChatGPT, "This is a test chatgpt response."),
+            (llm_lib.RevChatGPT, "This is a test revchatgpt response."),
+            (llm_lib.RevBard, "This is a test revbard response."),
+            (llm_lib.PaLM, "This is a test PaLM response."),
+        ],
+    )
+    def test_stream_completion(self, setup, llm_type, expected):
+        """Test streaming the test responses of the LLMs."""
+        llm = llm_type(test_mode=True)
+        chunks = list(llm_lib.stream_completion(llm, "This is a test prompt."))
+        assert "".join(chunks) == expected
+        if llm_type in (llm_lib.ChatGPT, llm_lib.RevChatGPT):
+            assert len(chunks) > 1
+
+    @pytest.mark.parametrize(
+        "llm_type, expected",
+        [
+            (llm_lib.ChatGPT, "This is a test chatgpt response."),
+            (llm_lib.RevChatGPT, "This is a test revchatgpt response."),
+            (llm_lib.RevBard, "This is a test revbard response."),
+            (llm_lib.PaLM, "This is a test PaLM response."),
+        ],
+    )
+    def test_async_completion(self, setup, llm_type, expected):
+        """Test completing and streaming many prompts concurrently on one loop."""
+        llm = llm_type(test_mode=True)
+
+        async def stream(prompt):
+            return [chunk async for chunk in llm_lib.astream_completion(llm, prompt)]
+
+        async def run():
+            prompts = [f"This is test prompt {idx}." for idx in range(100)]
+            completions = await asyncio.gather(
+                *[llm_lib.acomplete(llm, prompt) for prompt in prompts]
+            )
+            chunks = await stream(prompts[0])
+            await llm_lib.aclose_clients()
+            return completions, chunks
+
+        completions, chunks = asyncio.run(run())
+        assert completions == [expected] * 100
+        assert "".join(chunks) == expected
+
+
+class TestClientPool:
+    @pytest.mark.parametrize(
+        "max_size, num_threads, expected_max_created",
+        [
+            (1, 4, 1),
+            (2, 8, 2),
+            (4, 2, 2),
+        ],
+    )
+    def test_acquire(self, max_size, num_threads, expected_max_created):
+        """Test that concurrent callers share at most max_size clients."""
+        pool = llm_lib.ClientPool(factory=object, max_size=max_size)
+        barrier = threading.Barrier(num_threads)
+        seen = set()
+
+        def borrow():
+            barrier.wait()
+            for _ in range(20):
+                with pool.acquire() as client:
+                    seen.add(id(client))
+                    time.sleep(0.001)
+
+        threads = [threading.Thread(target=borrow) for _ in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert pool.num_created <= expected_max_created
+        assert len(seen) <= expected_max_created
+
+    def test_discard_on_error(self):
+        """Test that a client that raised is not handed out again."""
+        pool = llm_lib.ClientPool(factory=object, max_size=1)
+        with pytest.raises(ValueError):
+            with pool.acquire() as broken:
+                raise ValueError("broken session")
+        assert pool.num_created == 0
+        with pool.acquire() as client:
+            assert client is not broken
+
+
+class TestCachedValue:
+    @pytest.mark.parametrize(
+        "ttl_seconds, expected_num_loads",
+        [
+            (3600, 1),
+            (0, 3),
+        ],
+    )
+    def test_get(self, ttl_seconds, expected_num_loads):
+        """Test that the value is loaded once until it expires."""
+        num_loads = []
+        cached = llm_lib.CachedValue(
+            lambda: num_loads.append(1) or len(num_loads), ttl_seconds=ttl_seconds
+        )
+        values = [cached.get() for _ in range(3)]
+        assert len(num_loads) == expected_num_loads
+        assert values[-1] == expected_num_loads
+        cached.invalidate()
+        assert cached.get() == expected_num_loads + 1
+
+
+class TestPaLMModel:
+    @pytest.mark.parametrize(
+        "model, expected_model",
+        [
+            ("", "models/text-bison-001"),
+            ("models/text-bison-002", "models/text-bison-002"),
+        ],
+    )
+    def test_model(self, monkeypatch, model, expected_model):
+        """Test that the configured model is kept, and the resolved one is not
+        written over it."""
+        monkeypatch.setenv("PALM_API_KEY", f"key-{model}")
+        monkeypatch.setattr(
+            llm_lib, "_resolve_palm_model", lambda api_key: "models/text-bison-001"
+        )
+        monkeypatch.setattr(llm_lib, "_palm_api_key", None)
+        api_keys = []
+        monkeypatch.setattr(
+            llm_lib.palm, "configure", lambda api_key: api_keys.append(api_key)
+        )
+        models = []
+
+        def generate_text(model, **kwargs):
+            models.append(model)
+            return {}
+
+        monkeypatch.setattr(llm_lib.palm, "generate_text", generate_text, raising=False)
+        llm = llm_lib.PaLM(model=model)
+        assert llm("Hello") == "No response from PaLM"
+        assert llm("Hello") == "No response from PaLM"
+        assert models == [expected_model] * 2
+        assert llm.model == model
+        # The key is configured once, whether the model is set or resolved.
+        assert api_keys == [f"key-{model}"]
+
+
+class FakeAsyncChatbot:
+    """A chatbot that sends the whole message so far, and rewrites it once."""
+
+    def __init__(self, config):
+        pass
+
+    def reset_chat(self):
+        pass
+
+    async def ask(self, prompt):
+        for message in ["Hel", "Hello", "Hi there", "Hi there!"]:
+            yield {"message": message}
+
+
+def test_revchatgpt_astream_rewritten_message(monkeypatch):
+    """Test that a rewritten message is streamed whole, as by stream."""
+    monkeypatch.setenv("CHATGPT_ACCESS_TOKEN", "token")
+    monkeypatch.setattr(llm_lib, "AsyncChatbot", FakeAsyncChatbot)
+    llm = llm_lib.RevChatGPT()
+
+    async def run():
+        return [chunk async for chunk in llm.astream("Hello")]
+
+    assert asyncio.run(run()) == ["Hel", "lo", "Hi there", "!"]
+
+
+class TestAsyncClientPool:
+    @pytest.mark.parametrize("max_size, num_tasks", [(1, 4), (2, 8), (4, 2)])
+    def test_acquire(self, max_size, num_tasks):
+        """Test that concurrent tasks share at most max_size clients."""
+
+        async def create_client():
+            await asyncio.sleep(0)
+            return object()
+
+        pool = llm_lib.AsyncClientPool(factory=create_client, max_size=max_size)
+        seen = set()
+
+        async def borrow():
+            for _ in range(20):
+                async with pool.acquire() as client:
+                    seen.add(id(client))
+                    await asyncio.sleep(0.001)
+
+        async def run():
+            await asyncio.gather(*[borrow() for _ in range(num_tasks)])
+
+        asyncio.run(run())
+        assert pool.num_created <= min(max_size, num_tasks)
+        assert len(seen) <= min(max_size, num_tasks)
@@ -0,0 +1,277 @@
+"""Test the memories.
+Run this test with command: pytest your_assistant/tests/core/test_memory.py
+"""
+import threading
+import time
+from typing import Any, List, Optional
+
+import pytest
+from langchain.llms.base import LLM
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain.schema import BaseMessage, get_buffer_string
+
+import your_assistant.core.memory as memory_lib
+
+
+class FakeSummaryLLM(LLM):
+    """A slow summarizer that counts one token per word."""
+
+    delay: float = 0.0
+    num_calls: int = 0
+    gate: Any = None
+    num_counted_texts: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "FakeSummaryLLM"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        if self.gate:
+            self.gate.wait()
+        time.sleep(self.delay)
+        self.num_calls += 1
+        return f"summary {self.num_calls}"
+
+    def get_num_tokens(self, text: str) -> int:
+        self.num_counted_texts += 1
+        return len(text.split())
+
+    def get_num_tokens_from_messages(self, messages: List[BaseMessage]) -> int:
+        return self.get_num_tokens(get_buffer_string(messages))
+
+
+class TestIncrementalSummaryBufferMemory:
+    def test_prunes_like_summary_buffer_memory(self):
+        memory = memory_lib.IncrementalSummaryBufferMemory(
+            llm=FakeSummaryLLM(), max_token_limit=20
+        )
+        expected_memory = ConversationSummaryBufferMemory(
+            llm=FakeSummaryLLM(), max_token_limit=20
+        )
+        for idx in range(10):
+            inputs, outputs = {"user": f"question {idx}"}, {"AI": f"answer {idx}"}
+            memory.save_context(inputs, outputs)
+            expected_memory.save_context(inputs, outputs)
+            assert memory.buffer == expected_memory.buffer
+            assert memory.moving_summary_buffer == expected_memory.moving_summary_buffer
+        assert memory.buffer_token_count == sum(memory.message_token_counts)
+        assert memory.buffer_token_count <= memory.max_token_limit
+
+    def test_counts_each_message_once(self):
+        llm = FakeSummaryLLM()
+        memory = memory_lib.IncrementalSummaryBufferMemory(llm=llm, max_token_limit=20)
+        for idx in range(100):
+            memory.save_context({"user": f"question {idx}"}, {"AI": f"answer {idx}"})
+        assert llm.num_counted_texts == 200
+
+    def test_clear(self):
+        memory = memory_lib.IncrementalSummaryBufferMemory(
+            llm=FakeSummaryLLM(), max_token_limit=20
+        )
+        memory.save_context({"user": "question"}, {"AI": "answer"})
+        memory.clear()
+        assert memory.buffer_token_count == 0
+        assert len(memory.message_token_counts) == 0
+
+
+@pytest.fixture()
+def setup():
+    llm = FakeSummaryLLM(delay=0.2)
+    memory = memory_lib.AsyncSummaryMemory(
+        memory=memory_lib.IncrementalSummaryBufferMemory(llm=llm, max_token_limit=4),
+        coalesce_turns=2,
+        max_pending_turns=4,
+    )
+    yield llm, memory
+    memory.close()
+
+
+class TestAsyncSummaryMemory:
+    def test_save_does_not_wait_for_summary(self, setup):
+        llm, memory = setup
+        start = time.perf_counter()
+        for idx in range(3):
+            memory.save_context({"user": f"question {idx}"}, {"AI": f"answer {idx}"})
+            history = memory.load_memory_variables({})["history"]
+            assert f"answer {idx}" in history
+        assert time.perf_counter() - start < llm.delay
+
+    def test_flush_coalesces_turns(self, setup):
+        llm, memory = setup
+        for idx in range(2):
+            memory.save_context({"user": f"question {idx}"}, {"AI": f"answer {idx}"})
+        assert memory.flush(timeout=5)
+        assert memory.pending_turns == 0
+        assert llm.num_calls == 1
+        assert memory.memory.moving_summary_buffer == "summary 1"
+        history = memory.load_memory_variables({})["history"]
+        assert "summary 1" in history and "answer 1" in history
+
+    def test_load_waits_when_too_many_turns_pending(self, setup):
+        llm, memory = setup
+        # Block the summarizer so that the turns pile up.
+        llm.gate = threading.Event()
+        for idx in range(4):
+            memory.save_context({"user": f"question {idx}"}, {"AI": f"answer {idx}"})
+        threading.Timer(0.1, llm.gate.set).start()
+        memory.load_memory_variables({})
+        assert memory.pending_turns < memory.max_pending_turns
+
+    def test_memories_share_the_summary_threads(self):
+        memories = [
+            memory_lib.AsyncSummaryMemory(
+                memory=memory_lib.IncrementalSummaryBufferMemory(
+                    llm=FakeSummaryLLM(), max_token_limit=4
+                ),
+                coalesce_turns=1,
+            )
+            for _ in range(20)
+        ]
+        threads_before = threading.active_count()
+        for memory in memories:
+            memory.save_context({"user": "question"}, {"AI": "answer"})
+        for memory in memories:
+            assert memory.flush(timeout=5)
+            memory.close()
+        assert threading.active_count() - threads_before <= memory_lib.SUMMARY_WORKERS
+
+    def test_failed_summary_keeps_turns_pending(self, setup):
+        llm, memory = setup
+        llm.delay = 0.0
+        predict_new_summary = memory.memory.predict_new_summary
+        memory.memory.__dict__["predict_new_summary"] = lambda *args: 1 / 0
+        for idx in range(2):
+            memory.save_context({"user": f"question {idx}"}, {"AI": f"answer {idx}"})
+        assert not memory.flush(timeout=5)
+        assert memory.pending_turns == 2
+        assert "answer 0" in memory.load_memory_variables({})["history"]
+        # The turns are summarized with the next ones once the llm is back.
+        memory.memory.__dict__["predict_new_summary"] = predict_new_summary
+        memory.save_context({"user": "question 2"}, {"AI": "answer 2"})
+        assert memory.flush(timeout=5)
+        assert memory.pending_turns == 0
+        assert memory.memory.moving_summary_buffer == "summary 1"
+
+    @pytest.mark.parametrize("coalesce_turns, max_pending_turns", [(0, 3), (3, 2)])
+    def test_invalid_args(self, coalesce_turns, max_pending_turns):
+        with pytest.raises(ValueError):
+            memory_lib.AsyncSummaryMemory(
+                memory=memory_lib.IncrementalSummaryBufferMemory(
+                    llm=FakeSummaryLLM(), max_token_limit=4
+                ),
+                coalesce_turns=coalesce_turns,
+                max_pending_turns=max_pending_turns,
+            )
+
+
+@pytest.fixture()
+def store_factory(tmp_path):
+    stores = []
+
+    def create(**kwargs):
+        store = memory_lib.SessionMemoryStore(
+            memory_factory=lambda: memory_lib.AsyncSummaryMemory(
+                memory=memory_lib.IncrementalSummaryBufferMemory(
+                    llm=FakeSummaryLLM(), max_token_limit=100
+                ),
+            ),
+            namespace="test",
+            db_path=str(tmp_path / "memory.db"),
+            **kwargs,
+        )
+        stores.append(store)
+        return store
+
+    yield create
+    for store in stores:
+        store.close()
+
+
+class TestSessionMemoryStore:
+    def test_sessions_are_isolated(self, store_factory):
+        store = store_factory()
+        store.get("alice").save_context({"user": "I am Alice"}, {"AI": "Hi Alice"})
+        store.get("bob").save_context({"user": "I am Bob"}, {"AI": "Hi Bob"})
+        assert "Alice" not in store.get("bob").load_memory_variables({})["history"]
+        assert "Bob" not in store.get("alice").load_memory_variables({})["history"]
+
+    def test_lru_session_is_spilled_and_reloaded(self, store_factory):
+        store = store_factory(max_sessions=2)
+        store.get("alice").save_context({"user": "I am Alice"}, {"AI": "Hi Alice"})
+        store.get("bob")
+        store.get("carol")
+        assert len(store) == 2
+        history = store.get("alice").load_memory_variables({})["history"]
+        assert "Hi Alice" in history
+
+    def test_pinned_session_is_not_spilled(self, store_factory):
+        store = store_factory(max_sessions=1)
+        with store.pin("alice"):
+            alice = store.get("alice")
+            store.get("bob")
+            # The request in flight saves its turn to the memory in the store.
+            alice.save_context({"user": "I am Alice"}, {"AI": "Hi Alice"})
+            assert store.get("alice") is alice
+        store.get("bob")
+        assert len(store) == 1
+        history = store.get("alice").load_memory_variables({})["history"]
+        assert "Hi Alice" in history
+
+    def test_idle_session_is_spilled(self, store_factory):
+        store = store_factory(ttl_seconds=0.05)
+        store.get("alice")
+        time.sleep(0.1)
+        store.get("bob")
+        assert len(store) == 1
+
+    def test_budget_bounds_resident_sessions(self, store_factory):
+        store = store_factory(max_total_size=30)
+        store.get("alice").save_context({"user": "a" * 20}, {"AI": "b" * 20})
+        store.get("bob")
+        assert len(store) == 1
+
+    def test_total_size(self, store_factory):
+        store = store_factory(max_sessions=2)
+        for session_id in ["alice", "bob", "carol", "alice"]:
+            memory = store.get(session_id)
+            memory.save_context({"user": session_id}, {"AI": f"Hi {session_id}"})
+            memory.flush(timeout=5)
+        # The sizes are updated by the saves and the summaries, not only on get.
+        assert store.total_size() == sum(
+            memory.size() for memory, _ in store._sessions.values()
+        )
+        store.close()
+        assert store.total_size() == 0
+
+    def test_expired_sessions_are_deleted(self, store_factory):
+        store = store_factory(max_sessions=1, spilled_ttl_seconds=0.05)
+        store.get("alice").save_context({"user": "I am Alice"}, {"AI": "Hi Alice"})
+        store.get("bob")
+        time.sleep(0.1)
+        # Spilling bob deletes alice, who did not come back in time.
+        store.get("carol")
+        count = store._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        assert count == 1
+        history = store.get("alice").load_memory_variables({})["history"]
+        assert "Hi Alice" not in history
+
+    def test_shared_sessions(self, store_factory):
+        """Test that the processes sharing the db see the turns of one another."""
+        stores = [store_factory(shared=True) for _ in range(2)]
+        for idx in range(4):
+            store = stores[idx % 2]
+            with store.pin("alice"):
+                memory = store.get("alice")
+                memory.save_context(
+                    {"user": f"question {idx}"}, {"AI": f"answer {idx}"}
+                )
+        history = stores[0].get("alice").load_memory_variables({})["history"]
+        assert all(f"answer {idx}" in history for idx in range(4))
+
+    def test_sessions_survive_restart(self, store_factory):
+        store = store_factory()
+        store.get("alice").save_context({"user": "I am Alice"}, {"AI": "Hi Alice"})
+        store.close()
+        restarted_store = store_factory()
+        history = restarted_store.get("alice").load_memory_variables({})["history"]
+        assert "Hi Alice" in history
@@ -0,0 +1,81 @@
+"""Test the metrics of the llm and embedding calls.
+Run this test with command: pytest your_assistant/tests/core/test_metrics.py
+"""
+import pytest
+from langchain.embeddings import FakeEmbeddings
+
+import your_assistant.core.metrics as metrics_lib
+
+
+class TestMetricsRegistry:
+    @pytest.mark.parametrize(
+        "text, expected",
+        [
+            ("", 0),
+            ("Hello world", 2),
+            ("Hello, world!", 4),
+        ],
+    )
+    def test_count_tokens(self, text, expected):
+        assert metrics_lib.count_tokens(text) == expected
+
+    @pytest.mark.parametrize(
+        "cache, expected_prompt_tokens, expected_completion_tokens",
+        [
+            ("off", 3, 2),
+            ("miss", 3, 2),
+            ("bypass", 3, 2),
+            ("hit", 0, 0),
+            ("coalesced", 0, 0),
+        ],
+    )
+    def test_track(self, cache, expected_prompt_tokens, expected_completion_tokens):
+        registry = metrics_lib.MetricsRegistry()
+        with registry.track("llm", "ChatGPT", "How are you") as call:
+            call.cache = cache
+            call.first_token()
+            call.response = "Fine thanks"
+        stats = registry.snapshot()["llm"]["ChatGPT"]
+        assert stats["calls"] == 1
+        assert stats["errors"] == 0
+        assert stats["prompt_tokens"] == expected_prompt_tokens
+        assert stats["completion_tokens"] == expected_completion_tokens
+        assert stats["cache"][cache] == 1
+        assert stats["time_to_first_token"]["p50"] <= stats["latency"]["p50"]
+
+    def test_track_error(self):
+        registry = metrics_lib.MetricsRegistry()
+        for idx in range(4):
+            with pytest.raises(ValueError):
+                with registry.track("llm", "ChatGPT", "Hi"):
+                    raise ValueError("The llm failed.")
+        with registry.track("llm", "ChatGPT", "Hi") as call:
+            call.response = "Hello"
+        stats = registry.snapshot()["llm"]["ChatGPT"]
+        assert (stats["calls"], stats["errors"]) == (5, 4)
+        assert stats["time_to_first_token"] == {"p50": None, "p95": None}
+
+    def test_percentiles(self):
+        registry = metrics_lib.MetricsRegistry(window=100)
+        for latency in range(1, 201):
+            call = metrics_lib.CallMetrics(kind="llm", backend="PaLM", prompt="")
+            call.latency = float(latency)
+            registry.record(call)
+        latency = registry.snapshot()["llm"]["PaLM"]["latency"]
+        # The mean covers all the calls, the percentiles only the recent ones.
+        assert latency["mean"] == pytest.approx(100.5)
+        assert (latency["p50"], latency["p95"], latency["p99"]) == (150, 195, 199)
+        registry.reset()
+        assert registry.snapshot() == {}
+
+    def test_metered_embeddings(self):
+        registry = metrics_lib.MetricsRegistry()
+        embeddings = metrics_lib.MeteredEmbeddings(
+            FakeEmbeddings(size=8), registry=registry
+        )
+        assert len(embeddings.embed_query("Hello world")) == 8
+        assert len(embeddings.embed_documents(["a b", "c d e"])) == 2
+        stats = registry.snapshot()["embedding"]["FakeEmbeddings"]
+        assert stats["calls"] == 2
+        assert stats["prompt_tokens"] == 2 + 5
+        assert stats["completion_tokens"] == 0
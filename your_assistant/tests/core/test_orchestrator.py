@@ -0,0 +1,384 @@
+"""Test the orchestrators.
+Run this test with command: pytest your_assistant/tests/core/test_orchestrator.py
+"""
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from langchain.llms.fake import FakeListLLM
+
+import your_assistant.core.metrics as metrics_lib
+import your_assistant.core.tracing as tracing
+import your_assistant.core.utils as utils
+from your_assistant.core.orchestrator import LLMOrchestrator, RequestContext
+
+
+class FakeSummaryLLM(FakeListLLM):
+    """A summarizer that counts one token per word."""
+
+    def get_num_tokens(self, text):
+        return len(text.split())
+
+
+class EchoOrchestrator(LLMOrchestrator):
+    """An orchestrator that echoes the last word of the prompt after a delay, and
+    fails on "fail"."""
+
+    def __init__(self, args, delay=0.1):
+        self.delay = delay
+        self.num_in_flight = 0
+        self.max_in_flight = 0
+        self.prompts = []
+        self._lock = threading.Lock()
+        super().__init__(args=args)
+
+    def _init_llm(self, args):
+        self.llm = FakeSummaryLLM(responses=["summary"] * 100)
+
+    def _process(self, args):
+        with self._lock:
+            self.num_in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.num_in_flight)
+            self.prompts.append(args.prompt)
+        time.sleep(self.delay)
+        with self._lock:
+            self.num_in_flight -= 1
+        if args.prompt.endswith("fail"):
+            raise ValueError("The llm failed.")
+        return f"echo {args.prompt.split()[-1]}"
+
+    def _stream(self, args):
+        response = self._process(args)
+        yield response[:4]
+        yield response[4:]
+
+    async def _aprocess(self, args):
+        with self._lock:
+            self.num_in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.num_in_flight)
+            self.prompts.append(args.prompt)
+        await asyncio.sleep(self.delay)
+        with self._lock:
+            self.num_in_flight -= 1
+        if args.prompt.endswith("fail"):
+            raise ValueError("The llm failed.")
+        return f"echo {args.prompt.split()[-1]}"
+
+    async def _astream(self, args):
+        response = await self._aprocess(args)
+        yield response[:4]
+        yield response[4:]
+
+
+@pytest.fixture()
+def orchestrator_factory(tmp_path):
+    orchestrators = []
+
+    def create(extra_args=(), delay=0.1):
+        parser = utils.init_parser("Echo", EchoOrchestrator)
+        args = parser.parse_args(
+            ["Echo", "--memory-db-path", ""]
+            + ["--cache-db-path", os.path.join(tmp_path, "cache.db")]
+            + list(extra_args)
+        )
+        orchestrator = EchoOrchestrator(args=args, delay=delay)
+        orchestrators.append(orchestrator)
+        return orchestrator, args
+
+    yield create
+    for orchestrator in orchestrators:
+        orchestrator.close()
+
+
+class TestProcessBatch:
+    @pytest.mark.parametrize(
+        "num_prompts, concurrency, expected_max_in_flight",
+        [
+            (8, 1, 1),
+            (8, 4, 4),
+            (3, 8, 3),
+        ],
+    )
+    @pytest.mark.parametrize("use_async", [False, True])
+    def test_concurrency_and_order(
+        self,
+        orchestrator_factory,
+        num_prompts,
+        concurrency,
+        expected_max_in_flight,
+        use_async,
+    ):
+        orchestrator, args = orchestrator_factory()
+        prompts = [f"prompt {idx}" for idx in range(num_prompts - 1)] + ["fail"]
+        kwargs = {"prompts": prompts, "args": args, "concurrency": concurrency}
+        if use_async:
+            results = asyncio.run(orchestrator.aprocess_batch(**kwargs))
+        else:
+            results = orchestrator.process_batch(**kwargs)
+        assert [result.prompt for result in results] == prompts
+        assert [result.response for result in results[:-1]] == [
+            f"echo {prompt.split()[-1]}" for prompt in prompts[:-1]
+        ]
+        assert not results[-1].ok and str(results[-1].error) == "The llm failed."
+        assert orchestrator.max_in_flight == expected_max_in_flight
+        # The args of the caller are left untouched.
+        assert not hasattr(args, "prompt")
+
+    def test_rate_limit(self, orchestrator_factory):
+        orchestrator, args = orchestrator_factory()
+        start = time.monotonic()
+        results = orchestrator.process_batch(
+            prompts=["a", "b", "c", "d"], args=args, concurrency=4, rate_limit=20
+        )
+        # The first prompt starts at once and the others 1 / 20 seconds apart.
+        assert time.monotonic() - start >= 0.15
+        assert all(result.ok for result in results)
+
+    @pytest.mark.parametrize(
+        "memory_mode, expected_max_in_flight, expected_histories",
+        [
+            ("none", 3, [False, False, False]),
+            ("isolated", 3, [True, True, True]),
+            ("shared", 1, [True, True, True]),
+        ],
+    )
+    def test_memory_mode(
+        self,
+        orchestrator_factory,
+        memory_mode,
+        expected_max_in_flight,
+        expected_histories,
+    ):
+        orchestrator, args = orchestrator_factory()
+        results = orchestrator.process_batch(
+            prompts=["a", "b", "c"], args=args, memory_mode=memory_mode
+        )
+        assert [result.response for result in results] == ["echo a", "echo b", "echo c"]
+        assert orchestrator.max_in_flight == expected_max_in_flight
+        assert [
+            "Current conversation:" in prompt for prompt in orchestrator.prompts
+        ] == expected_histories
+        session_ids = [session_id for session_id in orchestrator.memory_store._sessions]
+        if memory_mode == "isolated":
+            assert sorted(session_ids) == [
+                f"{args.session_id}/batch-{idx}" for idx in range(3)
+            ]
+        elif memory_mode == "shared":
+            assert session_ids == [args.session_id]
+            # The later prompts see the earlier turns of the conversation.
+            assert "echo a" in orchestrator.prompts[-1]
+
+    def test_invalid_memory_mode(self, orchestrator_factory):
+        orchestrator, args = orchestrator_factory()
+        with pytest.raises(ValueError):
+            orchestrator.process_batch(prompts=["a"], args=args, memory_mode="all")
+
+
+class TestMetrics:
+    @pytest.mark.parametrize(
+        "extra_args, expected_cache, expected_prompt_tokens",
+        [
+            ([], {"off": 4}, 7),
+            # The failed call misses the cache too.
+            (["--use-cache"], {"miss": 2, "hit": 2}, 3),
+        ],
+    )
+    def test_llm_calls(
+        self, orchestrator_factory, extra_args, expected_cache, expected_prompt_tokens
+    ):
+        metrics_lib.REGISTRY.reset()
+        orchestrator, args = orchestrator_factory(extra_args=extra_args)
+        args.use_memory = False
+        for _ in range(2):
+            args.prompt = "hello there"
+            assert orchestrator.process(args=args) == "echo there"
+        args.prompt = "hello there"
+        assert "".join(orchestrator.stream(args=args)) == "echo there"
+        args.prompt = "fail"
+        with pytest.raises(ValueError):
+            orchestrator.process(args=args)
+        stats = metrics_lib.REGISTRY.snapshot()["llm"]["EchoOrchestrator"]
+        assert (stats["calls"], stats["errors"]) == (4, 1)
+        assert {
+            status: count for status, count in stats["cache"].items() if count
+        } == expected_cache
+        # The failed call is charged its prompt, as it reached the llm.
+        assert stats["prompt_tokens"] == expected_prompt_tokens
+        assert stats["latency"]["p50"] >= 0.1 or "hit" in expected_cache
+        assert stats["time_to_first_token"]["p50"] is not None
+
+
+class TestConcurrentRequests:
+    def test_request_context(self, orchestrator_factory):
+        _, args = orchestrator_factory()
+        request = RequestContext.from_args(args, prompt="hi", session_id="a")
+        assert (request.prompt, request.session_id) == ("hi", "a")
+        assert request.replace(prompt="bye").prompt == "bye"
+        assert request.prompt == "hi"
+        with pytest.raises(AttributeError):
+            request.prompt = "bye"
+        with pytest.raises(AttributeError):
+            del request.prompt
+
+    def test_astream_of_sync_stream(self, orchestrator_factory):
+        orchestrator, args = orchestrator_factory()
+        request = RequestContext.from_args(args, prompt="hi there", session_id="a")
+
+        async def collect(stop_after=None):
+            chunks = []
+            # The base astream drives the sync stream of the orchestrator.
+            stream = super(LLMOrchestrator, orchestrator).astream(request)
+            async for chunk in stream:
+                chunks.append((chunk, threading.get_ident()))
+                if len(chunks) == stop_after:
+                    break
+            await stream.aclose()
+            return chunks
+
+        thread_ids = []
+        original_stream = orchestrator.stream
+
+        def stream(args):
+            for chunk in original_stream(args):
+                thread_ids.append(threading.get_ident())
+                yield chunk
+
+        orchestrator.stream = stream
+        chunks = asyncio.run(collect())
+        assert "".join(chunk for chunk, _ in chunks) == "echo there"
+        # The chunks are pulled in one thread, off the event loop, so the session
+        # lock is released by the thread that took it.
+        assert len(set(thread_ids)) == 1
+        assert thread_ids[0] != chunks[0][1]
+        assert len(orchestrator.session_locks) == 0
+
+        asyncio.run(collect(stop_after=1))
+        deadline = time.monotonic() + 5
+        while len(orchestrator.session_locks) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(orchestrator.session_locks) == 0
+
+    def test_coalesce_across_sessions(self, orchestrator_factory):
+        orchestrator, args = orchestrator_factory()
+        orchestrator.process(
+            RequestContext.from_args(args, prompt="I am carol", session_id="carol")
+        )
+        requests = [
+            RequestContext.from_args(args, prompt="hello there", session_id=session_id)
+            for session_id in ["alice", "bob", "carol"]
+        ] + [RequestContext.from_args(args, prompt="hello there", use_memory=False)]
+
+        async def run():
+            return await asyncio.gather(
+                *[orchestrator.aprocess(args=request) for request in requests]
+            )
+
+        assert asyncio.run(run()) == ["echo there"] * 4
+        # The new conversations and the one without memory share one llm call,
+        # while the conversation with history is answered on its own.
+        assert len(orchestrator.prompts) == 3
+        assert sum("I am carol" in prompt for prompt in orchestrator.prompts) == 2
+        for session_id in ["alice", "bob", "carol"]:
+            history = orchestrator.memory_store.get(session_id).load_memory_variables(
+                {}
+            )["history"]
+            assert "echo there" in history
+
+    @pytest.mark.parametrize("use_async", [False, True])
+    def test_stress(self, orchestrator_factory, use_async):
+        # A large token limit keeps all the turns in the buffer, unsummarized.
+        orchestrator, args = orchestrator_factory(
+            extra_args=["--memory-token-size", "100000"], delay=0.01
+        )
+        num_sessions, num_turns = 20, 15
+        requests = [
+            RequestContext.from_args(
+                args, prompt=f"s{session}-t{turn}", session_id=f"session-{session}"
+            )
+            for session in range(num_sessions)
+            for turn in range(num_turns)
+        ]
+        random.Random(0).shuffle(requests)
+        if use_async:
+
+            async def run():
+                return await asyncio.gather(
+                    *[orchestrator.aprocess(args=request) for request in requests]
+                )
+
+            responses = asyncio.run(run())
+        else:
+            with ThreadPoolExecutor(max_workers=64) as executor:
+                responses = list(
+                    executor.map(
+                        lambda request: orchestrator.process(request), requests
+                    )
+                )
+        assert responses == [f"echo {request.prompt}" for request in requests]
+        # Each prompt sent to the llm only holds the turns of its own session.
+        assert len(orchestrator.prompts) == num_sessions * num_turns
+        for prompt in orchestrator.prompts:
+            assert len(set(re.findall(r"s(\d+)-t\d+", prompt))) == 1
+        for session in range(num_sessions):
+            _, messages = orchestrator.memory_store.get(f"session-{session}").snapshot()
+            prompts = [message.content for message in messages[::2]]
+            assert sorted(prompts) == sorted(
+                f"s{session}-t{turn}" for turn in range(num_turns)
+            )
+            # Each response follows its own prompt.
+            assert [message.content for message in messages[1::2]] == [
+                f"echo {prompt}" for prompt in prompts
+            ]
+        assert len(orchestrator.session_locks) == 0
+        assert not hasattr(args, "prompt")
+
+
+class TestTracing:
+    @pytest.mark.parametrize("use_async", [False, True])
+    def test_spans(self, orchestrator_factory, tmp_path, use_async):
+        orchestrator, args = orchestrator_factory()
+        request = RequestContext.from_args(args, prompt="hello there", session_id="a")
+        path = os.path.join(tmp_path, "trace.jsonl")
+        tracing.configure(path)
+        try:
+            if use_async:
+
+                async def run():
+                    return await orchestrator.aprocess(request), "".join(
+                        [chunk async for chunk in orchestrator.astream(request)]
+                    )
+
+                assert asyncio.run(run()) == ("echo there", "echo there")
+            else:
+                assert orchestrator.process(request) == "echo there"
+                assert "".join(orchestrator.stream(request)) == "echo there"
+        finally:
+            tracing.configure(None)
+        with open(path) as f:
+            spans = [json.loads(line) for line in f]
+        prefix = "a" if use_async else ""
+        assert [span["name"] for span in spans] == [
+            "memory.load",
+            "llm.call",
+            "memory.save",
+            f"orchestrator.{prefix}process",
+            "memory.load",
+            "llm.call",
+            "memory.save",
+            f"orchestrator.{prefix}stream",
+        ]
+        for request_spans in [spans[:4], spans[4:]]:
+            root = request_spans[-1]
+            assert root["attributes"] == {
+                "orchestrator": "EchoOrchestrator",
+                "session_id": "a",
+            }
+            for span in request_spans[:-1]:
+                assert span["parent_id"] == root["span_id"]
+        assert spans[1]["attributes"] == {"backend": "EchoOrchestrator", "cache": "off"}
@@ -0,0 +1,169 @@
+"""Test the Prometheus metrics.
+Run this test with command: pytest your_assistant/tests/core/test_prometheus.py
+"""
+import re
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import your_assistant.core.metrics as metrics_lib
+import your_assistant.core.prometheus as prometheus
+
+_SAMPLE_PATTERN = re.compile(r"^(\w+)(?:\{(.*)\})? (\S+)$")
+_LABEL_PATTERN = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse(text):
+    """Parse the exposition format like a Prometheus server, into the types of the
+    metrics and the samples by name and labels."""
+    types, samples = {}, {}
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split(" ")
+            types[name] = kind
+        elif line and not line.startswith("#"):
+            name, labels, value = _SAMPLE_PATTERN.match(line).groups()
+            family = re.sub(r"_(bucket|sum|count)$", "", name)
+            assert name in types or family in types, f"{name} has no TYPE line."
+            key = (name, frozenset(_LABEL_PATTERN.findall(labels or "")))
+            samples[key] = float(value)
+    return types, samples
+
+
+@pytest.fixture()
+def scrape():
+    """Serve a registry over http and scrape it, like a local Prometheus."""
+    registry = prometheus.PrometheusRegistry(namespace="test")
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.expose().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", prometheus.CONTENT_TYPE)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def _scrape():
+        url = f"http://127.0.0.1:{server.server_port}/metrics"
+        with urllib.request.urlopen(url) as response:
+            assert response.headers["Content-Type"] == prometheus.CONTENT_TYPE
+            return parse(response.read().decode())
+
+    yield registry, _scrape
+    server.shutdown()
+    server.server_close()
+
+
+class TestPrometheus:
+    def test_counter_and_gauge(self, scrape):
+        registry, _scrape = scrape
+        requests = registry.counter("requests_total", "The requests.", ["route"])
+        in_flight = registry.gauge("in_flight", "The requests in flight.")
+        requests.labels(route="/qa").inc()
+        requests.labels(route="/qa").inc(2)
+        requests.labels(route='/a"b\\').inc()
+        in_flight.inc(3)
+        in_flight.dec()
+        types, samples = _scrape()
+        assert types == {"test_requests_total": "counter", "test_in_flight": "gauge"}
+        assert samples[("test_requests_total", frozenset({("route", "/qa")}))] == 3
+        assert (
+            samples[("test_requests_total", frozenset({("route", '/a\\"b\\\\')}))] == 1
+        )
+        assert samples[("test_in_flight", frozenset())] == 2
+        with pytest.raises(ValueError):
+            requests.labels(path="/qa")
+        with pytest.raises(ValueError):
+            requests.labels(route="/qa").inc(-1)
+
+    def test_histogram(self, scrape):
+        registry, _scrape = scrape
+        latency = registry.histogram(
+            "latency_seconds", "The latency.", ["route"], buckets=[0.1, 1]
+        )
+        for value in [0.05, 0.1, 0.5, 2]:
+            latency.labels(route="/qa").observe(value)
+        _, samples = _scrape()
+        route = ("route", "/qa")
+        buckets = {
+            le: samples[("test_latency_seconds_bucket", frozenset({route, ("le", le)}))]
+            for le in ["0.1", "1.0", "+Inf"]
+        }
+        assert buckets == {"0.1": 2, "1.0": 3, "+Inf": 4}
+        assert samples[
+            ("test_latency_seconds_sum", frozenset({route}))
+        ] == pytest.approx(2.65)
+        assert samples[("test_latency_seconds_count", frozenset({route}))] == 4
+
+    def test_concurrent_updates(self, scrape):
+        registry, _scrape = scrape
+        counter = registry.counter("events_total", "The events.")
+        histogram = registry.histogram("sizes", "The sizes.", buckets=[10])
+
+        def update(_):
+            for idx in range(1000):
+                counter.inc()
+                histogram.observe(idx % 20)
+
+        # The threads of the pool outlive the updates, the one-off threads do not.
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(update, range(16)))
+        threads = [threading.Thread(target=update, args=(0,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        _, samples = _scrape()
+        assert samples[("test_events_total", frozenset())] == 20000
+        assert samples[("test_sizes_count", frozenset())] == 20000
+        assert samples[("test_sizes_bucket", frozenset({("le", "10.0")}))] == 11000
+
+    def test_register(self):
+        registry = prometheus.PrometheusRegistry()
+        counter = registry.counter("calls_total", "The calls.", ["backend"])
+        assert registry.counter("calls_total", "The calls.", ["backend"]) is counter
+        with pytest.raises(ValueError):
+            registry.gauge("calls_total", "The calls.", ["backend"])
+        with pytest.raises(ValueError):
+            registry.counter("calls_total", "The calls.", ["kind"])
+
+    def test_metrics_registry(self, scrape):
+        registry, _scrape = scrape
+        metrics = metrics_lib.MetricsRegistry(prometheus_registry=registry)
+        for cache in ["hit", "miss", "miss", "miss"]:
+            with metrics.track("llm", "ChatGPT", "How are you?") as call:
+                call.cache = cache
+                call.first_token()
+                call.response = "Fine."
+        with pytest.raises(RuntimeError):
+            with metrics.track("llm", "ChatGPT", "How are you?"):
+                raise RuntimeError("The backend is down.")
+        types, samples = _scrape()
+        labels = {("kind", "llm"), ("backend", "ChatGPT")}
+        assert types["test_call_duration_seconds"] == "histogram"
+        assert samples[("test_call_duration_seconds_count", frozenset(labels))] == 5
+        assert (
+            samples[("test_time_to_first_token_seconds_count", frozenset(labels))] == 4
+        )
+        assert (
+            samples[("test_calls_total", frozenset(labels | {("cache", "miss")}))] == 3
+        )
+        assert samples[("test_call_errors_total", frozenset(labels))] == 1
+        # Only the 3 misses and the failed call reached the backend.
+        assert samples[("test_prompt_tokens_total", frozenset(labels))] == 16
+        assert samples[("test_completion_tokens_total", frozenset(labels))] == 6
+        assert samples[("test_cache_hit_ratio", frozenset(labels))] == 0.25
+        metrics.reset()
+        _, samples = _scrape()
+        assert samples[("test_cache_hit_ratio", frozenset(labels))] == 0
+        assert samples[("test_call_duration_seconds_count", frozenset(labels))] == 5
@@ -0,0 +1,93 @@
+"""Test the orchestrator registry.
+Run this test with command: pytest your_assistant/tests/core/test_registry.py
+"""
+import threading
+import time
+
+import pytest
+
+from your_assistant.core.registry import OrchestratorRegistry
+
+
+class FakeOrchestrator:
+    """An orchestrator that is slow to create and to warm up."""
+
+    num_created = 0
+
+    def __init__(self, name, fail_warmup=False):
+        time.sleep(0.1)
+        FakeOrchestrator.num_created += 1
+        self.name = name
+        self.fail_warmup = fail_warmup
+        self.warm = False
+        self.closed = False
+
+    def warmup(self):
+        time.sleep(0.1)
+        if self.fail_warmup:
+            raise ValueError("The index does not exist.")
+        self.warm = True
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture()
+def registry():
+    FakeOrchestrator.num_created = 0
+    return OrchestratorRegistry(
+        {"ChatGPT": FakeOrchestrator, "QA": FakeOrchestrator},
+        lambda name, orchestrator_type: orchestrator_type(
+            name, fail_warmup=name == "QA"
+        ),
+    )
+
+
+class TestOrchestratorRegistry:
+    def test_get_creates_once(self, registry):
+        barrier = threading.Barrier(8)
+        orchestrators = []
+
+        def get():
+            barrier.wait()
+            orchestrators.append(registry.get("ChatGPT"))
+
+        threads = [threading.Thread(target=get) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert FakeOrchestrator.num_created == 1
+        assert registry.get_created("ChatGPT") is orchestrators[0]
+        assert registry.get_created("QA") is None
+        assert all(orchestrator is orchestrators[0] for orchestrator in orchestrators)
+        assert registry.status()["created"] == ["ChatGPT"]
+        with pytest.raises(KeyError):
+            registry.get("Unknown")
+
+    @pytest.mark.parametrize(
+        "names, expected_ready, expected_errors",
+        [
+            ([], True, {}),
+            (["ChatGPT"], True, {}),
+            (["ChatGPT", "QA"], False, {"QA": "The index does not exist."}),
+        ],
+    )
+    def test_warmup(self, registry, names, expected_ready, expected_errors):
+        thread = registry.warmup(names)
+        # Nothing is created before the first use, except the warmup list.
+        assert registry.ready() == (not names)
+        thread.join()
+        status = registry.status()
+        assert status["ready"] == expected_ready
+        assert status["created"] == names
+        assert status["warmup_errors"] == expected_errors
+        assert [registry.get(name).warm for name in names] == [
+            name not in expected_errors for name in names
+        ]
+        registry.close()
+        assert all(registry.get(name).closed for name in names)
+
+    def test_warmup_unknown(self, registry):
+        with pytest.raises(ValueError):
+            registry.warmup(["Unknown"])
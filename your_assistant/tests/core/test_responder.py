@@ -1,19 +1,204 @@
-"""Test the utils.
-Run this test with command: pytest your_assistant/tests/core/test_indexer.py
+"""Test the responders.
+Run this test with command: pytest your_assistant/tests/core/test_responder.py
 """
+import asyncio
+import json
 import os
+import threading
+import time
 
 import pytest
+from langchain.docstore.document import Document
+from langchain.embeddings import FakeEmbeddings
+from langchain.vectorstores import FAISS
 
-from your_assistant.core.utils import load_env
+import your_assistant.core.metrics as metrics_lib
+import your_assistant.core.responder as responder
+import your_assistant.core.tracing as tracing
+from your_assistant.core.indexer import MetadataIndex
 
 
 @pytest.fixture()
-def setup() -> str:
-    test_folder_path = os.path.dirname(os.path.abspath(__file__))
-    root_path = os.path.dirname(os.path.dirname(os.path.dirname(test_folder_path)))
-    return root_path
+def setup(tmp_path):
+    documents = [
+        Document(
+            page_content=f"Page {page} of {title}.",
+            metadata={
+                "source": f"{title}.pdf",
+                "title": title,
+                "authors": authors,
+                "page": page,
+            },
+        )
+        for title, authors in [
+            ("book-a", ["Alice"]),
+            ("book-b", ["Bob"]),
+            ("book-c", ["Alice", "Bob"]),
+        ]
+        for page in range(1, 11)
+    ]
+    db_index_path = os.path.join(tmp_path, "index")
+    FAISS.from_documents(documents, FakeEmbeddings(size=16)).save_local(db_index_path)
+    metadata_index = MetadataIndex()
+    for idx, doc in enumerate(documents):
+        metadata_index.add(idx, doc.metadata)
+    metadata_index.save(db_index_path)
+    qa = responder.DocumentQA(
+        db_name=str(tmp_path), llm_type="RevBard", use_memory=False, test_mode=True
+    )
+    qa.embeddings_tool = FakeEmbeddings(size=16)
+    return qa
 
 
 class TestResponder:
-    pass
+    @pytest.mark.parametrize(
+        "retrieval_filter, k, expected_titles, expected_pages",
+        [
+            (None, 5, {"book-a", "book-b", "book-c"}, range(1, 11)),
+            ({"title": "book-b"}, 5, {"book-b"}, range(1, 11)),
+            ({"authors": ["Alice"]}, 5, {"book-a", "book-c"}, range(1, 11)),
+            ({"authors": "Bob", "page_range": [3, 4]}, 4, {"book-b", "book-c"}, [3, 4]),
+            (
+                {"source": ["book-a.pdf", "book-c.pdf"]},
+                3,
+                {"book-a", "book-c"},
+                range(1, 11),
+            ),
+        ],
+    )
+    def test_retrieve_with_filter(
+        self, setup, retrieval_filter, k, expected_titles, expected_pages
+    ):
+        qa = setup
+        docs = qa.retrieve("Which page?", k=k, retrieval_filter=retrieval_filter)
+        assert len(docs) == k
+        for doc in docs:
+            assert doc.metadata["title"] in expected_titles
+            assert doc.metadata["page"] in expected_pages
+
+    def test_retrieve_with_filter_matching_nothing(self, setup):
+        qa = setup
+        assert qa.retrieve("Which page?", retrieval_filter={"title": "void"}) == []
+
+    def test_metadata_index_backfilled_from_faiss(self, setup):
+        qa = setup
+        os.remove(os.path.join(qa.db_index_name, MetadataIndex.FILE_NAME))
+        docs = qa.retrieve("Which page?", k=3, retrieval_filter={"title": "book-a"})
+        assert {doc.metadata["title"] for doc in docs} == {"book-a"}
+
+    def test_reload_index(self, setup):
+        qa = setup
+        old_index = qa._load_index()
+        documents = [
+            Document(
+                page_content=f"Page {page} of book-d.",
+                metadata={"source": "book-d.pdf", "title": "book-d", "page": page},
+            )
+            for page in range(1, 4)
+        ]
+        db = FAISS.from_documents(documents, FakeEmbeddings(size=16))
+        db.save_local(qa.db_index_name)
+        metadata_index = MetadataIndex()
+        for idx, doc in enumerate(documents):
+            metadata_index.add(idx, doc.metadata)
+        metadata_index.save(qa.db_index_name)
+        index_path = os.path.join(qa.db_index_name, "index.faiss")
+        os.utime(index_path, (time.time() + 10, time.time() + 10))
+        # While another thread loads the changed index, the loaded one is used.
+        with qa._index_lock:
+            assert qa._load_index() is old_index
+        qa.reload_index()
+        assert qa._load_index() is not old_index
+        docs = qa.retrieve("Which page?", k=2, retrieval_filter={"title": "book-d"})
+        assert {doc.metadata["title"] for doc in docs} == {"book-d"}
+
+    def test_preloaded_index(self, setup, tmp_path):
+        qa = setup
+        assert not responder.preload_index(
+            os.path.join(tmp_path, "void"), FakeEmbeddings(size=16)
+        )
+        assert responder.preload_index(str(tmp_path), FakeEmbeddings(size=16))
+        preloaded = responder._PRELOADED_INDEXES[qa.db_index_name][1]
+        try:
+            # The index preloaded before a fork is shared, not loaded again.
+            assert qa._load_index() is preloaded
+            assert responder.preload_index(str(tmp_path), FakeEmbeddings(size=16))
+            assert responder._PRELOADED_INDEXES[qa.db_index_name][1] is preloaded
+            docs = qa.retrieve("Which page?", k=3, retrieval_filter={"title": "book-a"})
+            assert {doc.metadata["title"] for doc in docs} == {"book-a"}
+        finally:
+            responder._PRELOADED_INDEXES.clear()
+
+    def test_async_answer(self, setup):
+        qa = setup
+
+        async def run():
+            answers = await asyncio.gather(
+                *[qa.aanswer(f"Which page {idx}?") for idx in range(10)]
+            )
+            chunks = [chunk async for chunk in qa.astream_answer("Which page?")]
+            return answers, chunks
+
+        answers, chunks = asyncio.run(run())
+        assert answers == [qa.answer("Which page?")] * 10
+        assert "".join(chunks) == answers[0]
+
+    def test_build_prompt_stages(self, setup):
+        qa = setup
+        # The embedding and the history only get past the barrier if they run at
+        # the same time.
+        barrier = threading.Barrier(2, timeout=5)
+        events = []
+
+        def embed_query(question):
+            events.append("start embedding")
+            if qa.stage_executor:
+                barrier.wait()
+            events.append("end embedding")
+            # A fixed embedding, so that both runs retrieve the same documents.
+            return [1.0] * 16
+
+        def load_history(session_id):
+            events.append("start history")
+            if qa.stage_executor:
+                barrier.wait()
+            events.append("end history")
+            return ""
+
+        qa._embed_query = embed_query
+        qa._load_history = load_history
+        metrics_lib.REGISTRY.reset()
+        prompts = qa._build_prompt(question="Which page?", k=3, session_id="a")
+        stages = metrics_lib.REGISTRY.snapshot()["stage"]
+        assert sorted(stages) == [
+            f"DocumentQA.{name}" for name in ["docs", "embedding", "history", "index"]
+        ]
+        # Without workers, the stages run one after the other.
+        qa.stage_executor.shutdown()
+        qa.stage_executor = None
+        events.clear()
+        assert qa._build_prompt(question="Which page?", k=3, session_id="a") == prompts
+        assert [event.split()[0] for event in events] == ["start", "end"] * 2
+
+    def test_answer_spans(self, setup, tmp_path):
+        qa = setup
+        path = os.path.join(tmp_path, "trace.jsonl")
+        tracing.configure(path)
+        try:
+            qa.answer("Which page?")
+        finally:
+            tracing.configure(None)
+        with open(path) as f:
+            spans = [json.loads(line) for line in f]
+        names = {span["span_id"]: span["name"] for span in spans}
+        parents = {span["name"]: names.get(span["parent_id"]) for span in spans}
+        assert parents == {
+            "qa.answer": None,
+            "qa.build_prompt": "qa.answer",
+            "stage.index": "qa.build_prompt",
+            "stage.embedding": "qa.build_prompt",
+            "stage.docs": "qa.build_prompt",
+            "stage.history": "qa.build_prompt",
+            "llm.call": "qa.answer",
+            "llm.RevBard._call": "llm.call",
+        }
@@ -0,0 +1,167 @@
+"""Test the routing between the LLM backends.
+Run this test with command: pytest your_assistant/tests/core/test_routing.py
+"""
+import asyncio
+import time
+
+import pytest
+
+import your_assistant.core.routing as routing
+import your_assistant.core.utils as utils
+from your_assistant.core.orchestrator import RouterOrchestrator
+
+
+class FakeBackend:
+    """A backend that answers with its name after a delay, or fails."""
+
+    def __init__(self, name, delay=0.0, fail=False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.num_calls = 0
+
+    def process(self, args):
+        self.num_calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise ValueError(f"{self.name} failed")
+        return self.name
+
+    async def aprocess(self, args):
+        self.num_calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise ValueError(f"{self.name} failed")
+        return self.name
+
+    def stream(self, args):
+        yield self.process(args)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture()
+def router_factory(tmp_path):
+    def create(backends, extra_args=()):
+        parser = utils.init_parser("Router", RouterOrchestrator)
+        args = parser.parse_args(
+            ["Router", "--backends", "PaLM", "RevBard", "--memory-db-path", ""]
+            + list(extra_args)
+        )
+        args.use_memory = False
+        orchestrator = RouterOrchestrator(args=args)
+        orchestrator.backends = {backend.name: backend for backend in backends}
+        orchestrator.router = routing.LatencyRouter(
+            backends=[backend.name for backend in backends],
+            failure_threshold=args.failure_threshold,
+            reset_seconds=args.circuit_reset_seconds,
+            default_hedge_delay=args.default_hedge_delay,
+        )
+        return orchestrator, args
+
+    return create
+
+
+class TestCircuitBreaker:
+    def test_open_and_probe(self):
+        breaker = routing.CircuitBreaker(failure_threshold=2, reset_seconds=10)
+        breaker.record_failure(now=0)
+        assert breaker.allow(now=0)
+        breaker.record_failure(now=1)
+        assert breaker.state == routing.CircuitBreaker.OPEN
+        assert not breaker.allow(now=5)
+        # A single probe is let through after the reset time.
+        assert breaker.allow(now=11)
+        assert breaker.state == routing.CircuitBreaker.HALF_OPEN
+        assert not breaker.allow(now=12)
+        breaker.record_failure(now=12)
+        assert breaker.state == routing.CircuitBreaker.OPEN
+        assert breaker.allow(now=22)
+        breaker.record_success()
+        assert breaker.state == routing.CircuitBreaker.CLOSED
+
+
+class TestBackendStats:
+    def test_record(self):
+        stats = routing.BackendStats(alpha=0.5)
+        for latency in [1.0, 3.0]:
+            stats.record(latency=latency, error=False)
+        assert stats.latency == pytest.approx(2.0)
+        stats.record(latency=0.01, error=True)
+        assert stats.latency == pytest.approx(2.0)
+        assert stats.error_rate == pytest.approx(0.5)
+        assert stats.percentile(50) == 1.0
+        assert stats.percentile(95) == 3.0
+
+
+class TestLatencyRouter:
+    def test_candidates(self):
+        router = routing.LatencyRouter(backends=["a", "b", "c"], failure_threshold=1)
+        assert router.candidates() == ["a", "b", "c"]
+        router.record("a", latency=2.0, error=False)
+        router.record("b", latency=1.0, error=False)
+        # The unmeasured backend is tried first, then the fastest.
+        assert router.candidates() == ["c", "b", "a"]
+        router.record("c", latency=0.1, error=True)
+        assert router.candidates() == ["b", "a"]
+        with pytest.raises(routing.CircuitOpenError):
+            router.acquire("c")
+
+
+class TestRouterOrchestrator:
+    def test_route_to_fastest(self, router_factory):
+        slow, fast = FakeBackend("slow", delay=0.05), FakeBackend("fast")
+        orchestrator, args = router_factory([slow, fast])
+        for _ in range(5):
+            args.prompt = "Hello"
+            orchestrator.process(args=args)
+        assert orchestrator.process(args=args) == "fast"
+        assert slow.num_calls == 1
+
+    def test_failover_and_circuit(self, router_factory):
+        broken, healthy = FakeBackend("broken", fail=True), FakeBackend("healthy")
+        orchestrator, args = router_factory(
+            [broken, healthy], ["--failure-threshold", "1"]
+        )
+        args.prompt = "Hello"
+        assert orchestrator.process(args=args) == "healthy"
+        assert orchestrator.process(args=args) == "healthy"
+        assert broken.num_calls == 1
+        assert orchestrator.router.snapshot()["broken"]["circuit"] == "open"
+
+    def test_all_backends_fail(self, router_factory):
+        orchestrator, args = router_factory([FakeBackend("broken", fail=True)])
+        args.prompt = "Hello"
+        with pytest.raises(RuntimeError):
+            orchestrator.process(args=args)
+
+    @pytest.mark.parametrize("use_async", [False, True])
+    def test_hedge(self, router_factory, use_async):
+        stuck, backup = FakeBackend("stuck", delay=1.0), FakeBackend("backup")
+        orchestrator, args = router_factory(
+            [stuck, backup], ["--hedge", "--default-hedge-delay", "0.05"]
+        )
+        args.prompt = "Hello"
+        start = time.monotonic()
+        if use_async:
+            response = asyncio.run(orchestrator.aprocess(args=args))
+        else:
+            response = orchestrator.process(args=args)
+        assert response == "backup"
+        assert time.monotonic() - start < 0.5
+        assert [stuck.num_calls, backup.num_calls] == [1, 1]
+
+    def test_stream_skips_open_circuit(self, router_factory):
+        broken, healthy = FakeBackend("broken", fail=True), FakeBackend("healthy")
+        orchestrator, args = router_factory(
+            [broken, healthy], ["--failure-threshold", "1"]
+        )
+        args.prompt = "Hello"
+        assert "".join(orchestrator.stream(args=args)) == "healthy"
+        # The circuit opens after the candidates were listed, e.g. by another call.
+        orchestrator.router.candidates = lambda: ["broken", "healthy"]
+        assert "".join(orchestrator.stream(args=args)) == "healthy"
+        # The refused call is not recorded as another failure of the backend.
+        assert broken.num_calls == 1
+        assert orchestrator.router.snapshot()["broken"]["calls"] == 1
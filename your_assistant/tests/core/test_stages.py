@@ -0,0 +1,74 @@
+"""Test the stage graph.
+Run this test with command: pytest your_assistant/tests/core/test_stages.py
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from your_assistant.core.stages import StageGraph
+
+
+class TestStageGraph:
+    def _graph(self, events, barrier=None):
+        def stage(name, result):
+            def run(**kwargs):
+                events.append(f"start {name}")
+                time.sleep(0.05)
+                # The independent stages a and b both reach the barrier, if any.
+                if barrier and name in ("a", "b"):
+                    barrier.wait()
+                events.append(f"end {name}")
+                return result(**kwargs)
+
+            return run
+
+        return (
+            StageGraph()
+            .add("a", stage("a", lambda: 1))
+            .add("b", stage("b", lambda: 2))
+            .add("c", stage("c", lambda a, b: a + b), deps=["a", "b"])
+            .add("d", stage("d", lambda a: a * 10), deps=["a"])
+        )
+
+    @pytest.mark.parametrize("use_executor", [False, True])
+    def test_run(self, use_executor):
+        events = []
+        if use_executor:
+            # a and b only get past the barrier if they run at the same time.
+            graph = self._graph(events, barrier=threading.Barrier(2, timeout=5))
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                results, timings = graph.run(executor)
+        else:
+            graph = self._graph(events)
+            results, timings = graph.run()
+        assert results == {"a": 1, "b": 2, "c": 3, "d": 10}
+        assert sorted(timings) == ["a", "b", "c", "d"]
+        assert all(timing >= 0.05 for timing in timings.values())
+        # A stage starts only after the stages it depends on.
+        for stage, deps in [("c", ["a", "b"]), ("d", ["a"])]:
+            for dep in deps:
+                assert events.index(f"end {dep}") < events.index(f"start {stage}")
+        if not use_executor:
+            # Each stage ends before the next one starts.
+            assert all(
+                event.startswith("start" if idx % 2 == 0 else "end")
+                for idx, event in enumerate(events)
+            )
+
+    def test_run_propagates_errors(self):
+        def fail():
+            raise ValueError("The stage failed.")
+
+        graph = StageGraph().add("a", fail).add("b", lambda a: a, deps=["a"])
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            with pytest.raises(ValueError, match="The stage failed."):
+                graph.run(executor)
+
+    def test_invalid(self):
+        graph = StageGraph().add("a", lambda: 1)
+        with pytest.raises(ValueError):
+            graph.add("a", lambda: 1)
+        with pytest.raises(ValueError):
+            graph.add("b", lambda c: c, deps=["c"])
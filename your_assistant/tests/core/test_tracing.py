@@ -0,0 +1,193 @@
+"""Test the tracing of the requests.
+Run this test with command: pytest your_assistant/tests/core/test_tracing.py
+"""
+import asyncio
+import inspect
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import your_assistant.core.tracing as tracing
+from your_assistant.core.stages import StageGraph
+
+
+def load_spans(path):
+    """Load the spans of a jsonl trace, by name."""
+    with open(path) as f:
+        return {span["name"]: span for span in map(json.loads, f)}
+
+
+@pytest.fixture()
+def trace_path(tmp_path):
+    path = os.path.join(tmp_path, "trace.jsonl")
+    tracing.configure(path)
+    yield path
+    tracing.configure(None)
+
+
+class TestTracing:
+    def test_disabled(self, tmp_path):
+        tracing.configure(None)
+
+        @tracing.traced()
+        def add(a, b):
+            return a + b
+
+        with tracing.span("request", user="a") as span:
+            span.set_attribute("status", 200)
+            assert add(1, 2) == 3
+        assert tracing.current_span() is None
+        assert not tracing.TRACER.enabled
+        assert add.__name__ == "add"
+
+    def test_nested_spans(self, trace_path):
+        with tracing.span("request", user="a") as span:
+            span.set_attribute("status", 200)
+            with tracing.span("step"):
+                assert tracing.current_span().name == "step"
+            with pytest.raises(ValueError):
+                with tracing.span("failing"):
+                    raise ValueError("The step failed.")
+        assert tracing.current_span() is None
+        spans = load_spans(trace_path)
+        request = spans["request"]
+        assert request["attributes"] == {"user": "a", "status": 200}
+        assert request["parent_id"] is None
+        for name in ["step", "failing"]:
+            assert spans[name]["parent_id"] == request["span_id"]
+            assert spans[name]["trace_id"] == request["trace_id"]
+            assert spans[name]["duration"] <= request["duration"]
+        assert (
+            spans["failing"]["attributes"]["error"] == "ValueError('The step failed.')"
+        )
+
+    def test_traced(self, trace_path):
+        @tracing.traced()
+        def add(a, b):
+            return a + b
+
+        @tracing.traced("count")
+        def count(n):
+            yield from range(n)
+
+        @tracing.traced("acount")
+        async def acount(n):
+            for idx in range(n):
+                yield idx
+
+        @tracing.traced("aadd")
+        async def aadd(a, b):
+            return a + b
+
+        # The wrappers keep the kind of the functions.
+        assert inspect.iscoroutinefunction(aadd)
+        assert inspect.isasyncgenfunction(acount)
+        assert inspect.isgeneratorfunction(count)
+
+        async def run():
+            return [idx async for idx in acount(3)], await aadd(1, 2)
+
+        with tracing.span("request"):
+            assert add(1, 2) == 3
+            assert list(count(3)) == [0, 1, 2]
+            assert asyncio.run(run()) == ([0, 1, 2], 3)
+        spans = load_spans(trace_path)
+        assert sorted(spans) == [
+            "aadd",
+            "acount",
+            "count",
+            "request",
+            "test_tracing.TestTracing.test_traced.<locals>.add",
+        ]
+        # The asyncio tasks inherit the span of their creator.
+        for name in ["aadd", "acount", "count"]:
+            assert spans[name]["parent_id"] == spans["request"]["span_id"]
+
+    def test_bind_to_threads(self, trace_path):
+        graph = StageGraph().add("a", lambda: 1).add("b", lambda a: a + 1, deps=["a"])
+        with tracing.span("request"):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                graph.run(executor)
+            # An unbound thread starts a new trace.
+            thread = threading.Thread(
+                target=lambda: tracing.span("orphan").start().end()
+            )
+            thread.start()
+            thread.join()
+        spans = load_spans(trace_path)
+        for name in ["stage.a", "stage.b"]:
+            assert spans[name]["parent_id"] == spans["request"]["span_id"]
+        assert spans["stage.a"]["thread_id"] != spans["request"]["thread_id"]
+        assert spans["orphan"]["parent_id"] is None
+
+    def test_chrome_trace(self, tmp_path):
+        path = os.path.join(tmp_path, "trace.json")
+        tracing.configure(path)
+        with tracing.span("http.request", path="/api/v1/qa"):
+            with tracing.span("qa.answer"):
+                pass
+        tracing.configure(None)
+        with open(path) as f:
+            events = json.load(f)
+        assert [event["name"] for event in events] == ["qa.answer", "http.request"]
+        assert all(event["ph"] == "X" for event in events)
+        assert events[1]["cat"] == "http"
+        assert events[1]["args"]["path"] == "/api/v1/qa"
+        assert events[0]["args"]["parent_id"] == events[1]["args"]["span_id"]
+        assert events[1]["ts"] <= events[0]["ts"]
+
+    def test_invalid_format(self, tmp_path):
+        with pytest.raises(ValueError):
+            tracing.configure(os.path.join(tmp_path, "trace"), trace_format="xml")
+
+    @pytest.mark.parametrize("use_async", [False, True])
+    def test_stream_spans(self, trace_path, use_async):
+        @tracing.isolate_spans
+        def count(n, name="count"):
+            with tracing.span(name):
+                for idx in range(n):
+                    with tracing.span(f"{name} item {idx}"):
+                        yield idx
+
+        @tracing.isolate_spans
+        async def acount(n):
+            with tracing.span("count"):
+                for idx in range(n):
+                    with tracing.span(f"count item {idx}"):
+                        yield idx
+
+        seen = []
+
+        def consume(idx):
+            # Between the items, the consumer is back in its own span.
+            seen.append(tracing.current_span().name)
+            with tracing.span(f"consume {idx}"):
+                pass
+
+        async def run():
+            async for idx in acount(2):
+                consume(idx)
+
+        with tracing.span("request"):
+            if use_async:
+                asyncio.run(run())
+            else:
+                for idx in count(2):
+                    consume(idx)
+            # A stream left open is closed later, e.g. by another thread.
+            stream = count(2, name="left open")
+            next(stream)
+        thread = threading.Thread(target=stream.close)
+        thread.start()
+        thread.join()
+        assert tracing.current_span() is None
+        assert seen == ["request", "request"]
+        spans = load_spans(trace_path)
+        for idx in range(2):
+            assert spans[f"consume {idx}"]["parent_id"] == spans["request"]["span_id"]
+            assert spans[f"count item {idx}"]["parent_id"] == spans["count"]["span_id"]
+        assert spans["left open"]["parent_id"] == spans["request"]["span_id"]
+        assert spans["left open item 0"]["parent_id"] == spans["left open"]["span_id"]
@@ -0,0 +1,249 @@
+"""Test the text-to-speech models and the speech cache.
+Run this test with command: pytest your_assistant/tests/core/test_tts.py
+"""
+import io
+import os
+import threading
+import time
+import wave
+
+import numpy as np
+import pytest
+
+import your_assistant.core.tts as tts
+
+
+class FakeTTS:
+    """A model that speaks 10ms of a tone per character, in a given time."""
+
+    loaded = 0
+
+    def __init__(self, delay=0.0):
+        FakeTTS.loaded += 1
+        self.delay = delay
+        self.version = "fake_v1"
+        self.threads = {}
+
+    def init_thread(self, num_threads):
+        self.threads[threading.get_ident()] = num_threads
+
+    def synthesize(self, text, voice_id, sample_rate):
+        time.sleep(self.delay)
+        num_samples = len(text) * sample_rate // 100
+        return 0.5 * np.sin(np.arange(num_samples) / 10.0).astype(np.float32)
+
+
+@pytest.fixture(autouse=True)
+def reset_loaded():
+    FakeTTS.loaded = 0
+
+
+class TestTTSModelPool:
+    def test_models_loaded_once(self):
+        pool = tts.TTSModelPool(model_factory=FakeTTS, size=2, num_threads=3)
+        assert pool.load_seconds == 0
+        for _ in range(3):
+            speech = pool.synthesize("Hello.", voice_id="en_0", sample_rate=8000)
+            assert len(speech.audio) == 480
+            assert speech.synthesis_seconds >= 0
+        assert FakeTTS.loaded == 2
+        assert pool.load_seconds > 0
+        assert pool.version == "fake_v1"
+        pool.close()
+
+    def test_concurrent_synthesis(self):
+        models = []
+
+        def factory():
+            models.append(FakeTTS(delay=0.1))
+            return models[-1]
+
+        pool = tts.TTSModelPool(model_factory=factory, size=2, num_threads=3)
+        pool.load()
+        speeches = []
+        threads = [
+            threading.Thread(
+                target=lambda: speeches.append(pool.synthesize("Hi.", sample_rate=8000))
+            )
+            for _ in range(4)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Two at a time, each model used by one thread at a time.
+        assert 0.2 <= time.perf_counter() - start < 0.35
+        assert len(speeches) == 4
+        assert max(speech.wait_seconds for speech in speeches) >= 0.09
+        # Each pool thread set its own budget of intra-op threads once.
+        budgets = {}
+        for model in models:
+            budgets.update(model.threads)
+        assert list(budgets.values()) == [3, 3]
+        pool.close()
+
+    def test_stream(self):
+        pool = tts.TTSModelPool(model_factory=lambda: FakeTTS(delay=0.1))
+        pool.load()
+        text = "One. Two two! Three three three? Four."
+        start = time.perf_counter()
+        speeches = pool.stream(text, sample_rate=8000)
+        first = next(speeches)
+        # The first sentence is heard after its own synthesis.
+        assert time.perf_counter() - start < 0.18
+        assert len(first.audio) == len("One.") * 80
+        lengths = [len(speech.audio) for speech in speeches]
+        assert lengths == [
+            len(s) * 80 for s in ["Two two!", "Three three three?", "Four."]
+        ]
+        pool.close()
+
+    def test_stream_closed_early(self):
+        pool = tts.TTSModelPool(model_factory=lambda: FakeTTS(delay=0.05))
+        speeches = pool.stream("One. Two. Three. Four. Five.", lookahead=2)
+        next(speeches)
+        start = time.perf_counter()
+        speeches.close()
+        # The sentences not started are dropped.
+        pool.close()
+        assert time.perf_counter() - start < 0.09
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            tts.TTSModelPool(model_factory=FakeTTS, size=0)
+
+    def test_loaded_version(self):
+        pool = tts.TTSModelPool(model_factory=FakeTTS, version="stale")
+        assert pool.version == "stale"
+        pool.load()
+        assert pool.version == "fake_v1"
+        pool.close()
+
+    def test_file_version(self, tmp_path):
+        model_path = os.path.join(tmp_path, "model.pt")
+        assert tts.SileroTTS.file_version(model_path) == ""
+        versions = []
+        for content in [b"model", b"model", b"swapped model"]:
+            with open(model_path, "wb") as f:
+                f.write(content)
+            versions.append(tts.SileroTTS.file_version(model_path))
+        assert versions[0] == versions[1] != versions[2]
+        assert versions[0].startswith(tts.SileroTTS.VERSION)
+
+    def test_from_env(self, monkeypatch):
+        monkeypatch.setenv("TTS_POOL_SIZE", "2")
+        monkeypatch.setenv("TTS_THREADS", "8")
+        pool = tts.TTSModelPool.from_env(workers=4)
+        assert (pool.size, pool.num_threads) == (2, 4)
+        pool.close()
+
+
+class TestSplitSentences:
+    @pytest.mark.parametrize(
+        "text, max_chars, expected",
+        [
+            ("Hello there. How are you?", 500, ["Hello there.", "How are you?"]),
+            ("Yes!\n\nNo... maybe", 500, ["Yes!", "No...", "maybe"]),
+            ("a b c d e", 3, ["a b", "c d", "e"]),
+            ("  \n ", 500, []),
+        ],
+    )
+    def test_split_sentences(self, text, max_chars, expected):
+        assert tts.split_sentences(text, max_chars=max_chars) == expected
+
+
+class TestSpeech:
+    def test_to_wav(self):
+        audio = np.array([0.0, 0.5, -1.0, 2.0], dtype=np.float32)
+        speech = tts.Speech(
+            audio, sample_rate=8000, wait_seconds=0, synthesis_seconds=0
+        )
+        with wave.open(io.BytesIO(speech.to_wav()), "rb") as wav_file:
+            assert wav_file.getnchannels() == 1
+            assert wav_file.getsampwidth() == 2
+            assert wav_file.getframerate() == 8000
+            frames = wav_file.readframes(wav_file.getnframes())
+        assert np.frombuffer(frames, dtype="<i2").tolist() == [0, 16383, -32767, 32767]
+
+    def test_wav_header(self):
+        audio = np.array([0.0, 0.5], dtype=np.float32)
+        speech = tts.Speech(
+            audio, sample_rate=8000, wait_seconds=0, synthesis_seconds=0
+        )
+        # Only the sizes, unknown when streaming, differ from the ones of a file.
+        header = tts.wav_header(8000)
+        assert len(header) == 44
+        wav = speech.to_wav()
+        assert header[8:40] == wav[8:40]
+        assert header[4:8] == header[40:44] == b"\xff\xff\xff\xff"
+
+    def test_wav_frames(self):
+        audio = np.array([0.0, 0.5, -1.0], dtype=np.float32)
+        wav = tts.Speech(
+            audio, sample_rate=8000, wait_seconds=0, synthesis_seconds=0
+        ).to_wav()
+        pcm = wav[44:]
+        assert tts.wav_frames(wav) == pcm
+        # A file of another writer may have more chunks before its frames.
+        info = b"LIST" + (4).to_bytes(4, "little") + b"INFO"
+        wav = wav[:36] + info + wav[36:]
+        wav = wav[:4] + (len(wav) - 8).to_bytes(4, "little") + wav[8:]
+        assert tts.wav_frames(wav) == pcm
+
+
+class TestSpeechCache:
+    def test_make_key(self):
+        key = tts.SpeechCache.make_key("Hello.", "en_0", 48000, "Silero/v3_en")
+        assert key == tts.SpeechCache.make_key("Hello.", "en_0", 48000, "Silero/v3_en")
+        for other in [
+            tts.SpeechCache.make_key("Hello!", "en_0", 48000, "Silero/v3_en"),
+            tts.SpeechCache.make_key("Hello.", "en_1", 48000, "Silero/v3_en"),
+            tts.SpeechCache.make_key("Hello.", "en_0", 24000, "Silero/v3_en"),
+            tts.SpeechCache.make_key("Hello.", "en_0", 48000, "Silero/v4_en"),
+        ]:
+            assert other != key
+
+    def test_memory_and_disk(self, tmp_path):
+        cache = tts.SpeechCache(directory=str(tmp_path), memory_size=800)
+        assert cache.get("aa") == (None, None)
+        path = cache.put("aa", b"a" * 100)
+        with open(path, "rb") as f:
+            assert f.read() == b"a" * 100
+        assert cache.get("aa") == (b"a" * 100, None)
+        # Pushed out of memory by the entries put after it.
+        for key in ["bb", "cc", "dd", "ee", "ff", "gg", "hh", "ii"]:
+            cache.put(key, b"b" * 100)
+        assert cache.get("aa") == (None, path)
+        # Hot again, so back in memory.
+        assert cache.get("aa") == (b"a" * 100, None)
+        stats = cache.stats()
+        assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (2, 1, 1)
+        assert (stats["entries"], stats["size"]) == (9, 900)
+
+    def test_size_eviction(self, tmp_path):
+        cache = tts.SpeechCache(directory=str(tmp_path), max_size=350, memory_size=0)
+        for key in ["aa", "bb", "cc"]:
+            cache.put(key, b"x" * 100)
+        # The least recently used entry is evicted first.
+        assert cache.get("aa")[1] is not None
+        cache.put("dd", b"x" * 100)
+        assert cache.get("bb") == (None, None)
+        assert not os.path.exists(cache.path("bb"))
+        for key in ["aa", "cc", "dd"]:
+            assert cache.get(key)[1] is not None
+        assert cache.stats()["size"] <= 350
+
+    def test_shared_directory(self, tmp_path):
+        # Like the workers of a PreforkServer, with the same directory.
+        first = tts.SpeechCache(directory=str(tmp_path), max_size=250, memory_size=0)
+        second = tts.SpeechCache(directory=str(tmp_path), max_size=250, memory_size=0)
+        first.put("aa", b"x" * 100)
+        assert second.get("aa")[1] == first.path("aa")
+        first.put("bb", b"x" * 100)
+        second.put("cc", b"x" * 100)
+        second.put("dd", b"x" * 100)
+        # The second cache found the files of the first before evicting.
+        assert tts.SpeechCache(directory=str(tmp_path)).stats()["size"] <= 250
+        # A file evicted by another process is a miss.
+        assert first.get("bb") == (None, None)
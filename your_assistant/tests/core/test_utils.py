@@ -1,8 +1,12 @@
 """Test the utils.
 Run this test with command: pytest your_assistant/tests/core/test_utils.py
 """
+import io
+import logging
 import os
 import textwrap
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytest
 
@@ -25,6 +29,18 @@ def test_chunk_list(input, chunk_size, expected):
     assert list(chunk_iterator) == expected
 
 
+@pytest.mark.parametrize(
+    "input, expected",
+    [
+        (["He", "Hello", "Hello world"], ["He", "llo", " world"]),
+        (["Hello", "Hello", "Bye"], ["Hello", "Bye"]),
+        ([], []),
+    ],
+)
+def test_iter_text_deltas(input, expected):
+    assert list(utils.iter_text_deltas(input)) == expected
+
+
 @pytest.mark.parametrize(
     "input, expected",
     [
@@ -75,3 +91,103 @@ def test_chunk_list(input, chunk_size, expected):
 )
 def test_xml_to_markdown(input, expected):
     assert utils.xml_to_markdown(input).strip() == expected.strip()
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serve a.txt, and redirect to it from the other paths."""
+
+    def do_GET(self):
+        if self.path == "/a.txt":
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b"Hello")
+        else:
+            self.send_response(302)
+            self.send_header("Location", "/a.txt")
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.mark.parametrize("path", ["/a.txt", "/redirect"])
+@pytest.mark.parametrize("public_only", [False, True])
+def test_file_downloader(monkeypatch, tmp_path, path, public_only):
+    monkeypatch.chdir(tmp_path)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}{path}"
+    try:
+        if public_only:
+            # The local hosts are refused as they are connected to.
+            with pytest.raises(ValueError):
+                utils.file_downloader(url, public_only=True)
+        else:
+            _, filepath = utils.file_downloader(url)
+            with open(filepath, "rb") as f:
+                assert f.read() == b"Hello"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class TestLogger:
+    def test_caller_and_lazy_format(self, caplog):
+        logger = utils.Logger("TestLogger")
+        with caplog.at_level(logging.INFO, logger="TestLogger"):
+            logger.info("Indexed %d documents.", 3)
+            logger.warning("100% done.")
+        assert [record.getMessage() for record in caplog.records] == [
+            "Indexed 3 documents.",
+            "100% done.",
+        ]
+        # The records point at the caller, not at the logger.
+        assert {record.funcName for record in caplog.records} == {
+            "test_caller_and_lazy_format"
+        }
+
+    def test_not_verbose(self, caplog):
+        logger = utils.Logger("QuietLogger", verbose=False)
+        with caplog.at_level(logging.INFO, logger="QuietLogger"):
+            logger.error("Failed.")
+        assert caplog.records == []
+
+    def test_handler_added_once(self):
+        loggers = [utils.Logger("SharedLogger") for _ in range(3)]
+        assert len(loggers[-1].logger.handlers) == 1
+        assert utils.Logger("OtherLogger").logger.handlers == loggers[0].logger.handlers
+
+    @pytest.mark.parametrize("use_queue", [False, True])
+    def test_log_handler(self, use_queue):
+        stream = io.StringIO()
+        handler = utils._create_log_handler(stream=stream, use_queue=use_queue)
+        logger = utils.Logger(f"HandlerLogger{use_queue}")
+        logger.logger.handlers = [handler]
+        logger.info("Hello %s.", "world")
+        # Closing the queue handler waits for the queued records to be written.
+        handler.close()
+        assert "HandlerLogger" in stream.getvalue()
+        assert "(test_log_handler L" in stream.getvalue()
+        assert "Hello world." in stream.getvalue()
+
+    @pytest.mark.parametrize("use_queue", [False, True])
+    def test_level(self, use_queue):
+        stream = io.StringIO()
+        handler = utils._create_log_handler(stream=stream, use_queue=use_queue)
+        loggers = [
+            utils.Logger(f"{level}Logger{use_queue}", level=level)
+            for level in [logging.DEBUG, logging.WARNING]
+        ]
+        for logger in loggers:
+            logger.logger.handlers = [handler]
+            logger.logger.debug("Debug from %s.", logger.logger.name)
+            logger.info("Info from %s.", logger.logger.name)
+            logger.warning("Warning from %s.", logger.logger.name)
+        handler.close()
+        # The handler shared by the loggers lets the level of each one decide.
+        lines = stream.getvalue()
+        assert f"Debug from 10Logger{use_queue}." in lines
+        assert f"Info from 10Logger{use_queue}." in lines
+        assert f"Info from 30Logger{use_queue}." not in lines
+        assert f"Warning from 30Logger{use_queue}." in lines
+        assert utils._shared_log_handler().level == logging.NOTSET
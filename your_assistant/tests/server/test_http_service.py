@@ -0,0 +1,287 @@
+"""Test the http service.
+Run this test with command: pytest your_assistant/tests/server/test_http_service.py
+"""
+import io
+import wave
+
+import numpy as np
+import pytest
+
+import your_assistant.server.http_service as http_service
+from your_assistant.core.tts import SpeechCache, TTSModelPool
+
+
+class FakeTTS:
+    """A model that speaks 10ms of a tone per character."""
+
+    version = "fake_v1"
+    synthesized = 0
+    threads: list = []
+
+    def init_thread(self, num_threads):
+        FakeTTS.threads.append(num_threads)
+
+    def synthesize(self, text, voice_id, sample_rate):
+        FakeTTS.synthesized += 1
+        num_samples = len(text) * sample_rate // 100
+        return 0.5 * np.sin(np.arange(num_samples) / 10.0).astype(np.float32)
+
+
+@pytest.fixture()
+def client(monkeypatch):
+    pool = TTSModelPool(model_factory=FakeTTS)
+    monkeypatch.setattr(http_service, "tts_pool", pool)
+    monkeypatch.setattr(http_service, "tts_cache", None)
+    FakeTTS.synthesized = 0
+    FakeTTS.threads = []
+    yield http_service.app.test_client()
+    pool.close()
+
+
+def read_wav(data):
+    with wave.open(io.BytesIO(data), "rb") as wav_file:
+        return wav_file.getframerate(), wav_file.getnframes()
+
+
+class TestSessions:
+    def session_id(self, **kwargs):
+        with http_service.app.test_request_context(json={}, **kwargs):
+            return http_service._session_id()
+
+    def test_session_ids_are_issued(self):
+        session_id = self.session_id()
+        assert session_id != self.session_id()
+        assert self.session_id(headers={"X-Session-Id": session_id}) == session_id
+        # A made up id, e.g. the one of another client, starts a new conversation.
+        signature = session_id.rpartition(".")[2]
+        for forged_id in ["alice", f"alice.{signature}", "127.0.0.1"]:
+            assert self.session_id(headers={"X-Session-Id": forged_id}) not in [
+                forged_id,
+                session_id,
+            ]
+
+    @pytest.mark.parametrize("has_session", [False, True])
+    def test_session_id_header(self, has_session):
+        app = http_service.app
+        with app.test_request_context("/health", json={}):
+            app.preprocess_request()
+            session_id = http_service._session_id() if has_session else None
+            response = app.process_response(http_service.Response())
+        assert response.headers.get("X-Session-Id") == session_id
+
+
+class FakeAdmission:
+    """Admit every request, and record its priority and its timeout."""
+
+    def __init__(self):
+        self.requests = []
+
+    def pool(self, backend):
+        return self
+
+    def acquire(self, priority, timeout):
+        self.requests.append((priority, timeout))
+        return 0.0
+
+    def release(self, admitted):
+        pass
+
+
+class TestAdmission:
+    @pytest.fixture()
+    def fake_admission(self, monkeypatch):
+        fake_admission = FakeAdmission()
+        monkeypatch.setattr(http_service, "admission", fake_admission)
+        monkeypatch.setattr(http_service, "_admin_token", "secret")
+        return fake_admission
+
+    def admit(self, path, headers):
+        with http_service.app.test_request_context(
+            path, method="POST", json={}, headers=headers
+        ):
+            response = http_service._admit_request()
+        return response.status_code if response else 200
+
+    @pytest.mark.parametrize(
+        "path, headers, expected_priority",
+        [
+            ("/api/v1/chatgpt", {}, "interactive"),
+            ("/api/v1/chatgpt", {"X-Priority": "batch"}, "batch"),
+            ("/api/v1/chatgpt", {"X-Priority": "critical"}, "interactive"),
+            ("/api/v1/qa", {"X-Priority": "interactive"}, "batch"),
+            ("/api/v1/qa", {"X-Priority": "urgent"}, "batch"),
+            (
+                "/api/v1/qa",
+                {"X-Priority": "critical", "Authorization": "Bearer wrong"},
+                "batch",
+            ),
+            (
+                "/api/v1/qa",
+                {"X-Priority": "critical", "Authorization": "Bearer secret"},
+                "critical",
+            ),
+        ],
+    )
+    def test_priority(self, fake_admission, path, headers, expected_priority):
+        assert self.admit(path, headers) == 200
+        assert fake_admission.requests == [(expected_priority, None)]
+
+    @pytest.mark.parametrize(
+        "timeout, expected_status",
+        [("2.5", 200), ("soon", 400), ("-1", 400), ("nan", 400), ("inf", 400)],
+    )
+    def test_timeout(self, fake_admission, timeout, expected_status):
+        status = self.admit("/api/v1/chatgpt", {"X-Request-Timeout": timeout})
+        assert status == expected_status
+        if expected_status == 200:
+            assert fake_admission.requests == [("interactive", 2.5)]
+
+
+class TestTextToSpeech:
+    def test_synthesize(self, client):
+        response = client.post(
+            "/api/v1/audio/text-to-speech",
+            json={"model": "Silero", "body": "Hello.", "sample_rate": 8000},
+        )
+        assert response.status_code == 200
+        assert response.mimetype == "audio/wav"
+        assert read_wav(response.data) == (8000, 480)
+        assert float(response.headers["X-TTS-Synthesis-Seconds"]) >= 0
+        # The models stay loaded: the next request does not wait for them.
+        response = client.post(
+            "/api/v1/audio/text-to-speech",
+            json={"model": "Silero", "body": "Hello.", "sample_rate": 8000},
+        )
+        assert float(response.headers["X-TTS-Load-Seconds"]) < 0.01
+
+    @pytest.mark.parametrize("audio_format", ["wav", "pcm"])
+    def test_stream(self, client, audio_format):
+        response = client.post(
+            "/api/v1/audio/text-to-speech",
+            json={
+                "model": "Silero",
+                "body": "Hello. How are you?",
+                "sample_rate": 8000,
+                "is_streaming": True,
+                "format": audio_format,
+            },
+            buffered=False,
+        )
+        assert response.status_code == 200
+        assert response.headers["X-Audio-Sample-Rate"] == "8000"
+        chunks = list(response.response)
+        if audio_format == "wav":
+            assert response.mimetype == "audio/wav"
+            assert chunks.pop(0)[:4] == b"RIFF"
+        else:
+            assert response.mimetype == "audio/pcm"
+        # The audio of each sentence is sent as soon as it is synthesized.
+        assert [len(chunk) for chunk in chunks] == [6 * 80 * 2, 12 * 80 * 2]
+        response.close()
+
+    @pytest.mark.parametrize(
+        "num_threads, expected_status, expected_threads",
+        [
+            (None, 200, [4]),
+            (2, 200, [2]),
+            (16, 200, [4]),
+            (0, 400, []),
+            ("2", 400, []),
+        ],
+    )
+    def test_num_threads(self, client, num_threads, expected_status, expected_threads):
+        """Test that a request may lower the threads of the pool, not raise them."""
+        body = {"model": "Silero", "body": "Hello.", "sample_rate": 8000}
+        if num_threads is not None:
+            body["num_threads"] = num_threads
+        response = client.post("/api/v1/audio/text-to-speech", json=body)
+        assert response.status_code == expected_status
+        assert FakeTTS.threads == expected_threads
+
+    @pytest.mark.parametrize("sample_rate", ["fast", None, 44100])
+    def test_invalid_sample_rate(self, client, sample_rate):
+        response = client.post(
+            "/api/v1/audio/text-to-speech",
+            json={"model": "Silero", "body": "Hello.", "sample_rate": sample_rate},
+        )
+        assert response.status_code == 400
+        assert FakeTTS.synthesized == 0
+
+    def test_unknown_model(self, client):
+        response = client.post(
+            "/api/v1/audio/text-to-speech", json={"model": "Void", "body": "Hello."}
+        )
+        assert response.status_code == 400
+
+
+class TestSpeechCache:
+    @pytest.fixture()
+    def cache(self, client, monkeypatch, tmp_path):
+        cache = SpeechCache(directory=str(tmp_path), memory_size=800000)
+        monkeypatch.setattr(http_service, "tts_cache", cache)
+        return cache
+
+    def post(self, client, **kwargs):
+        return client.post(
+            "/api/v1/audio/text-to-speech",
+            json={"model": "Silero", "body": "Hello.", "sample_rate": 8000},
+            **kwargs,
+        )
+
+    def test_hits(self, client, cache):
+        miss = self.post(client)
+        assert miss.headers["X-TTS-Cache"] == "miss"
+        hit = self.post(client)
+        assert hit.headers["X-TTS-Cache"] == "memory"
+        assert hit.data == miss.data
+        cache._memory.clear()
+        hit = self.post(client)
+        assert hit.headers["X-TTS-Cache"] == "disk"
+        assert hit.data == miss.data
+        assert FakeTTS.synthesized == 1
+
+    def test_ranges(self, client, cache):
+        response = self.post(client)
+        audio = response.data
+        url = response.headers["Content-Location"]
+        for source in ["memory", "disk"]:
+            if source == "disk":
+                cache._memory.clear()
+            response = client.get(url, headers={"Range": "bytes=44-99"})
+            assert response.status_code == 206
+            assert response.data == audio[44:100]
+            assert response.headers["Content-Range"] == f"bytes 44-99/{len(audio)}"
+            # The key addresses the content, so it is the entity tag.
+            etag = response.headers["ETag"]
+            response = client.get(url, headers={"If-None-Match": etag})
+            assert response.status_code == 304
+        assert client.get("/api/v1/audio/speech/void").status_code == 404
+
+    def test_stream_cached(self, client, cache):
+        streamed = client.post(
+            "/api/v1/audio/text-to-speech",
+            json={
+                "model": "Silero",
+                "body": "Hello. How are you?",
+                "sample_rate": 8000,
+                "is_streaming": True,
+                "format": "pcm",
+            },
+        )
+        assert streamed.headers["X-TTS-Cache"] == "miss"
+        # The speech is cached once it is fully sent.
+        streamed_audio = streamed.data
+        response = client.post(
+            "/api/v1/audio/text-to-speech",
+            json={
+                "model": "Silero",
+                "body": "Hello. How are you?",
+                "sample_rate": 8000,
+                "is_streaming": True,
+                "format": "pcm",
+            },
+        )
+        assert response.headers["X-TTS-Cache"] == "memory"
+        assert response.mimetype == "audio/pcm"
+        assert response.data == streamed_audio
+        assert FakeTTS.synthesized == 2
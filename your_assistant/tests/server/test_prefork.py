@@ -0,0 +1,118 @@
+"""Test the pre-fork server.
+Run this test with command: pytest your_assistant/tests/server/test_prefork.py
+"""
+import json
+import os
+import signal
+import threading
+import time
+import urllib.request
+
+import pytest
+from flask import Flask
+
+from your_assistant.server.prefork import PreforkServer
+
+# The number of times the shared state was loaded, as seen by the workers.
+generation = 0
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        assert time.perf_counter() < deadline, "The condition was never met."
+        time.sleep(0.01)
+
+
+def children(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return {int(child) for child in f.read().split()}
+
+
+@pytest.fixture()
+def server():
+    app = Flask("Prefork Test")
+
+    @app.route("/")
+    def index():
+        return {"pid": os.getpid(), "generation": generation}
+
+    @app.route("/slow")
+    def slow():
+        time.sleep(0.5)
+        return {"pid": os.getpid()}
+
+    def preload():
+        global generation
+        generation += 1
+
+    server = PreforkServer(
+        app, host="127.0.0.1", port=0, workers=2, preload=preload, graceful_timeout=5
+    )
+    port = server.bind()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            server.serve()
+        finally:
+            os._exit(0)
+    server.socket.close()
+    wait_for(lambda: len(children(pid)) == 2)
+    yield pid, f"http://127.0.0.1:{port}"
+    try:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    except (ProcessLookupError, ChildProcessError):
+        # The test stopped the server.
+        pass
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.loads(response.read())
+
+
+class TestPreforkServer:
+    def test_serve(self, server):
+        pid, url = server
+        workers = children(pid)
+        for _ in range(5):
+            response = get(url)
+            assert response["pid"] in workers
+            assert response["generation"] == 1
+
+    def test_restart_dead_worker(self, server):
+        pid, url = server
+        dead = children(pid).pop()
+        os.kill(dead, signal.SIGKILL)
+        wait_for(lambda: len(children(pid) - {dead}) == 2)
+        assert get(url)["pid"] in children(pid)
+
+    def test_reload(self, server):
+        pid, url = server
+        old_workers = children(pid)
+        os.kill(pid, signal.SIGHUP)
+        wait_for(lambda: len(children(pid) - old_workers) == 2)
+        wait_for(lambda: not children(pid) & old_workers)
+        response = get(url)
+        assert response["generation"] == 2
+        assert response["pid"] not in old_workers
+
+    def test_graceful_stop(self, server):
+        pid, url = server
+        responses = []
+        request = threading.Thread(target=lambda: responses.append(get(f"{url}/slow")))
+        request.start()
+        time.sleep(0.2)
+        start = time.perf_counter()
+        os.kill(pid, signal.SIGTERM)
+        request.join()
+        _, status = os.waitpid(pid, 0)
+        # The request in flight finished, and the workers did not wait to be killed.
+        assert len(responses) == 1
+        assert os.waitstatus_to_exitcode(status) == 0
+        assert time.perf_counter() - start < 3
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            PreforkServer(Flask("Prefork Test"), host="127.0.0.1", port=0, workers=0)